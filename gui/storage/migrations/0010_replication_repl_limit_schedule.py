@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0009_disk_disk_passwd'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replication',
+            name='repl_limit_schedule',
+            field=models.CharField(blank=True, help_text='Change the replication speed limit over the week, overriding Limit. Space separated [Day-]HH:MM,RATE entries, e.g. "Mon-08:00,512 Fri-18:00,off" or "08:00,1M 18:00,off". Rate in kilobytes/second unless suffixed with B, K, M or G.', max_length=500, verbose_name='Limit Schedule'),
+        ),
+    ]
@@ -843,6 +843,16 @@ class Replication(Model):
             "Limit the replication speed. Unit in "
             "kilobits/second. 0 = unlimited."),
     )
+    repl_limit_schedule = models.CharField(
+        max_length=500,
+        blank=True,
+        verbose_name=_("Limit Schedule"),
+        help_text=_(
+            "Change the replication speed limit over the week, overriding "
+            "Limit. Space separated [Day-]HH:MM,RATE entries, e.g. "
+            "\"Mon-08:00,512 Fri-18:00,off\" or \"08:00,1M 18:00,off\". "
+            "Rate in kilobytes/second unless suffixed with B, K, M or G."),
+    )
     repl_begin = models.TimeField(
         default=time(hour=0),
         verbose_name=_("Begin"),
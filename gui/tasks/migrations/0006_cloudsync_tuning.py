@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0005_merge_20180617_1001'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cloudsync',
+            name='transfers',
+            field=models.IntegerField(blank=True, help_text='Number of files transferred in parallel. Leave empty for the provider default.', null=True, verbose_name='Transfers'),
+        ),
+        migrations.AddField(
+            model_name='cloudsync',
+            name='checkers',
+            field=models.IntegerField(blank=True, help_text='Number of files checked in parallel. Leave empty for the provider default.', null=True, verbose_name='Checkers'),
+        ),
+        migrations.AddField(
+            model_name='cloudsync',
+            name='chunk_size',
+            field=models.IntegerField(blank=True, help_text='Size of the parts of multipart uploads. Leave empty for the provider default.', null=True, verbose_name='Chunk size (MiB)'),
+        ),
+        migrations.AddField(
+            model_name='cloudsync',
+            name='buffer_size',
+            field=models.IntegerField(blank=True, help_text='In-memory buffer of every transfer. Leave empty for 16 MiB.', null=True, verbose_name='Buffer size (MiB)'),
+        ),
+        migrations.AddField(
+            model_name='cloudsync',
+            name='bwlimit',
+            field=models.CharField(blank=True, help_text='Space separated [Day-]HH:MM,RATE entries, e.g. "Mon-08:00,512 Fri-18:00,off" or "08:00,1M 18:00,off". Rate in kilobytes/second unless suffixed with B, K, M or G.', max_length=500, verbose_name='Bandwidth limit'),
+        ),
+    ]
@@ -111,6 +111,46 @@ class CloudSync(Model):
             "These arguments will be passed to rclone."
             "<br>See <a href=\"https://rclone.org/docs/\">https://rclone.org/docs/</a> for help"),
     )
+    transfers = models.IntegerField(
+        null=True,
+        blank=True,
+        verbose_name=_("Transfers"),
+        help_text=_(
+            "Number of files transferred in parallel. "
+            "Leave empty for the provider default."),
+    )
+    checkers = models.IntegerField(
+        null=True,
+        blank=True,
+        verbose_name=_("Checkers"),
+        help_text=_(
+            "Number of files checked in parallel. "
+            "Leave empty for the provider default."),
+    )
+    chunk_size = models.IntegerField(
+        null=True,
+        blank=True,
+        verbose_name=_("Chunk size (MiB)"),
+        help_text=_(
+            "Size of the parts of multipart uploads. "
+            "Leave empty for the provider default."),
+    )
+    buffer_size = models.IntegerField(
+        null=True,
+        blank=True,
+        verbose_name=_("Buffer size (MiB)"),
+        help_text=_(
+            "In-memory buffer of every transfer. Leave empty for 16 MiB."),
+    )
+    bwlimit = models.CharField(
+        max_length=500,
+        blank=True,
+        verbose_name=_("Bandwidth limit"),
+        help_text=_(
+            "Space separated [Day-]HH:MM,RATE entries, e.g. "
+            "\"Mon-08:00,512 Fri-18:00,off\" or \"08:00,1M 18:00,off\". "
+            "Rate in kilobytes/second unless suffixed with B, K, M or G."),
+    )
     minute = models.CharField(
         max_length=100,
         default="00",
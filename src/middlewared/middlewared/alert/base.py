@@ -4,6 +4,9 @@ import hashlib
 import json
 import logging
 import os
+import threading
+
+import requests
 
 from middlewared.alert.schedule import IntervalSchedule
 
@@ -72,6 +75,9 @@ class AlertSource:
 
     run_on_backup_node = True
 
+    # Seconds `check` is allowed to run, the source is considered unavailable after that
+    run_timeout = 120
+
     def __init__(self, middleware):
         self.middleware = middleware
 
@@ -110,6 +116,9 @@ class AlertService:
 
         self.logger = logging.getLogger(self.__class__.__name__)
 
+        self._session = None
+        self._session_lock = threading.Lock()
+
     @classmethod
     def name(cls):
         return cls.__name__.replace("AlertService", "")
@@ -118,6 +127,21 @@ class AlertService:
     def validate(cls, attributes):
         cls.schema.validate(attributes)
 
+    @property
+    def session(self):
+        """
+        HTTP session kept for the lifetime of the alert service so connections are reused between sends.
+        """
+        with self._session_lock:
+            if self._session is None:
+                self._session = requests.Session()
+            return self._session
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
     async def send(self, alerts, gone_alerts, new_alerts):
         raise NotImplementedError
 
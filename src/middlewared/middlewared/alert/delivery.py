@@ -0,0 +1,207 @@
+from collections import defaultdict, deque
+from datetime import datetime
+import logging
+import time
+
+from middlewared.alert.base import Alert, AlertLevel
+
+__all__ = ["Delivery", "DeliveryOutbox", "serialize_alert", "deserialize_alert"]
+
+logger = logging.getLogger(__name__)
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def serialize_alert(alert):
+    # Alert datetimes are naive UTC, store them as timestamps so they load back the same
+    return dict(alert.__dict__,
+                datetime=(alert.datetime - EPOCH).total_seconds() if alert.datetime is not None else None,
+                level=alert.level.value if alert.level is not None else None)
+
+
+def deserialize_alert(data):
+    data = dict(data)
+    if data.get("level") is not None:
+        data["level"] = AlertLevel(data["level"])
+    if data.get("datetime") is not None:
+        data["datetime"] = datetime.utcfromtimestamp(data["datetime"])
+    return Alert(**data)
+
+
+class Delivery:
+    """
+    Alerts to be sent to a single alert service.
+    """
+
+    def __init__(self, service_id, service_type, alerts, gone_alerts, new_alerts, attempts=0, next_attempt=0,
+                 created=None):
+        self.service_id = service_id
+        self.service_type = service_type
+        self.alerts = alerts
+        self.gone_alerts = gone_alerts
+        self.new_alerts = new_alerts
+        self.attempts = attempts
+        self.next_attempt = next_attempt
+        self.created = created if created is not None else time.time()
+
+    def __repr__(self):
+        return (f"<Delivery service_id={self.service_id!r} service_type={self.service_type!r} "
+                f"attempts={self.attempts!r}>")
+
+    def dump(self):
+        return {
+            "service_id": self.service_id,
+            "service_type": self.service_type,
+            "alerts": [serialize_alert(alert) for alert in self.alerts],
+            "gone_alerts": [serialize_alert(alert) for alert in self.gone_alerts],
+            "new_alerts": [serialize_alert(alert) for alert in self.new_alerts],
+            "attempts": self.attempts,
+            "next_attempt": self.next_attempt,
+            "created": self.created,
+        }
+
+    @classmethod
+    def load(cls, data):
+        return cls(
+            data["service_id"],
+            data["service_type"],
+            [deserialize_alert(alert) for alert in data["alerts"]],
+            [deserialize_alert(alert) for alert in data["gone_alerts"]],
+            [deserialize_alert(alert) for alert in data["new_alerts"]],
+            data["attempts"],
+            data["next_attempt"],
+            data["created"],
+        )
+
+
+class DeliveryOutbox:
+    """
+    Pending deliveries, one FIFO queue per alert service.
+
+    Deliveries for a service are sent in order: a failed delivery is retried with exponential backoff
+    and the ones queued after it wait for it to succeed or be given up on after `max_attempts`.
+    """
+
+    def __init__(self, base_delay=30, max_delay=3600, max_attempts=10, max_size=1000):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.max_size = max_size
+        self.queues = defaultdict(deque)
+        self.stats = defaultdict(lambda: {
+            "sent": 0,
+            "failed": 0,
+            "retried": 0,
+            "dropped": 0,
+            "last_success": None,
+            "last_failure": None,
+            "last_latency": None,
+            "max_latency": 0,
+            "total_latency": 0,
+        })
+        self.changed = False
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def add(self, delivery):
+        queue = self.queues[delivery.service_id]
+        if len(queue) >= self.max_size:
+            dropped = queue.popleft()
+            self.stats[dropped.service_type]["dropped"] += 1
+            logger.warning("Too many pending deliveries for alert service %r, dropping oldest", dropped.service_type)
+        queue.append(delivery)
+        self.changed = True
+
+    def remove_service(self, service_id):
+        """
+        Drop pending deliveries of a service that no longer exists.
+        """
+        if self.queues.pop(service_id, None):
+            self.changed = True
+
+    def due(self, now=None):
+        """
+        Returns {service_id: [delivery, ...]} for each service whose oldest delivery is due.
+        """
+        now = time.time() if now is None else now
+        return {
+            service_id: list(queue)
+            for service_id, queue in self.queues.items()
+            if queue and queue[0].next_attempt <= now
+        }
+
+    def next_due(self):
+        return min((queue[0].next_attempt for queue in self.queues.values() if queue), default=None)
+
+    def succeeded(self, delivery, latency, now=None):
+        self.__remove(delivery)
+
+        stats = self.stats[delivery.service_type]
+        stats["sent"] += 1
+        if delivery.attempts:
+            stats["retried"] += 1
+        stats["last_success"] = time.time() if now is None else now
+        stats["last_latency"] = latency
+        stats["max_latency"] = max(stats["max_latency"], latency)
+        stats["total_latency"] += latency
+
+    def failed(self, delivery, now=None):
+        """
+        Reschedule failed `delivery`, returns False if it was given up on.
+        """
+        now = time.time() if now is None else now
+
+        stats = self.stats[delivery.service_type]
+        stats["failed"] += 1
+        stats["last_failure"] = now
+
+        delivery.attempts += 1
+        self.changed = True
+        if delivery.attempts >= self.max_attempts:
+            self.__remove(delivery)
+            stats["dropped"] += 1
+            return False
+
+        delivery.next_attempt = now + self.backoff(delivery.attempts)
+        return True
+
+    def backoff(self, attempts):
+        return min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+
+    def __remove(self, delivery):
+        queue = self.queues.get(delivery.service_id)
+        if queue:
+            try:
+                queue.remove(delivery)
+            except ValueError:
+                pass
+            if not queue:
+                del self.queues[delivery.service_id]
+        self.changed = True
+
+    def dump(self):
+        return [delivery.dump() for queue in self.queues.values() for delivery in queue]
+
+    def load(self, data):
+        for item in data:
+            try:
+                delivery = Delivery.load(item)
+            except Exception:
+                logger.warning("Invalid pending alert delivery %r", item, exc_info=True)
+                continue
+            self.queues[delivery.service_id].append(delivery)
+
+    def get_stats(self):
+        result = {}
+        for service_type, stats in self.stats.items():
+            result[service_type] = dict(stats, average_latency=(stats["total_latency"] / stats["sent"]
+                                                                if stats["sent"] else None))
+        pending = defaultdict(int)
+        for queue in self.queues.values():
+            for delivery in queue:
+                pending[delivery.service_type] += 1
+        for service_type, count in pending.items():
+            result.setdefault(service_type, {})["pending"] = count
+        return result
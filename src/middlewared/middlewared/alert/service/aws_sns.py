@@ -15,15 +15,20 @@ class AWSSNSAlertService(ThreadedAlertService):
         Str("aws_secret_access_key"),
     )
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.client = None
+
     def send_sync(self, alerts, gone_alerts, new_alerts):
-        client = boto3.client(
-            "sns",
-            region_name=self.attributes["region"],
-            aws_access_key_id=self.attributes["aws_access_key_id"],
-            aws_secret_access_key=self.attributes["aws_secret_access_key"],
-        )
+        if self.client is None:
+            self.client = boto3.client(
+                "sns",
+                region_name=self.attributes["region"],
+                aws_access_key_id=self.attributes["aws_access_key_id"],
+                aws_secret_access_key=self.attributes["aws_secret_access_key"],
+            )
 
-        client.publish(
+        self.client.publish(
             TopicArn=self.attributes["topic_arn"],
             Subject="Alerts",
             Message=format_alerts(alerts, gone_alerts, new_alerts),
@@ -1,5 +1,4 @@
 import json
-import requests
 
 from middlewared.alert.base import ThreadedAlertService, format_alerts
 from middlewared.schema import Dict, Str
@@ -19,7 +18,7 @@ class HtpChatAlertService(ThreadedAlertService):
 
     def send_sync(self, alerts, gone_alerts, new_alerts):
         base_url = self.attributes["base_url"] or "https://api.hipchat.com"
-        r = requests.post(
+        r = self.session.post(
             f"{base_url}/v2/room/{self.attributes['room_id']}/notification",
             params={"auth_token": self.attributes["auth_token"]},
             headers={"Content-type": "application/json"},
@@ -16,10 +16,15 @@ class InfluxDBAlertService(ThreadedAlertService):
         Str("series_name"),
     )
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.client = None
+
     def send_sync(self, alerts, gone_alerts, new_alerts):
-        client = InfluxDBClient(self.attributes["host"], 8086, self.attributes["username"], self.attributes["password"],
-                                self.attributes["database"])
-        client.write_points([
+        if self.client is None:
+            self.client = InfluxDBClient(self.attributes["host"], 8086, self.attributes["username"],
+                                         self.attributes["password"], self.attributes["database"])
+        self.client.write_points([
             {
                 "measurement": self.attributes["series_name"],
                 "tags": {},
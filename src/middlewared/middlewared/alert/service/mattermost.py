@@ -1,5 +1,4 @@
 import json
-import requests
 
 from middlewared.alert.base import ThreadedAlertService, format_alerts
 from middlewared.schema import Dict, Str
@@ -19,7 +18,7 @@ class MattermostAlertService(ThreadedAlertService):
     )
 
     def send_sync(self, alerts, gone_alerts, new_alerts):
-        r = requests.post(
+        r = self.session.post(
             self.attributes["url"],
             headers={"Content-type": "application/json"},
             data=json.dumps({
@@ -1,5 +1,4 @@
 import json
-import requests
 
 from middlewared.alert.base import ProThreadedAlertService, ellipsis
 from middlewared.schema import Dict, Str
@@ -15,7 +14,7 @@ class OpsGenieAlertService(ProThreadedAlertService):
     )
 
     def create_alert(self, alert):
-        r = requests.post(
+        r = self.session.post(
             "https://api.opsgenie.com/v2/alerts",
             headers={"Authorization": f"GenieKey {self.attributes['api_key']}",
                      "Content-type": "application/json"},
@@ -29,7 +28,7 @@ class OpsGenieAlertService(ProThreadedAlertService):
         r.raise_for_status()
 
     def delete_alert(self, alert):
-        r = requests.delete(
+        r = self.session.delete(
             "https://api.opsgenie.com/v2/alerts/" + self._alert_id(alert),
             params={"identifierType": "alias"},
             headers={"Authorization": f"GenieKey {self.attributes['api_key']}"},
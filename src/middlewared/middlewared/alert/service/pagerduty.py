@@ -1,5 +1,4 @@
 import json
-import requests
 
 from middlewared.alert.base import ProThreadedAlertService, ellipsis
 from middlewared.schema import Dict, Str
@@ -15,7 +14,7 @@ class PagerDutyAlertService(ProThreadedAlertService):
     )
 
     def create_alert(self, alert):
-        r = requests.post(
+        r = self.session.post(
             "https://events.pagerduty.com/generic/2010-04-15/create_event.json",
             headers={"Content-type": "application/json"},
             data=json.dumps({
@@ -30,7 +29,7 @@ class PagerDutyAlertService(ProThreadedAlertService):
         r.raise_for_status()
 
     def delete_alert(self, alert):
-        r = requests.post(
+        r = self.session.post(
             "https://events.pagerduty.com/generic/2010-04-15/create_event.json",
             headers={"Content-type": "application/json"},
             data=json.dumps({
@@ -1,5 +1,4 @@
 import json
-import requests
 
 from middlewared.alert.base import ProThreadedAlertService
 from middlewared.schema import Dict, Str
@@ -15,7 +14,7 @@ class VictorOpsAlertService(ProThreadedAlertService):
     )
 
     def create_alert(self, alert):
-        r = requests.post(
+        r = self.session.post(
             f"https://alert.victorops.com/integrations/generic/20131114/alert/{self.attributes['api_key']}/"
             f"{self.attributes['routing_key']}",
             headers={"Content-type": "application/json"},
@@ -30,7 +29,7 @@ class VictorOpsAlertService(ProThreadedAlertService):
         r.raise_for_status()
 
     def delete_alert(self, alert):
-        r = requests.post(
+        r = self.session.post(
             f"https://alert.victorops.com/integrations/generic/20131114/alert/{self.attributes['api_key']}/"
             f"{self.attributes['routing_key']}",
             headers={"Content-type": "application/json"},
@@ -1,21 +1,18 @@
-import libzfs
-
-from middlewared.alert.base import Alert, AlertLevel, ThreadedAlertSource
+from middlewared.alert.base import Alert, AlertLevel, AlertSource
 from middlewared.alert.schedule import CrontabSchedule
 
 
-class ScrubPausedAlertSource(ThreadedAlertSource):
+class ScrubPausedAlertSource(AlertSource):
     level = AlertLevel.WARNING
     title = "Scrub is paused"
 
     schedule = CrontabSchedule(hour=3)
 
-    def check_sync(self):
+    async def check(self):
         alerts = []
-        with libzfs.ZFS() as zfs:
-            for pool in zfs.pools:
-                if pool.scrub.pause is not None:
-                    alerts.append(Alert(title="Scrub for pool %r is paused",
-                                        args=pool.name,
-                                        key=[pool.name]))
+        for pool in (await self.middleware.call("zfs.pool.health"))["pools"].values():
+            if pool["scrub_paused"]:
+                alerts.append(Alert(title="Scrub for pool %r is paused",
+                                    args=pool["name"],
+                                    key=[pool["name"]]))
         return alerts
@@ -15,6 +15,8 @@ class SMARTAlertSource(ThreadedAlertSource):
     schedule = IntervalSchedule(timedelta(minutes=5))
 
     def check_sync(self):
+        # Messages are the problems smartd reported for each disk (e.g. failed self-tests, increasing
+        # attributes), not SMART data sampled by `smart.collect_all`, so they are still read from smartd's store
         alerts = []
 
         with SmartAlert() as sa:
@@ -11,11 +11,19 @@ class VolumeStatusAlertSource(AlertSource):
         if not await self.enabled():
             return
 
+        health = (await self.middleware.call("zfs.pool.health"))["pools"]
+
         alerts = []
-        for pool in await self.middleware.call("pool.query"):
-            if not pool["is_decrypted"]:
+        for pool in await self.middleware.call("datastore.query", "storage.volume", [], {"prefix": "vol_"}):
+            if pool["name"] in health:
+                if health[pool["name"]]["healthy"]:
+                    continue
+            # Pools that failed to import are not in the health snapshot and are unhealthy as well, unless they are
+            # encrypted and locked
+            elif pool["encrypt"] > 0 and not await self.middleware.call("pool.is_decrypted", pool["id"]):
                 continue
 
+            # Only unhealthy pools need `zpool status` for a description of the problem
             state, status = await self.middleware.call("notifier.zpool_status", pool["name"])
             if state != "HEALTHY":
                 if not (await self.middleware.call("system.is_freenas")):
@@ -52,3 +52,90 @@ async def get_smartctl_args(disk, device):
         args = args + ["-d", "sat"]
 
     return args
+
+
+RE_ATTRIBUTE = re.compile(
+    r"^\s*(?P<id>\d+)\s+(?P<name>\S+)\s+(?P<flags>0x[0-9a-fA-F]+)\s+(?P<value>\d+)\s+(?P<worst>\d+)\s+"
+    r"(?P<thresh>\S+)\s+(?P<type>\S+)\s+(?P<updated>\S+)\s+(?P<when_failed>\S+)\s+(?P<raw_value>.+?)\s*$"
+)
+RE_INFO = re.compile(r"^(?P<key>[A-Za-z][^:]+?):\s+(?P<value>.*?)\s*$")
+RE_NUMBER = re.compile(r"^[\d,]+")
+
+
+def _number(value):
+    match = RE_NUMBER.match(value or "")
+    if match is None:
+        return None
+    try:
+        return int(match.group(0).replace(",", ""))
+    except ValueError:
+        return None
+
+
+def parse_smartctl(output):
+    """
+    Parse `smartctl -a` output of ATA, SCSI and NVMe devices.
+
+    Returns:
+        dict(model, serial, firmware, capacity, rotation_rate, smart_enabled, health,
+             temperature, power_on_hours, attributes)
+    """
+    info = {}
+    attributes = []
+    for line in output.splitlines():
+        m = RE_ATTRIBUTE.match(line)
+        if m:
+            attribute = m.groupdict()
+            for k in ("id", "value", "worst"):
+                attribute[k] = int(attribute[k])
+            attribute["thresh"] = _number(attribute["thresh"])
+            attribute["raw"] = _number(attribute["raw_value"])
+            attributes.append(attribute)
+            continue
+
+        m = RE_INFO.match(line)
+        if m:
+            # First value wins, e.g. "SMART support is:" is printed twice
+            info.setdefault(m.group("key").lower(), m.group("value"))
+
+    def get(*keys):
+        for key in keys:
+            if key in info:
+                return info[key]
+
+    smart_enabled = None
+    for line in output.splitlines():
+        if line.startswith("SMART support is:"):
+            if "Enabled" in line:
+                smart_enabled = True
+            elif "Disabled" in line:
+                smart_enabled = False
+
+    health = get("smart overall-health self-assessment test result", "smart health status")
+
+    temperature = get("current drive temperature", "temperature")
+    temperature = _number(temperature) if temperature else None
+    by_name = {attribute["name"]: attribute for attribute in attributes}
+    if temperature is None:
+        for name in ("Temperature_Celsius", "Airflow_Temperature_Cel"):
+            if name in by_name:
+                temperature = by_name[name]["raw"]
+                break
+
+    power_on_hours = get("power on hours", "accumulated power on time, hours:minutes")
+    power_on_hours = _number(power_on_hours) if power_on_hours else None
+    if power_on_hours is None and "Power_On_Hours" in by_name:
+        power_on_hours = by_name["Power_On_Hours"]["raw"]
+
+    return {
+        "model": get("device model", "model number", "product"),
+        "serial": get("serial number"),
+        "firmware": get("firmware version", "revision"),
+        "capacity": _number(get("user capacity", "total nvm capacity") or ""),
+        "rotation_rate": get("rotation rate"),
+        "smart_enabled": smart_enabled,
+        "health": health,
+        "temperature": temperature,
+        "power_on_hours": power_on_hours,
+        "attributes": attributes,
+    }
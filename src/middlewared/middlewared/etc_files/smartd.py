@@ -52,58 +52,18 @@ def get_smartd_config(disk):
         config += f" -m root"
 
     config += " -M exec /usr/local/www/freenasUI/tools/smart_alert.py"
-
-    if disk.get('smarttest_type'):
-        config += f"\\\n-s {disk['smarttest_type']}/" + get_smartd_schedule(disk) + "\\\n"
-
     config += f" {disk['disk_smartoptions']}"
 
     return config
 
 
-def get_smartd_schedule(disk):
-    return "/".join([
-        get_smartd_schedule_piece(disk['smarttest_month'], 1, 12, dict(zip([
-            "jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"
-        ], range(1, 13)))),
-        get_smartd_schedule_piece(disk['smarttest_daymonth'], 1, 31),
-        get_smartd_schedule_piece(disk['smarttest_dayweek'], 1, 7, dict(zip([
-            "mon", "tue", "wed", "thu", "fri", "sat", "sun"
-        ], range(1, 8)))),
-        get_smartd_schedule_piece(disk['smarttest_hour'], 0, 23, "%02d"),
-    ])
-
-
-def get_smartd_schedule_piece(value, min, max, enum=None):
-    enum = enum or {}
-
-    width = len(str(max))
-
-    if value == "*":
-        return "." * width
-    m = re.match("\*/([0-9]+)", value)
-    if m:
-        d = int(m.group(1))
-        if d == 1:
-            return "." * width
-        values = [v for v in range(min, max + 1) if v % d == 0]
-    else:
-        values = list(filter(None, map(lambda s: enum.get(s.lower(), int(s) if re.match("([0-9]+)$", s) else None),
-                                       value.split(","))))
-        if values == list(range(min, max + 1)):
-            return "." * width
-
-    return "(" + "|".join([f"%0{width}d" % v for v in values]) + ")"
-
-
 async def render(service, middleware):
     smart_config = await middleware.call("datastore.query", "services.smart", None, {"get": True})
 
+    # SMART tests are started by the data protection scheduler, smartd only monitors disks
     disks = await middleware.call("datastore.sql", """
         SELECT *
         FROM storage_disk d
-        LEFT JOIN tasks_smarttest_smarttest_disks sd ON sd.disk_id = d.disk_identifier
-        LEFT JOIN tasks_smarttest s ON sd.smarttest_id = s.id
         WHERE disk_togglesmart = 1 AND disk_expiretime IS NULL
     """)
 
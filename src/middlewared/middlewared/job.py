@@ -493,3 +493,41 @@ class JobProgressBuffer:
 
         self.pending_update_body = None
         self.pending_update = None
+
+
+class JobLogsBuffer:
+    """
+    This wrapper for `job.logs_fd` buffers writes and does them from a thread every `interval` seconds or once
+    `size` bytes are pending so jobs that log a lot do not block the event loop.
+    """
+
+    def __init__(self, job, interval=1, size=65536):
+        self.job = job
+
+        self.interval = interval
+        self.size = size
+
+        self.buffer = bytearray()
+        self.lock = asyncio.Lock()
+        self.pending_flush = None
+
+    async def write(self, data):
+        self.buffer += data
+
+        if len(self.buffer) >= self.size:
+            await self.flush()
+        elif self.pending_flush is None:
+            self.pending_flush = asyncio.get_event_loop().call_later(
+                self.interval, lambda: asyncio.ensure_future(self.flush())
+            )
+
+    async def flush(self):
+        if self.pending_flush is not None:
+            self.pending_flush.cancel()
+            self.pending_flush = None
+
+        # Keep writes in order
+        async with self.lock:
+            data, self.buffer = bytes(self.buffer), bytearray()
+            if data:
+                await self.job.middleware.run_in_thread(self.job.logs_fd.write, data)
@@ -1,6 +1,12 @@
+import atexit
+import copy
+import json
 import os
 import logging
 import logging.handlers
+import queue
+import threading
+import time
 
 from logging.config import dictConfig
 from .utils import sw_version, sw_version_is_stable
@@ -19,6 +25,16 @@ logging.getLogger('ws4py').setLevel(logging.WARN)
 LOGFILE = '/var/log/middlewared.log'
 logging.TRACE = 6
 
+# Maximum number of records waiting to be written by the logging thread.
+# Records below WARNING are dropped (and accounted for) once this is reached
+# so that logging can never block the event loop.
+QUEUE_SIZE = 10000
+# Maximum number of records written between two flushes of the log file.
+BATCH_SIZE = 512
+# Records below WARNING allowed per logger per second (and burst size).
+RATE_LIMIT = 200
+RATE_LIMIT_BURST = 1000
+
 
 def trace(self, message, *args, **kws):
     if self.isEnabledFor(logging.TRACE):
@@ -163,6 +179,28 @@ class LoggerStream(object):
             self.logger.debug(line.rstrip())
 
 
+class JsonFormatter(logging.Formatter):
+    """Format log records as JSON lines"""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record, self.datefmt),
+            'created': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'function': record.funcName,
+            'lineno': record.lineno,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            # Records that went through the logging queue only have the formatted traceback
+            data['exception'] = record.exc_text
+        return json.dumps(data)
+
+
 class ErrorProneRotatingFileHandler(logging.handlers.RotatingFileHandler):
     def handleError(self, record):
         try:
@@ -173,6 +211,153 @@ class ErrorProneRotatingFileHandler(logging.handlers.RotatingFileHandler):
             # involves logging
             pass
 
+    def handle_batch(self, records):
+        """
+        Write a batch of records flushing the stream only once at the end.
+        """
+        records = [record for record in records if self.filter(record)]
+        if not records:
+            return
+
+        self.acquire()
+        try:
+            for record in records:
+                try:
+                    if self.stream is None:
+                        self.stream = self._open()
+                    if self.shouldRollover(record):
+                        self.stream.flush()
+                        self.doRollover()
+                    self.stream.write(self.format(record) + self.terminator)
+                except Exception:
+                    self.handleError(record)
+            try:
+                self.stream.flush()
+            except Exception:
+                self.handleError(records[-1])
+        finally:
+            self.release()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Per-logger token bucket for records below WARNING.
+
+    Records exceeding the rate are dropped and counted; the number of dropped
+    records is reported once the logger is allowed to log again.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_LIMIT_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.dropped = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(record.name, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[record.name] = (tokens, now)
+                self.dropped[record.name] = self.dropped.get(record.name, 0) + 1
+                return False
+            self.buckets[record.name] = (tokens - 1, now)
+            dropped = self.dropped.pop(record.name, 0)
+
+        if dropped:
+            record.msg = f'[{dropped} messages dropped by rate limit] {record.msg}'
+        return True
+
+    def stats(self):
+        with self.lock:
+            return dict(self.dropped)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hand records over to the logging thread without ever blocking the caller.
+    """
+
+    def __init__(self, queue_):
+        super().__init__(queue_)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Unlike `QueueHandler.prepare`, keep the formatted traceback in `exc_text` instead of appending it to the
+        message so that formatters of the writer thread (e.g. `JsonFormatter`) can still output it on its own.
+        """
+        record = copy.copy(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging._defaultFormatter.formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno < logging.WARNING:
+                self.dropped += 1
+                return
+            # Do not lose warnings and errors, wait for the writer thread
+            self.queue.put(record)
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """
+    Dedicated writer thread which drains the queue in batches so that handlers
+    supporting `handle_batch` only flush once per batch.
+    """
+
+    def __init__(self, queue_, *handlers, batch_size=BATCH_SIZE):
+        super().__init__(queue_, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        while True:
+            record = self.dequeue(True)
+            batch = [record]
+            while record is not self._sentinel and len(batch) < self.batch_size:
+                try:
+                    record = self.dequeue(False)
+                except queue.Empty:
+                    break
+                batch.append(record)
+
+            stop = batch[-1] is self._sentinel
+            if stop:
+                batch.pop()
+
+            if batch:
+                self.handle_batch(batch)
+
+            for _ in range(len(batch) + (1 if stop else 0)):
+                self.queue.task_done()
+
+            if stop:
+                break
+
+    def handle_batch(self, records):
+        records = [self.prepare(record) for record in records]
+        for handler in self.handlers:
+            batch = [record for record in records if record.levelno >= handler.level]
+            if not batch:
+                continue
+            if hasattr(handler, 'handle_batch'):
+                handler.handle_batch(batch)
+            else:
+                for record in batch:
+                    handler.handle(record)
+
 
 class Logger(object):
     """Pseudo-Class for Logger - Wrapper for logging module"""
@@ -181,7 +366,8 @@ class Logger(object):
         'disable_existing_loggers': False,
         'root': {
             'level': 'NOTSET',
-            'handlers': ['file'],
+            # Records reach the file handler through the logging queue
+            'handlers': [],
         },
         'handlers': {
             'file': {
@@ -200,25 +386,75 @@ class Logger(object):
                 'format': '[%(asctime)s] (%(levelname)s) %(name)s.%(funcName)s():%(lineno)d - %(message)s',
                 'datefmt': '%Y/%m/%d %H:%M:%S',
             },
+            'json': {
+                '()': 'middlewared.logger.JsonFormatter',
+                'datefmt': '%Y/%m/%d %H:%M:%S',
+            },
         },
     }
 
-    def __init__(self, application_name, debug_level=None):
+    queue_handler = None
+    listener = None
+    rate_limit = None
+
+    def __init__(self, application_name, debug_level=None, log_format='text'):
         self.application_name = application_name
         self.debug_level = debug_level or 'DEBUG'
+        self.log_format = log_format
 
     def getLogger(self):
         return logging.getLogger(self.application_name)
 
     def stream(self):
-        for handler in logging.root.handlers:
-            if isinstance(handler, ErrorProneRotatingFileHandler):
-                return handler.stream
+        handler = logging._handlers.get('file')
+        if isinstance(handler, ErrorProneRotatingFileHandler):
+            return handler.stream
+
+    @classmethod
+    def stats(cls):
+        """
+        Returns:
+            dict: state of the logging queue and number of dropped records.
+        """
+        if cls.listener is None:
+            return {'queued': 0, 'dropped_queue_full': 0, 'dropped_rate_limit': {}}
+        return {
+            'queued': cls.listener.queue.qsize(),
+            'dropped_queue_full': cls.queue_handler.dropped,
+            'dropped_rate_limit': cls.rate_limit.stats(),
+        }
+
+    @classmethod
+    def _start_queue(cls, *handlers):
+        """
+        Attach a non-blocking queue handler to the root logger and start the
+        writer thread feeding `handlers`.
+        """
+        cls._stop_queue()
+
+        queue_ = queue.Queue(QUEUE_SIZE)
+        cls.rate_limit = RateLimitFilter()
+        cls.queue_handler = NonBlockingQueueHandler(queue_)
+        cls.queue_handler.addFilter(cls.rate_limit)
+        cls.listener = BatchingQueueListener(queue_, *handlers)
+        cls.listener.start()
+        logging.root.addHandler(cls.queue_handler)
+
+    @classmethod
+    def _stop_queue(cls):
+        if cls.listener is None:
+            return
+        logging.root.removeHandler(cls.queue_handler)
+        cls.listener.stop()
+        cls.listener = None
 
     def _set_output_file(self):
         """Set the output format for file log."""
+        config = copy.deepcopy(self.DEFAULT_LOGGING)
+        if self.log_format == 'json':
+            config['handlers']['file']['formatter'] = 'json'
         try:
-            dictConfig(self.DEFAULT_LOGGING)
+            dictConfig(config)
         except Exception:
             # If something happens during system dataset reconfiguration, we have the chance of not having
             # /var/log present leaving us with "ValueError: Unable to configure handler 'file':
@@ -233,6 +469,10 @@ class Logger(object):
         except OSError:
             pass
 
+        handler = logging._handlers.get('file')
+        if handler is not None:
+            self._start_queue(handler)
+
     def _set_output_console(self):
         """Set the output format for console."""
 
@@ -241,9 +481,12 @@ class Logger(object):
 
         log_format = "[%(asctime)s] (%(levelname)s) %(name)s.%(funcName)s():%(lineno)d - %(message)s"
         time_format = "%Y/%m/%d %H:%M:%S"
-        console_handler.setFormatter(LoggerFormatter(log_format, datefmt=time_format))
+        if self.log_format == 'json':
+            console_handler.setFormatter(JsonFormatter(datefmt=time_format))
+        else:
+            console_handler.setFormatter(LoggerFormatter(log_format, datefmt=time_format))
 
-        logging.root.addHandler(console_handler)
+        self._start_queue(console_handler)
 
     def configure_logging(self, output_option='file'):
         """Configure the log output to file or console.
@@ -258,3 +501,7 @@ class Logger(object):
             self._set_output_file()
 
         logging.root.setLevel(getattr(logging, self.debug_level))
+
+
+# Make sure everything queued gets written before the process exits
+atexit.register(Logger._stop_queue)
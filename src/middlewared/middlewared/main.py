@@ -2,7 +2,7 @@ from .apidocs import app as apidocs_app
 from .client import ejson as json
 from .event import EventSource
 from .job import Job, JobsQueue
-from .pipe import Pipes, Pipe
+from .pipe import BUFFER_SIZE as PIPE_BUFFER_SIZE, Pipes, Pipe, remove_file
 from .restful import RESTfulAPI
 from .schema import ResolverError, Error as SchemaError
 from .service import CallError, CallException, ValidationError, ValidationErrors
@@ -344,22 +344,48 @@ class Application(object):
 
 class FileApplication(object):
 
+    # Seconds a temporary file handed over by a download job can still be downloaded, e.g. to resume with a Range
+    # request
+    FILE_TTL = 600
+
     def __init__(self, middleware, loop):
         self.middleware = middleware
         self.loop = loop
         self.jobs = {}
+        # {job_id: (path, cleanup handle)}
+        self.files = {}
 
     def register_job(self, job_id):
         self.jobs[job_id] = self.middleware.loop.call_later(
             60, lambda: asyncio.ensure_future(self._cleanup_job(job_id)))
 
     async def _cleanup_job(self, job_id):
-        self.jobs[job_id].cancel()
-        del self.jobs[job_id]
+        handle = self.jobs.pop(job_id, None)
+        if handle is None:
+            return
+        handle.cancel()
 
         job = self.middleware.jobs[job_id]
         await job.pipes.close()
 
+    def _register_file(self, job_id, path):
+        self.files[job_id] = (path, self.middleware.loop.call_later(
+            self.FILE_TTL, lambda: asyncio.ensure_future(self._expire_file(job_id))))
+
+    async def _expire_file(self, job_id):
+        path, handle = self.files.pop(job_id)
+        await self.middleware.run_in_thread(remove_file, path)
+
+    def _file_response(self, path, filename, resumable):
+        # sendfile(2) from the page cache, with Range and conditional requests handled by aiohttp
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Content-Disposition': f'attachment; filename="{filename}"',
+        }
+        if resumable:
+            headers['Accept-Ranges'] = 'bytes'
+        return web.FileResponse(path, chunk_size=PIPE_BUFFER_SIZE, headers=headers)
+
     async def download(self, request):
         path = request.path.split('/')
         if not request.path[-1].isdigit():
@@ -389,35 +415,49 @@ class FileApplication(object):
             resp.set_status(401)
             return resp
 
+        if job_id in self.files:
+            return self._file_response(self.files[job_id][0], filename, True)
+
         job = self.middleware.jobs.get(job_id)
         if not job:
             resp = web.Response()
             resp.set_status(404)
             return resp
 
-        if job_id not in self.jobs:
+        # Job is downloaded once, the pipes are closed here after the transfer instead of by `_cleanup_job` as the
+        # transfer can take longer than the time the job waits to be downloaded
+        handle = self.jobs.pop(job_id, None)
+        if handle is None:
             resp = web.Response()
             resp.set_status(410)
             return resp
-
-        resp = web.StreamResponse(status=200, reason='OK', headers={
-            'Content-Type': 'application/octet-stream',
-            'Content-Disposition': f'attachment; filename="{filename}"',
-            'Transfer-Encoding': 'chunked',
-        })
-        await resp.prepare(request)
-
-        def do_copy():
-            while True:
-                read = job.pipes.output.r.read(1048576)
-                if read == b'':
-                    break
-                asyncio.run_coroutine_threadsafe(resp.write(read), loop=self.loop).result()
+        handle.cancel()
 
         try:
-            await self.middleware.run_in_thread(do_copy)
+            reader = await job.pipes.output.reader()
+            read = await reader.read(PIPE_BUFFER_SIZE)
+            if read == b'':
+                # Job handed over a whole file
+                path, temporary = job.pipes.output.take_file()
+                if path is not None:
+                    # Only a temporary file does not change between requests, it is kept to resume the download
+                    if temporary:
+                        self._register_file(job_id, path)
+                    return self._file_response(path, filename, temporary)
+
+            resp = web.StreamResponse(status=200, reason='OK', headers={
+                'Content-Type': 'application/octet-stream',
+                'Content-Disposition': f'attachment; filename="{filename}"',
+                'Transfer-Encoding': 'chunked',
+            })
+            await resp.prepare(request)
+
+            while read != b'':
+                # Waits for the client to take the data before reading more from the job
+                await resp.write(read)
+                read = await reader.read(PIPE_BUFFER_SIZE)
         finally:
-            await self._cleanup_job(job_id)
+            await job.pipes.close()
 
         await resp.drain()
         return resp
@@ -482,23 +522,20 @@ class FileApplication(object):
             resp.set_status(405)
             return resp
 
-        def copy():
-            while True:
-                read = asyncio.run_coroutine_threadsafe(
-                    filepart.read_chunk(1048576),
-                    loop=self.loop,
-                ).result()
-                if read == b'':
-                    break
-                job.pipes.input.w.write(read)
-
         try:
             job = await self.middleware.call(data['method'], *(data.get('params') or []),
                                              pipes=Pipes(input=self.middleware.pipe()))
             try:
-                await self.middleware.run_in_thread(copy)
+                writer = await job.pipes.input.writer()
+                while True:
+                    read = await filepart.read_chunk(PIPE_BUFFER_SIZE)
+                    if read == b'':
+                        break
+                    writer.write(read)
+                    # Stop reading the request while the job is behind
+                    await writer.drain()
             finally:
-                await self.middleware.run_in_thread(job.pipes.input.w.close)
+                await job.pipes.input.close_writer()
         except CallError as e:
             if e.errno == CallError.ENOMETHOD:
                 status_code = 422
@@ -944,10 +981,17 @@ class Middleware(object):
         finally:
             executor.shutdown(wait=False)
 
-    def pipe(self):
-        return Pipe(self)
+    def pipe(self, sendfile=False):
+        return Pipe(self, sendfile)
+
+    async def _call(self, name, serviceobj, methodobj, params=None, app=None, pipes=None, io_thread=True, cache=True):
 
-    async def _call(self, name, serviceobj, methodobj, params=None, app=None, pipes=None, io_thread=True):
+        cache_options = getattr(methodobj, '_cached', None)
+        if cache and cache_options and not hasattr(methodobj, '_job'):
+            return await self.get_service('cache').call_cached(
+                name, cache_options, params or [],
+                functools.partial(self._call, name, serviceobj, methodobj, params, app, pipes, io_thread, False),
+            )
 
         args = []
         if hasattr(methodobj, '_pass_app'):
@@ -1245,9 +1289,13 @@ def main():
         'console',
         'file',
     ], default='console')
+    parser.add_argument('--log-format', choices=[
+        'text',
+        'json',
+    ], default='text')
     args = parser.parse_args()
 
-    _logger = logger.Logger('middleware', args.debug_level)
+    _logger = logger.Logger('middleware', args.debug_level, args.log_format)
     _logger.getLogger()
 
     pidpath = '/var/run/middlewared.pid'
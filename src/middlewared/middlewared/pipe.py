@@ -1,4 +1,10 @@
+import asyncio
+import mmap
 import os
+import shutil
+
+# Size of the blocks copied through pipes, a multiple of the page size
+BUFFER_SIZE = 1024 * 1024
 
 
 class Pipes:
@@ -19,13 +25,133 @@ class Pipes:
 
 
 class Pipe:
-    def __init__(self, middleware):
+    def __init__(self, middleware, sendfile=False):
         self.middleware = middleware
 
         r, w = os.pipe()
         self.r = os.fdopen(r, "rb")
         self.w = os.fdopen(w, "wb")
 
+        # The reader can send whole files by itself (e.g. with sendfile(2) to an HTTP client), see `send_file`
+        self.sendfile = sendfile
+        self.path = None
+        self.temporary = False
+
+        # Transports of `reader` and `writer`, they own a duplicate of the pipe end they are given
+        self.read_transport = None
+        self.write_transport = None
+
     async def close(self):
+        if self.read_transport is not None:
+            self.read_transport.close()
+        if self.write_transport is not None:
+            self.write_transport.close()
         await self.middleware.run_in_thread(self.r.close)
         await self.middleware.run_in_thread(self.w.close)
+        # Temporary file nobody took
+        if self.path is not None and self.temporary:
+            await self.middleware.run_in_thread(remove_file, self.path)
+            self.path = None
+
+    async def close_writer(self):
+        """
+        Close the write end, the reader gets EOF once it has read what was written.
+        """
+        if self.write_transport is not None:
+            # Flushes what `writer` still has buffered before closing
+            self.write_transport.close()
+        await self.middleware.run_in_thread(self.w.close)
+
+    async def send_file(self, path, temporary=False):
+        """
+        Write the contents of `path` to the pipe. A reader that can send files by itself gets `path` instead (see
+        `take_file`) and reads EOF from the pipe.
+
+        `temporary` is a file made for this pipe alone, e.g. a copy of a file that can change while it is sent. It
+        is removed once sent and, as it does not change, it can be sent more than once until then (e.g. to resume a
+        download).
+        """
+        if self.sendfile:
+            self.path = path
+            self.temporary = temporary
+            await self.middleware.run_in_thread(self.w.close)
+            return
+
+        def copy():
+            try:
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, self.w, BUFFER_SIZE)
+                self.w.flush()
+            finally:
+                if temporary:
+                    remove_file(path)
+
+        await self.middleware.run_in_thread(copy)
+
+    def take_file(self):
+        """
+        (path, temporary) of the file given to `send_file`, (None, False) if there is none. Whoever takes a
+        temporary file removes it.
+        """
+        path, temporary = self.path, self.temporary
+        self.path, self.temporary = None, False
+        return path, temporary
+
+    def copy_to_file(self, f):
+        """
+        Copy everything read from the pipe to file object `f` in `BUFFER_SIZE` blocks, from a page-aligned
+        buffer so that the file gets large aligned writes. Returns the number of bytes copied.
+        """
+        buf = mmap.mmap(-1, BUFFER_SIZE)
+        view = memoryview(buf)
+        total = 0
+        try:
+            while True:
+                filled = 0
+                while filled < BUFFER_SIZE:
+                    n = self.r.readinto(view[filled:])
+                    if not n:
+                        break
+                    filled += n
+
+                written = 0
+                while written < filled:
+                    # Unbuffered files can write less than asked
+                    written += f.write(view[written:filled])
+                total += filled
+
+                if filled < BUFFER_SIZE:
+                    return total
+        finally:
+            view.release()
+            buf.close()
+
+    async def reader(self):
+        """
+        `asyncio.StreamReader` on the read end of the pipe, for use in the event loop.
+        """
+        reader = asyncio.StreamReader(limit=BUFFER_SIZE)
+        transport, protocol = await asyncio.get_event_loop().connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(os.dup(self.r.fileno()), "rb")
+        )
+        self.read_transport = transport
+        return reader
+
+    async def writer(self):
+        """
+        `asyncio.StreamWriter` on the write end of the pipe, for use in the event loop. `drain()` waits for the
+        reader to catch up.
+        """
+        loop = asyncio.get_event_loop()
+        transport, protocol = await loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin, os.fdopen(os.dup(self.w.fileno()), "wb")
+        )
+        self.write_transport = transport
+        return asyncio.StreamWriter(transport, protocol, None, loop)
+
+
+def remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
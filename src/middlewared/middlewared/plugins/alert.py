@@ -1,7 +1,10 @@
+import asyncio
+import bisect
 from collections import defaultdict
-import copy
 from datetime import datetime
+import json
 import os
+import time
 import traceback
 
 from freenasUI.support.utils import get_license
@@ -17,6 +20,7 @@ from middlewared.alert.base import (
     ProThreadedAlertService
 )
 from middlewared.alert.base import UnavailableException, AlertService as _AlertService
+from middlewared.alert.delivery import Delivery, DeliveryOutbox
 from middlewared.schema import Dict, Str, Bool, Int, accepts, Patch
 from middlewared.service import (
     ConfigService, CRUDService, Service, ValidationErrors,
@@ -24,10 +28,18 @@ from middlewared.service import (
 )
 from middlewared.service_exception import CallError
 from middlewared.utils import load_modules, load_classes
+from middlewared.utils.asyncio_ import asyncio_map
 
 POLICIES = ["IMMEDIATELY", "HOURLY", "DAILY", "NEVER"]
 DEFAULT_POLICY = "IMMEDIATELY"
 
+# How many alert sources are allowed to run at the same time,
+# can be overridden with `alert.run_sources_concurrency` key of keyvalue store.
+RUN_SOURCES_CONCURRENCY = 8
+
+# How long (seconds) a single delivery to an alert service may take before it is considered failed
+DELIVERY_TIMEOUT = 60
+
 ALERT_SOURCES = {}
 ALERT_SERVICES_FACTORIES = {}
 
@@ -37,24 +49,24 @@ class AlertPolicy:
         self.key = key
 
         self.last_key_value = None
-        self.last_key_value_alerts = defaultdict(lambda: defaultdict(dict))
+        # (node, source, key) -> alert as of `last_key_value`
+        self.last_key_value_alerts = {}
 
     def receive_alerts(self, now, alerts):
+        """
+        `alerts` is a dict of (node, source, key) -> alert.
+        """
         gone_alerts = []
         new_alerts = []
         key = self.key(now)
         if key != self.last_key_value:
-            for node in set(alerts.keys()) | set(self.last_key_value_alerts.keys()):
-                for alert_source_name in set(alerts[node].keys()) | set(self.last_key_value_alerts[node].keys()):
-                    for gone_alert in (set(self.last_key_value_alerts[node][alert_source_name].keys()) -
-                                       set(alerts[node][alert_source_name].keys())):
-                        gone_alerts.append(self.last_key_value_alerts[node][alert_source_name][gone_alert])
-                    for new_alert in (set(alerts[node][alert_source_name].keys()) -
-                                      set(self.last_key_value_alerts[node][alert_source_name].keys())):
-                        new_alerts.append(alerts[node][alert_source_name][new_alert])
+            gone_alerts = [self.last_key_value_alerts[k]
+                           for k in self.last_key_value_alerts.keys() - alerts.keys()]
+            new_alerts = [alerts[k] for k in alerts.keys() - self.last_key_value_alerts.keys()]
 
             self.last_key_value = key
-            self.last_key_value_alerts = copy.deepcopy(alerts)
+            # Alerts are replaced, never mutated (except for `dismissed`), so we only need the references
+            self.last_key_value_alerts = dict(alerts)
 
         return gone_alerts, new_alerts
 
@@ -66,8 +78,31 @@ class AlertService(Service):
         self.node = "A"
 
         self.alerts = defaultdict(lambda: defaultdict(dict))
+        # (node, source, key) -> alert
+        self.alerts_index = {}
+        # (title, id) of every alert, kept sorted for `alert.list`
+        self.alerts_sorted = []
+        # (node, source, key) -> `system.alert` row id
+        self.alerts_ids = {}
+        # (node, source, key) changed since last flush
+        self.alerts_dirty = set()
 
         self.alert_source_last_run = defaultdict(lambda: datetime.min)
+        self.alert_source_stats = defaultdict(lambda: {
+            "runs": 0,
+            "timeouts": 0,
+            "unavailable": 0,
+            "last_run": None,
+            "last_duration": None,
+            "max_duration": 0,
+            "total_duration": 0,
+        })
+
+        # Deliveries not sent yet, persisted in keyvalue store so they are retried after restart
+        self.outbox = DeliveryOutbox()
+        self.outbox_lock = asyncio.Lock()
+        # alert service id -> (type, attributes, instance) reused between deliveries
+        self.alert_services = {}
 
         self.policies = {
             "IMMEDIATELY": AlertPolicy(),
@@ -83,15 +118,20 @@ class AlertService(Service):
                 self.node = "B"
 
         for alert in await self.middleware.call("datastore.query", "system.alert"):
-            del alert["id"]
+
+            id = alert.pop("id")
             alert["level"] = AlertLevel(alert["level"])
 
             alert = Alert(**alert)
 
             self.alerts[alert.node][alert.source][alert.key] = alert
+            self.__index_alert(alert)
+            self.alerts_ids[self.__alert_id(alert)] = id
 
         for policy in self.policies.values():
-            policy.receive_alerts(datetime.utcnow(), self.alerts)
+            policy.receive_alerts(datetime.utcnow(), self.alerts_index)
+
+        self.outbox.load(await self.middleware.call("keyvalue.get", "alert.outbox", []))
 
         main_sources_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, "alert", "source")
         sources_dirs = [os.path.join(overlay_dir, "alert", "source") for overlay_dir in self.middleware.overlay_dirs]
@@ -115,6 +155,9 @@ class AlertService(Service):
     async def terminate(self):
         await self.flush_alerts()
 
+        await self.__save_outbox()
+        await self.middleware.call("keyvalue.flush")
+
     @accepts()
     async def list_policies(self):
         return POLICIES
@@ -136,26 +179,26 @@ class AlertService(Service):
                  id=f"{alert.node};{alert.source};{alert.key}",
                  level=alert.level.name,
                  formatted=alert.formatted)
-            for alert in sorted(self.__get_all_alerts(), key=lambda alert: alert.title)
+            for alert in [self.alerts_index[id] for title, id in self.alerts_sorted]
         ]
 
     @accepts(Str("id"))
     def dismiss(self, id):
-        node, source, key = id.split(";", 2)
-        try:
-            alert = self.alerts[node][source][key]
-        except KeyError:
-            return
-        alert.dismissed = True
+        self.__set_dismissed(id, True)
 
     @accepts(Str("id"))
     def restore(self, id):
-        node, source, key = id.split(";", 2)
+        self.__set_dismissed(id, False)
+
+    def __set_dismissed(self, id, dismissed):
+        id = tuple(id.split(";", 2))
         try:
-            alert = self.alerts[node][source][key]
+            alert = self.alerts_index[id]
         except KeyError:
             return
-        alert.dismissed = False
+        if alert.dismissed != dismissed:
+            alert.dismissed = dismissed
+            self.alerts_dirty.add(id)
 
     @periodic(60)
     @job(lock="process_alerts", transient=True)
@@ -176,11 +219,13 @@ class AlertService(Service):
 
         all_alerts = self.__get_all_alerts()
 
+        alert_service_descs = await self.middleware.call("datastore.query", "system.alertservice")
+
         now = datetime.now()
         for policy_name, policy in self.policies.items():
-            gone_alerts, new_alerts = policy.receive_alerts(now, self.alerts)
+            gone_alerts, new_alerts = policy.receive_alerts(now, self.alerts_index)
 
-            for alert_service_desc in await self.middleware.call("datastore.query", "system.alertservice"):
+            for alert_service_desc in alert_service_descs:
                 service_settings = dict(default_settings, **alert_service_desc["settings"])
 
                 service_gone_alerts = [alert for alert in gone_alerts
@@ -191,23 +236,8 @@ class AlertService(Service):
                 if not service_gone_alerts and not service_new_alerts:
                     continue
 
-                factory = ALERT_SERVICES_FACTORIES.get(alert_service_desc["type"])
-                if factory is None:
-                    self.logger.error("Alert service %r does not exist", alert_service_desc["type"])
-                    continue
-
-                try:
-                    alert_service = factory(self.middleware, alert_service_desc["attributes"])
-                except Exception:
-                    self.logger.error("Error creating alert service %r with parameters=%r",
-                                      alert_service_desc["type"], alert_service_desc["attributes"], exc_info=True)
-                    continue
-
-                if all_alerts or service_gone_alerts or service_new_alerts:
-                    try:
-                        await alert_service.send(all_alerts, service_gone_alerts, service_new_alerts)
-                    except Exception:
-                        self.logger.error("Error in alert service %r", alert_service_desc["type"], exc_info=True)
+                self.outbox.add(Delivery(alert_service_desc["id"], alert_service_desc["type"], all_alerts,
+                                         service_gone_alerts, service_new_alerts))
 
             if policy_name == "IMMEDIATELY":
                 for alert in new_alerts:
@@ -262,6 +292,108 @@ class AlertService(Service):
                                 except Exception:
                                     self.logger.error(f"Failed to create a support ticket", exc_info=True)
 
+        # Slow or unreachable alert services must not hold up the next run
+        asyncio.ensure_future(self.deliver())
+
+    @private
+    @periodic(30)
+    async def deliver(self):
+        """
+        Send pending alert deliveries that are due, concurrently for each alert service.
+        """
+        async with self.outbox_lock:
+            try:
+                while True:
+                    due = self.outbox.due()
+                    if not due:
+                        break
+
+                    alert_service_descs = {
+                        alert_service_desc["id"]: alert_service_desc
+                        for alert_service_desc in await self.middleware.call("datastore.query",
+                                                                             "system.alertservice")
+                    }
+                    for alert_service_id in set(self.alert_services) - set(alert_service_descs):
+                        self.alert_services.pop(alert_service_id)[2].close()
+
+                    await asyncio.gather(*[
+                        self.__deliver(alert_service_id, alert_service_descs.get(alert_service_id), deliveries)
+                        for alert_service_id, deliveries in due.items()
+                    ])
+            finally:
+                await self.__save_outbox()
+
+    async def __deliver(self, alert_service_id, alert_service_desc, deliveries):
+        if alert_service_desc is None:
+            # Alert service was removed
+            self.outbox.remove_service(alert_service_id)
+            return
+
+        for delivery in deliveries:
+            start = time.monotonic()
+            try:
+                alert_service = self.__get_alert_service(alert_service_desc)
+                await asyncio.wait_for(
+                    alert_service.send(delivery.alerts, delivery.gone_alerts, delivery.new_alerts),
+                    DELIVERY_TIMEOUT,
+                )
+            except Exception:
+                if self.outbox.failed(delivery):
+                    self.logger.warning("Error in alert service %r, retrying in %d seconds",
+                                        alert_service_desc["type"], self.outbox.backoff(delivery.attempts),
+                                        exc_info=True)
+                else:
+                    self.logger.error("Error in alert service %r, giving up after %d attempts",
+                                      alert_service_desc["type"], delivery.attempts, exc_info=True)
+                # Keep deliveries to this alert service in order
+                break
+            else:
+                self.outbox.succeeded(delivery, time.monotonic() - start)
+
+    def __get_alert_service(self, alert_service_desc):
+        attributes = json.dumps(alert_service_desc["attributes"], sort_keys=True)
+
+        cached = self.alert_services.get(alert_service_desc["id"])
+        if cached is not None:
+            if cached[:2] == (alert_service_desc["type"], attributes):
+                return cached[2]
+
+            self.alert_services.pop(alert_service_desc["id"])
+            cached[2].close()
+
+        factory = ALERT_SERVICES_FACTORIES.get(alert_service_desc["type"])
+        if factory is None:
+            raise CallError(f"Alert service {alert_service_desc['type']!r} does not exist")
+
+        try:
+            alert_service = factory(self.middleware, alert_service_desc["attributes"])
+        except Exception:
+            self.logger.error("Error creating alert service %r with parameters=%r",
+                              alert_service_desc["type"], alert_service_desc["attributes"], exc_info=True)
+            raise
+
+        self.alert_services[alert_service_desc["id"]] = (alert_service_desc["type"], attributes, alert_service)
+        return alert_service
+
+    async def __save_outbox(self):
+        if not self.outbox.changed:
+            return
+
+        self.outbox.changed = False
+        try:
+            await self.middleware.call("keyvalue.set", "alert.outbox", self.outbox.dump())
+        except Exception:
+            self.outbox.changed = True
+            self.logger.error("Failed to save pending alert deliveries", exc_info=True)
+
+    @private
+    async def delivery_stats(self):
+        """
+        Returns, for each alert service type, the number of sent, failed, retried, dropped and pending
+        deliveries along with delivery latency.
+        """
+        return self.outbox.get_stats()
+
     async def __run_alerts(self):
         master_node = "A"
         backup_node = "B"
@@ -281,47 +413,63 @@ class AlertService(Service):
                         if remote_failover_status == "BACKUP":
                             run_on_backup_node = True
 
+        now = datetime.utcnow()
+        alert_sources = []
         for alert_source in ALERT_SOURCES.values():
-            if not alert_source.schedule.should_run(datetime.utcnow(), self.alert_source_last_run[alert_source.name]):
+            if not alert_source.schedule.should_run(now, self.alert_source_last_run[alert_source.name]):
                 continue
 
-            self.alert_source_last_run[alert_source.name] = datetime.utcnow()
+            self.alert_source_last_run[alert_source.name] = now
+            alert_sources.append(alert_source)
 
-            self.logger.trace("Running alert source: %r", alert_source.name)
+        if not alert_sources:
+            return
+
+        # Backup node runs its sources in a single call while we run ours
+        remote = None
+        remote_sources = [alert_source.name for alert_source in alert_sources
+                          if run_on_backup_node and alert_source.run_on_backup_node]
+        if remote_sources:
+            remote = asyncio.ensure_future(
+                self.middleware.call("failover.call_remote", "alert.run_sources", [remote_sources])
+            )
+
+        local_results = await self.__run_sources([alert_source.name for alert_source in alert_sources])
 
+        remote_results = {}
+        remote_exception = None
+        if remote is not None:
             try:
-                alerts_a = await self.__run_source(alert_source.name)
-            except UnavailableException:
+                remote_results = await remote
+            except Exception:
+                remote_exception = traceback.format_exc()
+
+        for alert_source in alert_sources:
+            alerts_a = local_results[alert_source.name]
+            if alerts_a is None:
                 alerts_a = list(self.alerts["A"][alert_source.name].values())
             for alert in alerts_a:
                 alert.node = master_node
 
             alerts_b = []
-            if run_on_backup_node and alert_source.run_on_backup_node:
-                try:
-                    try:
-                        alerts_b = await self.middleware.call("failover.call_remote", "alert.run_source",
-                                                              [alert_source.name])
-                    except CallError as e:
-                        if e.errno == CallError.EALERTCHECKERUNAVAILABLE:
-                            alerts_b = list(self.alerts["B"][alert_source.name].values())
-                        else:
-                            raise
-                    else:
-                        alerts_b = [Alert(**dict(alert,
-                                                 level=(AlertLevel(alert["level"]) if alert["level"] is not None
-                                                        else alert["level"])))
-                                    for alert in alerts_b]
-                except Exception:
+            if alert_source.name in remote_sources:
+                if remote_exception is not None:
                     alerts_b = [
                         Alert(title="Unable to run alert source %(source_name)r on backup node\n%(traceback)s",
                               args={
                                   "source_name": alert_source.name,
-                                  "traceback": traceback.format_exc(),
+                                  "traceback": remote_exception,
                               },
                               key="__remote_call_exception__",
                               level=AlertLevel.CRITICAL)
                     ]
+                elif remote_results.get(alert_source.name) is None:
+                    alerts_b = list(self.alerts["B"][alert_source.name].values())
+                else:
+                    alerts_b = [Alert(**dict(alert,
+                                             level=(AlertLevel(alert["level"]) if alert["level"] is not None
+                                                    else alert["level"])))
+                                for alert in remote_results[alert_source.name]]
             for alert in alerts_b:
                 alert.node = backup_node
 
@@ -340,8 +488,59 @@ class AlertService(Service):
                 else:
                     alert.dismissed = existing_alert.dismissed
 
-            self.alerts["A"][alert_source.name] = {alert.key: alert for alert in alerts_a}
-            self.alerts["B"][alert_source.name] = {alert.key: alert for alert in alerts_b}
+            self.__set_source_alerts("A", alert_source.name, alerts_a)
+            self.__set_source_alerts("B", alert_source.name, alerts_b)
+
+    def __alert_id(self, alert):
+        return alert.node, alert.source, alert.key
+
+    def __index_alert(self, alert):
+        id = self.__alert_id(alert)
+        existing = self.alerts_index.get(id)
+        if existing is not None:
+            self.__unindex_alert(existing)
+        self.alerts_index[id] = alert
+        bisect.insort(self.alerts_sorted, (alert.title, id))
+
+    def __unindex_alert(self, alert):
+        id = self.__alert_id(alert)
+        if self.alerts_index.get(id) is not alert:
+            return
+        del self.alerts_index[id]
+        i = bisect.bisect_left(self.alerts_sorted, (alert.title, id))
+        if i < len(self.alerts_sorted) and self.alerts_sorted[i] == (alert.title, id):
+            del self.alerts_sorted[i]
+
+    def __set_source_alerts(self, node, source, alerts):
+        """
+        Replace alerts of `source` on `node` keeping the index up to date and
+        marking only the alerts that actually changed for the next flush.
+        """
+        old = self.alerts[node][source]
+        new = {alert.key: alert for alert in alerts}
+
+        for key, alert in old.items():
+            new_alert = new.get(key)
+            if new_alert is None or self.__alert_id(new_alert) != self.__alert_id(alert):
+                self.__unindex_alert(alert)
+                self.alerts_dirty.add(self.__alert_id(alert))
+
+        for key, alert in new.items():
+            old_alert = old.get(key)
+            if old_alert is not None and self.__alert_id(old_alert) == self.__alert_id(alert):
+                if old_alert is alert:
+                    continue
+                self.__unindex_alert(old_alert)
+                if (
+                    (old_alert.title, old_alert.args, old_alert.level, old_alert.dismissed) !=
+                    (alert.title, alert.args, alert.level, alert.dismissed)
+                ):
+                    self.alerts_dirty.add(self.__alert_id(alert))
+            else:
+                self.alerts_dirty.add(self.__alert_id(alert))
+            self.__index_alert(alert)
+
+        self.alerts[node][source] = new
 
     @private
     async def run_source(self, source_name):
@@ -351,13 +550,66 @@ class AlertService(Service):
         except UnavailableException:
             raise CallError("This alert checker is unavailable", CallError.EALERTCHECKERUNAVAILABLE)
 
+    @private
+    async def run_sources(self, source_names):
+        """
+        Run several alert sources concurrently (used by the other node).
+
+        Returns a dict of alerts per source, `None` for unavailable sources.
+        """
+        return {
+            source_name: (
+                [dict(alert.__dict__, level=alert.level.value if alert.level is not None else alert.level)
+                 for alert in alerts]
+                if alerts is not None else None
+            )
+            for source_name, alerts in (await self.__run_sources(source_names)).items()
+        }
+
+    @private
+    async def source_stats(self):
+        """
+        Run time statistics of each alert source.
+        """
+        return {
+            name: dict(stats, average_duration=stats["total_duration"] / stats["runs"] if stats["runs"] else None)
+            for name, stats in self.alert_source_stats.items()
+        }
+
+    async def __run_sources(self, source_names):
+        """
+        Run alert sources with limited concurrency.
+        Returns a dict of alerts per source, `None` for unavailable sources.
+        """
+        concurrency = await self.middleware.call("keyvalue.get", "alert.run_sources_concurrency",
+                                                 RUN_SOURCES_CONCURRENCY)
+
+        async def run(source_name):
+            self.logger.trace("Running alert source: %r", source_name)
+            try:
+                return await self.__run_source(source_name)
+            except UnavailableException:
+                return None
+
+        results = await asyncio_map(run, source_names, concurrency)
+        return dict(zip(source_names, results))
+
     async def __run_source(self, source_name):
         alert_source = ALERT_SOURCES[source_name]
+        stats = self.alert_source_stats[source_name]
+        stats["last_run"] = datetime.utcnow()
+        start = time.monotonic()
 
         try:
-            alerts = (await alert_source.check()) or []
+            alerts = (await asyncio.wait_for(alert_source.check(), alert_source.run_timeout)) or []
         except UnavailableException:
+            stats["unavailable"] += 1
             raise
+        except asyncio.TimeoutError:
+            # Keep previous alerts of this source
+            self.logger.warning("Alert source %r timed out after %d seconds", source_name, alert_source.run_timeout)
+            stats["timeouts"] += 1
+            raise UnavailableException()
         except Exception:
             alerts = [
                 Alert(title="Unable to run alert source %(source_name)r\n%(traceback)s",
@@ -371,6 +623,12 @@ class AlertService(Service):
         else:
             if not isinstance(alerts, list):
                 alerts = [alerts]
+        finally:
+            duration = time.monotonic() - start
+            stats["runs"] += 1
+            stats["last_duration"] = duration
+            stats["max_duration"] = max(stats["max_duration"], duration)
+            stats["total_duration"] += duration
 
         return alerts
 
@@ -383,16 +641,46 @@ class AlertService(Service):
         ):
             return
 
-        await self.middleware.call("datastore.delete", "system.alert", [])
+        ids = list(self.alerts_dirty)
+        self.alerts_dirty.clear()
+
+        operations_ids = []
+        operations = []
+        for id in ids:
+            alert = self.alerts_index.get(id)
+            if alert is None:
+                # Not there anymore, nothing to do if it came and went between two flushes
+                if id in self.alerts_ids:
+                    operations_ids.append(id)
+                    operations.append(["delete", self.alerts_ids[id]])
+                continue
 
-        for alert in self.__get_all_alerts():
             d = alert.__dict__.copy()
             d["level"] = d["level"].value
             del d["mail"]
-            await self.middleware.call("datastore.insert", "system.alert", d)
+            operations_ids.append(id)
+            if id in self.alerts_ids:
+                operations.append(["update", self.alerts_ids[id], d])
+            else:
+                operations.append(["insert", d])
+
+        if not operations:
+            return
+
+        try:
+            result = await self.middleware.call("datastore.bulk", "system.alert", operations)
+        except Exception:
+            self.alerts_dirty.update(ids)
+            raise
+
+        for id, operation, pk in zip(operations_ids, operations, result):
+            if operation[0] == "delete":
+                self.alerts_ids.pop(id, None)
+            else:
+                self.alerts_ids[id] = pk
 
     def __get_all_alerts(self):
-        return sum([sum([list(vv.values()) for vv in v.values()], []) for v in self.alerts.values()], [])
+        return list(self.alerts_index.values())
 
 
 class AlertServiceService(CRUDService):
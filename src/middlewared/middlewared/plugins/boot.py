@@ -5,8 +5,6 @@ from middlewared.schema import Bool, Dict, Int, Str, accepts
 from middlewared.service import CallError, Service, job, private
 from middlewared.utils import run
 
-from bsd import geom
-
 
 class BootService(Service):
 
@@ -31,14 +29,14 @@ class BootService(Service):
         Returns:
             "BIOS", "EFI", None
         """
-        await self.middleware.run_in_thread(geom.scan)
-        labelclass = geom.class_by_name('PART')
+        topology = await self.middleware.call('geom.topology')
         efi = bios = 0
         for disk in await self.get_disks():
-            for e in labelclass.xml.findall(f".//geom[name='{disk}']/provider/config/type"):
-                if e.text == 'efi':
+            g = topology.geom_by_name('PART', disk)
+            for p in (g.providers if g else []):
+                if p.config.get('type') == 'efi':
                     efi += 1
-                elif e.text == 'freebsd-boot':
+                elif p.config.get('type') == 'freebsd-boot':
                     bios += 1
         if efi == 0 and bios == 0:
             return None
@@ -160,11 +158,12 @@ class BootService(Service):
             # Lets try to find out the size of the current freebsd-zfs partition so
             # the new partition is not bigger, preventing size mismatch if one of
             # them fail later on. See #21336
-            await self.middleware.run_in_thread(geom.scan)
-            labelclass = geom.class_by_name('PART')
-            for e in labelclass.xml.findall(f"./geom[name='{disks[0]}']/provider/config[type='freebsd-zfs']"):
-                format_opts['size'] = int(e.find('./length').text)
-                break
+            topology = await self.middleware.call('geom.topology')
+            g = topology.geom_by_name('PART', disks[0])
+            for p in (g.providers if g else []):
+                if p.config.get('type') == 'freebsd-zfs':
+                    format_opts['size'] = int(p.config['length'])
+                    break
 
         boottype = await self.format(dev, format_opts)
 
@@ -1,6 +1,11 @@
 from middlewared.schema import Any, Str, accepts, Int
-from middlewared.service import Service, private
-from collections import namedtuple
+from middlewared.service import Service, periodic, private
+from middlewared.utils.lru import LRUCache
+
+import asyncio
+import copy
+import json
+import threading
 import time
 
 
@@ -11,8 +16,13 @@ class CacheService(Service):
 
     def __init__(self, *args, **kwargs):
         super(CacheService, self).__init__(*args, **kwargs)
-        self.__cache = {}
-        self.kv_tuple = namedtuple('Cache', ['value', 'timeout'])
+        self.__cache = LRUCache()
+        # Keys being computed by get_or_put (threads) and call_cached (event loop)
+        # so concurrent misses on the same key compute the value only once
+        self.__inflight = {}
+        self.__inflight_lock = threading.Lock()
+        self.__inflight_async = {}
+        self.__timings = {}
 
     @accepts(Str('key'))
     def has_key(self, key):
@@ -29,55 +39,129 @@ class CacheService(Service):
         Raises:
             KeyError: not found in the cache
         """
-
-        if self.__cache[key].timeout > 0:
-            self.get_timeout(key)
-
-        return self.__cache[key].value
+        return self.__cache.get(key)
 
     @accepts(Str('key'), Any('value'), Int('timeout', default=0))
     def put(self, key, value, timeout):
         """
         Put `key` of `value` in the cache.
-        """
-
-        if timeout != 0:
-            timeout = time.monotonic() + timeout
 
-        v = self.kv_tuple(value=value, timeout=timeout)
-        self.__cache[key] = v
+        `timeout` is the number of seconds the value is valid for, 0 means
+        it will only be removed to make room for other keys.
+        """
+        self.__cache.put(key, value, timeout)
 
     @accepts(Str('key'))
     def pop(self, key):
         """
         Removes and returns `key` from cache.
         """
-        cache = self.__cache.pop(key, None)
+        return self.__cache.pop(key)
 
-        if cache is not None:
-            cache = cache.value
+    @accepts(Str('method'))
+    def invalidate(self, method):
+        """
+        Removes all results of `method` cached by the `@cached` decorator.
+        """
+        return self.__cache.pop_prefix(self._method_prefix(method))
 
-        return cache
+    @accepts()
+    def stats(self):
+        """
+        Returns cache statistics (hits, misses, evictions, size) and the
+        average time spent computing values for each `@cached` method.
+        """
+        stats = self.__cache.stats()
+        stats['methods'] = {
+            method: {'computed': count, 'average_time': total / count}
+            for method, (count, total) in self.__timings.items()
+        }
+        return stats
 
     @private
-    def get_timeout(self, key):
+    @periodic(60)
+    def expire(self):
         """
-        Check if 'key' has expired
+        Remove expired keys so they do not linger until accessed.
         """
-        now = time.monotonic()
-        value, timeout = self.__cache[key]
+        return self.__cache.expire()
 
-        if now >= timeout:
-            # Bust the cache
-            del self.__cache[key]
+    @private
+    def get_or_put(self, key, timeout, method):
+        while True:
+            try:
+                return self.__cache.get(key)
+            except KeyError:
+                pass
+
+            with self.__inflight_lock:
+                event = self.__inflight.get(key)
+                if event is None:
+                    event = self.__inflight[key] = threading.Event()
+                    leader = True
+                else:
+                    leader = False
+
+            if not leader:
+                # Someone else is computing this key, wait for it and try again
+                event.wait()
+                continue
+
+            try:
+                value = method()
+                self.__cache.put(key, value, timeout)
+                return value
+            finally:
+                with self.__inflight_lock:
+                    self.__inflight.pop(key, None)
+                event.set()
 
-            raise KeyError(f'{key} has expired')
+    @private
+    def _method_prefix(self, method):
+        return f'method:{method}:'
 
     @private
-    def get_or_put(self, key, timeout, method):
+    async def call_cached(self, method, options, args, call):
+        """
+        Used by middleware to serve methods flagged with `@cached`.
+
+        `call` is a coroutine function computing the value on a miss.
+        Concurrent misses for the same key wait for a single computation.
+        """
+        if options['key'] is not None:
+            suffix = options['key'](*args)
+        else:
+            try:
+                suffix = json.dumps(list(args), sort_keys=True)
+            except TypeError:
+                # Arguments we cannot reliably build a key from
+                return await call()
+        key = self._method_prefix(method) + suffix
+
         try:
-            return self.get(key)
+            return copy.deepcopy(self.__cache.get(key))
         except KeyError:
-            value = method()
-            self.put(key, value, timeout)
-            return value
+            pass
+
+        fut = self.__inflight_async.get(key)
+        if fut is not None:
+            return copy.deepcopy(await asyncio.shield(fut))
+
+        fut = self.__inflight_async[key] = asyncio.get_event_loop().create_future()
+        try:
+            start = time.monotonic()
+            value = await call()
+            count, total = self.__timings.get(method, (0, 0))
+            self.__timings[method] = (count + 1, total + time.monotonic() - start)
+
+            self.__cache.put(key, value, options['ttl'])
+            fut.set_result(value)
+        except BaseException as e:
+            fut.set_exception(e)
+            # Waiters get the exception, do not warn about it not being retrieved
+            fut.exception()
+            raise
+        finally:
+            self.__inflight_async.pop(key, None)
+
+        return copy.deepcopy(value)
@@ -1,9 +1,14 @@
+from middlewared.job import JobLogsBuffer, JobProgressBuffer
 from middlewared.rclone.base import BaseRcloneRemote
+from middlewared.rclone.log import RcloneLog, supports_json_log
 from middlewared.schema import accepts, Bool, Cron, Dict, Error, Int, Patch, Ref, Str
 from middlewared.service import (
     CallError, CRUDService, ValidationErrors, filterable, item_method, job, private
 )
-from middlewared.utils import load_modules, load_classes, Popen, run
+from middlewared.utils import filter_list, load_modules, load_classes, Popen, run
+from middlewared.utils.bwlimit import parse_timetable
+from middlewared.utils.lru import LRUCache
+from middlewared.validators import Range
 
 import asyncio
 import base64
@@ -14,15 +19,33 @@ from Crypto.Cipher import AES
 from Crypto.Util import Counter
 import json
 import os
-import re
 import shlex
+import shutil
+import socket
 import subprocess
 import tempfile
-
-CHUNK_SIZE = 5 * 1024 * 1024
-RE_TRANSF = re.compile(r"Transferred:\s*?(.+)$", re.S)
+import threading
+from time import monotonic
+
+# rclone default --buffer-size in MiB
+BUFFER_SIZE = 16
+# Share of the physical memory the buffers of a sync can use
+MEMORY_SHARE = 1 / 4
+MiB = 1024 * 1024
+LOG_READ_SIZE = 65536
+# Remote directory listings, rclone takes a while to list big directories and the folder picker lists the same
+# ones over and over. The remote can change behind our back so they are only kept for a short time, listings a
+# sync job may have changed are dropped when it finishes.
+LS_CACHE_ITEMS = 256
+LS_CACHE_SIZE = 256 * 1024 * 1024
+LS_CACHE_TTL = 60
+# Subdirectories of a listed directory that are listed in background, browsing usually goes into one of them next
+LS_WARM_DIRECTORIES = 8
+LS_WARM_CONCURRENCY = 2
 
 REMOTES = {}
+# Whether the installed rclone supports `--use-json-log`, checked once
+RCLONE_JSON_LOG = None
 
 RcloneConfigTuple = namedtuple("RcloneConfigTuple", ["config_path", "remote_path"])
 
@@ -52,6 +75,9 @@ class RcloneConfig:
         if "attributes" in self.cloud_sync:
             config.update(dict(self.cloud_sync["attributes"], **self.provider.get_task_extra(self.cloud_sync)))
 
+            if self.cloud_sync.get("chunk_size") is not None:
+                config["chunk_size"] = f"{self.cloud_sync['chunk_size']}M"
+
             remote_path = "remote:" + "/".join([self.cloud_sync["attributes"].get("bucket", ""),
                                                 self.cloud_sync["attributes"].get("folder", "")]).strip("/")
 
@@ -83,14 +109,19 @@ class RcloneConfig:
 
 
 async def rclone(job, cloud_sync):
+    physmem = (await job.middleware.call("system.info"))["physmem"]
+
     # Use a temporary file to store rclone file
     with RcloneConfig(cloud_sync) as config:
         args = [
             "/usr/local/bin/rclone",
             "--config", config.config_path,
             "-v",
+        ] + await rclone_log_args() + [
             "--stats", "1s",
-        ] + shlex.split(cloud_sync["args"]) + [
+        ] + rclone_tuning_args(cloud_sync, REMOTES[cloud_sync["credentials"]["provider"]], physmem) + shlex.split(
+            cloud_sync["args"]
+        ) + [
             cloud_sync["transfer_mode"].lower(),
         ]
 
@@ -104,25 +135,119 @@ async def rclone(job, cloud_sync):
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
         )
-        check_cloud_sync = asyncio.ensure_future(rclone_check_progress(job, proc))
+        log = RcloneLog()
+        check_cloud_sync = asyncio.ensure_future(rclone_check_progress(job, proc, log))
         await proc.wait()
+        await asyncio.wait_for(check_cloud_sync, None)
         if proc.returncode != 0:
-            await asyncio.wait_for(check_cloud_sync, None)
+            if log.errors:
+                raise ValueError(f"rclone failed: {log.errors[-1]}")
             raise ValueError("rclone failed")
         return True
 
 
-async def rclone_check_progress(job, proc):
+async def rclone_log_args():
+    """
+    Older rclone does not have JSON logs, its text output is still parsed by `RcloneLog`.
+    """
+    global RCLONE_JSON_LOG
+    if RCLONE_JSON_LOG is None:
+        cp = await run(["/usr/local/bin/rclone", "version"], check=False, encoding="utf8")
+        RCLONE_JSON_LOG = supports_json_log(cp.stdout)
+    return ["--use-json-log"] if RCLONE_JSON_LOG else []
+
+
+def rclone_tuning(task, provider, physmem=None):
+    """
+    Parallel transfers and checkers, chunk size and buffer size (in MiB) of `task`, defaulting to the ones rclone
+    uses for `provider`.
+
+    If `physmem` is given and `task` does not set `transfers`, they are lowered so that the buffers of all of them fit
+    in `MEMORY_SHARE` of it.
+    """
+    def get(name, default):
+        return default if task.get(name) is None else task[name]
+
+    tuning = {
+        "transfers": get("transfers", provider.transfers),
+        "checkers": get("checkers", provider.checkers),
+        "chunk_size": get("chunk_size", provider.chunk_size) if provider.chunk_size is not None else None,
+        "buffer_size": get("buffer_size", BUFFER_SIZE),
+    }
+
+    if physmem is not None and task.get("transfers") is None:
+        per_transfer = rclone_tuning_memory(dict(tuning, transfers=1))
+        if per_transfer:
+            tuning["transfers"] = max(1, min(tuning["transfers"], int(physmem * MEMORY_SHARE / MiB) // per_transfer))
+
+    return tuning
+
+
+def rclone_tuning_memory(tuning):
+    # Every transfer buffers `buffer_size` of the files being read and `chunk_size` of the parts being uploaded
+    return tuning["transfers"] * (tuning["buffer_size"] + (tuning["chunk_size"] or 0))
+
+
+def rclone_tuning_args(task, provider, physmem):
+    # Only options set on the task are passed, and transfers if they had to be lowered, rclone defaults apply otherwise
+    tuning = rclone_tuning(task, provider, physmem)
+    args = []
+    if task.get("transfers") is not None or tuning["transfers"] != provider.transfers:
+        args.extend(["--transfers", str(tuning["transfers"])])
+    if task.get("checkers") is not None:
+        args.extend(["--checkers", str(tuning["checkers"])])
+    if task.get("buffer_size") is not None:
+        args.extend(["--buffer-size", f"{tuning['buffer_size']}M"])
+    if task.get("bwlimit"):
+        args.extend(["--bwlimit", task["bwlimit"]])
+    return args
+
+
+async def rclone_check_progress(job, proc, log):
+    logs = JobLogsBuffer(job)
+    progress_buffer = JobProgressBuffer(job)
+    progress = None
+    try:
+        while True:
+            data = await proc.stdout.read(LOG_READ_SIZE)
+            if not data:
+                await logs.write(log.flush().encode("utf-8", "ignore"))
+                break
+
+            # Parsing is done in a thread, a verbose sync of many small files logs thousands of lines per second
+            text = await job.middleware.run_in_thread(log.feed, data)
+            await logs.write(text.encode("utf-8", "ignore"))
+
+            if log.progress is not None and log.progress is not progress:
+                progress = log.progress
+                progress_buffer.set_progress(*progress)
+    finally:
+        progress_buffer.flush()
+        await logs.flush()
+
+
+def benchmark_files(path, files, size):
+    # Random data repeated, rclone does not compress
+    block = os.urandom(1024 * 1024)
+    os.mkdir(path)
+    for i in range(files):
+        with open(os.path.join(path, f"{i}.bin"), "wb") as f:
+            for j in range(size // files + (1 if i < size % files else 0)):
+                f.write(block)
+
+
+async def wait_port(port, timeout=10):
+    started_at = monotonic()
     while True:
-        read = (await proc.stdout.readline()).decode()
-        job.logs_fd.write(read.encode("utf-8", "ignore"))
-        if read == "":
-            break
-        reg = RE_TRANSF.search(read)
-        if reg:
-            transferred = reg.group(1).strip()
-            if not transferred.isdigit():
-                job.set_progress(None, transferred)
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            if monotonic() - started_at > timeout:
+                raise CallError("rclone HTTP server did not start")
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return
 
 
 def rclone_encrypt_password(password):
@@ -190,6 +315,7 @@ class CredentialsService(CRUDService):
             id,
             data,
         )
+        await self.middleware.call("cloudsync.invalidate_ls", id)
 
         data["id"] = id
 
@@ -202,6 +328,7 @@ class CredentialsService(CRUDService):
             "system.cloudcredentials",
             id,
         )
+        await self.middleware.call("cloudsync.invalidate_ls", id)
 
     async def _validate(self, schema_name, data, id=None):
         verrors = ValidationErrors()
@@ -226,6 +353,16 @@ class CloudSyncService(CRUDService):
         datastore = "tasks.cloudsync"
         datastore_extend = "cloudsync._extend"
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__ls_cache = LRUCache(max_items=LS_CACHE_ITEMS, max_size=LS_CACHE_SIZE)
+        # {key: (generation, future)}
+        self.__ls_inflight = {}
+        # Incremented by `invalidate_ls`, listings that started before are not cached: {credentials_id: generation}
+        self.__ls_generation = {}
+        self.__ls_lock = threading.Lock()
+        self.__ls_warm_semaphore = asyncio.Semaphore(LS_WARM_CONCURRENCY)
+
     @filterable
     async def query(self, filters=None, options=None):
         tasks_or_task = await super().query(filters, options)
@@ -326,6 +463,32 @@ class CloudSyncService(CRUDService):
         except ValueError as e:
             verrors.add(f"{name}.args", f"Parse error: {e.args[0]}")
 
+        await self._validate_tuning(verrors, name, data, provider)
+
+    @private
+    async def _validate_tuning(self, verrors, name, data, provider):
+        if data.get("chunk_size") is not None:
+            if provider.chunk_size is None:
+                verrors.add(f"{name}.chunk_size", "This remote does not upload files in chunks")
+            elif not (provider.chunk_size_range[0] <= data["chunk_size"] <= provider.chunk_size_range[1]):
+                verrors.add(f"{name}.chunk_size", "Chunk size for this remote should be between {} and {} MiB".format(
+                    *provider.chunk_size_range))
+
+        if data.get("bwlimit"):
+            try:
+                parse_timetable(data["bwlimit"])
+            except ValueError as e:
+                verrors.add(f"{name}.bwlimit", str(e))
+
+        # Effective values, defaults included. Transfers that are not set are lowered to fit, the ones that are set
+        # are not
+        physmem = (await self.middleware.call("system.info"))["physmem"]
+        tuning = rclone_tuning(data, provider, physmem)
+        memory = rclone_tuning_memory(tuning)
+        if memory * MiB > physmem * MEMORY_SHARE:
+            verrors.add(f"{name}.buffer_size", f"{tuning['transfers']} transfers would use up to {memory} MiB "
+                                               "of memory, more than a quarter of the physical memory")
+
     @private
     async def _validate_folder(self, verrors, name, data):
         if data["direction"] == "PULL":
@@ -342,7 +505,7 @@ class CloudSyncService(CRUDService):
                     encryption_salt=data.get("encryption_salt"),
                     attributes=dict(data["attributes"], folder=folder_parent),
                     args=data.get("args"),
-                ))
+                ), [("Name", "=", folder_basename)])
                 for item in ls:
                     if item["Name"] == folder_basename:
                         if not item["IsDir"]:
@@ -372,6 +535,11 @@ class CloudSyncService(CRUDService):
         Str("encryption_salt"),
         Cron("schedule"),
         Dict("attributes", additional_attrs=True),
+        Int("transfers", validators=[Range(min=1, max=256)]),
+        Int("checkers", validators=[Range(min=1, max=256)]),
+        Int("chunk_size", validators=[Range(min=1)]),
+        Int("buffer_size", validators=[Range(min=0)]),
+        Str("bwlimit", default=""),
         Str("args", default=""),
         Bool("enabled", default=True),
         register=True,
@@ -380,6 +548,14 @@ class CloudSyncService(CRUDService):
         """
         Creates a new cloud_sync entry.
 
+        `transfers` and `checkers` are the number of files transferred and checked in parallel, `chunk_size` is the
+        size in MiB of the parts of multipart uploads and `buffer_size` the in-memory buffer in MiB of every
+        transfer. When they are not set rclone defaults apply, `cloudsync.providers` reports them for the remote.
+        Transfers that are not set are lowered if their buffers would not fit in a quarter of the physical memory.
+
+        `bwlimit` is a weekly bandwidth timetable in the format of rclone `--bwlimit`, e.g.
+        "Mon-08:00,512 Fri-18:00,off" limits it to 512 KiB/s during weekdays.
+
         .. examples(websocket)::
 
           Create a new cloud_sync using amazon s3 attributes, which is supposed to run every hour.
@@ -478,7 +654,10 @@ class CloudSyncService(CRUDService):
         if not provider.buckets:
             raise CallError("This provider does not use buckets")
 
-        return await self.ls({"credentials": credentials}, "")
+        config = {"credentials": credentials}
+        ls = await self.ls(config, "")
+        self.__ls_warm(config, "", ls)
+        return ls
 
     @accepts(Dict(
         "cloud_sync_ls",
@@ -489,8 +668,14 @@ class CloudSyncService(CRUDService):
         Str("encryption_salt"),
         Dict("attributes", additional_attrs=True),
         Str("args"),
-    ))
-    async def list_directory(self, cloud_sync):
+    ), Ref("query-filters"), Ref("query-options"))
+    async def list_directory(self, cloud_sync, filters=None, options=None):
+        """
+        List the `attributes.folder` directory (of `attributes.bucket`) of the remote.
+
+        Listings are cached for a short time. Use `offset` and `limit` query options to browse big directories page
+        by page.
+        """
         verrors = ValidationErrors()
 
         await self._validate(verrors, "cloud_sync", cloud_sync)
@@ -505,29 +690,199 @@ class CloudSyncService(CRUDService):
         else:
             path = cloud_sync["attributes"]["folder"]
 
-        return await self.ls(dict(cloud_sync, credentials=credentials), path)
+        config = dict(cloud_sync, credentials=credentials)
+        ls = await self.ls(config, path)
+        self.__ls_warm(config, path, ls)
+        return filter_list(ls, filters, options)
 
     @private
     async def ls(self, config, path):
-        with RcloneConfig(config) as config:
-            proc = await run(["rclone", "--config", config.config_path, "lsjson", "remote:" + path],
-                             check=False, encoding="utf8")
-            if proc.returncode == 0:
-                return json.loads(proc.stdout)
-            else:
+        """
+        Cached listing of `path` of the remote, concurrent calls for the same `path` share the same rclone run.
+        The listing must not be modified.
+        """
+        credentials_id = config["credentials"]["id"]
+        key = self.__ls_key(credentials_id, path)
+        try:
+            return self.__ls_cache.get(key)
+        except KeyError:
+            pass
+
+        generation = self.__ls_generation.get(credentials_id, 0)
+        inflight = self.__ls_inflight.get(key)
+        if inflight is not None and inflight[0] == generation:
+            return await asyncio.shield(inflight[1])
+
+        fut = asyncio.get_event_loop().create_future()
+        self.__ls_inflight[key] = (generation, fut)
+        try:
+            with RcloneConfig(config) as rclone_config:
+                proc = await run(["rclone", "--config", rclone_config.config_path, "lsjson", "remote:" + path],
+                                 check=False, encoding="utf8")
+            if proc.returncode != 0:
                 raise CallError(proc.stderr)
 
+            # Directories with 100k+ entries are tens of megabytes of JSON
+            ls = await self.middleware.run_in_thread(self.__ls_load, key, proc.stdout, credentials_id, generation)
+            fut.set_result(ls)
+        except BaseException as e:
+            fut.set_exception(e)
+            # Waiters get the exception, do not warn about it not being retrieved
+            fut.exception()
+            raise
+        finally:
+            if self.__ls_inflight.get(key, (None, None))[1] is fut:
+                del self.__ls_inflight[key]
+
+        return ls
+
+    @private
+    def invalidate_ls(self, credentials_id, path=""):
+        """
+        Drop cached listings of `path` of the remote, of its subdirectories and of its parents.
+        """
+        key = self.__ls_key(credentials_id, path)
+        with self.__ls_lock:
+            self.__ls_generation[credentials_id] = self.__ls_generation.get(credentials_id, 0) + 1
+            self.__ls_cache.pop(key)
+            self.__ls_cache.pop_prefix(key[:-1] + "/" if path.strip("/") else f"{credentials_id}:")
+            path = key[len(f"{credentials_id}:"):-1]
+            while path:
+                path = path.rsplit("/", 1)[0] if "/" in path else ""
+                self.__ls_cache.pop(self.__ls_key(credentials_id, path))
+
+    def __ls_load(self, key, stdout, credentials_id, generation):
+        ls = json.loads(stdout)
+        with self.__ls_lock:
+            # A listing that was running when the remote changed may not include the changes
+            if self.__ls_generation.get(credentials_id, 0) == generation:
+                self.__ls_cache.put(key, ls, LS_CACHE_TTL)
+        return ls
+
+    def __ls_key(self, credentials_id, path):
+        return f"{credentials_id}:{'/'.join(filter(None, path.split('/')))}:"
+
+    def __ls_warm(self, config, path, ls):
+        for name in [item["Name"] for item in ls if item["IsDir"]][:LS_WARM_DIRECTORIES]:
+            asyncio.ensure_future(self.__ls_warm_directory(config, f"{path.rstrip('/')}/{name}".lstrip("/")))
+
+    async def __ls_warm_directory(self, config, path):
+        async with self.__ls_warm_semaphore:
+            try:
+                await self.ls(config, path)
+            except Exception:
+                self.logger.debug("Failed to list %r in background", path, exc_info=True)
+
     @item_method
     @accepts(Int("id"))
     @job(lock=lambda args: "cloud_sync:{}".format(args[-1]), lock_queue_size=1, logs=True)
     async def sync(self, job, id):
         """
         Run the cloud_sync job `id`, syncing the local data to remote.
+
+        Job progress `extra` holds the `bytes` transferred out of `total_bytes`, the `files` transferred out of
+        `total_files`, `checks`, the `speed` in bytes per second, the `eta` in seconds, the number of `errors` and
+        the `last_error`, as reported by rclone every second.
         """
 
         cloud_sync = await self._get_instance(id)
 
-        return await rclone(job, cloud_sync)
+        try:
+            return await rclone(job, cloud_sync)
+        finally:
+            self.invalidate_ls(cloud_sync["credentials"]["id"], "/".join([
+                cloud_sync["attributes"].get("bucket", ""), cloud_sync["attributes"].get("folder", ""),
+            ]))
+
+    @accepts(Dict(
+        "cloud_sync_benchmark",
+        Str("remote", enum=["LOCAL", "HTTP"], default="LOCAL"),
+        Str("path"),
+        Int("size", default=1024, validators=[Range(min=1)]),
+        Int("files", default=16, validators=[Range(min=1)]),
+        Int("transfers", validators=[Range(min=1, max=256)]),
+        Int("checkers", validators=[Range(min=1, max=256)]),
+        Int("buffer_size", validators=[Range(min=0)]),
+        Str("bwlimit", default=""),
+    ))
+    @job(lock="cloud_sync_benchmark", logs=True)
+    async def benchmark(self, job, options):
+        """
+        Measure rclone throughput with the given tuning without involving a cloud provider, copying `files` files
+        totalling `size` MiB created in a temporary directory under `path` to rclone `local:` remote, or from an
+        HTTP stand-in remote (`rclone serve http`) if `remote` is "HTTP".
+
+        Returns the `bytes` transferred, the `seconds` it took and the resulting `speed` in bytes per second.
+        """
+        verrors = ValidationErrors()
+        await self._validate_tuning(verrors, "cloud_sync_benchmark", options, BaseRcloneRemote)
+        if options["path"] and not os.path.isdir(options["path"]):
+            verrors.add("cloud_sync_benchmark.path", "Directory does not exist")
+        if verrors:
+            raise verrors
+
+        physmem = (await self.middleware.call("system.info"))["physmem"]
+        tmp = await self.middleware.run_in_thread(tempfile.mkdtemp, None, None, options["path"])
+        try:
+            source = os.path.join(tmp, "source")
+            target = os.path.join(tmp, "target")
+
+            job.set_progress(0, "Creating files")
+            await self.middleware.run_in_thread(benchmark_files, source, options["files"], options["size"])
+
+            with tempfile.NamedTemporaryFile(mode="w+") as config:
+                server = None
+                if options["remote"] == "HTTP":
+                    with socket.socket() as sock:
+                        sock.bind(("127.0.0.1", 0))
+                        port = sock.getsockname()[1]
+                    server = await Popen(["/usr/local/bin/rclone", "serve", "http", source,
+                                          "--addr", f"127.0.0.1:{port}"],
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    config.write(f"[http]\ntype = http\nurl = http://127.0.0.1:{port}/\n")
+                    config.flush()
+                    source = "http:"
+
+                try:
+                    if server is not None:
+                        await wait_port(port)
+
+                    proc = await Popen(
+                        [
+                            "/usr/local/bin/rclone",
+                            "--config", config.name,
+                            "-v",
+                        ] + await rclone_log_args() + [
+                            "--stats", "1s",
+                        ] + rclone_tuning_args(options, BaseRcloneRemote, physmem) + ["copy", source, target],
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                    )
+                    log = RcloneLog()
+                    started_at = monotonic()
+                    check_progress = asyncio.ensure_future(rclone_check_progress(job, proc, log))
+                    await proc.wait()
+                    seconds = monotonic() - started_at
+                    await asyncio.wait_for(check_progress, None)
+                finally:
+                    if server is not None:
+                        server.terminate()
+                        await server.wait()
+
+            if proc.returncode != 0:
+                raise CallError(f"rclone failed: {log.errors[-1]}" if log.errors else "rclone failed")
+
+            size = await self.middleware.run_in_thread(
+                lambda: sum(os.path.getsize(os.path.join(target, name)) for name in os.listdir(target))
+            )
+        finally:
+            await self.middleware.run_in_thread(shutil.rmtree, tmp, True)
+
+        return {
+            "bytes": size,
+            "seconds": seconds,
+            "speed": int(size / seconds) if seconds else None,
+        }
 
     @accepts()
     async def providers(self):
@@ -544,6 +899,13 @@ class CloudSyncService(CRUDService):
                         for field in provider.credentials_schema
                     ],
                     "buckets": provider.buckets,
+                    "defaults": {
+                        "transfers": provider.transfers,
+                        "checkers": provider.checkers,
+                        "chunk_size": provider.chunk_size,
+                        "chunk_size_range": provider.chunk_size_range,
+                        "buffer_size": BUFFER_SIZE,
+                    },
                     "task_schema": [
                         {
                             "property": field.name,
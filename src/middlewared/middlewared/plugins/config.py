@@ -1,11 +1,26 @@
 import os
 import shutil
+import sqlite3
 import tarfile
 import tempfile
 
 from middlewared.schema import Bool, Dict, accepts
 from middlewared.service import Service, job
 
+DATABASE = '/data/freenas-v1.db'
+
+
+def copy_database(path):
+    conn = sqlite3.connect(DATABASE, isolation_level=None)
+    try:
+        # A read transaction keeps writers from changing the database while it is copied
+        conn.execute('BEGIN')
+        conn.execute('SELECT count(*) FROM sqlite_master').fetchall()
+        shutil.copyfile(DATABASE, path)
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
 
 class ConfigService(Service):
 
@@ -23,22 +38,27 @@ class ConfigService(Service):
         if options is None:
             options = {}
 
-        if not options.get('secretseed'):
-            bundle = False
-            filename = '/data/freenas-v1.db'
-        else:
-            bundle = True
-            filename = tempfile.mkstemp()[1]
-            os.chmod(filename, 0o600)
-            with tarfile.open(filename, 'w') as tar:
-                tar.add('/data/freenas-v1.db', arcname='freenas-v1.db')
-                tar.add('/data/pwenc_secret', arcname='pwenc_secret')
-
-        with open(filename, 'rb') as f:
-            await self.middleware.run_in_thread(shutil.copyfileobj, f, job.pipes.output.w)
-
-        if bundle:
+        # The database can change while it is downloaded, a copy of it is sent instead
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            if not options.get('secretseed'):
+                await self.middleware.run_in_thread(copy_database, filename)
+            else:
+                fd, database = tempfile.mkstemp()
+                os.close(fd)
+                try:
+                    await self.middleware.run_in_thread(copy_database, database)
+                    with tarfile.open(filename, 'w') as tar:
+                        tar.add(database, arcname='freenas-v1.db')
+                        tar.add('/data/pwenc_secret', arcname='pwenc_secret')
+                finally:
+                    os.remove(database)
+        except Exception:
             os.remove(filename)
+            raise
+
+        await job.pipes.output.send_file(filename, temporary=True)
 
     @accepts()
     @job(pipes=["input"])
@@ -0,0 +1,355 @@
+from datetime import datetime, timedelta
+import asyncio
+import errno
+import os
+import subprocess
+import time
+
+from middlewared.schema import accepts
+from middlewared.service import CallError, Service, filterable, private
+from middlewared.utils import Popen, filter_list, run
+from middlewared.utils.scheduler import Admission, ScheduledTask, WaitStats, path_pool, task_due, upcoming
+
+# Data protection tasks running at the same time, scrubs and SMART tests running in background are not counted
+CONCURRENCY = 4
+# I/O budget of a pool and the share of it each kind of task uses: up to two tasks can use the same pool at the same
+# time. A scrub can last for days, it only takes a share of the pool so that other tasks of that pool still run.
+POOL_BUDGET = 2
+WEIGHTS = {
+    'CLOUD_SYNC': 1,
+    'REPLICATION': 1,
+    'RSYNC': 1,
+    'SCRUB': 1,
+    'SMART': 1,
+}
+# Hours of upcoming runs listed by `dataprotection.query`
+PLAN_HOURS = 24
+# Scheduled minutes that are caught up after the event loop was blocked or the clock moved
+MAX_MISSED_MINUTES = 10
+# Scrubs and SMART tests run in background once started, they are polled until they are over
+POLL_INTERVAL = 60
+# Seconds tasks are cached. Task changes invalidate the cache, it is also refreshed for disks moving between pools.
+TASKS_TTL = 3600
+CRON_PATH = '/bin:/sbin:/usr/bin:/usr/sbin:/usr/local/bin:/usr/local/sbin:/root/bin'
+
+
+class DataProtectionService(Service):
+    """
+    Runs scheduled cloud sync, rsync, scrub and SMART test tasks and replication tasks started after periodic
+    snapshots. Instead of starting every task on its scheduled minute, starts are spread with a jitter derived from
+    the task and tasks are queued until at most `CONCURRENCY` of them run and the I/O budget of their pools allows
+    it. Scrubs and SMART tests run in background for hours or days, they only use the budget of their pools.
+    """
+
+    class Config:
+        namespace = 'dataprotection'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__admission = Admission(CONCURRENCY, POOL_BUDGET)
+        self.__stats = WaitStats()
+        # [(task, queued at (monotonic), queued at, future)]
+        self.__queue = []
+        # {key: (task, started at, future)}
+        self.__running = {}
+        # (tasks, built at (monotonic)), bumping the generation drops a cache that is being built
+        self.__tasks = None
+        self.__tasks_generation = 0
+
+    @filterable
+    async def query(self, filters=None, options=None):
+        """
+        Tasks that are running, queued or planned to run in the next `PLAN_HOURS` hours.
+
+        Planned runs `time` includes the jitter of the task, they can start later if they are not admitted right
+        away.
+        """
+        now = datetime.now().replace(microsecond=0)
+        plan = []
+        for task, started_at, _ in self.__running.values():
+            plan.append(self.__entry(task, started_at, 'RUNNING'))
+        for task, _, queued_at, _ in self.__queue:
+            plan.append(self.__entry(task, queued_at, 'QUEUED'))
+        for at, task in upcoming(await self.tasks(), now, now + timedelta(hours=PLAN_HOURS)):
+            plan.append(self.__entry(task, at, 'PLANNED'))
+
+        return filter_list(plan, filters, options)
+
+    @accepts()
+    async def stats(self):
+        """
+        Current pool budget usage and queue wait times (`count`, `total`, `average`, `max` and `last`, in seconds)
+        by kind of task.
+        """
+        return {
+            'concurrency': CONCURRENCY,
+            'pool_budget': POOL_BUDGET,
+            'pools': dict(self.__admission.usage),
+            'running': len(self.__running),
+            'queued': len(self.__queue),
+            'wait': self.__stats.report(),
+        }
+
+    @private
+    async def tasks(self):
+        if self.__tasks is not None and time.monotonic() - self.__tasks[1] < TASKS_TTL:
+            return self.__tasks[0]
+
+        generation = self.__tasks_generation
+        tasks = await self.__build_tasks()
+        if generation == self.__tasks_generation:
+            self.__tasks = (tasks, time.monotonic())
+        return tasks
+
+    @private
+    async def invalidate(self):
+        """
+        Drop cached tasks after tasks, pools or disks changed.
+        """
+        self.__tasks = None
+        self.__tasks_generation += 1
+
+    async def __build_tasks(self):
+        pools = {pool['id']: pool['name'] for pool in await self.middleware.call('pool.query')}
+
+        tasks = []
+        for cloud_sync in await self.middleware.call('cloudsync.query', [('enabled', '=', True)]):
+            tasks.append(ScheduledTask(
+                'CLOUD_SYNC', cloud_sync['id'], cloud_sync['description'], cloud_sync['schedule'],
+                filter(None, [path_pool(cloud_sync['path'])]), WEIGHTS['CLOUD_SYNC'],
+            ))
+
+        for rsync in await self.middleware.call('rsynctask.query', [('enabled', '=', True)]):
+            tasks.append(ScheduledTask(
+                'RSYNC', rsync['id'], rsync['desc'], rsync['schedule'],
+                filter(None, [path_pool(rsync['path'])]), WEIGHTS['RSYNC'],
+            ))
+
+        for replication in await self.middleware.call('replication.query', [('enabled', '=', True)]):
+            tasks.append(ScheduledTask(
+                'REPLICATION', replication['id'], replication['filesystem'], None,
+                filter(None, [replication['filesystem'].split('/')[0]]), WEIGHTS['REPLICATION'],
+            ))
+
+        for scrub in await self.middleware.call('pool.scrub.query', [('enabled', '=', True)]):
+            if scrub['pool'] in pools:
+                tasks.append(ScheduledTask(
+                    'SCRUB', scrub['id'], scrub['description'] or pools[scrub['pool']], scrub['schedule'],
+                    [pools[scrub['pool']]], WEIGHTS['SCRUB'], background=True,
+                ))
+
+        smart_tests = await self.middleware.call('smart.test.query')
+        if smart_tests:
+            disk_pools = await self.__disk_pools(pools.values())
+            for test in smart_tests:
+                disks = await self.__disk_names(test['disks'])
+                tasks.append(ScheduledTask(
+                    'SMART', test['id'], test['desc'] or f'{test["type"]} test',
+                    # SMART tests are scheduled by the hour
+                    dict(test['schedule'], minute='0'),
+                    filter(None, [disk_pools.get(disk) for disk in disks]), WEIGHTS['SMART'], background=True,
+                ))
+
+        return tasks
+
+    @private
+    async def tick(self, minute):
+        """
+        Queue the tasks scheduled at `minute`, each one after its jitter.
+        """
+        if await self.__passive():
+            return
+
+        for task in await self.tasks():
+            if task_due(task, minute):
+                asyncio.ensure_future(self.__submit_later(task, task.jitter))
+
+    @private
+    async def submit(self, kind, id):
+        """
+        Queue task `id` of `kind` right away and wait for it to finish. Returns its result.
+        """
+        for task in await self.tasks():
+            if task.kind == kind and task.id == id:
+                break
+        else:
+            raise CallError(f'{kind} task {id} does not exist', errno.ENOENT)
+
+        return await asyncio.shield(self.__enqueue(task))
+
+    async def __submit_later(self, task, delay):
+        await asyncio.sleep(delay)
+        self.__enqueue(task)
+
+    def __enqueue(self, task):
+        # A task that is still queued or running is not queued once more
+        if task.key in self.__running:
+            self.logger.debug('%r is still running, not starting it again', task)
+            return self.__running[task.key][2]
+        for queued in self.__queue:
+            if queued[0].key == task.key:
+                return queued[3]
+
+        fut = asyncio.get_event_loop().create_future()
+        self.__queue.append((task, time.monotonic(), datetime.now().replace(microsecond=0), fut))
+        self.__dispatch()
+        return fut
+
+    def __dispatch(self):
+        queue = {queued[0].key: queued for queued in self.__queue}
+        for task in self.__admission.select([queued[0] for queued in self.__queue]):
+            queued = queue[task.key]
+            self.__queue.remove(queued)
+            self.__stats.record(task.kind, time.monotonic() - queued[1])
+            self.__running[task.key] = (task, datetime.now().replace(microsecond=0), queued[3])
+            asyncio.ensure_future(self.__run(task, queued[3]))
+
+    async def __run(self, task, fut):
+        try:
+            result = await self.__run_task(task)
+        except Exception as e:
+            self.logger.warning('%r failed: %s', task, e)
+            fut.set_exception(e)
+            # Scheduled runs nobody is waiting for
+            fut.exception()
+        else:
+            fut.set_result(result)
+        finally:
+            self.__admission.finish(task)
+            self.__running.pop(task.key, None)
+            self.__dispatch()
+
+    async def __run_task(self, task):
+        if task.kind == 'CLOUD_SYNC':
+            return await self.__wait_job(await self.middleware.call('cloudsync.sync', task.id))
+        if task.kind == 'REPLICATION':
+            return await self.__wait_job(await self.middleware.call('replication.run', task.id))
+        if task.kind == 'RSYNC':
+            return await self.__run_rsync(task.id)
+        if task.kind == 'SCRUB':
+            return await self.__run_scrub(task.id)
+        if task.kind == 'SMART':
+            return await self.__run_smart_test(task.id)
+        raise CallError(f'Unknown task kind {task.kind}')
+
+    async def __wait_job(self, job):
+        result = await job.wait()
+        if job.error:
+            raise CallError(job.error)
+        return result
+
+    async def __run_rsync(self, id):
+        rsync = await self.middleware.call('rsynctask.query', [('id', '=', id)], {'get': True})
+        command = await self.middleware.call('notifier.rsync_command', id)
+
+        # Output goes to syslog as it did when rsync tasks were run by cron
+        r, w = os.pipe()
+        try:
+            logger = await Popen(['/usr/bin/logger', '-t', 'rsync'], stdin=r)
+            proc = await Popen(
+                ['/usr/bin/su', '-m', rsync['user'], '-c', f'PATH="{CRON_PATH}" {command}'],
+                stdout=w, stderr=subprocess.STDOUT,
+            )
+        finally:
+            # logger exits once rsync closes its end of the pipe
+            os.close(r)
+            os.close(w)
+        await proc.wait()
+        await logger.wait()
+
+        if proc.returncode != 0:
+            raise CallError(f'rsync returned exit code {proc.returncode}')
+
+    async def __run_scrub(self, id):
+        scrub = await self.middleware.call('pool.scrub.query', [('id', '=', id)], {'get': True})
+        pool = await self.middleware.call('pool.query', [('id', '=', scrub['pool'])], {'get': True})
+
+        proc = await run(
+            ['/usr/local/libexec/nas/scrub', '-t', str(scrub['threshold']), pool['name']],
+            check=False, encoding='utf8',
+        )
+        if proc.returncode != 0:
+            raise CallError(f'Failed to start scrub of {pool["name"]}: {proc.stderr or proc.stdout}')
+
+        # Scrub runs in background, the pool budget is held until it is over or paused
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            health = (await self.middleware.call('zfs.pool.health'))['pools'].get(pool['name']) or {}
+            scan = health.get('scan')
+            if not scan or scan['state'] != 'SCANNING' or health.get('scrub_paused'):
+                break
+
+    async def __run_smart_test(self, id):
+        test = await self.middleware.call('smart.test.query', [('id', '=', id)], {'get': True})
+
+        devices = []
+        for disk in await self.__disk_names(test['disks']):
+            args = await self.middleware.call('smart.smartctl_args', disk)
+            if args is None:
+                self.logger.debug('SMART is not supported on %r, skipping %s test', disk, test['type'])
+                continue
+
+            proc = await run(['smartctl', '-t', test['type'].lower()] + args, check=False, encoding='utf8')
+            if proc.returncode != 0:
+                self.logger.warning('Failed to start SMART %s test on %r: %s', test['type'], disk, proc.stdout)
+                continue
+            devices.append(args)
+
+        # Tests run in background in the disks, the pool budget is held until they are over
+        while devices:
+            await asyncio.sleep(POLL_INTERVAL)
+            for args in list(devices):
+                proc = await run(['smartctl', '-c'] + args, check=False, encoding='utf8')
+                if 'Self-test routine in progress' not in proc.stdout:
+                    devices.remove(args)
+
+    async def __disk_names(self, identifiers):
+        disks = {disk['identifier']: disk['name'] for disk in await self.middleware.call('disk.query')}
+        return [disks[identifier] for identifier in identifiers if disks.get(identifier)]
+
+    async def __disk_pools(self, pools):
+        disk_pools = {}
+        for pool in pools:
+            try:
+                for disk in await self.middleware.call('zfs.pool.get_disks', pool):
+                    disk_pools[disk] = pool
+            except Exception:
+                self.logger.debug('Failed to get disks of pool %r', pool, exc_info=True)
+        return disk_pools
+
+    async def __passive(self):
+        # Standby controller does not have the pools
+        if await self.middleware.call('system.is_freenas'):
+            return False
+        return await self.middleware.call('notifier.failover_status') == 'BACKUP'
+
+    def __entry(self, task, at, state):
+        return {
+            'kind': task.kind,
+            'id': task.id,
+            'description': task.description,
+            'pools': sorted(task.pools),
+            'weight': task.weight,
+            'time': at,
+            'state': state,
+        }
+
+
+async def scheduler_loop(middleware):
+    minute = datetime.now().replace(second=0, microsecond=0)
+    while True:
+        minute += timedelta(minutes=1)
+        now = datetime.now()
+        if now - minute > timedelta(minutes=MAX_MISSED_MINUTES):
+            minute = now.replace(second=0, microsecond=0)
+
+        await asyncio.sleep(max((minute - now).total_seconds(), 0))
+
+        try:
+            await middleware.call('dataprotection.tick', minute)
+        except Exception:
+            middleware.logger.error('Failed to queue data protection tasks scheduled at %s', minute, exc_info=True)
+
+
+def setup(middleware):
+    asyncio.ensure_future(scheduler_loop(middleware))
@@ -1,5 +1,5 @@
 from middlewared.service import CallError, Service
-from middlewared.schema import accepts, Any, Bool, Dict, List, Ref, Str
+from middlewared.schema import accepts, Any, Bool, Dict, Int, List, Ref, Str
 from sqlite3 import OperationalError
 
 import os
@@ -15,7 +15,7 @@ if not apps.ready:
     django.setup()
 
 from django.apps import apps
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import Q
 from django.db.models.fields.related import ForeignKey, ManyToManyField
 
@@ -99,6 +99,8 @@ class DatastoreService(Service):
             Bool('count'),
             Bool('get'),
             Str('prefix'),
+            Int('offset'),
+            Int('limit'),
             register=True,
         ),
     )
@@ -166,6 +168,11 @@ class DatastoreService(Service):
         if options.get('count') is True:
             return qs.count()
 
+        offset = options.get('offset') or 0
+        limit = options.get('limit')
+        if offset or limit:
+            qs = qs[offset:offset + limit if limit else None]
+
         result = []
         for i in self.__queryset_serialize(
             qs, extend=options.get('extend'), field_prefix=options.get('prefix')
@@ -271,6 +278,34 @@ class DatastoreService(Service):
             model.objects.get(pk=id_or_filters).delete()
         return True
 
+    @accepts(Str('name'), List('operations'), Dict('options', Str('prefix')))
+    def bulk(self, name, operations, options=None):
+        """
+        Run several operations on `name` within a single transaction.
+
+        Each entry of `operations` is one of:
+
+            ['insert', data]
+            ['update', id, data]
+            ['delete', id_or_filters]
+
+        Returns a list with the result of each operation (the primary key
+        for inserts and updates).
+        """
+        results = []
+        with transaction.atomic():
+            for operation in operations:
+                op, args = operation[0], list(operation[1:])
+                if op == 'insert':
+                    results.append(self.insert(name, args[0], options))
+                elif op == 'update':
+                    results.append(self.update(name, args[0], args[1], options))
+                elif op == 'delete':
+                    results.append(self.delete(name, args[0]))
+                else:
+                    raise CallError(f'Invalid bulk operation: {op}')
+        return results
+
     def sql(self, query, params=None):
         cursor = connection.cursor()
         rv = None
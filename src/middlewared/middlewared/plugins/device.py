@@ -1,19 +1,22 @@
 import asyncio
 import os
+import re
 import shlex
 import socket
 
 from middlewared.schema import accepts, Str
-from middlewared.service import Service
+from middlewared.service import Service, cached
 
-from bsd import devinfo, geom
+from bsd import devinfo
 
 DEVD_SOCKETFILE = '/var/run/devd.pipe'
+RE_DEVD_VARIABLE = re.compile(r'([^\s=]+)=(?:"([^"]*)"|(\S*))')
 
 
 class DeviceService(Service):
 
     @accepts(Str('type', enum=['SERIAL', 'DISK']))
+    @cached(300)
     async def get_info(self, _type):
         """
         Get info for certain device types.
@@ -39,9 +42,9 @@ class DeviceService(Service):
         return ports
 
     async def _get_disk(self):
-        await self.middleware.run_in_thread(geom.scan)
+        topology = await self.middleware.call('geom.topology')
         disks = {}
-        klass = geom.class_by_name('DISK')
+        klass = topology.class_by_name('DISK')
         if not klass:
             return disks
         for g in klass.geoms:
@@ -60,6 +63,30 @@ class DeviceService(Service):
         return disks
 
 
+def parse_devd_message(msg):
+    """
+    Parse variables of a devd notification (without the leading `!`), e.g.
+    `system=DEVFS subsystem=CDEV type=CREATE cdev=da0`.
+
+    Raises:
+        ValueError: message is not made of `key=value` pairs
+    """
+    if '\\' in msg or "'" in msg:
+        # Escapes and single quotes are rare, leave them to shlex
+        return dict(t.split('=', 1) for t in shlex.split(msg))
+
+    parsed = {}
+    end = 0
+    for m in RE_DEVD_VARIABLE.finditer(msg):
+        if msg[end:m.start()].strip():
+            raise ValueError(f'Invalid devd message: {msg}')
+        parsed[m.group(1)] = m.group(2) if m.group(2) is not None else m.group(3)
+        end = m.end()
+    if msg[end:].strip():
+        raise ValueError(f'Invalid devd message: {msg}')
+    return parsed
+
+
 async def devd_loop(middleware):
     while True:
         try:
@@ -88,7 +115,7 @@ async def devd_listen(middleware):
             continue
 
         try:
-            parsed = await middleware.run_in_thread(lambda l: dict(t.split('=') for t in shlex.split(l)), line[1:])
+            parsed = parse_devd_message(line[1:])
         except ValueError:
             middleware.logger.warn(f'Failed to parse devd message: {line}')
             continue
@@ -100,6 +127,11 @@ async def devd_listen(middleware):
         if parsed['system'] in ('CAM', 'ACPI'):
             continue
 
+        # Make sure subscribers do not get stale devices
+        if parsed['system'] in ('DEVFS', 'GEOM'):
+            await middleware.call('geom.invalidate')
+            await middleware.call('cache.invalidate', 'device.get_info')
+
         middleware.send_event(
             f'devd.{parsed["system"]}'.lower(),
             'ADDED',
@@ -10,15 +10,16 @@ import subprocess
 import sys
 import sysctl
 import tempfile
+import time
 
-from bsd import geom, getswapinfo
+from bsd import getswapinfo
 
 from middlewared.common.camcontrol import camcontrol_list
-from middlewared.common.smart.smartctl import get_smartctl_args
 from middlewared.schema import accepts, Bool, Dict, List, Str
 from middlewared.service import filterable, job, private, CallError, CRUDService
 from middlewared.utils import Popen, run
 from middlewared.utils.asyncio_ import asyncio_map
+from middlewared.utils.geom_topology import PART_TYPE_SWAP, PART_TYPE_ZFS
 
 # FIXME: temporary import of SmartAlert until alert is implemented
 # in middlewared
@@ -27,6 +28,13 @@ if '/usr/local/www' not in sys.path:
 from freenasUI.services.utils import SmartAlert
 
 DISK_EXPIRECACHE_DAYS = 7
+# How many disks are probed with smartctl at the same time during sync
+DISK_SERIAL_PROBE_CONCURRENCY = 16
+# Disk attach/detach events are handled once no new one arrived for DISK_EVENTS_WINDOW seconds,
+# or DISK_EVENTS_MAX_DELAY seconds after the first one while they keep coming
+DISK_EVENTS_WINDOW = 1
+DISK_EVENTS_MAX_DELAY = 10
+DISK_EVENTS = None
 MIRROR_MAX = 5
 RE_CAMCONTROL_DRIVE_LOCKED = re.compile(r'^drive locked\s+yes$', re.M)
 RE_DA = re.compile('^da[0-9]+$')
@@ -149,6 +157,9 @@ class DiskService(CRUDService):
         Helper method to get all disks that are not in use, either by the boot
         pool or the user pools.
         """
+        # Partitions can have just been changed by gpart outside of middlewared and the devd event be late,
+        # reserved disks are then looked up in a fresh topology
+        await self.middleware.call('geom.topology', True)
         disks = await self.query([('name', 'nin', await self.get_reserved())])
 
         if join_partitions:
@@ -169,13 +180,14 @@ class DiskService(CRUDService):
         """
         providers = []
 
+        # Runs after partitions were changed outside of middlewared, the devd event can be late
+        topology = self.middleware.call_sync('geom.topology', True)
+
         disks_blacklist = []
         if options['unused']:
             disks_blacklist += self.middleware.call_sync('disk.get_reserved')
 
-        geom.scan()
-        klass_part = geom.class_by_name('PART')
-        klass_label = geom.class_by_name('LABEL')
+        klass_part = topology.class_by_name('PART')
         if not klass_part:
             return providers
 
@@ -197,15 +209,7 @@ class DiskService(CRUDService):
                 except subprocess.CalledProcessError:
                     continue
 
-                dev = None
-                if klass_label:
-                    for g in klass_label.geoms:
-                        if g.name == p.name:
-                            dev = g.provider.name
-                            break
-
-                if dev is None:
-                    dev = p.name
+                dev = topology.labels_by_dev.get(p.name, p.name)
 
                 providers.append({
                     'name': p.name,
@@ -288,32 +292,22 @@ class DiskService(CRUDService):
 
         return partitions
 
-    async def __get_smartctl_args(self, devname):
-        camcontrol = await camcontrol_list()
-        if devname not in camcontrol:
-            return
-
-        args = await get_smartctl_args(devname, camcontrol[devname])
-        if args is None:
-            return
-
-        return args
-
     @private
     async def toggle_smart_off(self, devname):
-        args = await self.__get_smartctl_args(devname)
+        args = await self.middleware.call('smart.smartctl_args', devname)
         if args:
             await run('/usr/local/sbin/smartctl', '--smart=off', *args, check=False)
+            await self.middleware.call('smart.invalidate', devname)
 
     @private
     async def toggle_smart_on(self, devname):
-        args = await self.__get_smartctl_args(devname)
+        args = await self.middleware.call('smart.smartctl_args', devname)
         if args:
             await run('/usr/local/sbin/smartctl', '--smart=on', *args, check=False)
+            await self.middleware.call('smart.invalidate', devname)
 
-    @private
-    async def serial_from_device(self, name):
-        args = await self.__get_smartctl_args(name)
+    async def __serial_from_smartctl(self, name, camcontrol=None):
+        args = await self.middleware.call('smart.smartctl_args', name, camcontrol)
         if args:
             p1 = await Popen(['smartctl', '-i'] + args, stdout=subprocess.PIPE)
             output = (await p1.communicate())[0].decode()
@@ -321,8 +315,14 @@ class DiskService(CRUDService):
             if search:
                 return search.group('serial')
 
-        await self.middleware.run_in_thread(geom.scan)
-        g = geom.geom_by_name('DISK', name)
+    @private
+    async def serial_from_device(self, name):
+        serial = await self.__serial_from_smartctl(name)
+        if serial:
+            return serial
+
+        topology = await self.middleware.call('geom.topology')
+        g = topology.geom_by_name('DISK', name)
         if g and g.provider.config.get('ident'):
             return g.provider.config['ident']
 
@@ -345,9 +345,9 @@ class DiskService(CRUDService):
         Returns:
             str - identifier
         """
-        await self.middleware.run_in_thread(geom.scan)
+        topology = await self.middleware.call('geom.topology')
 
-        g = geom.geom_by_name('DISK', name)
+        g = topology.geom_by_name('DISK', name)
         if g and g.provider.config.get('ident'):
             serial = g.provider.config['ident']
             lunid = g.provider.config.get('lunid')
@@ -359,20 +359,16 @@ class DiskService(CRUDService):
         if serial:
             return f'{{serial}}{serial}'
 
-        klass = geom.class_by_name('PART')
-        if klass:
-            for g in klass.geoms:
-                for p in g.providers:
-                    if p.name == name:
-                        # freebsd-zfs partition
-                        if p.config['rawtype'] == '516e7cba-6ecf-11d6-8ff8-00022d09712b':
-                            return f'{{uuid}}{p.config["rawuuid"]}'
+        p = topology.partitions.get(name)
+        # freebsd-zfs partition
+        if p and p.config.get('rawtype') == PART_TYPE_ZFS:
+            return f'{{uuid}}{p.config["rawuuid"]}'
 
-        g = geom.geom_by_name('LABEL', name)
+        g = topology.geom_by_name('LABEL', name)
         if g:
             return f'{{label}}{g.provider.name}'
 
-        g = geom.geom_by_name('DEV', name)
+        g = topology.geom_by_name('DEV', name)
         if g:
             return f'{{devicename}}{name}'
 
@@ -380,17 +376,10 @@ class DiskService(CRUDService):
 
     @private
     def label_to_dev(self, label, geom_scan=True):
-        if label.endswith('.nop'):
-            label = label[:-4]
-        elif label.endswith('.eli'):
-            label = label[:-4]
-
-        if geom_scan:
-            geom.scan()
-        klass = geom.class_by_name('LABEL')
-        prov = klass.xml.find(f'.//provider[name="{label}"]/../name')
-        if prov is not None:
-            return prov.text
+        """
+        `geom_scan` is kept for compatibility, GEOM topology is refreshed on devd events.
+        """
+        return self.middleware.call_sync('geom.topology').label_to_dev(label)
 
     @private
     @accepts(Str('name'))
@@ -429,10 +418,10 @@ class DiskService(CRUDService):
             disk = {'disk_identifier': ident}
         disk.update({'disk_name': name, 'disk_expiretime': None})
 
-        await self.middleware.run_in_thread(geom.scan)
-        g = geom.geom_by_name('DISK', name)
+        topology = await self.middleware.call('geom.topology')
+        g = topology.geom_by_name('DISK', name)
         if g:
-            if g.provider.config['ident']:
+            if g.provider.config.get('ident'):
                 disk['disk_serial'] = g.provider.config['ident']
             if g.provider.mediasize:
                 disk['disk_size'] = g.provider.mediasize
@@ -450,12 +439,96 @@ class DiskService(CRUDService):
         # FIXME: use a truenas middleware plugin
         await self.middleware.call('notifier.sync_disk_extra', disk['disk_identifier'], False)
 
+    def __geom_snapshot(self, topology):
+        """
+        Index everything disk sync needs to translate identifiers to devices
+        and back from a GEOM topology.
+        """
+        snapshot = {
+            'disks': {},
+            'serial': topology.disks_by_serial,
+            'serial_normalized': {},
+            'serial_lunid': topology.disks_by_serial_lunid,
+            'uuid': topology.disks_by_partition_uuid,
+            'zfs_uuid': {},
+            'label': topology.labels,
+            'label_by_geom': topology.labels_by_dev,
+            'dev': {g.name for g in topology.class_geoms('DEV')},
+        }
+
+        for name, p in topology.disks.items():
+            ident = p.config.get('ident')
+            snapshot['disks'][name] = {'ident': ident, 'lunid': p.config.get('lunid'), 'size': p.mediasize}
+            if ident:
+                snapshot['serial_normalized'].setdefault(' '.join(ident.split()), name)
+
+        for name, p in topology.partitions.items():
+            # freebsd-zfs partition
+            if p.config.get('rawtype') == PART_TYPE_ZFS and p.config.get('rawuuid'):
+                snapshot['zfs_uuid'][name] = p.config['rawuuid']
+
+        return snapshot
+
+    def __snapshot_identifier_to_device(self, snapshot, serials, ident):
+        """
+        Same as `notifier.identifier_to_device` using a GEOM snapshot and
+        serials already probed with smartctl.
+        """
+        search = re.search(r'\{(?P<type>.+?)\}(?P<value>.+)', ident or '')
+        if not search:
+            return None
+
+        tp = search.group('type')
+        value = search.group('value')
+        if tp == 'uuid':
+            return snapshot['uuid'].get(value)
+        elif tp == 'label':
+            return snapshot['label'].get(value)
+        elif tp == 'serial':
+            return (
+                snapshot['serial'].get(value) or
+                snapshot['serial_normalized'].get(' '.join(value.split())) or
+                next((name for name, serial in serials.items() if serial == value), None)
+            )
+        elif tp == 'serial_lunid':
+            return snapshot['serial_lunid'].get(value)
+        elif tp == 'devicename':
+            return value if value in snapshot['dev'] else None
+
+    def __snapshot_device_to_identifier(self, snapshot, serials, name):
+        """
+        Same as `disk.device_to_identifier` using a GEOM snapshot and
+        serials already probed with smartctl.
+        """
+        disk = snapshot['disks'].get(name)
+        if disk and disk['ident']:
+            if disk['lunid']:
+                return f'{{serial_lunid}}{disk["ident"]}_{disk["lunid"]}'
+            return f'{{serial}}{disk["ident"]}'
+
+        if serials.get(name):
+            return f'{{serial}}{serials[name]}'
+
+        if name in snapshot['zfs_uuid']:
+            return f'{{uuid}}{snapshot["zfs_uuid"][name]}'
+
+        if name in snapshot['label_by_geom']:
+            return f'{{label}}{snapshot["label_by_geom"][name]}'
+
+        if name in snapshot['dev']:
+            return f'{{devicename}}{name}'
+
+        return ''
+
     @private
     @accepts()
     @job(lock="disk.sync_all")
     async def sync_all(self, job):
         """
         Synchronyze all disks with the cache in database.
+
+        GEOM is scanned and the database read only once, changes are computed
+        in memory and written in a single transaction.
         """
         # Skip sync disks on backup node
         if (
@@ -467,103 +540,130 @@ class DiskService(CRUDService):
 
         sys_disks = list((await self.middleware.call('device.get_info', 'DISK')).keys())
 
-        seen_disks = {}
-        serials = []
-        await self.middleware.run_in_thread(geom.scan)
-        for disk in (await self.middleware.call('datastore.query', 'storage.disk', [], {'order_by': ['disk_expiretime']})):
+        snapshot = self.__geom_snapshot(await self.middleware.call('geom.topology', True))
+        db_disks = await self.middleware.call('datastore.query', 'storage.disk', [],
+                                              {'order_by': ['disk_expiretime']})
 
-            original_disk = disk.copy()
+        # Disks without a GEOM ident need smartctl to find out their serial, probe them all at once
+        probe = [name for name in sys_disks if not (snapshot['disks'].get(name) or {}).get('ident')]
+        serials = {}
+        if probe:
+            job.set_progress(10, 'Probing disks serials')
+            camcontrol = await camcontrol_list()
+            serials = dict(zip(probe, await asyncio_map(
+                lambda name: self.__serial_from_smartctl(name, camcontrol), probe, DISK_SERIAL_PROBE_CONCURRENCY,
+            )))
 
-            name = await self.middleware.call('notifier.identifier_to_device', disk['disk_identifier'])
+        job.set_progress(50, 'Computing changes')
+
+        now = datetime.utcnow()
+        expiretime = now + timedelta(days=DISK_EXPIRECACHE_DAYS)
+
+        disks = {disk['disk_identifier']: disk for disk in db_disks}
+        originals = {disk['disk_identifier']: disk.copy() for disk in db_disks}
+        deleted = set()
+        inserted = {}
+        extra = []
+
+        def update_from_geom(disk, name):
+            serial = ''
+            geom_disk = snapshot['disks'].get(name)
+            if geom_disk:
+                if geom_disk['ident']:
+                    serial = disk['disk_serial'] = geom_disk['ident']
+                serial += geom_disk['lunid'] or ''
+                if geom_disk['size']:
+                    disk['disk_size'] = geom_disk['size']
+            if not disk.get('disk_serial'):
+                serial = disk['disk_serial'] = serials.get(name) or ''
+            return serial
+
+        seen_disks = {}
+        seen_serials = set()
+        for disk in db_disks:
+            name = self.__snapshot_identifier_to_device(snapshot, serials, disk['disk_identifier'])
             if not name or name in seen_disks:
                 # If we cant translate the identifier to a device, give up
                 # If name has already been seen once then we are probably
                 # dealing with with multipath here
                 if not disk['disk_expiretime']:
-                    disk['disk_expiretime'] = datetime.utcnow() + timedelta(days=DISK_EXPIRECACHE_DAYS)
-                    await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
-                elif disk['disk_expiretime'] < datetime.utcnow():
+                    disk['disk_expiretime'] = expiretime
+                elif disk['disk_expiretime'] < now:
                     # Disk expire time has surpassed, go ahead and remove it
-                    await self.middleware.call('datastore.delete', 'storage.disk', disk['disk_identifier'])
+                    deleted.add(disk['disk_identifier'])
                 continue
-            else:
-                disk['disk_expiretime'] = None
-                disk['disk_name'] = name
+
+            disk['disk_expiretime'] = None
+            disk['disk_name'] = name
 
             reg = RE_DSKNAME.search(name)
             if reg:
                 disk['disk_subsystem'] = reg.group(1)
                 disk['disk_number'] = int(reg.group(2))
-            serial = ''
-            g = geom.geom_by_name('DISK', name)
-            if g:
-                if g.provider.config['ident']:
-                    serial = disk['disk_serial'] = g.provider.config['ident']
-                serial += g.provider.config.get('lunid') or ''
-                if g.provider.mediasize:
-                    disk['disk_size'] = g.provider.mediasize
-            if not disk.get('disk_serial'):
-                serial = disk['disk_serial'] = await self.serial_from_device(name) or ''
 
+            serial = update_from_geom(disk, name)
             if serial:
-                serials.append(serial)
+                seen_serials.add(serial)
 
             # If for some reason disk is not identified as a system disk
             # mark it to expire.
             if name not in sys_disks and not disk['disk_expiretime']:
-                    disk['disk_expiretime'] = datetime.utcnow() + timedelta(days=DISK_EXPIRECACHE_DAYS)
-            # Do not issue unnecessary updates, they are slow on HA systems and cause severe boot delays
-            # when lots of drives are present
-            if disk != original_disk:
-                await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
+                disk['disk_expiretime'] = expiretime
 
-            # FIXME: use a truenas middleware plugin
-            await self.middleware.call('notifier.sync_disk_extra', disk['disk_identifier'], False)
+            extra.append((disk['disk_identifier'], False))
             seen_disks[name] = disk
 
         for name in sys_disks:
-            if name not in seen_disks:
-                disk_identifier = await self.device_to_identifier(name)
-                qs = await self.middleware.call('datastore.query', 'storage.disk', [('disk_identifier', '=', disk_identifier)])
-                if qs:
-                    new = False
-                    disk = qs[0]
-                else:
-                    new = True
-                    disk = {'disk_identifier': disk_identifier}
-                original_disk = disk.copy()
-                disk['disk_name'] = name
-                serial = ''
-                g = geom.geom_by_name('DISK', name)
-                if g:
-                    if g.provider.config['ident']:
-                        serial = disk['disk_serial'] = g.provider.config['ident']
-                    serial += g.provider.config.get('lunid') or ''
-                    if g.provider.mediasize:
-                        disk['disk_size'] = g.provider.mediasize
-                if not disk.get('disk_serial'):
-                    serial = disk['disk_serial'] = await self.serial_from_device(name) or ''
-                if serial:
-                    if serial in serials:
-                        # Probably dealing with multipath here, do not add another
-                        continue
-                    else:
-                        serials.append(serial)
-                reg = RE_DSKNAME.search(name)
-                if reg:
-                    disk['disk_subsystem'] = reg.group(1)
-                    disk['disk_number'] = int(reg.group(2))
-
-                if not new:
-                    # Do not issue unnecessary updates, they are slow on HA systems and cause severe boot delays
-                    # when lots of drives are present
-                    if disk != original_disk:
-                        await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
-                else:
-                    disk['disk_identifier'] = await self.middleware.call('datastore.insert', 'storage.disk', disk)
-                # FIXME: use a truenas middleware plugin
-                await self.middleware.call('notifier.sync_disk_extra', disk['disk_identifier'], True)
+            if name in seen_disks:
+                continue
+
+            disk_identifier = self.__snapshot_device_to_identifier(snapshot, serials, name)
+            # Work on a copy, changes are discarded if the disk turns out to be a multipath duplicate
+            if disk_identifier in inserted:
+                disk = dict(inserted[disk_identifier])
+            elif disk_identifier in disks and disk_identifier not in deleted:
+                disk = dict(disks[disk_identifier])
+            else:
+                disk = {'disk_identifier': disk_identifier}
+            disk['disk_name'] = name
+
+            serial = update_from_geom(disk, name)
+            if serial:
+                if serial in seen_serials:
+                    # Probably dealing with multipath here, do not add another
+                    continue
+                seen_serials.add(serial)
 
+            reg = RE_DSKNAME.search(name)
+            if reg:
+                disk['disk_subsystem'] = reg.group(1)
+                disk['disk_number'] = int(reg.group(2))
+
+            if disk_identifier in disks and disk_identifier not in deleted:
+                disks[disk_identifier] = disk
+            else:
+                inserted[disk_identifier] = disk
+            extra.append((disk_identifier, True))
+
+        # Do not issue unnecessary updates, they are slow on HA systems and cause severe boot delays
+        # when lots of drives are present
+        operations = [['delete', identifier] for identifier in deleted]
+        operations += [
+            ['update', identifier, disk]
+            for identifier, disk in disks.items()
+            if identifier not in deleted and disk != originals[identifier]
+        ]
+        operations += [['insert', disk] for disk in inserted.values()]
+
+        if operations:
+            job.set_progress(80, f'Writing {len(operations)} changes')
+            await self.middleware.call('datastore.bulk', 'storage.disk', operations)
+
+        # FIXME: use a truenas middleware plugin
+        for identifier, add in extra:
+            await self.middleware.call('notifier.sync_disk_extra', identifier, add)
+
+        job.set_progress(100, 'Disks synced')
         return "OK"
 
     @private
@@ -718,10 +818,11 @@ class DiskService(CRUDService):
         Returns:
             The string of the multipath name to be created
         """
-        await self.middleware.run_in_thread(geom.scan)
+        # Multipaths may have just been created
+        topology = await self.middleware.call('geom.topology', True)
         numbers = sorted([
             int(RE_MPATH_NAME.search(g.name).group(1))
-            for g in geom.class_by_name('MULTIPATH').geoms if RE_MPATH_NAME.match(g.name)
+            for g in topology.class_geoms('MULTIPATH') if RE_MPATH_NAME.match(g.name)
         ])
         if not numbers:
             numbers = [0]
@@ -746,10 +847,10 @@ class DiskService(CRUDService):
         then a gmultipath is automatically created and will be available for use.
         """
 
-        await self.middleware.run_in_thread(geom.scan)
+        topology = await self.middleware.call('geom.topology')
 
         mp_disks = []
-        for g in geom.class_by_name('MULTIPATH').geoms:
+        for g in topology.class_geoms('MULTIPATH'):
             for c in g.consumers:
                 p_geom = c.provider.geom
                 # For now just DISK is allowed
@@ -768,7 +869,7 @@ class DiskService(CRUDService):
 
         serials = defaultdict(list)
         active_active = []
-        for g in geom.class_by_name('DISK').geoms:
+        for g in topology.class_geoms('DISK'):
             if not RE_DA.match(g.name) or g.name in reserved or g.name in mp_disks:
                 continue
             if not is_freenas:
@@ -810,9 +911,9 @@ class DiskService(CRUDService):
             await self.__multipath_create(name, disks, 'A' if disks[0] in active_active else mode)
 
         # Scan again to take new multipaths into account
-        await self.middleware.run_in_thread(geom.scan)
+        topology = await self.middleware.call('geom.topology', True)
         mp_ids = []
-        for g in geom.class_by_name('MULTIPATH').geoms:
+        for g in topology.class_geoms('MULTIPATH'):
             _disks = []
             for c in g.consumers:
                 p_geom = c.provider.geom
@@ -856,11 +957,12 @@ class DiskService(CRUDService):
         We try to mirror all available swap partitions to avoid a system
         crash in case one of them dies.
         """
-        await self.middleware.run_in_thread(geom.scan)
+        # Runs right after gpart created swap partitions outside of middlewared, the devd event can be late
+        topology = await self.middleware.call('geom.topology', True)
 
         used_partitions = set()
         swap_devices = []
-        klass = geom.class_by_name('MIRROR')
+        klass = topology.class_by_name('MIRROR')
         if klass:
             for g in klass.geoms:
                 # Skip gmirror that is not swap*
@@ -877,7 +979,7 @@ class DiskService(CRUDService):
                         # Add all partitions used in swap, removing .eli
                         used_partitions.add(c.provider.name.strip('.eli'))
 
-        klass = geom.class_by_name('PART')
+        klass = topology.class_by_name('PART')
         if not klass:
             return
 
@@ -886,7 +988,7 @@ class DiskService(CRUDService):
         for g in klass.geoms:
             for p in g.providers:
                 # if swap partition
-                if p.config['rawtype'] == '516e7cb5-6ecf-11d6-8ff8-00022d09712b':
+                if p.config.get('rawtype') == PART_TYPE_SWAP:
                     if p.name not in used_partitions:
                         # Try to save a core dump from that.
                         # Only try savecore if the partition is not already in use
@@ -943,21 +1045,21 @@ class DiskService(CRUDService):
         it will offline if from swap, remove it from the gmirror (if exists)
         and detach the geli.
         """
-        await self.middleware.run_in_thread(geom.scan)
+        topology = await self.middleware.call('geom.topology', True)
         providers = {}
         for disk in disks:
-            partgeom = geom.geom_by_name('PART', disk)
+            partgeom = topology.geom_by_name('PART', disk)
             if not partgeom:
                 continue
             for p in partgeom.providers:
-                if p.config['rawtype'] == '516e7cb5-6ecf-11d6-8ff8-00022d09712b':
+                if p.config.get('rawtype') == PART_TYPE_SWAP:
                     providers[p.id] = p
                     break
 
         if not providers:
             return
 
-        klass = geom.class_by_name('MIRROR')
+        klass = topology.class_by_name('MIRROR')
         if not klass:
             return
 
@@ -1019,18 +1121,11 @@ class DiskService(CRUDService):
 
         # First do a quick wipe of every partition to clean things like zfs labels
         if mode == 'QUICK':
-            await self.middleware.run_in_thread(geom.scan)
-            klass = geom.class_by_name('PART')
-            for g in klass.xml.findall(f'./geom[name=\'{dev}\']'):
-                for p in g.findall('./provider'):
-                    size = p.find('./mediasize')
-                    if size is not None:
-                        try:
-                            size = int(size.text)
-                        except ValueError:
-                            size = None
-                    name = p.find('./name')
-                    await self.wipe_quick(name.text, size=size)
+            # Swap may have just been removed from the disk
+            topology = await self.middleware.call('geom.topology', True)
+            g = topology.geom_by_name('PART', dev)
+            for p in (g.providers if g else []):
+                await self.wipe_quick(p.name, size=p.mediasize)
 
         await run('gpart', 'destroy', '-F', f'/dev/{dev}', check=False)
 
@@ -1097,46 +1192,105 @@ async def dempdev_configure(name):
     return True
 
 
+class DiskEventCoalescer(object):
+    """
+    Collects disk attach/detach events so that attaching an enclosure full
+    of drives results in one batched sync instead of one per drive.
+    """
+
+    def __init__(self, middleware):
+        self.middleware = middleware
+        self.created = set()
+        self.destroyed = set()
+        self.last_event = None
+        self.task = None
+        self.lock = asyncio.Lock()
+
+    def add(self, event_type, cdev):
+        if event_type == 'CREATE':
+            self.created.add(cdev)
+        else:
+            self.destroyed.add(cdev)
+        self.last_event = time.monotonic()
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        try:
+            first_event = self.last_event
+            while True:
+                last_event = self.last_event
+                await asyncio.sleep(DISK_EVENTS_WINDOW)
+                if self.last_event == last_event or time.monotonic() - first_event >= DISK_EVENTS_MAX_DELAY:
+                    break
+        finally:
+            created, self.created = self.created, set()
+            destroyed, self.destroyed = self.destroyed, set()
+            self.task = None
+
+        async with self.lock:
+            try:
+                await self.process(created, destroyed)
+            except Exception:
+                self.middleware.logger.error('Failed to handle disk events', exc_info=True)
+
+    async def process(self, created, destroyed):
+        # A disk hot swapped in can reuse the name of another one behind a different controller
+        for cdev in created | destroyed:
+            await self.middleware.call('smart.invalidate', cdev)
+
+        # TODO: hack so every disk is not synced independently during boot
+        # This is a performance issue
+        if not os.path.exists('/tmp/.sync_disk_done'):
+            return
+
+        disks = await self.middleware.run_in_thread(lambda: sysctl.filter('kern.disks')[0].value.split())
+        # Devices notified about that are not disks, or already gone
+        created = [cdev for cdev in created if cdev in disks]
+        if not created and not destroyed:
+            return
+
+        if destroyed or len(created) > 1:
+            await (await self.middleware.call('disk.sync_all')).wait()
+        else:
+            await self.middleware.call('disk.sync', created[0])
+
+        if created:
+            await asyncio_map(lambda cdev: self.middleware.call('disk.sed_unlock', cdev), created, 16)
+
+        await self.middleware.call('disk.multipath_sync')
+
+        try:
+            with SmartAlert() as sa:
+                for cdev in created + list(destroyed):
+                    sa.device_delete(cdev)
+        except Exception:
+            pass
+
+        if destroyed:
+            # If a disk dies we need to reconfigure swaps so we are not left
+            # with a single disk mirror swap, which may be a point of failure.
+            await self.middleware.call('disk.swaps_configure')
+
+
 async def _event_devfs(middleware, event_type, args):
     data = args['data']
     if data.get('subsystem') != 'CDEV':
         return
 
     if data['type'] == 'CREATE':
-        disks = await middleware.run_in_thread(lambda: sysctl.filter('kern.disks')[0].value.split())
-        # Device notified about is not a disk
-        if data['cdev'] not in disks:
-            return
-        # TODO: hack so every disk is not synced independently during boot
-        # This is a performance issue
-        if os.path.exists('/tmp/.sync_disk_done'):
-            await middleware.call('disk.sync', data['cdev'])
-            await middleware.call('disk.sed_unlock', data['cdev'])
-            await middleware.call('disk.multipath_sync')
-            try:
-                with SmartAlert() as sa:
-                    sa.device_delete(data['cdev'])
-            except Exception:
-                pass
+        # Whether it is a disk is checked against kern.disks once the batch is handled
+        DISK_EVENTS.add('CREATE', data['cdev'])
     elif data['type'] == 'DESTROY':
         # Device notified about is not a disk
         if not RE_ISDISK.match(data['cdev']):
             return
-        # TODO: hack so every disk is not synced independently during boot
-        # This is a performance issue
-        if os.path.exists('/tmp/.sync_disk_done'):
-            await (await middleware.call('disk.sync_all')).wait()
-            await middleware.call('disk.multipath_sync')
-            try:
-                with SmartAlert() as sa:
-                    sa.device_delete(data['cdev'])
-            except Exception:
-                pass
-            # If a disk dies we need to reconfigure swaps so we are not left
-            # with a single disk mirror swap, which may be a point of failure.
-            await middleware.call('disk.swaps_configure')
+        DISK_EVENTS.add('DESTROY', data['cdev'])
 
 
 def setup(middleware):
+    global DISK_EVENTS
+    DISK_EVENTS = DiskEventCoalescer(middleware)
+
     # Listen to DEVFS events so we can sync on disk attach/detach
     middleware.event_subscribe('devd.devfs', _event_devfs)
@@ -5,7 +5,6 @@ import grp
 import os
 import pwd
 import select
-import shutil
 
 from middlewared.main import EventSource
 from middlewared.schema import Bool, Dict, Int, Ref, Str, accepts
@@ -170,13 +169,14 @@ class FilesystemService(Service):
     async def get(self, job, path):
         """
         Job to get contents of `path`.
+
+        Downloads through `core.download` send the file as is, with HTTP Range support.
         """
 
         if not os.path.isfile(path):
             raise CallError(f'{path} is not a file')
 
-        with open(path, 'rb') as f:
-            await self.middleware.run_in_thread(shutil.copyfileobj, f, job.pipes.output.w)
+        await job.pipes.output.send_file(path)
 
     @accepts(
         Str('path'),
@@ -200,8 +200,8 @@ class FilesystemService(Service):
         else:
             openmode = 'wb+'
 
-        with open(path, openmode) as f:
-            await self.middleware.run_in_thread(shutil.copyfileobj, job.pipes.input.r, f)
+        with open(path, openmode, buffering=0) as f:
+            await self.middleware.run_in_thread(job.pipes.input.copy_to_file, f)
 
         mode = options.get('mode')
         if mode:
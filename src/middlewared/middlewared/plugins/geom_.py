@@ -0,0 +1,53 @@
+from middlewared.schema import Bool, accepts
+from middlewared.service import Service
+from middlewared.utils.geom_topology import GeomTopology
+
+import sysctl
+import threading
+
+
+class GeomService(Service):
+
+    class Config:
+        private = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__topology = None
+        self.__stale = True
+        self.__lock = threading.Lock()
+        self.__stats = {'hits': 0, 'refreshes': 0, 'parses': 0}
+
+    @accepts(Bool('force_refresh', default=False))
+    def topology(self, force_refresh):
+        """
+        Returns a `GeomTopology` of the GEOM configuration.
+
+        The topology is shared between callers and only read again from the kernel after
+        a devd GEOM/DEVFS event or if `force_refresh` is set, e.g. right after changing
+        GEOM configuration ourselves. It must not be modified.
+        """
+        with self.__lock:
+            if not force_refresh and not self.__stale and self.__topology is not None:
+                self.__stats['hits'] += 1
+                return self.__topology
+
+            # Events arriving while we read the configuration mark it stale again
+            self.__stale = False
+            self.__stats['refreshes'] += 1
+            xml = sysctl.filter('kern.geom.confxml')[0].value
+            if self.__topology is None or xml != self.__topology.xml:
+                self.__stats['parses'] += 1
+                self.__topology = GeomTopology(xml)
+            return self.__topology
+
+    @accepts()
+    async def invalidate(self):
+        """
+        Mark GEOM topology as changed, it is read again on next use.
+        """
+        self.__stale = True
+
+    @accepts()
+    async def stats(self):
+        return dict(self.__stats)
@@ -1,6 +1,9 @@
 from middlewared.client import ejson as json
-from middlewared.schema import Any, Str, accepts
-from middlewared.service import Service
+from middlewared.schema import Any, Dict, Int, List, Str, accepts
+from middlewared.service import Service, private
+
+import asyncio
+import copy
 
 
 class KeyValueService(Service):
@@ -8,38 +11,150 @@ class KeyValueService(Service):
     class Config:
         private = True
 
+    # How long (seconds) changes may stay in memory before being written to the database
+    FLUSH_INTERVAL = 5
+    # WRITEBACK: `set` returns right away, changes are flushed in the background
+    # SYNC: `set` returns once the change is written to the database
+    DURABILITY = 'WRITEBACK'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__values = None
+        self.__ids = {}
+        self.__dirty = set()
+        self.__load_lock = asyncio.Lock()
+        self.__flush_lock = asyncio.Lock()
+        self.__flush_scheduled = None
+        self.flush_interval = self.FLUSH_INTERVAL
+        self.durability = self.DURABILITY
+
+    @private
+    async def load(self):
+        """
+        Load all keys from the database, only done once.
+        """
+        async with self.__load_lock:
+            if self.__values is not None:
+                return
+
+            values = {}
+            for row in await self.middleware.call("datastore.query", "system.keyvalue"):
+                try:
+                    values[row["key"]] = json.loads(row["value"])
+                except ValueError:
+                    self.logger.warning("Invalid value for key %r", row["key"])
+                    continue
+                self.__ids[row["key"]] = row["id"]
+            self.__values = values
+
     @accepts(Str('key'))
     async def has_key(self, key):
-        try:
-            await self.get(key)
-            return True
-        except KeyError:
-            return False
+        if self.__values is None:
+            await self.load()
+        return key in self.__values
 
     @accepts(Str('key'), Any('default'))
     async def get(self, key, default):
+        if self.__values is None:
+            await self.load()
         try:
-            return json.loads(
-                (await self.middleware.call(
-                    "datastore.query", "system.keyvalue", [["key", "=", key]], {"get": True}))["value"])
-        except IndexError:
+            # Callers must not be able to change cached values without `set`
+            return copy.deepcopy(self.__values[key])
+        except KeyError:
             if default is not None:
                 return default
 
-            raise KeyError(key)
+            raise
+
+    @accepts(List('keys', items=[Str('key')]))
+    async def get_many(self, keys):
+        """
+        Returns a dict of the values for `keys`, keys not set are omitted.
+        """
+        if self.__values is None:
+            await self.load()
+        return {key: copy.deepcopy(self.__values[key]) for key in keys if key in self.__values}
 
     @accepts(Str('key'), Any('value'))
     async def set(self, key, value):
+        await self.set_many({key: value})
+        return value
+
+    @accepts(Dict('values', additional_attrs=True))
+    async def set_many(self, values):
+        """
+        Set every key/value in `values`, written to the database in one transaction.
+        """
+        if self.__values is None:
+            await self.load()
+
+        for key, value in values.items():
+            # Values are stored as they would be read back from the database
+            self.__values[key] = json.loads(json.dumps(value))
+            self.__dirty.add(key)
+
+        if self.durability == 'SYNC':
+            await self.flush()
+        elif self.__flush_scheduled is None:
+            self.__flush_scheduled = asyncio.ensure_future(self.__delayed_flush())
+
+        return values
+
+    @private
+    @accepts(Int('flush_interval'), Str('durability', enum=['WRITEBACK', 'SYNC']))
+    async def configure(self, flush_interval, durability):
+        """
+        Change how often changes are written to the database and whether
+        `set` waits for them to be written.
+        """
+        self.flush_interval = flush_interval
+        self.durability = durability
+        if durability == 'SYNC':
+            await self.flush()
+
+    async def __delayed_flush(self):
+        try:
+            await asyncio.sleep(self.flush_interval)
+        finally:
+            self.__flush_scheduled = None
         try:
-            row = await self.middleware.call("datastore.query", "system.keyvalue", [["key", "=", key]], {"get": True})
-        except IndexError:
-            await self.middleware.call("datastore.insert", "system.keyvalue", {
-                "key": key,
-                "value": json.dumps(value)
-            })
-        else:
-            await self.middleware.call("datastore.update", "system.keyvalue", row["id"], {
-                "value": json.dumps(value)
-            })
+            await self.flush()
+        except Exception:
+            self.logger.error("Failed to flush keyvalue changes", exc_info=True)
 
-        return value
+    @private
+    async def flush(self):
+        """
+        Write all pending changes to the database in a single transaction.
+        """
+        async with self.__flush_lock:
+            if not self.__dirty:
+                return
+
+            keys = list(self.__dirty)
+            self.__dirty.clear()
+
+            operations = []
+            for key in keys:
+                value = json.dumps(self.__values[key])
+                if key in self.__ids:
+                    operations.append(["update", self.__ids[key], {"value": value}])
+                else:
+                    operations.append(["insert", {"key": key, "value": value}])
+
+            try:
+                result = await self.middleware.call("datastore.bulk", "system.keyvalue", operations)
+            except Exception:
+                # Try again next time unless key was set again in the meantime
+                self.__dirty.update(keys)
+                if self.__flush_scheduled is None and self.durability != 'SYNC':
+                    self.__flush_scheduled = asyncio.ensure_future(self.__delayed_flush())
+                raise
+
+            for key, operation, pk in zip(keys, operations, result):
+                if operation[0] == "insert":
+                    self.__ids[key] = pk
+
+    @private
+    async def terminate(self):
+        await self.flush()
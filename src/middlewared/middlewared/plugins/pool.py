@@ -13,7 +13,7 @@ from middlewared.job import JobProgressBuffer
 from middlewared.schema import (accepts, Bool, Cron, Dict, Int, List, Patch,
                                 Str, UnixPerm)
 from middlewared.service import (
-    ConfigService, filterable, item_method, job, private, CallError, CRUDService, ValidationErrors
+    ConfigService, cached, filterable, item_method, job, private, CallError, CRUDService, ValidationErrors
 )
 from middlewared.utils import Popen, filter_list, run
 from middlewared.validators import Range, Time
@@ -206,6 +206,11 @@ class PoolService(CRUDService):
         datastore_extend = 'pool.pool_extend'
         datastore_prefix = 'vol_'
 
+    @filterable
+    @cached(10)
+    async def query(self, filters=None, options=None):
+        return await super().query(filters, options)
+
     @accepts()
     async def filesystem_choices(self):
         vol_names = [vol['name'] for vol in (await self.query())]
@@ -267,16 +272,23 @@ class PoolService(CRUDService):
             if zpool:
                 pool['is_decrypted'] = True
             else:
-                decrypted = True
-                for ed in self.middleware.call_sync('datastore.query', 'storage.encrypteddisk', [('encrypted_volume', '=', pool['id'])]):
-                    if not os.path.exists(f'/dev/{ed["encrypted_provider"]}.eli'):
-                        decrypted = False
-                        break
-                pool['is_decrypted'] = decrypted
+                pool['is_decrypted'] = self.is_decrypted(pool['id'])
         else:
             pool['is_decrypted'] = True
         return pool
 
+    @private
+    def is_decrypted(self, oid):
+        """
+        Whether all geli providers of encrypted pool `oid`, that is not imported, exist.
+        """
+        for ed in self.middleware.call_sync(
+            'datastore.query', 'storage.encrypteddisk', [('encrypted_volume', '=', oid)]
+        ):
+            if not os.path.exists(f'/dev/{ed["encrypted_provider"]}.eli'):
+                return False
+        return True
+
     @item_method
     @accepts(Int('id', required=False))
     async def get_disks(self, oid=None):
@@ -419,6 +431,7 @@ class PoolService(CRUDService):
             args = []
 
         await self.middleware.call('notifier.volume_import', data.get('name') or pool['name'], data['guid'], *args)
+        await self.middleware.call('cache.invalidate', 'pool.query')
         return True
 
     @accepts(Str('volume'), Str('fs_type'), Dict('fs_options', additional_attrs=True), Str('dst_path'))
@@ -1028,5 +1041,13 @@ class PoolScrubService(CRUDService):
         return response
 
 
+async def _event_zfs(middleware, event_type, args):
+    """
+    Pools status, scan and topology may change on any ZFS event
+    """
+    await middleware.call('cache.invalidate', 'pool.query')
+
+
 def setup(middleware):
+    middleware.event_subscribe('devd.zfs', _event_zfs)
     asyncio.ensure_future(middleware.call('pool.configure_resilver_priority'))
@@ -1,22 +1,30 @@
 from middlewared.async_validators import resolve_hostname
 from middlewared.client import Client
+from middlewared.job import JobProgressBuffer
+from middlewared.replication.engine import ReplicationEngine, ReplicationError
+from middlewared.replication.transport import close_ssh_transports, keyscan, SSHTransport
 from middlewared.schema import accepts, Bool, Dict, Int, Patch, Str
-from middlewared.service import private, CallError, CRUDService, ValidationErrors
-from middlewared.utils import Popen
+from middlewared.service import item_method, job, private, CallError, CRUDService, ValidationErrors
+from middlewared.utils.bwlimit import parse_timetable
 from middlewared.validators import Range, Time
 
+import asyncio
 import base64
 import errno
 import os
 import pickle
-import re
-import subprocess
 
-from datetime import time
+from collections import defaultdict
+from datetime import datetime, time
+from time import monotonic
 
 
 REPLICATION_KEY = '/data/ssh/replication.pub'
 REPL_RESULTFILE = '/tmp/.repl-result'
+# Datasets of a single replication task sent at the same time
+REPLICATION_CONCURRENCY = 4
+# Do not send the same failure notification more often than that (seconds)
+REPLICATION_MAIL_INTERVAL = 2 * 3600
 
 
 class ReplicationService(CRUDService):
@@ -49,17 +57,12 @@ class ReplicationService(CRUDService):
             except Exception:
                 data['lastresult'] = {'msg': None}
 
-        progressfile = f'/tmp/.repl_progress_{data["id"]}'
-        if os.path.exists(progressfile):
-            with open(progressfile, 'r') as f:
-                pid = int(f.read())
-            title = await self.middleware.call('notifier.get_proc_title', pid)
-            if title:
-                reg = re.search(r'sending (\S+) \((\d+)%', title)
-                if reg:
-                    data['status'] = f'Sending {reg.groups()[0]}s {reg.groups()[1]}s'
-                else:
-                    data['status'] = 'Sending'
+        for j in await self.middleware.call('core.get_jobs', [
+            ('method', '=', 'replication.run'), ('state', '=', 'RUNNING'),
+        ]):
+            if j['arguments'] and j['arguments'][0] == data['id']:
+                data['status'] = j['progress']['description'] or 'Sending'
+                break
 
         if 'status' not in data:
             data['status'] = data['lastresult'].get('msg')
@@ -96,6 +99,12 @@ class ReplicationService(CRUDService):
                 'Invalid Filesystem'
             )
 
+        if data.get('limit_schedule'):
+            try:
+                parse_timetable(data['limit_schedule'])
+            except ValueError as e:
+                verrors.add(f'{schema_name}.limit_schedule', str(e))
+
         remote_mode = data.pop('remote_mode', 'MANUAL')
 
         remote_port = data.pop('remote_port')
@@ -147,6 +156,7 @@ class ReplicationService(CRUDService):
             Bool('remote_https'),
             Bool('userepl', default=False),
             Int('limit', default=0, validators=[Range(min=0)]),
+            Str('limit_schedule'),
             Int('remote_port', default=22, required=True),
             Str('begin', validators=[Time()]),
             Str('compression', enum=['OFF', 'LZ4', 'PIGZ', 'PLZIP']),
@@ -208,6 +218,9 @@ class ReplicationService(CRUDService):
         if verrors:
             raise verrors
 
+        # Pairing may have changed the port or host key of a remote we already had a connection to
+        await close_ssh_transports(remote_hostname)
+
         remote_pk = await self.middleware.call(
             'datastore.insert',
             'storage.replremote',
@@ -229,6 +242,8 @@ class ReplicationService(CRUDService):
             {'prefix': self._config.datastore_prefix}
         )
 
+        await self.middleware.call('dataprotection.invalidate')
+
         return await self._get_instance(pk)
 
     @accepts(
@@ -252,6 +267,8 @@ class ReplicationService(CRUDService):
         new.pop('status')
         new.pop('lastresult')
 
+        await close_ssh_transports(old['remote_hostname'])
+
         await self.middleware.call(
             'datastore.update',
             'storage.replremote',
@@ -273,6 +290,8 @@ class ReplicationService(CRUDService):
             {'prefix': self._config.datastore_prefix}
         )
 
+        await self.middleware.call('dataprotection.invalidate')
+
         return await self._get_instance(id)
 
     @accepts(
@@ -280,14 +299,134 @@ class ReplicationService(CRUDService):
     )
     async def do_delete(self, id):
 
+        replication = await self._get_instance(id)
+        await close_ssh_transports(replication['remote_hostname'])
+
         response = await self.middleware.call(
             'datastore.delete',
             self._config.datastore,
             id
         )
 
+        await self.middleware.call('dataprotection.invalidate')
+
         return response
 
+    @item_method
+    @accepts(Int('id'))
+    @job(lock=lambda args: f'replication_{args[-1]}', lock_queue_size=1)
+    async def run(self, job, id):
+        """
+        Run replication task `id`, sending new snapshots to the remote side.
+
+        Datasets are sent concurrently, children after their parent. Interrupted transfers are resumed
+        the next time the task runs.
+
+        Job progress `extra` holds the stream bytes `transferred` out of an estimated `total`, the bytes `sent`
+        after compression and the average `speed` in bytes per second.
+        """
+        replication = await self._get_instance(id)
+
+        job.set_progress(0, 'Running')
+        self.__set_result(id, {'msg': 'Running'})
+
+        progress_buffer = JobProgressBuffer(job)
+
+        started_at = monotonic()
+
+        def progress(transferred, total):
+            if total:
+                percent = min(transferred * 100 / total, 100)
+                description = f'Sending {percent:.0f}%'
+            else:
+                percent = None
+                description = 'Sending'
+            progress_buffer.set_progress(percent, description, {
+                'transferred': transferred,
+                'total': total,
+                'sent': engine.sent,
+                'speed': int(engine.sent / max(monotonic() - started_at, 1)),
+            })
+
+        engine = ReplicationEngine(
+            replication['filesystem'],
+            replication['zfs'],
+            SSHTransport.from_replication(replication),
+            recursive=replication['userepl'],
+            followdelete=replication['followdelete'],
+            compression=replication['compression'],
+            limit=replication['limit'],
+            limit_schedule=replication['limit_schedule'] or None,
+            concurrency=REPLICATION_CONCURRENCY,
+            check_readonly=not await self.middleware.call('system.is_freenas'),
+            progress=progress,
+        )
+        try:
+            result, mails = await engine.run()
+        except ReplicationError as e:
+            result, mails = {'msg': e.msg}, [e.mail] if e.mail else []
+        finally:
+            progress_buffer.cancel()
+
+        self.__set_result(id, result)
+
+        for subject, text in mails:
+            try:
+                await self.middleware.call('mail.send', {
+                    'subject': subject,
+                    'text': f'Hello,\n    {text}',
+                    'interval': REPLICATION_MAIL_INTERVAL,
+                    'channel': 'autorepl',
+                })
+            except Exception:
+                self.logger.warning('Failed to send replication failure notification', exc_info=True)
+
+        if result['msg'] not in ('Succeeded', 'Up to date'):
+            raise CallError(result['msg'])
+
+        job.set_progress(100, result['msg'])
+        return result
+
+    @private
+    @job(lock='replication_run_pending')
+    async def run_pending(self, job):
+        """
+        Run enabled replication tasks whose begin/end window includes current time and wait for them to finish.
+
+        Tasks are queued by the data protection scheduler so that they share pools with other tasks.
+        """
+        now = datetime.now().replace(microsecond=0)
+        if now.second >= 30 and now.minute != 59:
+            now = now.replace(minute=now.minute + 1)
+        now = time(now.hour, now.minute)
+
+        tasks = []
+        for replication in await self.query([('enabled', '=', True)]):
+            begin = time(*[int(v) for v in replication['begin'].split(':')])
+            end = time(*[int(v) for v in replication['end'].split(':')])
+            if begin <= end:
+                if not (begin <= now <= end):
+                    continue
+            elif not (now >= begin or now <= end):
+                continue
+
+            tasks.append(self.middleware.call('dataprotection.submit', 'REPLICATION', replication['id']))
+
+        # Failures are reported by each task result
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def __set_result(self, id, result):
+        try:
+            with open(REPL_RESULTFILE, 'rb') as f:
+                results = pickle.loads(f.read())
+        except Exception:
+            results = defaultdict(dict)
+
+        results.setdefault(id, {}).update(result)
+
+        with open(REPL_RESULTFILE, 'wb') as f:
+            f.write(pickle.dumps(results))
+
     @accepts()
     def public_key(self):
         """
@@ -308,20 +447,12 @@ class ReplicationService(CRUDService):
         """
         Scan the SSH key on `host`:`port`.
         """
-        proc = await Popen([
-            "/usr/bin/ssh-keyscan",
-            "-p", str(port),
-            "-T", "2",
-            str(host),
-        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        key, errmsg = await proc.communicate()
-        if proc.returncode != 0 or not key:
+        returncode, key, errmsg = await keyscan(host, port)
+        if returncode != 0 or not key:
             if not errmsg:
                 errmsg = 'ssh key scan failed for unknown reason'
-            else:
-                errmsg = errmsg.decode()
             raise CallError(errmsg)
-        return key.decode()
+        return key
 
     @private
     @accepts(Dict(
@@ -35,6 +35,7 @@ import shutil
 import asyncssh
 import glob
 import asyncio
+import time
 
 from collections import defaultdict
 from middlewared.schema import accepts, Bool, Cron, Dict, Str, Int, Ref, List, Patch
@@ -43,10 +44,17 @@ from middlewared.service import (
     Service, job, CallError, CRUDService, private, SystemServiceService, ValidationErrors
 )
 from middlewared.logger import Logger
+from middlewared.utils.rsync import (
+    ShardProgress, parse_progress2, partition_directories, partition_files, shard_command, source_base, tree_files
+)
 
 
 logger = Logger('rsync').getLogger()
 RSYNC_PATH = '/usr/local/bin/rsync'
+PARTITIONS = {
+    'DIRECTORY': partition_directories,
+    'FILES': partition_files,
+}
 
 
 def demote(user):
@@ -65,6 +73,18 @@ def demote(user):
     return set_ids
 
 
+def benchmark_tree(path, files, size, directories):
+    """
+    Create `files` files totalling `size` MiB spread in `directories` directories under `path`.
+    """
+    file_size = max(size * 1024 * 1024 // files, 1)
+    for i in range(files):
+        directory = os.path.join(path, f'dir{i % directories:03d}')
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f'file{i:06d}'), 'wb') as f:
+            f.write(os.urandom(file_size))
+
+
 class RsyncService(Service):
 
     def __rsync_worker(self, line, user, job):
@@ -123,6 +143,133 @@ class RsyncService(Service):
                 f'Rsync copy job id: {job.id} returned non-zero exit code. Command used was: {line}. Error: {rsync_proc.stderr.read()}'
             )
 
+    def __rsync_run(self, line, user, on_progress=None):
+        # Runs an `--info=progress2` rsync, returns its exit code and error output
+        with tempfile.TemporaryFile() as stderr:
+            proc = subprocess.Popen(
+                line,
+                shell=True,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                preexec_fn=demote(user)
+            )
+            pending = b''
+            while True:
+                data = os.read(proc.stdout.fileno(), 4096)
+                if not data:
+                    break
+                lines = re.split(rb'[\r\n]', pending + data)
+                pending = lines.pop()
+                if on_progress is not None:
+                    for op in reversed(lines):
+                        percent = parse_progress2(op.decode('utf8', 'ignore'))
+                        if percent is not None:
+                            on_progress(percent)
+                            break
+            proc.stdout.close()
+            proc.wait()
+
+            stderr.seek(0)
+            return proc.returncode, stderr.read().decode('utf8', 'ignore').strip()
+
+    def __rsync_parallel(self, job, line, source, destination, user, parallel, delete):
+        """
+        Copy `source` to `destination` with `parallel['workers']` rsync processes, each one copying shards of
+        the source tree taken from a queue. Failed shards are queued again up to `parallel['retries']` times.
+        """
+        base = source_base(source)[0]
+        job.set_progress(0, 'Partitioning source tree')
+        shards = PARTITIONS[parallel['partition']](source)
+        progress = ShardProgress(shards)
+
+        pending = list(reversed(shards))
+        running = 0
+        errors = []
+        cond = threading.Condition()
+
+        def copy_shard(i, shard, files_from):
+            with open(files_from, 'wb') as f:
+                f.write(shard.files_from())
+            if user:
+                shutil.chown(files_from, user=user)
+
+            progress.start(i, shard)
+            returncode = None
+            try:
+                returncode, error = self.__rsync_run(
+                    shard_command(line, shard, files_from, base, destination),
+                    user,
+                    lambda percent: progress.update(i, percent),
+                )
+            finally:
+                progress.finish(i, returncode == 0)
+                job.set_progress(progress.percent, progress.description)
+
+            if returncode != 0:
+                raise CallError(error or f'rsync returned exit code {returncode}')
+
+        def worker(i, files_from):
+            nonlocal running
+            while True:
+                with cond:
+                    while not pending and running:
+                        cond.wait()
+                    if not pending:
+                        return
+                    shard = pending.pop()
+                    running += 1
+
+                shard.attempts += 1
+                retry = False
+                try:
+                    copy_shard(i, shard, files_from)
+                except Exception as e:
+                    logger.debug(f'Rsync copy job id: {job.id} failed to copy {shard!r}: {e}')
+                    if shard.attempts > parallel['retries']:
+                        errors.append(f'{shard.paths[0]} and {len(shard.paths) - 1} more: {e}')
+                    else:
+                        retry = True
+                finally:
+                    with cond:
+                        running -= 1
+                        if retry:
+                            pending.insert(0, shard)
+                        cond.notify_all()
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            if user:
+                shutil.chown(tmpdir, user=user)
+
+            threads = [
+                threading.Thread(target=worker, args=(i, os.path.join(tmpdir, f'shard{i}')), daemon=True)
+                for i in range(min(parallel['workers'], len(shards)))
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        if errors:
+            job.set_progress(None, 'Rsync copy job failed')
+            raise CallError(
+                f'Rsync copy job id: {job.id} failed to copy {len(errors)} of {len(shards)} shards. '
+                f'Errors: {"; ".join(errors[:10])}'
+            )
+
+        # Directories were created by one worker and filled by others, set their attributes again and delete
+        # extraneous files now that every file is there
+        job.set_progress(99, 'Finishing rsync copy job')
+        returncode, error = self.__rsync_run(
+            f'{line} -r --existing --ignore-existing{" --delete-delay" if delete else ""} "{source}" {destination}',
+            user,
+        )
+        if returncode != 0:
+            job.set_progress(None, 'Rsync copy job failed')
+            raise CallError(f'Rsync copy job id: {job.id} final pass returned non-zero exit code. Error: {error}')
+
     @accepts(Dict(
         'rsync-copy',
         Str('user', required=True),
@@ -146,6 +293,12 @@ class RsyncService(Service):
             Bool('preserve_attributes'),
             Bool('delay_updates')
         ),
+        Dict(
+            'parallel',
+            Int('workers', default=4, validators=[Range(min=1, max=64)]),
+            Str('partition', enum=list(PARTITIONS), default='DIRECTORY'),
+            Int('retries', default=2, validators=[Range(min=0)]),
+        ),
         required=True
     ))
     @job()
@@ -154,6 +307,15 @@ class RsyncService(Service):
         Starts an rsync copy task between current freenas machine
         and specified remote host (or local copy too). It reports
         the progress of the copy task.
+
+        If `parallel` is set the source tree is split in shards copied
+        by `parallel.workers` rsync processes at the same time, which
+        is faster for trees of many small files. Shards are either
+        the top level directories of the source (`DIRECTORY` partition)
+        or lists of files of the whole tree (`FILES` partition), a shard
+        that fails is copied again up to `parallel.retries` times.
+        The source has to be local (a PUSH, or a PULL from localhost)
+        and the copy recursive.
         """
 
         # Assigning variables and such
@@ -168,6 +330,7 @@ class RsyncService(Service):
         remote_password = rcopy.get('remote_password', None)
         password_file = None
         properties = rcopy.get('properties', defaultdict(bool))
+        parallel = rcopy.get('parallel')
 
         # Let's do a brief check of all the user provided parameters
         if not path:
@@ -194,6 +357,13 @@ class RsyncService(Service):
         ):
             raise CallError(f'The specified path: {remote_path} does not exist', errno.ENOENT)
 
+        local = mode == 'SSH' and rcopy.get('remote_host') in ['127.0.0.1', 'localhost']
+        if parallel:
+            if rcopy['direction'] != 'PUSH' and not local:
+                raise CallError('Parallel copy requires a local source', errno.EINVAL)
+            if not (properties.get('recursive') or properties.get('archive')):
+                raise CallError('Parallel copy requires a recursive copy', errno.EINVAL)
+
         # Phew! with that out of the let's begin the transfer
 
         line = f'{RSYNC_PATH} --info=progress2 -h'
@@ -210,16 +380,17 @@ class RsyncService(Service):
                 line += ' -p'
             if properties.get('preserve_attributes'):
                 line += ' -X'
-            if properties.get('delete'):
+            if properties.get('delete') and not parallel:
+                # Parallel copy deletes in its final pass, a worker only sees its own shard
                 line += ' --delete-delay'
             if properties.get('delay_updates'):
                 line += ' --delay-updates'
 
         if mode == 'MODULE':
             if rcopy.get('direction') == 'PUSH':
-                line += f' "{path}" {remote_address}::"{remote_module}"'
+                source, destination = f'"{path}"', f'{remote_address}::"{remote_module}"'
             else:
-                line += f' {remote_address}::"{remote_module}" "{path}"'
+                source, destination = f'{remote_address}::"{remote_module}"', f'"{path}"'
             if remote_password:
                 password_file = tempfile.NamedTemporaryFile(mode='w')
 
@@ -232,31 +403,103 @@ class RsyncService(Service):
             # there seems to be some code duplication here but hey its simple
             # if you find a way (THAT DOES NOT BREAK localhost based rsync copies)
             # then please go for it
-            if rcopy.get('remote_host') in ['127.0.0.1', 'localhost']:
+            if local:
                 if rcopy['direction'] == 'PUSH':
-                    line += f' "{path}" "{remote_path}"'
+                    source, destination = f'"{path}"', f'"{remote_path}"'
                 else:
-                    line += f' "{remote_path}" "{path}"'
+                    source, destination = f'"{remote_path}"', f'"{path}"'
             else:
                 line += ' -e "ssh -p {0} -o BatchMode=yes -o StrictHostKeyChecking=yes"'.format(
                     rcopy.get('remote_ssh_port', 22)
                 )
                 if rcopy['direction'] == 'PUSH':
-                    line += f' "{path}" {remote_address}:\\""{remote_path}"\\"'
+                    source, destination = f'"{path}"', f'{remote_address}:\\""{remote_path}"\\"'
                 else:
-                    line += f' {remote_address}:\\""{remote_path}"\\" "{path}"'
+                    source, destination = f'{remote_address}:\\""{remote_path}"\\"', f'"{path}"'
 
-        logger.debug(f'Executing rsync job id: {job.id} with the following command {line}')
         try:
-            t = threading.Thread(target=self.__rsync_worker, args=(line, user, job), daemon=True)
-            t.start()
-            t.join()
+            if parallel:
+                logger.debug(
+                    f'Executing rsync job id: {job.id} with {parallel["workers"]} workers running {line} '
+                    f'from {source} to {destination}'
+                )
+                self.__rsync_parallel(
+                    job, line, path if rcopy['direction'] == 'PUSH' else remote_path, destination, user, parallel,
+                    properties.get('delete'),
+                )
+            else:
+                line += f' {source} {destination}'
+                logger.debug(f'Executing rsync job id: {job.id} with the following command {line}')
+                t = threading.Thread(target=self.__rsync_worker, args=(line, user, job), daemon=True)
+                t.start()
+                t.join()
         finally:
             if password_file:
                 password_file.close()
 
         job.set_progress(100, 'Rsync copy job successfully completed')
 
+    @accepts(Dict(
+        'rsync-benchmark',
+        Str('path'),
+        Int('size', default=1024, validators=[Range(min=1)]),
+        Int('files', default=10000, validators=[Range(min=1)]),
+        Int('directories', default=16, validators=[Range(min=1)]),
+        Dict(
+            'parallel',
+            Int('workers', default=4, validators=[Range(min=1, max=64)]),
+            Str('partition', enum=list(PARTITIONS), default='DIRECTORY'),
+            Int('retries', default=0, validators=[Range(min=0)]),
+            default={'workers': 4, 'partition': 'DIRECTORY', 'retries': 0},
+        ),
+    ))
+    @job(lock='rsync_benchmark')
+    def benchmark(self, job, options):
+        """
+        Compare a single rsync with a `parallel` copy of the same local tree of `files` files totalling
+        `size` MiB in `directories` directories, created in a temporary directory under `path`.
+
+        Returns the `bytes` copied and the `seconds` each copy took.
+        """
+        if options.get('path') and not os.path.isdir(options['path']):
+            raise CallError(f'The specified path: {options["path"]} does not exist', errno.ENOENT)
+
+        tmp = tempfile.mkdtemp(dir=options.get('path') or None)
+        try:
+            source = os.path.join(tmp, 'source')
+            job.set_progress(0, 'Creating files')
+            benchmark_tree(source, options['files'], options['size'], options['directories'])
+
+            line = f'{RSYNC_PATH} --info=progress2 -a'
+
+            job.set_progress(0, 'Copying with a single rsync')
+            started_at = time.monotonic()
+            returncode, error = self.__rsync_run(f'{line} "{source}" "{os.path.join(tmp, "single")}"', None)
+            single = time.monotonic() - started_at
+            if returncode != 0:
+                raise CallError(f'Rsync returned non-zero exit code. Error: {error}')
+
+            started_at = time.monotonic()
+            self.__rsync_parallel(
+                job, line, source, f'"{os.path.join(tmp, "parallel")}"', None, options['parallel'], False
+            )
+            parallel = time.monotonic() - started_at
+
+            # Both copies must match the source, a fast copy that missed files is no result
+            files = tree_files(source)
+            for copy in ('single', 'parallel'):
+                if tree_files(os.path.join(tmp, copy, 'source')) != files:
+                    raise CallError(f'The {copy} copy does not match the source tree')
+            size = sum(size for size in files.values() if size is not None)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        return {
+            'bytes': size,
+            'single': {'seconds': single, 'speed': int(size / single) if single else None},
+            'parallel': {'seconds': parallel, 'speed': int(size / parallel) if parallel else None},
+        }
+
 
 class RsyncdService(SystemServiceService):
 
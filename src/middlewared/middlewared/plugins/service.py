@@ -512,6 +512,7 @@ class ServiceService(CRUDService):
 
     async def _restart_smartd(self, **kwargs):
         await self.middleware.call("etc.generate", "smartd")
+        await self.middleware.call("dataprotection.invalidate")
         await self._service("smartd-daemon", "stop", force=True, **kwargs)
         await self._service("smartd-daemon", "restart", **kwargs)
 
@@ -717,6 +718,8 @@ class ServiceService(CRUDService):
 
     async def _restart_cron(self, **kwargs):
         await self._service("ix-crontab", "start", quiet=True, **kwargs)
+        # Cloud sync, rsync and scrub tasks are scheduled by middlewared
+        await self.middleware.call("dataprotection.invalidate")
 
     async def _start_motd(self, **kwargs):
         await self._service("ix-motd", "start", quiet=True, **kwargs)
@@ -1,8 +1,29 @@
+from collections import deque
 from itertools import chain
+import asyncio
+import re
+import time
 
-from middlewared.schema import accepts, Cron, Dict, Int, List, Patch, Str
+from middlewared.common.camcontrol import camcontrol_list
+from middlewared.common.smart.smartctl import get_smartctl_args, parse_smartctl
+from middlewared.schema import accepts, Bool, Cron, Dict, Int, List, Patch, Str
 from middlewared.validators import Email, Range
-from middlewared.service import CRUDService, private, SystemServiceService, ValidationErrors
+from middlewared.service import CallError, CRUDService, periodic, private, SystemServiceService, ValidationErrors
+from middlewared.utils import run
+from middlewared.utils.asyncio_ import asyncio_map
+
+# How long (seconds) SMART data of a disk is served from cache
+SMART_CACHE_TTL = 300
+# How long (seconds) smartctl arguments of a disk (controller passthrough) are cached
+SMART_ARGS_TTL = 3600
+# How many smartctl processes may run at the same time
+SMART_CONCURRENCY = 8
+# How often (seconds) it is checked whether SMART data of all disks is due to be collected, it is collected every
+# SMART check interval
+SMART_COLLECT_TICK = 60
+# How many samples are kept per disk
+SMART_HISTORY_SIZE = 288
+RE_STANDBY = re.compile(r"^Device is in \S+ mode", re.M)
 
 
 class SMARTTestService(CRUDService):
@@ -153,6 +174,8 @@ class SMARTTestService(CRUDService):
             id
         )
 
+        await self.middleware.call('dataprotection.invalidate')
+
         return response
 
 
@@ -164,6 +187,20 @@ class SmartService(SystemServiceService):
         datastore_extend = "smart.smart_extend"
         datastore_prefix = "smart_"
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # disk -> (smartctl args, expiration)
+        self.__args = {}
+        # disk -> {"info": ..., "timestamp": ..., "expires": ...}
+        self.__cache = {}
+        # disk -> deque of samples
+        self.__history = {}
+        # disk -> future of a smartctl run in progress
+        self.__inflight = {}
+        # When (monotonic) SMART data of all disks was last collected
+        self.__collected = None
+        self.__semaphore = asyncio.BoundedSemaphore(SMART_CONCURRENCY)
+
     @private
     async def smart_extend(self, smart):
         smart["powermode"] = smart["powermode"].upper()
@@ -193,3 +230,178 @@ class SmartService(SystemServiceService):
         await self.smart_extend(new)
 
         return new
+
+    @private
+    async def smartctl_args(self, disk, camcontrol=None):
+        """
+        smartctl arguments to reach `disk` through its controller, `None` if it is not supported.
+        """
+        now = time.monotonic()
+        cached = self.__args.get(disk)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        if camcontrol is None:
+            camcontrol = await camcontrol_list()
+
+        args = None
+        if disk in camcontrol:
+            args = await get_smartctl_args(disk, camcontrol[disk])
+        self.__args[disk] = (args, now + SMART_ARGS_TTL)
+        return args
+
+    @accepts(Str('disk'), Bool('force_refresh', default=False))
+    async def disk_info(self, disk, force_refresh):
+        """
+        Returns SMART data of `disk`: identification, health, temperature, power on hours and attributes.
+
+        Data is served from cache for up to `SMART_CACHE_TTL` seconds unless `force_refresh` is set.
+        """
+        info = (await self.collect([disk], force_refresh))[disk]
+        if info is None:
+            raise CallError(f'Unable to read SMART data of {disk}')
+        return info
+
+    @accepts(Str('disk'), Str('attribute', null=True, default=None))
+    async def attributes_history(self, disk, attribute):
+        """
+        Returns SMART samples of `disk` collected over time, oldest first.
+
+        If `attribute` (name or id) is given only its `value`, `worst` and `raw` are returned for each sample.
+        """
+        history = list(self.__history.get(disk, []))
+        if attribute is None:
+            return history
+
+        result = []
+        for sample in history:
+            for attr in sample['attributes']:
+                if attribute in (attr['name'], str(attr['id'])):
+                    result.append({
+                        'timestamp': sample['timestamp'],
+                        'value': attr['value'],
+                        'worst': attr['worst'],
+                        'raw': attr['raw'],
+                    })
+                    break
+        return result
+
+    @private
+    async def invalidate(self, disk=None):
+        if disk is None:
+            self.__args.clear()
+            self.__cache.clear()
+        else:
+            self.__args.pop(disk, None)
+            self.__cache.pop(disk, None)
+
+    @private
+    async def collect(self, disks, force_refresh=False, powermode='NEVER'):
+        """
+        Read SMART data of `disks` concurrently, returns {disk: info or None}.
+
+        Disks in a low power mode matching `powermode` are not woken up, their last data is kept.
+        """
+        now = time.monotonic()
+        result = {}
+        pending = []
+        for disk in disks:
+            entry = self.__cache.get(disk)
+            if not force_refresh and entry is not None and entry['expires'] > now:
+                result[disk] = entry['info']
+            else:
+                pending.append(disk)
+
+        if pending:
+            camcontrol = None
+            if any(disk not in self.__args for disk in pending):
+                camcontrol = await camcontrol_list()
+
+            infos = await asyncio_map(lambda disk: self.__collect_disk(disk, camcontrol, powermode), pending)
+            result.update(zip(pending, infos))
+
+        return result
+
+    async def __collect_disk(self, disk, camcontrol, powermode):
+        # Requests for a disk being read wait for that read instead of running smartctl again
+        fut = self.__inflight.get(disk)
+        if fut is not None:
+            return await asyncio.shield(fut)
+
+        fut = self.__inflight[disk] = asyncio.get_event_loop().create_future()
+        try:
+            async with self.__semaphore:
+                info = await self.__read_disk(disk, camcontrol, powermode)
+            fut.set_result(info)
+        except BaseException as e:
+            fut.set_exception(e)
+            # Waiters get the exception, do not warn about it not being retrieved
+            fut.exception()
+            raise
+        finally:
+            self.__inflight.pop(disk, None)
+
+        return info
+
+    async def __read_disk(self, disk, camcontrol, powermode):
+        args = await self.smartctl_args(disk, camcontrol)
+        if not args:
+            return None
+
+        cmd = ['/usr/local/sbin/smartctl', '-a']
+        if powermode != 'NEVER':
+            cmd += ['-n', powermode.lower()]
+        cp = await run(cmd + args, check=False)
+        output = cp.stdout.decode('utf8', 'ignore')
+
+        entry = self.__cache.get(disk)
+        if RE_STANDBY.search(output):
+            return entry['info'] if entry else None
+
+        # Bits 0 and 1 of the exit status mean the device could not be read at all
+        if cp.returncode & 0b11:
+            self.logger.debug('smartctl failed for %s: %s', disk, output)
+            return None
+
+        timestamp = time.time()
+        info = dict(parse_smartctl(output), disk=disk, timestamp=timestamp)
+        self.__cache[disk] = {'info': info, 'expires': time.monotonic() + SMART_CACHE_TTL}
+
+        history = self.__history.get(disk)
+        if history is None:
+            history = self.__history[disk] = deque(maxlen=SMART_HISTORY_SIZE)
+        history.append({
+            'timestamp': timestamp,
+            'temperature': info['temperature'],
+            'power_on_hours': info['power_on_hours'],
+            'attributes': [
+                {k: attr[k] for k in ('id', 'name', 'value', 'worst', 'raw')} for attr in info['attributes']
+            ],
+        })
+
+        return info
+
+    @private
+    @periodic(SMART_COLLECT_TICK, run_on_start=False)
+    async def collect_all(self):
+        """
+        Sample SMART data of all disks with SMART enabled every SMART check interval, without waking up sleeping
+        disks. Nothing is sampled while the SMART service is not enabled.
+        """
+        if not await self.middleware.call(
+            'datastore.query', 'services.services', [('srv_service', '=', 'smartd'), ('srv_enable', '=', True)]
+        ):
+            return
+
+        config = await self.config()
+        now = time.monotonic()
+        if self.__collected is not None and now - self.__collected < config['interval'] * 60:
+            return
+        self.__collected = now
+
+        disks = [disk['name'] for disk in await self.middleware.call('disk.query', [('togglesmart', '=', True)])]
+        await self.collect(disks, True, config['powermode'])
+
+        for disk in set(self.__history) - set(disks):
+            self.__history.pop(disk, None)
+            self.__cache.pop(disk, None)
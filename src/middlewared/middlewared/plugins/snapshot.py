@@ -1,9 +1,16 @@
-from datetime import time
+from datetime import datetime, time
+from time import monotonic
 
 from middlewared.schema import accepts, Bool, Dict, Int, List, Patch, Str
-from middlewared.service import CRUDService, private, ValidationErrors
+from middlewared.service import CRUDService, job, private, ValidationErrors
+from middlewared.utils import run
+from middlewared.utils.periodic_snapshot import SnapshotInventory, plan_snapshots, task_matches
 from middlewared.validators import Range, Time
 
+# Seconds the inventory of periodic snapshots is trusted before listing them again
+SNAPSHOT_INVENTORY_TTL = 3600
+SNAPSHOT_MAIL_INTERVAL = 3600
+
 
 class PeriodicSnapshotTaskService(CRUDService):
 
@@ -13,6 +20,11 @@ class PeriodicSnapshotTaskService(CRUDService):
         datastore_extend = 'pool.snapshottask.periodic_snapshot_extend'
         namespace = 'pool.snapshottask'
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.inventory = None
+        self.inventory_loaded_at = None
+
     @private
     def periodic_snapshot_extend(self, data):
         data['begin'] = str(data['begin'])
@@ -22,6 +34,157 @@ class PeriodicSnapshotTaskService(CRUDService):
         data.pop('repeat_unit', None)
         return data
 
+    @private
+    @job(lock='periodic_snapshot_run_pending')
+    async def run_pending(self, job):
+        """
+        Take the snapshots of enabled periodic snapshot tasks that are due and destroy the expired ones.
+        """
+        now = datetime.now().replace(microsecond=0)
+        if now.second < 30 or now.minute == 59:
+            snaptime = now.replace(second=0)
+        else:
+            snaptime = now.replace(minute=now.minute + 1, second=0)
+
+        cp = await run('zpool', 'list', '-H', '-o', 'name', check=False)
+        pools = set(cp.stdout.decode('utf-8', 'ignore').split())
+
+        tasks = []
+        for task in await self.query([('enabled', '=', True)]):
+            if task['filesystem'].split('/')[0] not in pools:
+                if task_matches(task, snaptime):
+                    self.logger.warning('Pool of %s not imported, skipping snapshot task #%d', task['filesystem'],
+                                        task['id'])
+                continue
+            tasks.append(task)
+
+        if not tasks:
+            return
+
+        inventory = await self.get_inventory()
+        create, destroy = await self.middleware.run_in_thread(plan_snapshots, tasks, inventory, snaptime)
+
+        for recursive, snapshots in create:
+            await self.create_snapshots(inventory, recursive, snapshots)
+
+        if destroy:
+            if await self.middleware.call('core.get_jobs', [('method', '=', 'replication.run'),
+                                                            ('state', '=', 'RUNNING')]):
+                self.logger.debug('Replication running, skip destroying snapshots')
+            else:
+                await self.destroy_snapshots(inventory, destroy)
+
+    @private
+    async def get_inventory(self):
+        """
+        Periodic snapshots inventory, listed from ZFS once every `SNAPSHOT_INVENTORY_TTL` and kept up to date with
+        the snapshots taken and destroyed by `run_pending` in between.
+        """
+        if self.inventory is None or monotonic() - self.inventory_loaded_at > SNAPSHOT_INVENTORY_TTL:
+            cp = await run('zfs', 'list', '-H', '-t', 'snapshot', '-o', 'name', check=False)
+            if cp.returncode != 0:
+                self.logger.warning('Failed to list snapshots: %s', cp.stderr.decode('utf-8', 'ignore'))
+            self.inventory = await self.middleware.run_in_thread(
+                SnapshotInventory.load, cp.stdout.decode('utf-8', 'ignore').splitlines()
+            )
+            self.inventory_loaded_at = monotonic()
+
+        return self.inventory
+
+    @private
+    async def create_snapshots(self, inventory, recursive, snapshots):
+        # VMs stored on the datasets are snapshotted during the ZFS snapshot, the ones that have consistent VM
+        # snapshots inside them are taken separately to be flagged as such
+        vmware = await self.middleware.call('vmware.query')
+        contexts = []
+        for snapshot in snapshots:
+            dataset = snapshot.split('@')[0]
+            if any(
+                v['filesystem'] == dataset or (recursive and v['filesystem'].startswith(dataset + '/'))
+                for v in vmware
+            ):
+                contexts.append(await self.middleware.call('vmware.snapshot_begin', snapshot, recursive))
+
+        vmsynced = [context['snapshot'] for context in contexts if context['vmsynced']]
+        try:
+            for args, group in (
+                (['-o', 'freenas:vmsynced=Y'], vmsynced),
+                ([], [snapshot for snapshot in snapshots if snapshot not in vmsynced]),
+            ):
+                if not group:
+                    continue
+
+                # Snapshots of a single command are taken atomically
+                error = await self.__zfs_snapshot(recursive, args, group)
+                if error is None:
+                    taken = group
+                elif len(group) == 1:
+                    await self.__snapshot_failed(group, error)
+                    continue
+                else:
+                    # A single task whose dataset is gone fails the whole command, take the snapshots one by one
+                    # so that only that task fails
+                    taken = []
+                    for snapshot in group:
+                        error = await self.__zfs_snapshot(recursive, args, [snapshot])
+                        if error is None:
+                            taken.append(snapshot)
+                        else:
+                            await self.__snapshot_failed([snapshot], error)
+
+                for snapshot in taken:
+                    inventory.add(snapshot)
+                    if recursive:
+                        # Children created since the inventory was listed are snapshotted as well
+                        dataset, name = snapshot.split('@')
+                        for child in await self.__children(dataset):
+                            inventory.add(f'{child}@{name}')
+        finally:
+            for context in contexts:
+                await self.middleware.call('vmware.snapshot_end', context)
+
+    async def __zfs_snapshot(self, recursive, args, snapshots):
+        cp = await run('zfs', 'snapshot', *(['-r'] if recursive else []), *args, *snapshots, check=False)
+        if cp.returncode != 0:
+            return cp.stderr.decode('utf-8', 'ignore').strip()
+
+    async def __snapshot_failed(self, snapshots, error):
+        self.logger.error('Failed to create snapshots %s: %s', ', '.join(snapshots), error)
+        # Snapshot may already exist, list them again
+        self.inventory = None
+        try:
+            await self.middleware.call('mail.send', {
+                'subject': f'Snapshot failed! ({", ".join(snapshots)})',
+                'text': f'Hello,\n    Snapshot {", ".join(snapshots)} failed with the following error: {error}',
+                'interval': SNAPSHOT_MAIL_INTERVAL,
+                'channel': 'autosnap',
+            })
+        except Exception:
+            self.logger.warning('Failed to send snapshot failure notification', exc_info=True)
+
+    async def __children(self, dataset):
+        cp = await run('zfs', 'list', '-H', '-o', 'name', '-t', 'filesystem,volume', '-r', dataset, check=False)
+        if cp.returncode != 0:
+            self.logger.warning('Failed to list children of %s: %s', dataset, cp.stderr.decode('utf-8', 'ignore'))
+            self.inventory = None
+            return []
+        return cp.stdout.decode('utf-8', 'ignore').splitlines()
+
+    @private
+    async def destroy_snapshots(self, inventory, destroy):
+        for dataset, names in destroy:
+            # Snapshots with clones will have destruction deferred
+            cp = await run('zfs', 'destroy', '-r', '-d', f'{dataset}@{",".join(names)}', check=False)
+            if cp.returncode != 0:
+                self.logger.error('Failed to destroy snapshots of %s: %s', dataset,
+                                  cp.stderr.decode('utf-8', 'ignore').strip())
+                self.inventory = None
+                continue
+
+            for child in inventory.descendants(dataset):
+                for name in names:
+                    inventory.remove(f'{child}@{name}')
+
     @private
     async def common_validation(self, data, schema_name):
         verrors = ValidationErrors()
@@ -1,15 +1,27 @@
 from middlewared.client import ejson as json
 from middlewared.schema import Dict, Int, List, Str, accepts
-from middlewared.service import CallError, Service, ValidationError
+from middlewared.service import CallError, Service, ValidationError, cached, private
 from middlewared.utils import Popen
+from middlewared.utils.lru import LRUCache
+from middlewared.utils.rrd import XPORT_MAXROWS, RRDError, RRDFile, RRDUnsupported, resolve_times, xport
+from middlewared.utils.timeseries import aggregate, bucket, encode, lttb
+from middlewared.validators import Range
 
+import fnmatch
 import glob
+import math
 import os
 import re
 import subprocess
 
 
 RRD_PATH = '/var/db/collectd/rrd/localhost/'
+# Results of `get_data` kept in memory. They are only served while the RRD files did not change,
+# TTL bounds how long unused ones are kept around.
+RRD_CACHE_ITEMS = 256
+RRD_CACHE_TTL = 300
+# `query` downsamples from this many times the requested number of points
+QUERY_OVERSAMPLING = 10
 RE_DSTYPE = re.compile(r'ds\[(\w+)\]\.type = "(\w+)"')
 RE_STEP = re.compile(r'step = (\d+)')
 RE_LAST_UPDATE = re.compile(r'last_update = (\d+)')
@@ -17,7 +29,12 @@ RE_LAST_UPDATE = re.compile(r'last_update = (\d+)')
 
 class StatsService(Service):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__cache = LRUCache(max_items=RRD_CACHE_ITEMS)
+
     @accepts()
+    @cached(60)
     def get_sources(self):
         """
         Returns an object with all available sources tried with metric datasets.
@@ -40,6 +57,16 @@ class StatsService(Service):
         Returns info about a given dataset from some source.
         """
         rrdfile = '{}/{}/{}.rrd'.format(RRD_PATH, source, _type)
+        try:
+            info = await self.middleware.run_in_thread(self.__native_dataset_info, rrdfile)
+        except RRDUnsupported:
+            pass
+        except (OSError, RRDError) as e:
+            raise ValueError('Failed to read {}: {}'.format(rrdfile, e))
+        else:
+            info.update({'source': source, 'type': _type})
+            return info
+
         proc = await Popen(
             ['/usr/local/bin/rrdtool', 'info', rrdfile],
             stdout=subprocess.PIPE,
@@ -66,6 +93,15 @@ class StatsService(Service):
             info['last_update'] = int(reg.group(1))
         return info
 
+    def __native_dataset_info(self, rrdfile):
+        with RRDFile(rrdfile) as rrd:
+            info = rrd.info()
+        return {
+            'datasets': info['ds'],
+            'step': info['step'],
+            'last_update': info['last_update'],
+        }
+
     @accepts(
         List('stats_list', items=[
             Dict(
@@ -91,10 +127,40 @@ class StatsService(Service):
         if not data_list:
             raise ValidationError('stats_list', 'This parameter cannot be empty')
 
+        names_pair = [[data['source'], data['type']] for data in data_list]
+        data = await self.__xport(data_list, stats)
+
+        # Custom about property
+        data['about'] = 'Data for ' + ','.join(['/'.join(i) for i in names_pair])
+        return data
+
+    async def __xport(self, data_list, stats, maxrows=XPORT_MAXROWS):
+        try:
+            return await self.middleware.run_in_thread(self.__native_xport, data_list, stats, maxrows)
+        except RRDUnsupported:
+            return await self.__rrdtool_xport(data_list, stats, maxrows)
+        except (OSError, RRDError) as e:
+            raise CallError('Failed to read RRD data: {}'.format(e))
+
+    def __native_xport(self, data_list, stats, maxrows):
+        start, end = resolve_times(stats['start'], stats['end'])
+        defs = [
+            (
+                '{}/{}/{}.rrd'.format(RRD_PATH, data['source'], data['type']),
+                data['dataset'],
+                data['cf'],
+                '{}/{}'.format(data['source'], data['type']),
+            )
+            for data in data_list
+        ]
+        # Cached results are shared, give callers their own top level dict
+        return dict(xport(
+            defs, start, end, stats.get('step') or 0, maxrows=maxrows, cache=self.__cache, ttl=RRD_CACHE_TTL,
+        ))
+
+    async def __rrdtool_xport(self, data_list, stats, maxrows):
         defs = []
-        names_pair = []
         for i, data in enumerate(data_list):
-            names_pair.append([data['source'], data['type']])
             rrdfile = '{}/{}/{}.rrd'.format(RRD_PATH, data['source'], data['type'])
             defs.extend([
                 'DEF:xxx{}={}:{}:{}'.format(i, rrdfile, data['dataset'], data['cf']),
@@ -103,7 +169,7 @@ class StatsService(Service):
         proc = await Popen(
             [
                 '/usr/local/bin/rrdtool', 'xport', '--json',
-                '--start', stats['start'], '--end', stats['end'],
+                '--start', stats['start'], '--end', stats['end'], '--maxrows', str(maxrows),
             ] + (['--step', str(stats['step'])] if stats.get('step') else []) + defs,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
@@ -111,8 +177,130 @@ class StatsService(Service):
         data, err = await proc.communicate()
         if proc.returncode != 0:
             raise CallError('rrdtool failed: {}'.format(err.decode()))
-        data = json.loads(data.decode())
+        return json.loads(data.decode())
 
-        # Custom about property
-        data['about'] = 'Data for ' + ','.join(['/'.join(i) for i in names_pair])
-        return data
+    @accepts(
+        List('series', items=[
+            Dict(
+                'stats-series',
+                Str('source', required=True),
+                Str('type', required=True),
+                Str('dataset', required=True),
+                Str('cf', default='AVERAGE', enum=['AVERAGE', 'MIN', 'MAX', 'LAST']),
+            )
+        ]),
+        Dict(
+            'stats-query',
+            Str('start', default='now-1h'),
+            Str('end', default='now'),
+            Int('points', default=400, validators=[Range(min=3)]),
+            Str('downsample', default='LTTB', enum=['LTTB', 'MINMAX', 'AVERAGE', 'NONE']),
+            Str('aggregate', default='NONE', enum=['NONE', 'SUM', 'AVERAGE', 'MIN', 'MAX', 'PERCENTILE']),
+            Int('percentile', default=95, validators=[Range(min=0, max=100)]),
+            Str('encoding', default='JSON', enum=['JSON', 'BASE64']),
+        ),
+    )
+    async def query(self, series, options):
+        """
+        Query many series at once, reduced to about `points` points each.
+
+        `source` and `type` of each series may be shell-style patterns (e.g. `disk-*`) matching
+        every available source and type (see `get_sources`).
+
+        `aggregate` combines all matching series into a single one (e.g. SUM of all disks or the
+        `percentile`th percentile of all interfaces) before downsampling.
+
+        `downsample` picks how series are reduced to `points`:
+          - LTTB: keeps the visual shape of the series; each series gets its own `timestamps`
+          - AVERAGE: average of consecutive buckets, sampled at `start` + n * `step`
+          - MINMAX: like AVERAGE plus `min` and `max` of each bucket
+          - NONE: every row
+
+        With `encoding` BASE64 arrays are sent as base64 of little endian float32 (timestamps as int64),
+        unknown values being NaN, instead of JSON lists where they are null.
+
+        .. examples(websocket)::
+
+          Latency percentile of all disks for the last day
+
+            :::javascript
+            {
+                "id": "6841f242-840a-11e6-a437-00e04d680384",
+                "msg": "method",
+                "method": "stats.query",
+                "params": [
+                    [{"source": "geom_stat", "type": "geom_latency-*", "dataset": "value"}],
+                    {"start": "now-1d", "aggregate": "PERCENTILE", "percentile": 95}
+                ]
+            }
+        """
+        sources = await self.middleware.call('stats.get_sources')
+        data_list = []
+        for s in series:
+            for source in sorted(fnmatch.filter(sources.keys(), s['source'])):
+                for _type in sorted(fnmatch.filter(sources[source], s['type'])):
+                    data_list.append({'source': source, 'type': _type, 'dataset': s['dataset'], 'cf': s['cf']})
+
+        if not data_list:
+            raise ValidationError('series', 'No series matching the query')
+
+        data = await self.__xport(
+            data_list, {'start': options['start'], 'end': options['end'], 'step': 0},
+            options['points'] * QUERY_OVERSAMPLING,
+        )
+        return await self.middleware.run_in_thread(self.__reduce, data_list, data, options)
+
+    def __reduce(self, data_list, data, options):
+        meta = data['meta']
+        names = ['{}/{}/{}'.format(d['source'], d['type'], d['dataset']) for d in data_list]
+        columns = [
+            [math.nan if value is None else value for value in column]
+            for column in zip(*data['data'])
+        ] or [[] for name in names]
+
+        if options['aggregate'] != 'NONE':
+            columns = [aggregate(columns, options['aggregate'], options['percentile'])]
+            if options['aggregate'] == 'PERCENTILE':
+                names = ['p{}'.format(options['percentile'])]
+            else:
+                names = [options['aggregate'].lower()]
+
+        def values(v):
+            if options['encoding'] == 'BASE64':
+                return encode(v)
+            return [None if math.isnan(i) else i for i in v]
+
+        def timestamps(v):
+            if options['encoding'] == 'BASE64':
+                return encode(v, 'q')
+            return list(v)
+
+        result = {
+            'start': meta['start'],
+            'end': meta['end'],
+            'step': meta['step'],
+            'series': [],
+        }
+        for name, column in zip(names, columns):
+            if options['downsample'] == 'LTTB':
+                ts, column = lttb(
+                    range(meta['start'], meta['start'] + len(column) * meta['step'], meta['step']),
+                    column, options['points'],
+                )
+                result['series'].append({'name': name, 'timestamps': timestamps(ts), 'values': values(column)})
+            elif options['downsample'] in ('AVERAGE', 'MINMAX'):
+                size, buckets = bucket(column, options['points'])
+                result['step'] = meta['step'] * size
+                entry = {'name': name, 'values': values([b[0] for b in buckets])}
+                if options['downsample'] == 'MINMAX':
+                    entry['min'] = values([b[1] for b in buckets])
+                    entry['max'] = values([b[2] for b in buckets])
+                result['series'].append(entry)
+            else:
+                result['series'].append({'name': name, 'values': values(column)})
+
+        return result
+
+    @private
+    async def cache_stats(self):
+        return self.__cache.stats()
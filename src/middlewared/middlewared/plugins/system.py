@@ -1,7 +1,7 @@
 from datetime import datetime, date
 from middlewared.event import EventSource
 from middlewared.schema import accepts, Bool, Dict, Int, IPAddr, Str
-from middlewared.service import ConfigService, no_auth_required, job, private, Service, ValidationErrors
+from middlewared.service import ConfigService, cached, no_auth_required, job, private, Service, ValidationErrors
 from middlewared.utils import Popen, start_daemon_thread, sw_buildtime, sw_version
 from middlewared.validators import Range
 
@@ -28,8 +28,6 @@ from freenasUI.system.utils import debug_get_settings, debug_run
 # Flag telling whether the system completed boot and is ready to use
 SYSTEM_READY = False
 
-CACHE_POOLS_STATUSES = 'system.system_health_pools'
-
 
 class SytemAdvancedService(ConfigService):
 
@@ -270,17 +268,7 @@ class SystemService(Service):
             shell=True,
         )).communicate())[0].decode().strip()
 
-        serial = await self._system_serial()
-
-        product = (await(await Popen(
-            ['dmidecode', '-s', 'system-product-name'],
-            stdout=subprocess.PIPE,
-        )).communicate())[0].decode().strip() or None
-
-        manufacturer = (await(await Popen(
-            ['dmidecode', '-s', 'system-manufacturer'],
-            stdout=subprocess.PIPE,
-        )).communicate())[0].decode().strip() or None
+        dmidecode = await self.middleware.call('system.dmidecode_info')
 
         return {
             'version': self.version(),
@@ -292,14 +280,36 @@ class SystemService(Service):
             'loadavg': os.getloadavg(),
             'uptime': uptime,
             'uptime_seconds': time.clock_gettime(5),  # CLOCK_UPTIME = 5
-            'system_serial': serial,
-            'system_product': product,
+            'system_serial': dmidecode['system_serial'],
+            'system_product': dmidecode['system_product'],
             'license': await self.__get_license(),
             'boottime': datetime.fromtimestamp(
                 struct.unpack('l', sysctl.filter('kern.boottime')[0].value[:8])[0]
             ),
             'datetime': datetime.utcnow(),
             'timezone': (await self.middleware.call('datastore.config', 'system.settings'))['stg_timezone'],
+            'system_manufacturer': dmidecode['system_manufacturer'],
+        }
+
+    @private
+    @cached(86400)
+    async def dmidecode_info(self):
+        """
+        Hardware information from dmidecode, it does not change while we are running.
+        """
+        product = (await(await Popen(
+            ['dmidecode', '-s', 'system-product-name'],
+            stdout=subprocess.PIPE,
+        )).communicate())[0].decode().strip() or None
+
+        manufacturer = (await(await Popen(
+            ['dmidecode', '-s', 'system-manufacturer'],
+            stdout=subprocess.PIPE,
+        )).communicate())[0].decode().strip() or None
+
+        return {
+            'system_serial': await self._system_serial(),
+            'system_product': product,
             'system_manufacturer': manufacturer,
         }
 
@@ -742,16 +752,6 @@ async def _event_system_ready(middleware, event_type, args):
         SYSTEM_READY = True
 
 
-async def _event_zfs_status(middleware, event_type, args):
-    """
-    This is so we can invalidate the CACHE_POOLS_STATUSES cache
-    when pool status changes
-    """
-    data = args['data']
-    if data.get('type') == 'misc.fs.zfs.vdev_statechange':
-        await middleware.call('cache.pop', CACHE_POOLS_STATUSES)
-
-
 class SystemHealthEventSource(EventSource):
 
     def __init__(self, *args, **kwargs):
@@ -765,9 +765,10 @@ class SystemHealthEventSource(EventSource):
             self._cancel.wait(timeout=60 * 60 * 24)
 
     def pools_statuses(self):
+        health = self.middleware.call_sync('zfs.pool.health')['pools']
         return {
-            p['name']: {'status': p['status']}
-            for p in self.middleware.call_sync('pool.query')
+            p['vol_name']: {'status': health[p['vol_name']]['status'] if p['vol_name'] in health else 'OFFLINE'}
+            for p in self.middleware.call_sync('datastore.query', 'storage.volume')
         }
 
     def run(self):
@@ -796,12 +797,7 @@ class SystemHealthEventSource(EventSource):
 
             cpu_percent = round((sum(cp_diff[:3]) / sum(cp_diff)) * 100, 2)
 
-            pools = self.middleware.call_sync(
-                'cache.get_or_put',
-                CACHE_POOLS_STATUSES,
-                1800,
-                self.pools_statuses,
-            )
+            pools = self.pools_statuses()
 
             self.send_event('ADDED', fields={
                 'cpu_percent': cpu_percent,
@@ -817,5 +813,4 @@ def setup(middleware):
         SYSTEM_READY = True
 
     middleware.event_subscribe('system', _event_system_ready)
-    middleware.event_subscribe('devd.zfs', _event_zfs_status)
     middleware.register_event_source('system.health', SystemHealthEventSource)
@@ -474,10 +474,8 @@ Changelog:
 
         try:
             job.set_progress(10, 'Writing uploaded file to disk')
-            with open(destfile, 'wb') as f:
-                await self.middleware.run_in_thread(
-                    shutil.copyfileobj, job.pipes.input.r, f, 1048576,
-                )
+            with open(destfile, 'wb', buffering=0) as f:
+                await self.middleware.run_in_thread(job.pipes.input.copy_to_file, f)
 
             def do_update():
                 try:
@@ -1,14 +1,23 @@
+from datetime import datetime
 import errno
+import pickle
 import socket
 import ssl
+import uuid
+
+from lockfile import LockFile
 
 from middlewared.async_validators import resolve_hostname
 from middlewared.schema import accepts, Dict, Int, Str, Patch
 from middlewared.service import CallError, CRUDService, private, ValidationErrors
 
-from pyVim import connect
+from pyVim import connect, task as VimTask
 from pyVmomi import vim, vmodl
 
+VMWARE_FAILS = '/var/tmp/.vmwaresnap_fails'
+VMWARELOGIN_FAILS = '/var/tmp/.vmwarelogin_fails'
+VMWARESNAPDELETE_FAILS = '/var/tmp/.vmwaresnapdelete_fails'
+
 
 class VMWareService(CRUDService):
 
@@ -230,3 +239,210 @@ class VMWareService(CRUDService):
             }
             vms[vm.config.uuid] = data
         return vms
+
+    @private
+    def snapshot_begin(self, snapshot, recursive):
+        """
+        Snapshot the running VMs stored on the dataset of ZFS `snapshot` (and its children if `recursive`) before
+        it is taken, having VMware snapshots in existence impacts the performance of the VMs so `snapshot_end` must be
+        called with the returned context once the ZFS snapshot is done.
+
+        `vmsynced` in the context tells whether the ZFS snapshot has consistent VM snapshots inside it.
+        """
+        # A unique name that (hopefully) won't collide with anything on the VMware side, the description helps
+        # to determine where a dangling snapshot came from
+        dataset = snapshot.split('@')[0]
+        context = {
+            'snapshot': snapshot,
+            'vmsnapname': str(uuid.uuid4()),
+            'vmsnapobjs': [],
+            'vmsynced': False,
+        }
+        vmsnapdescription = str(datetime.now()).split('.')[0] + ' FreeNAS Created Snapshot'
+
+        vmlogin_fails = {}
+        for vmsnapobj in self.middleware.call_sync('vmware.query'):
+            if not (
+                vmsnapobj['filesystem'] == dataset or
+                (recursive and vmsnapobj['filesystem'].startswith(dataset + '/'))
+            ):
+                continue
+
+            vmsnapobj.update({'vms': [], 'fails': [], 'skips': []})
+            context['vmsnapobjs'].append(vmsnapobj)
+            try:
+                si = self._connect(vmsnapobj)
+                content = si.RetrieveContent()
+            except Exception as e:
+                self.logger.warning('VMware login failed to %s', vmsnapobj['hostname'], exc_info=True)
+                vmlogin_fails[vmsnapobj['id']] = getattr(e, 'msg', None) or str(e)
+                continue
+
+            # There's no point to even consider VMs that are paused or powered off
+            vm_view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+            for vm in vm_view.view:
+                if vm.summary.runtime.powerState != 'poweredOn':
+                    continue
+                if not self._vm_depends_on_datastore(vm, vmsnapobj['datastore']):
+                    continue
+
+                try:
+                    if self._can_snapshot_vm(vm):
+                        # The VM may use two datastores mapped to the same ZFS dataset
+                        if self._find_vm_snapshot(vm, context['vmsnapname']) is None:
+                            VimTask.WaitForTask(vm.CreateSnapshot_Task(
+                                name=context['vmsnapname'],
+                                description=vmsnapdescription,
+                                memory=False, quiesce=False,
+                            ))
+                    else:
+                        self.logger.info('Can\'t snapshot VM %s that depends on datastore %s and filesystem %s. '
+                                         'Possibly using PT devices. Skipping.', vm.name, vmsnapobj['datastore'],
+                                         dataset)
+                        vmsnapobj['skips'].append(vm.config.uuid)
+                except Exception as e:
+                    self.logger.warning('Snapshot of VM %s failed', vm.name, exc_info=True)
+                    vmsnapobj['fails'].append((vm.config.uuid, vm.name, str(e)))
+                vmsnapobj['vms'].append(vm.config.uuid)
+
+            connect.Disconnect(si)
+
+        try:
+            with LockFile(VMWARELOGIN_FAILS):
+                with open(VMWARELOGIN_FAILS, 'wb') as f:
+                    pickle.dump(vmlogin_fails, f)
+        except Exception:
+            self.logger.debug('Failed to write vmware login fails file', exc_info=True)
+
+        for vmsnapobj in context['vmsnapobjs']:
+            if vmsnapobj['fails']:
+                self._save_fails(VMWARE_FAILS, snapshot, [
+                    f'{name}: {error}' for vm_uuid, name, error in vmsnapobj['fails']
+                ])
+                self._notify(
+                    f'VMware Snapshot failed! ({snapshot})',
+                    f'The following VM failed to snapshot {snapshot}:\n' + '    \n'.join(
+                        f'{name}: {error}' for vm_uuid, name, error in vmsnapobj['fails']
+                    ),
+                )
+
+        context['vmsynced'] = bool(context['vmsnapobjs']) and all(
+            vmsnapobj['vms'] and not vmsnapobj['fails'] for vmsnapobj in context['vmsnapobjs']
+        )
+        return context
+
+    @private
+    def snapshot_end(self, context):
+        """
+        Remove the VM snapshots created by `snapshot_begin`.
+        """
+        for vmsnapobj in context['vmsnapobjs']:
+            try:
+                si = self._connect(vmsnapobj)
+            except Exception:
+                self.logger.warning('VMware login failed to %s', vmsnapobj['hostname'])
+                continue
+
+            failed = {vm_uuid for vm_uuid, name, error in vmsnapobj['fails']}
+            snapdeletefails = []
+            for vm_uuid in vmsnapobj['vms']:
+                if vm_uuid in failed or vm_uuid in vmsnapobj['skips']:
+                    continue
+
+                vm = si.content.searchIndex.FindByUuid(None, vm_uuid, True)
+                if not vm:
+                    self.logger.debug('Could not find VM %s', vm_uuid)
+                    continue
+
+                snap = self._find_vm_snapshot(vm, context['vmsnapname'])
+                try:
+                    if snap is not None:
+                        VimTask.WaitForTask(snap.RemoveSnapshot_Task(True))
+                except Exception:
+                    self.logger.debug('Exception removing snapshot %s %s', vm.name, context['vmsnapname'],
+                                      exc_info=True)
+                    snapdeletefails.append(vm.name)
+
+            if snapdeletefails:
+                self._save_fails(VMWARESNAPDELETE_FAILS, context['snapshot'], snapdeletefails)
+                self._notify(
+                    f'VMware Snapshot deletion failed! ({context["snapshot"]})',
+                    f'The following VM snapshot(s) failed to delete {context["snapshot"]}:\n' +
+                    '    \n'.join(snapdeletefails),
+                )
+
+            connect.Disconnect(si)
+
+    def _connect(self, vmsnapobj):
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        ssl_context.verify_mode = ssl.CERT_NONE
+        return connect.SmartConnect(
+            host=vmsnapobj['hostname'],
+            user=vmsnapobj['username'],
+            pwd=vmsnapobj['password'],
+            sslContext=ssl_context,
+        )
+
+    def _vm_depends_on_datastore(self, vm, datastore):
+        try:
+            # VM config data is on the datastore
+            for i in vm.datastore:
+                if i.info.name.startswith(datastore):
+                    return True
+            # VM has disks on the datastore
+            for device in vm.config.hardware.device:
+                if device.backing is None:
+                    continue
+                if hasattr(device.backing, 'fileName'):
+                    if device.backing.datastore.info.name == datastore:
+                        return True
+        except Exception:
+            self.logger.debug('Exception in _vm_depends_on_datastore', exc_info=True)
+        return False
+
+    def _can_snapshot_vm(self, vm):
+        try:
+            # PCI pass-through devices can't be snapshotted, see
+            # https://kb.vmware.com/selfservice/microsites/search.do?language=en_US&cmd=displayKC&externalId=1006392
+            for device in vm.config.hardware.device:
+                if isinstance(device, vim.VirtualPCIPassthrough):
+                    return False
+        except Exception:
+            self.logger.debug('Exception in _can_snapshot_vm', exc_info=True)
+        return True
+
+    def _find_vm_snapshot(self, vm, name):
+        try:
+            tree = vm.snapshot.rootSnapshotList
+            while tree[0].childSnapshotList is not None:
+                snap = tree[0]
+                if snap.name == name:
+                    return snap.snapshot
+                if len(tree[0].childSnapshotList) < 1:
+                    break
+                tree = tree[0].childSnapshotList
+        except Exception:
+            self.logger.debug('Exception in _find_vm_snapshot', exc_info=True)
+        return None
+
+    def _save_fails(self, path, snapname, fails):
+        # Read by the VMware snapshot alert sources
+        with LockFile(path):
+            try:
+                with open(path, 'rb') as f:
+                    saved = pickle.load(f)
+            except Exception:
+                saved = {}
+            saved[snapname] = fails
+            with open(path, 'wb') as f:
+                pickle.dump(saved, f)
+
+    def _notify(self, subject, text):
+        try:
+            self.middleware.call_sync('mail.send', {
+                'subject': subject,
+                'text': f'Hello,\n    {text}',
+                'channel': 'snapvmware',
+            })
+        except Exception:
+            self.logger.warning('Failed to send VMware snapshot notification', exc_info=True)
@@ -5,7 +5,7 @@ import textwrap
 import threading
 import time
 
-from bsd import getmntinfo, geom
+from bsd import getmntinfo
 import humanfriendly
 import libzfs
 
@@ -16,7 +16,11 @@ from middlewared.service import (
 )
 from middlewared.utils import filter_list, start_daemon_thread
 
-SCAN_THREADS = {}
+# How often (seconds) pools health is sampled, and how often while a scrub/resilver is running
+POOL_HEALTH_INTERVAL = 30
+POOL_HEALTH_SCAN_INTERVAL = 2
+
+POOL_HEALTH = None
 
 
 def find_vdev(pool, vname):
@@ -69,20 +73,11 @@ class ZFSPoolService(Service):
         except libzfs.ZFSException as e:
             raise CallError(str(e), errno.ENOENT)
 
-        geom.scan()
-        labelclass = geom.class_by_name('LABEL')
+        topology = self.middleware.call_sync('geom.topology')
         for absdev in disks:
             dev = absdev.replace('/dev/', '').replace('.eli', '')
-            find = labelclass.xml.findall(f".//provider[name='{dev}']/../consumer/provider")
-            name = None
-            if find:
-                name = geom.provider_by_id(find[0].get('ref')).geom.name
-            else:
-                g = geom.geom_by_name('DEV', dev)
-                if g:
-                    name = g.consumer.provider.geom.name
-
-            if name and geom.geom_by_name('DISK', name):
+            name = topology.dev_to_disk(dev)
+            if name:
                 yield name
             else:
                 self.logger.debug(f'Could not find disk for {dev}')
@@ -203,6 +198,36 @@ class ZFSPoolService(Service):
         with libzfs.ZFS() as zfs:
             return [i.__getstate__() for i in zfs.find_import()]
 
+    @accepts()
+    def health(self):
+        """
+        Returns the latest health snapshot of all imported pools:
+
+        {
+            "timestamp": 1514764800.0,
+            "pools": {
+                "tank": {
+                    "name": "tank", "guid": "...", "status": "ONLINE", "healthy": True,
+                    "capacity": 42, "scan": {...}, "scrub_paused": False,
+                    "errors": {"read": 0, "write": 0, "checksum": 0, "data": 0},
+                },
+            },
+        }
+
+        The snapshot is shared by all callers and replaced on every sample, it must not be modified.
+        """
+        return POOL_HEALTH.get()
+
+    @accepts(Int('interval'))
+    def configure_health(self, interval):
+        """
+        Change how often (seconds) pools health is sampled.
+        """
+        if interval < POOL_HEALTH_SCAN_INTERVAL:
+            raise CallError(f'Interval must be at least {POOL_HEALTH_SCAN_INTERVAL} seconds', errno.EINVAL)
+        POOL_HEALTH.interval = interval
+        POOL_HEALTH.wakeup()
+
 
 class ZFSDatasetService(CRUDService):
 
@@ -621,63 +646,109 @@ class ZFSQuoteService(Service):
                 await self.middleware.call('datastore.insert', 'storage.quotaexcess', excess)
 
 
-class ScanWatch(object):
+class PoolHealthSampler(object):
+    """
+    Samples status, capacity, scan and vdev errors of all imported pools in a single libzfs pass
+    so alert sources and event sources do not have to query each pool on their own.
+
+    While a scrub/resilver is running pools are sampled every `POOL_HEALTH_SCAN_INTERVAL` seconds
+    and `zfs.pool.scan` events are sent for it.
+    """
 
-    def __init__(self, middleware, pool):
+    def __init__(self, middleware, interval=POOL_HEALTH_INTERVAL):
         self.middleware = middleware
-        self.pool = pool
+        self.interval = interval
+        self.snapshot = {'timestamp': None, 'pools': {}}
+        self._sampled = threading.Event()
+        self._wakeup = threading.Event()
         self._cancel = threading.Event()
 
     def run(self):
+        while not self._cancel.is_set():
+            try:
+                self.sample()
+            except Exception:
+                self.middleware.logger.error('Failed to sample pools health', exc_info=True)
+            finally:
+                self._sampled.set()
 
-        while not self._cancel.wait(2):
-            with libzfs.ZFS() as zfs:
-                scan = zfs.get(self.pool).scrub.__getstate__()
-            if scan['state'] == 'SCANNING':
-                self.send_scan(scan)
-            elif scan['state'] == 'FINISHED':
-                # Since this thread finishes on scrub/resilver end the event is sent
-                # on devd event arrival
-                break
-
-    def send_scan(self, scan=None):
-        if not scan:
-            with libzfs.ZFS() as zfs:
-                scan = zfs.get(self.pool).scrub.__getstate__()
-        self.middleware.send_event('zfs.pool.scan', 'CHANGED', fields={
-            'scan': scan,
-            'name': self.pool,
-        })
+            scanning = any(self._scanning(pool) for pool in self.snapshot['pools'].values())
+            self._wakeup.wait(POOL_HEALTH_SCAN_INTERVAL if scanning else self.interval)
+            self._wakeup.clear()
+
+    def get(self):
+        self._sampled.wait()
+        return self.snapshot
+
+    def wakeup(self):
+        self._wakeup.set()
 
     def cancel(self):
         self._cancel.set()
+        self._wakeup.set()
+
+    def sample(self):
+        pools = {}
+        with libzfs.ZFS() as zfs:
+            for pool in zfs.pools:
+                pools[pool.name] = self._pool_health(pool)
+
+        previous = self.snapshot
+        # Replace, never modify, the snapshot so readers always see a consistent one
+        self.snapshot = {'timestamp': time.time(), 'pools': pools}
+
+        for name, pool in pools.items():
+            previous_pool = previous['pools'].get(name)
+            if self._scanning(pool) or (
+                # Last event with SCRUB/RESILVER as FINISHED/CANCELED
+                previous_pool is not None and self._scanning(previous_pool)
+            ):
+                self.middleware.send_event('zfs.pool.scan', 'CHANGED', fields={
+                    'scan': pool['scan'],
+                    'name': name,
+                })
+
+    def _scanning(self, pool):
+        return bool(pool['scan']) and pool['scan']['state'] == 'SCANNING'
+
+    def _pool_health(self, pool):
+        # Only what is needed is read, `pool.__getstate__()` would walk every dataset of the pool
+        status = pool.status
+
+        errors = {'read': 0, 'write': 0, 'checksum': 0, 'data': pool.error_count or 0}
+        vdevs = [vdev for group in pool.groups.values() for vdev in group]
+        while vdevs:
+            vdev = vdevs.pop()
+            stats = vdev.stats
+            errors['read'] += stats.read_errors
+            errors['write'] += stats.write_errors
+            errors['checksum'] += stats.checksum_errors
+            vdevs.extend(vdev.children)
+
+        try:
+            capacity = int(pool.properties['capacity'].rawvalue)
+        except (KeyError, ValueError):
+            capacity = None
+
+        scrub = pool.scrub
+        return {
+            'name': pool.name,
+            'guid': str(pool.guid),
+            'status': status,
+            'healthy': status == 'ONLINE' and not any(errors.values()),
+            'capacity': capacity,
+            'scan': scrub.__getstate__(),
+            'scrub_paused': scrub.pause is not None,
+            'errors': errors,
+        }
 
 
 async def _handle_zfs_events(middleware, event_type, args):
     data = args['data']
-    if data.get('type') in ('misc.fs.zfs.resilver_start', 'misc.fs.zfs.scrub_start'):
-        pool = data.get('pool_name')
-        if not pool:
-            return
-        if pool in SCAN_THREADS:
-            return
-        scanwatch = ScanWatch(middleware, pool)
-        SCAN_THREADS[pool] = scanwatch
-        start_daemon_thread(target=scanwatch.run)
-
-    elif data.get('type') in (
-        'misc.fs.zfs.resilver_finish', 'misc.fs.zfs.scrub_finish', 'misc.fs.zfs.scrub_abort',
-    ):
-        pool = data.get('pool_name')
-        if not pool:
-            return
-        scanwatch = SCAN_THREADS.pop(pool, None)
-        if not scanwatch:
-            return
-        await middleware.run_in_thread(scanwatch.cancel)
 
-        # Send the last event with SCRUB/RESILVER as FINISHED
-        await middleware.run_in_thread(scanwatch.send_scan)
+    # Pool state may have changed, resample right away
+    # (also picks up scrub/resilver start and finish)
+    await middleware.run_in_thread(POOL_HEALTH.wakeup)
 
     if data.get('type') == 'misc.fs.zfs.scrub_finish':
         await middleware.call('mail.send', {
@@ -687,4 +758,8 @@ async def _handle_zfs_events(middleware, event_type, args):
 
 
 def setup(middleware):
+    global POOL_HEALTH
+    POOL_HEALTH = PoolHealthSampler(middleware)
+    start_daemon_thread(target=POOL_HEALTH.run)
+
     middleware.event_subscribe('devd.zfs', _handle_zfs_events)
@@ -0,0 +1,86 @@
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import threading
+
+from middlewared.alert.base import Alert, AlertLevel
+from middlewared.alert.delivery import Delivery, DeliveryOutbox
+from middlewared.alert.service.slack import SlackAlertService
+
+
+def make_alert():
+    return Alert(title="Pool %s is degraded", args=["tank"], node="A", source="VolumeStatus",
+                 datetime=datetime(2018, 1, 1, 12, 30, 15, 123000), level=AlertLevel.CRITICAL, dismissed=False)
+
+
+def test__outbox__exponential_backoff_keeps_order():
+    outbox = DeliveryOutbox(base_delay=10, max_delay=30, max_attempts=3)
+    first = Delivery(1, "Slack", [], [], [make_alert()])
+    second = Delivery(1, "Slack", [], [], [make_alert()])
+    outbox.add(first)
+    outbox.add(second)
+
+    assert outbox.due(0) == {1: [first, second]}
+
+    assert outbox.failed(first, now=100)
+    assert first.next_attempt == 110
+    assert outbox.due(105) == {}
+    assert outbox.failed(first, now=110)
+    assert first.next_attempt == 130
+
+    assert not outbox.failed(first, now=130)
+    assert outbox.due(130) == {1: [second]}
+
+    outbox.succeeded(second, 0.5)
+    assert len(outbox) == 0
+    assert outbox.get_stats()["Slack"]["dropped"] == 1
+    assert outbox.get_stats()["Slack"]["sent"] == 1
+
+
+def test__outbox__dump_load():
+    outbox = DeliveryOutbox()
+    alert = make_alert()
+    outbox.add(Delivery(1, "Slack", [alert], [], [alert], attempts=2, next_attempt=50))
+
+    loaded = DeliveryOutbox()
+    loaded.load(json.loads(json.dumps(outbox.dump())))
+
+    delivery = loaded.due(50)[1][0]
+    assert delivery.attempts == 2
+    assert delivery.new_alerts[0].__dict__ == alert.__dict__
+
+
+def test__slack__reuses_connection():
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            requests.append((self.client_address, json.loads(self.rfile.read(int(self.headers["Content-Length"])))))
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        service = SlackAlertService(None, {
+            "url": f"http://127.0.0.1:{server.server_port}/hook",
+            "channel": "#alerts",
+            "username": "freenas",
+            "icon_url": "",
+        })
+        service.send_sync([], [], [make_alert()])
+        service.send_sync([], [make_alert()], [])
+        service.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert len(requests) == 2
+    assert "Pool tank is degraded" in requests[0][1]["text"]
+    assert requests[0][0] == requests[1][0]
@@ -0,0 +1,41 @@
+import asyncio
+
+from mock import Mock
+
+from middlewared.alert.source.volume_status import VolumeStatusAlertSource
+
+
+def test__volume_status__health_snapshot():
+    calls = []
+
+    async def call(method, *args):
+        calls.append((method,) + args)
+        if method == "system.is_freenas":
+            return True
+        if method == "zfs.pool.health":
+            return {"pools": {
+                "tank": {"healthy": True},
+                "data": {"healthy": False},
+            }}
+        if method == "datastore.query":
+            return [
+                {"id": 1, "name": "tank", "encrypt": 0},
+                {"id": 2, "name": "data", "encrypt": 0},
+                {"id": 3, "name": "locked", "encrypt": 1},
+                {"id": 4, "name": "missing", "encrypt": 1},
+            ]
+        if method == "pool.is_decrypted":
+            return args[0] == 4
+        if method == "notifier.zpool_status":
+            return "UNKNOWN" if args[0] == "missing" else "DEGRADED", "status"
+
+    middleware = Mock()
+    middleware.call = call
+
+    alerts = asyncio.new_event_loop().run_until_complete(VolumeStatusAlertSource(middleware).check())
+
+    # Healthy pools and locked pools are not looked at, pools failing to import are
+    assert [alert.args["volume"] for alert in alerts] == ["data", "missing"]
+    assert [c[1] for c in calls if c[0] == "notifier.zpool_status"] == ["data", "missing"]
+    assert [c[1] for c in calls if c[0] == "pool.is_decrypted"] == [3, 4]
+    assert not any(c[0] in ("pool.query", "zfs.pool.query") for c in calls)
@@ -4,7 +4,7 @@ import subprocess
 from mock import Mock, patch
 import pytest
 
-from middlewared.common.smart.smartctl import get_smartctl_args
+from middlewared.common.smart.smartctl import get_smartctl_args, parse_smartctl
 
 
 @pytest.mark.asyncio
@@ -116,3 +116,50 @@ async def test_get_disk__generic():
             "channel_no": 2,
             "lun_id": 10,
         }) == ["/dev/ada0"]
+
+
+def test__parse_smartctl__ata():
+    info = parse_smartctl("""
+=== START OF INFORMATION SECTION ===
+Device Model:     ST4000NM0033-9ZM170
+Serial Number:    Z1Z5ABCD
+Firmware Version: SN06
+User Capacity:    4,000,787,030,016 bytes [4.00 TB]
+SMART support is: Available - device has SMART capability.
+SMART support is: Enabled
+
+=== START OF READ SMART DATA SECTION ===
+SMART overall-health self-assessment test result: PASSED
+
+ID# ATTRIBUTE_NAME          FLAG     VALUE WORST THRESH TYPE      UPDATED  WHEN_FAILED RAW_VALUE
+  9 Power_On_Hours          0x0032   067   067   000    Old_age   Always       -       29125
+194 Temperature_Celsius     0x0022   031   045   000    Old_age   Always       -       31 (0 15 0 0 0)
+""")
+
+    assert info["model"] == "ST4000NM0033-9ZM170"
+    assert info["serial"] == "Z1Z5ABCD"
+    assert info["capacity"] == 4000787030016
+    assert info["smart_enabled"] is True
+    assert info["health"] == "PASSED"
+    assert info["temperature"] == 31
+    assert info["power_on_hours"] == 29125
+    assert [(a["id"], a["value"], a["worst"], a["raw"]) for a in info["attributes"]] == [
+        (9, 67, 67, 29125),
+        (194, 31, 45, 31),
+    ]
+
+
+def test__parse_smartctl__scsi():
+    info = parse_smartctl("""
+Product:              ST4000NM0023
+Revision:             0004
+Serial number:        Z1Z2ABCD
+SMART Health Status: OK
+Current Drive Temperature:     33 C
+""")
+
+    assert info["model"] == "ST4000NM0023"
+    assert info["serial"] == "Z1Z2ABCD"
+    assert info["health"] == "OK"
+    assert info["temperature"] == 33
+    assert info["attributes"] == []
@@ -0,0 +1,45 @@
+import io
+import json
+import logging
+import queue
+
+from middlewared.logger import BatchingQueueListener, JsonFormatter, NonBlockingQueueHandler
+
+
+def log_through_queue(formatter):
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(formatter)
+
+    queue_ = queue.Queue()
+    listener = BatchingQueueListener(queue_, handler)
+    listener.start()
+
+    logger = logging.getLogger("test_queue")
+    logger.propagate = False
+    logger.addHandler(NonBlockingQueueHandler(queue_))
+    try:
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.error("Failed to %s", "frobnicate", exc_info=True)
+    finally:
+        logger.handlers.clear()
+        listener.stop()
+
+    return stream.getvalue()
+
+
+def test__json_exception():
+    data = json.loads(log_through_queue(JsonFormatter()))
+
+    assert data["message"] == "Failed to frobnicate"
+    assert data["exception"].startswith("Traceback")
+    assert "ValueError: boom" in data["exception"]
+
+
+def test__text_exception():
+    lines = log_through_queue(logging.Formatter("%(message)s")).splitlines()
+
+    assert lines[0] == "Failed to frobnicate"
+    assert lines[-1] == "ValueError: boom"
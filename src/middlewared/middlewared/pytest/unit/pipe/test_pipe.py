@@ -0,0 +1,112 @@
+import asyncio
+import io
+import os
+import threading
+
+from middlewared.pipe import BUFFER_SIZE, Pipe
+
+
+class Middleware:
+    async def run_in_thread(self, method, *args, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(None, lambda: method(*args, **kwargs))
+
+
+def test__copy_to_file():
+    data = os.urandom(BUFFER_SIZE * 2 + 12345)
+    pipe = Pipe(Middleware())
+
+    def write():
+        with pipe.w:
+            for i in range(0, len(data), 65536):
+                pipe.w.write(data[i:i + 65536])
+
+    t = threading.Thread(target=write)
+    t.start()
+    f = io.BytesIO()
+    assert pipe.copy_to_file(f) == len(data)
+    t.join()
+
+    assert f.getvalue() == data
+
+
+def test__stream_through_pipe(tmpdir):
+    data = os.urandom(BUFFER_SIZE * 3 + 1)
+    path = str(tmpdir.join("file"))
+    with open(path, "wb") as f:
+        f.write(data)
+
+    async def main():
+        middleware = Middleware()
+
+        # Writer side copies the file, reader side reads it with asyncio
+        pipe = Pipe(middleware)
+        reader = await pipe.reader()
+        send = asyncio.ensure_future(pipe.send_file(path))
+        received = b""
+        while len(received) < len(data):
+            received += await reader.read(BUFFER_SIZE)
+        await send
+        await pipe.close()
+        assert received == data
+
+        # A reader that sends files by itself gets the path and EOF
+        pipe = Pipe(middleware, sendfile=True)
+        reader = await pipe.reader()
+        await pipe.send_file(path)
+        assert await reader.read(BUFFER_SIZE) == b""
+        assert pipe.path == path
+        await pipe.close()
+
+        # Writes from the event loop are read by a thread
+        pipe = Pipe(middleware)
+        writer = await pipe.writer()
+        copy = asyncio.ensure_future(middleware.run_in_thread(pipe.copy_to_file, io.BytesIO()))
+        for i in range(0, len(data), 100000):
+            writer.write(data[i:i + 100000])
+            await writer.drain()
+        await pipe.close_writer()
+        assert await copy == len(data)
+        await pipe.close()
+
+    asyncio.new_event_loop().run_until_complete(main())
+
+
+def test__send_temporary_file(tmpdir):
+    data = os.urandom(BUFFER_SIZE + 1)
+
+    def temporary_file(name):
+        path = str(tmpdir.join(name))
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    async def main():
+        middleware = Middleware()
+
+        # Removed once copied to the pipe
+        pipe = Pipe(middleware)
+        path = temporary_file("copied")
+        copy = asyncio.ensure_future(middleware.run_in_thread(pipe.copy_to_file, io.BytesIO()))
+        await pipe.send_file(path, temporary=True)
+        await pipe.close_writer()
+        assert await copy == len(data)
+        assert not os.path.exists(path)
+        await pipe.close()
+
+        # Whoever takes the file removes it
+        pipe = Pipe(middleware, sendfile=True)
+        path = temporary_file("taken")
+        await pipe.send_file(path, temporary=True)
+        assert pipe.take_file() == (path, True)
+        assert pipe.take_file() == (None, False)
+        await pipe.close()
+        assert os.path.exists(path)
+
+        # Removed with the pipe if nobody took it
+        pipe = Pipe(middleware, sendfile=True)
+        path = temporary_file("left")
+        await pipe.send_file(path, temporary=True)
+        await pipe.close()
+        assert not os.path.exists(path)
+
+    asyncio.new_event_loop().run_until_complete(main())
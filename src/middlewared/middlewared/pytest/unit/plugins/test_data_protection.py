@@ -0,0 +1,60 @@
+import asyncio
+
+from mock import Mock
+
+from middlewared.plugins.data_protection import CONCURRENCY, POOL_BUDGET, WEIGHTS, DataProtectionService
+from middlewared.utils.scheduler import Admission, ScheduledTask
+
+
+def data_protection_service(rsync_tasks):
+    calls = []
+
+    async def call(method, *args):
+        calls.append(method)
+        if method == "rsynctask.query":
+            return rsync_tasks
+        return []
+
+    middleware = Mock()
+    middleware.call = call
+    return DataProtectionService(middleware), calls
+
+
+def test__tasks__cached_until_invalidated():
+    rsync_tasks = [{"id": 1, "desc": "backup", "schedule": {"minute": "0"}, "path": "/mnt/tank/backup"}]
+    service, calls = data_protection_service(rsync_tasks)
+    loop = asyncio.new_event_loop()
+
+    assert [task.key for task in loop.run_until_complete(service.tasks())] == ["RSYNC:1"]
+    rsync_tasks.append({"id": 2, "desc": "other", "schedule": {"minute": "0"}, "path": "/mnt/data"})
+    assert [task.key for task in loop.run_until_complete(service.tasks())] == ["RSYNC:1"]
+    assert calls.count("rsynctask.query") == 1
+
+    loop.run_until_complete(service.invalidate())
+    assert [task.key for task in loop.run_until_complete(service.tasks())] == ["RSYNC:1", "RSYNC:2"]
+    assert calls.count("rsynctask.query") == 2
+
+
+def test__tasks__invalidated_while_building():
+    service, calls = data_protection_service([])
+    loop = asyncio.new_event_loop()
+
+    async def build():
+        tasks = asyncio.ensure_future(service.tasks())
+        await asyncio.sleep(0)
+        await service.invalidate()
+        await tasks
+
+    loop.run_until_complete(build())
+    loop.run_until_complete(service.tasks())
+    # Tasks built before the invalidation are not cached
+    assert calls.count("rsynctask.query") == 2
+
+
+def test__scrub__shares_pool():
+    admission = Admission(CONCURRENCY, POOL_BUDGET)
+    scrub = ScheduledTask("SCRUB", 1, "tank", {}, ["tank"], WEIGHTS["SCRUB"], background=True)
+    rsync = ScheduledTask("RSYNC", 1, "backup", {}, ["tank"], WEIGHTS["RSYNC"])
+
+    # A scrub running for days does not stop other tasks of its pool
+    assert admission.select([scrub, rsync]) == [scrub, rsync]
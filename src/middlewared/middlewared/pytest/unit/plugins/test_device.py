@@ -0,0 +1,35 @@
+import pytest
+
+from middlewared.plugins.device import parse_devd_message
+
+
+@pytest.mark.parametrize("msg,parsed", [
+    ("system=DEVFS subsystem=CDEV type=CREATE cdev=da0", {
+        "system": "DEVFS", "subsystem": "CDEV", "type": "CREATE", "cdev": "da0",
+    }),
+    ("system=DEVFS subsystem=CDEV type=DESTROY cdev=da0p1\n", {
+        "system": "DEVFS", "subsystem": "CDEV", "type": "DESTROY", "cdev": "da0p1",
+    }),
+    ('system=ZFS subsystem=ZFS type=misc.fs.zfs.scrub_finish pool_name="my pool" pool_guid=123', {
+        "system": "ZFS", "subsystem": "ZFS", "type": "misc.fs.zfs.scrub_finish", "pool_name": "my pool",
+        "pool_guid": "123",
+    }),
+    ("system=GEOM subsystem=DEV type=MEDIACHANGE cdev=", {
+        "system": "GEOM", "subsystem": "DEV", "type": "MEDIACHANGE", "cdev": "",
+    }),
+    ('system=IFNET subsystem=em0 type=LINK_UP notify="it\'s up"', {
+        "system": "IFNET", "subsystem": "em0", "type": "LINK_UP", "notify": "it's up",
+    }),
+])
+def test__parse_devd_message(msg, parsed):
+    assert parse_devd_message(msg) == parsed
+
+
+@pytest.mark.parametrize("msg", [
+    "system=DEVFS garbage type=CREATE",
+    "system=DEVFS subsystem=CDEV trailing",
+    "notify='unbalanced",
+])
+def test__parse_devd_message__malformed(msg):
+    with pytest.raises(ValueError):
+        parse_devd_message(msg)
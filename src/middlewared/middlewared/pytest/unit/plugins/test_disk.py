@@ -0,0 +1,129 @@
+import asyncio
+
+from mock import Mock, patch
+
+from middlewared.plugins.disk import DiskEventCoalescer, DiskService
+from middlewared.utils.geom_topology import GeomTopology
+
+ZFS_UUID = "6d5b1f2a-6e7e-11e8-a4e4-0cc47a3a1b2c"
+
+# A disk without serial number and with a ZFS partition
+CONFXML = f"""<mesh>
+  <class id="1">
+    <name>DISK</name>
+    <geom id="2">
+      <name>da0</name>
+      <provider id="3">
+        <name>da0</name>
+        <mediasize>4000787030016</mediasize>
+        <config><descr>VIRTUAL DISK</descr></config>
+      </provider>
+    </geom>
+  </class>
+  <class id="4">
+    <name>PART</name>
+    <geom id="5">
+      <name>da0</name>
+      <consumer id="6"><provider ref="3"/></consumer>
+      <provider id="7">
+        <name>da0p2</name>
+        <config>
+          <type>freebsd-zfs</type>
+          <rawtype>516e7cba-6ecf-11d6-8ff8-00022d09712b</rawtype>
+          <rawuuid>{ZFS_UUID}</rawuuid>
+        </config>
+      </provider>
+    </geom>
+  </class>
+  <class id="8">
+    <name>DEV</name>
+    <geom id="9"><name>da0</name></geom>
+    <geom id="10"><name>da0p2</name></geom>
+  </class>
+</mesh>"""
+
+
+def test__disk_service__sync_all__uuid_identifier():
+    db_disk = {
+        "disk_identifier": f"{{uuid}}{ZFS_UUID}",
+        "disk_name": "da3",
+        "disk_serial": "",
+        "disk_size": "4000787030016",
+        "disk_subsystem": "da",
+        "disk_number": 3,
+        "disk_expiretime": None,
+        "disk_togglesmart": False,
+    }
+    calls = []
+
+    async def call(method, *args):
+        calls.append((method,) + args)
+        return {
+            "system.is_freenas": True,
+            "device.get_info": {"da0": {}},
+            "geom.topology": GeomTopology(CONFXML),
+            "datastore.query": [dict(db_disk)],
+            "smart.smartctl_args": None,
+        }.get(method)
+
+    async def camcontrol_list():
+        return {}
+
+    middleware = Mock()
+    middleware.call = call
+
+    with patch("middlewared.plugins.disk.camcontrol_list", camcontrol_list):
+        asyncio.new_event_loop().run_until_complete(DiskService(middleware).sync_all(Mock()))
+
+    # Disk keeps its identifier and settings, it is only renamed
+    assert [c for c in calls if c[0] == "datastore.bulk"] == [
+        ("datastore.bulk", "storage.disk", [
+            ["update", db_disk["disk_identifier"], dict(db_disk, disk_name="da0", disk_number=0, disk_size=4000787030016)],
+        ]),
+    ]
+    assert ("notifier.sync_disk_extra", db_disk["disk_identifier"], False) in calls
+
+
+def test__disk_event_coalescer__burst():
+    calls = []
+
+    async def wait():
+        pass
+
+    async def call(method, *args):
+        calls.append((method,) + args)
+        if method == "disk.sync_all":
+            return Mock(wait=wait)
+
+    async def run_in_thread(method, *args):
+        return method(*args)
+
+    middleware = Mock()
+    middleware.call = call
+    middleware.run_in_thread = run_in_thread
+
+    sysctl = Mock()
+    sysctl.filter.return_value = [Mock(value="ada0 da0 da1 da2")]
+
+    async def burst(coalescer):
+        for cdev in ("da0", "da0p1", "da1", "da2"):
+            coalescer.add("CREATE", cdev)
+            await asyncio.sleep(0.01)
+        await coalescer.task
+        # Coalescer is ready for the next burst
+        assert coalescer.task is None
+        coalescer.add("DESTROY", "da2")
+        await coalescer.task
+
+    with patch("middlewared.plugins.disk.DISK_EVENTS_WINDOW", 0.05), \
+            patch("middlewared.plugins.disk.os.path.exists", Mock(return_value=True)), \
+            patch("middlewared.plugins.disk.sysctl", sysctl), \
+            patch("middlewared.plugins.disk.SmartAlert", Mock()):
+        asyncio.new_event_loop().run_until_complete(burst(DiskEventCoalescer(middleware)))
+
+    # One sync for the burst of new disks (partitions are not disks) and one for the disk that went away
+    assert [c for c in calls if c[0] in ("disk.sync", "disk.sync_all")] == [("disk.sync_all",), ("disk.sync_all",)]
+    assert sorted(c[1] for c in calls if c[0] == "disk.sed_unlock") == ["da0", "da1", "da2"]
+    assert [c for c in calls if c[0] == "disk.swaps_configure"] == [("disk.swaps_configure",)]
+    # smartctl arguments of disks are looked up again, the same name can be behind another controller
+    assert sorted(c[1] for c in calls if c[0] == "smart.invalidate") == ["da0", "da0p1", "da1", "da2", "da2"]
@@ -0,0 +1,47 @@
+import asyncio
+
+from mock import Mock
+
+from middlewared.plugins.smart import SmartService
+
+
+def smart_service(enabled):
+    async def call(method, *args):
+        if method == "datastore.query":
+            return [{"srv_service": "smartd", "srv_enable": True}] if enabled else []
+        if method == "disk.query":
+            return [{"name": "ada0"}]
+
+    async def config():
+        return {"interval": 30, "powermode": "STANDBY"}
+
+    collected = []
+
+    async def collect(disks, force_refresh=False, powermode="NEVER"):
+        collected.append((disks, powermode))
+
+    middleware = Mock()
+    middleware.call = call
+    service = SmartService(middleware)
+    service.config = config
+    service.collect = collect
+    return service, collected
+
+
+def test__collect_all__service_disabled():
+    service, collected = smart_service(False)
+
+    asyncio.new_event_loop().run_until_complete(service.collect_all())
+
+    assert collected == []
+
+
+def test__collect_all__interval():
+    service, collected = smart_service(True)
+    loop = asyncio.new_event_loop()
+
+    loop.run_until_complete(service.collect_all())
+    # Not due again before the SMART check interval passed
+    loop.run_until_complete(service.collect_all())
+
+    assert collected == [(["ada0"], "STANDBY")]
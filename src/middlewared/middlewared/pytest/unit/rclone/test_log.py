@@ -0,0 +1,48 @@
+import json
+
+from middlewared.rclone.log import RcloneLog, supports_json_log
+
+
+def entry(**kwargs):
+    return json.dumps(dict({"level": "info", "time": "2018-06-01T12:00:00+02:00"}, **kwargs)).encode() + b"\n"
+
+
+def test__rclone_log__json_stats():
+    log = RcloneLog()
+    data = (
+        entry(msg="file1: Copied (new)") +
+        entry(level="error", msg="file2: Failed to copy: permission denied") +
+        entry(msg="\nTransferred: 512M / 1 GBytes, 50%\n", stats={
+            "bytes": 512 * 1024 ** 2, "totalBytes": 1024 ** 3, "transfers": 1, "totalTransfers": 3,
+            "speed": 10.5 * 1024 ** 2, "eta": 51, "errors": 1, "lastError": "permission denied",
+        })
+    )
+
+    # Lines split across chunks
+    text = log.feed(data[:50]) + log.feed(data[50:-10]) + log.feed(data[-10:]) + log.flush()
+
+    assert text.splitlines()[:2] == [
+        "2018-06-01T12:00:00+02:00 INFO   : file1: Copied (new)",
+        "2018-06-01T12:00:00+02:00 ERROR  : file2: Failed to copy: permission denied",
+    ]
+    assert log.errors == ["file2: Failed to copy: permission denied"]
+    percent, description, extra = log.progress
+    assert percent == 50
+    assert description == "Transferred 512.00 MiB of 1.00 GiB at 10.50 MiB/s, ETA 51s, 1 errors"
+    assert extra["files"] == 1 and extra["total_files"] == 3 and extra["speed"] == 11010048
+
+
+def test__rclone_log__text():
+    log = RcloneLog()
+
+    assert log.feed(b"Transferred:   1.2 MBytes (100 kBytes/s)\nnot json\n") == (
+        "Transferred:   1.2 MBytes (100 kBytes/s)\nnot json\n"
+    )
+    assert log.progress == (None, "1.2 MBytes (100 kBytes/s)", None)
+
+
+def test__supports_json_log():
+    assert supports_json_log("rclone v1.48.0\n- os/arch: freebsd/amd64\n- go version: go1.12.6\n")
+    assert supports_json_log("rclone v1.50.2-DEV\n")
+    assert not supports_json_log("rclone v1.39\n- os/arch: freebsd/amd64\n")
+    assert not supports_json_log("")
@@ -0,0 +1,260 @@
+import asyncio
+import json
+import shlex
+import sys
+import textwrap
+
+import pytest
+
+from middlewared.replication.engine import ReplicationEngine
+from middlewared.replication.plan import nearest_ancestor, plan_replication, remote_parents
+from middlewared.replication.transport import LocalTransport
+
+# Stand-in for zfs working on a JSON file {"datasets": {name: {"readonly", "token", "snapshots"}}}.
+# Streams are a JSON header line followed by SNAPSHOT_SIZE bytes per snapshot.
+FAKE_ZFS = textwrap.dedent("""\
+    import fcntl, json, sys
+
+    path, cmd, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+    lock = open(path + ".lock", "w")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    state = json.load(open(path))
+    SNAPSHOT_SIZE = state.get("snapshot_size", 300000)
+    ds = state["datasets"]
+    state.setdefault("log", []).append([cmd] + args)
+
+    def fail(msg):
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+
+    def save():
+        json.dump(state, open(path, "w"))
+
+    def under(name, root):
+        return name == root or name.startswith(root + "/")
+
+    if cmd == "list" and "snapshot" in args:
+        if args[-1] not in ds:
+            fail(f"cannot open '{args[-1]}': dataset does not exist")
+        for name in sorted(ds):
+            if name == args[-1] or ("-d" not in args and under(name, args[-1])):
+                for snap, creation in ds[name]["snapshots"]:
+                    print(f"{name}@{snap}\\t{creation}")
+    elif cmd == "list":
+        for name in sorted(ds):
+            if under(name, args[-1]):
+                print(f"{name}\\t{'on' if ds[name]['readonly'] else 'off'}\\t{ds[name]['token'] or '-'}")
+    elif cmd == "create":
+        ds[args[-1]] = {"readonly": True, "token": None, "snapshots": []}
+    elif cmd == "send":
+        if "-t" in args:
+            header = json.loads(args[args.index("-t") + 1])
+        else:
+            name, last = args[-1].split("@")
+            names = [snap for snap, creation in ds[name]["snapshots"]]
+            base = args[args.index("-I") + 1].split("@")[1] if "-I" in args else None
+            start = names.index(base) + 1 if base else names.index(last)
+            header = {"dataset": name, "base": base, "snapshots": ds[name]["snapshots"][start:names.index(last) + 1]}
+        size = SNAPSHOT_SIZE * len(header["snapshots"])
+        save()
+        if "-nP" in args:
+            print(f"size\\t{size}")
+        else:
+            lock.close()
+            sys.stdout.buffer.write(json.dumps(header, separators=(",", ":")).encode() + b"\\n" + b"x" * size)
+        sys.exit(0)
+    elif cmd == "receive" and "-A" in args:
+        ds[args[-1]]["token"] = None
+    elif cmd == "receive":
+        if state.get("reject"):
+            fail(state["reject"])
+        header = json.loads(sys.stdin.buffer.readline())
+        data = sys.stdin.buffer.read()
+        name = args[-1] + header["dataset"][len(header["dataset"].split("/")[0]):]
+        if state.get("interrupt") == name:
+            state["interrupt"] = None
+            ds.setdefault(name, {"readonly": False, "token": None, "snapshots": []})
+            ds[name]["token"] = json.dumps(header, separators=(",", ":"))
+            save()
+            fail("cannot receive incremental stream: checksum mismatch or incomplete stream")
+        if len(data) != SNAPSHOT_SIZE * len(header["snapshots"]):
+            fail("stream is truncated")
+        if name.rsplit("/", 1)[0] not in ds and "/" in name:
+            fail(f"cannot receive: parent of {name} does not exist")
+        target = ds.setdefault(name, {"readonly": False, "token": None, "snapshots": []})
+        names = [snap for snap, creation in target["snapshots"]]
+        if header["base"] is None and names:
+            fail(f"destination '{name}' exists and has snapshots")
+        if header["base"] is not None:
+            if header["base"] not in names:
+                fail("destination does not have the base snapshot")
+            del target["snapshots"][names.index(header["base"]) + 1:]
+        target["snapshots"] += header["snapshots"]
+        target["token"] = None
+        state.setdefault("received", []).append(name)
+    elif cmd == "destroy" and "-r" in args:
+        for name in [name for name in ds if under(name, args[-1])]:
+            del ds[name]
+    elif cmd == "destroy":
+        name, snaps = args[-1].split("@")
+        ds[name]["snapshots"] = [s for s in ds[name]["snapshots"] if s[0] not in snaps.split(",")]
+    save()
+""")
+
+
+class FakePool:
+    def __init__(self, tmpdir, name, datasets):
+        self.path = str(tmpdir.join(f"{name}.json"))
+        self.fake = str(tmpdir.join("zfs.py"))
+        with open(self.fake, "w") as f:
+            f.write(FAKE_ZFS)
+        self.write({"datasets": {
+            ds: {"readonly": False, "token": None, "snapshots": [[snap, str(i)] for i, snap in snapshots]}
+            for ds, snapshots in datasets.items()
+        }})
+
+    @property
+    def argv(self):
+        return [sys.executable, self.fake, self.path]
+
+    def read(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def write(self, state):
+        with open(self.path, "w") as f:
+            json.dump(state, f)
+
+    def snapshots(self, prefix):
+        return {
+            name[len(prefix):]: [snap for snap, creation in ds["snapshots"]]
+            for name, ds in self.read()["datasets"].items() if name.startswith(prefix)
+        }
+
+
+def replicate(local, remote, **kwargs):
+    progress = []
+    engine = ReplicationEngine(
+        "tank/data", "backup", LocalTransport(), recursive=True, zfs=local.argv,
+        remote_zfs=" ".join(shlex.quote(arg) for arg in remote.argv),
+        progress=lambda transferred, total: progress.append((transferred, total)), **kwargs
+    )
+    result, mails = asyncio.get_event_loop().run_until_complete(engine.run())
+    return result, mails, progress
+
+
+@pytest.fixture
+def pools(tmpdir):
+    local = FakePool(tmpdir, "tank", {
+        "tank/data": [(1, "s1"), (4, "s2")],
+        "tank/data/a": [(1, "s1"), (4, "s2")],
+        "tank/data/a/b": [(1, "s1")],
+        "tank/data/c": [(1, "s1"), (4, "s2")],
+    })
+    remote = FakePool(tmpdir, "backup", {"backup": []})
+    return local, remote
+
+
+def test__plan_replication():
+    tasks = plan_replication({
+        "tank/a": [("s1", "1"), ("s2", "2"), ("s3", "3")],
+        "tank/b": [("s2", "2")],
+    }, {
+        "tank/a": [("old", "0"), ("s1", "1")],
+        "tank/b": [("x", "1")],
+        "tank/gone": [("s1", "1")],
+    }, followdelete=True)
+
+    assert tasks == {
+        "tank/a": {"action": "SEND", "base": "s1", "snapshots": ["s2", "s3"], "destroy": [], "delete": ["old"]},
+        "tank/b": {"action": "SEND", "base": None, "snapshots": ["s2"], "destroy": ["x"], "delete": []},
+        "tank/gone": {"action": "DESTROY", "base": None, "snapshots": [], "destroy": [], "delete": []},
+    }
+
+
+def test__plan_helpers():
+    assert nearest_ancestor("tank/a/b/c", {"tank", "tank/a/b"}) == "tank/a/b"
+    assert nearest_ancestor("tank/a", {"tank/b"}) is None
+    assert remote_parents("tank/data", "backup/repl") == ["backup/repl", "backup/repl/data"]
+    assert remote_parents("tank", "tank") == []
+
+
+def test__replicate__parents_first_and_progress(pools):
+    local, remote = pools
+
+    result, mails, progress = replicate(local, remote, concurrency=3)
+
+    assert result == {"msg": "Succeeded", "last_snapshot": "s2"}
+    assert remote.snapshots("backup/data") == local.snapshots("tank/data")
+    received = remote.read()["received"]
+    assert received.index("backup/data") < received.index("backup/data/a") < received.index("backup/data/a/b")
+    # 7 streams, transferred also counts their headers
+    assert progress[-1][1] == 7 * 300000
+    assert progress[-1][0] > progress[-1][1]
+
+    assert replicate(local, remote)[0] == {"msg": "Up to date"}
+
+
+def test__replicate__incremental_single_stream(pools):
+    local, remote = pools
+    replicate(local, remote)
+
+    state = local.read()
+    state["datasets"]["tank/data/a"]["snapshots"] += [["s3", "5"], ["s4", "6"], ["s5", "7"]]
+    local.write(state)
+
+    assert replicate(local, remote)[0]["msg"] == "Succeeded"
+
+    assert remote.snapshots("backup/data")["/a"] == ["s1", "s2", "s3", "s4", "s5"]
+    sends = [args for args in local.read()["log"] if args[0] == "send" and "-nP" not in args]
+    assert sends[-1] == ["send", "-I", "tank/data/a@s2", "tank/data/a@s5"]
+
+
+def test__replicate__resume(pools):
+    local, remote = pools
+    state = remote.read()
+    state["interrupt"] = "backup/data/a"
+    remote.write(state)
+
+    result, mails, progress = replicate(local, remote)
+    assert result["msg"].startswith("Failed: tank/data/a")
+    assert "backup/data/a/b" not in remote.read()["datasets"]
+    assert remote.read()["datasets"]["backup/data/a"]["token"]
+
+    assert replicate(local, remote)[0]["msg"] == "Succeeded"
+    assert any(args[:2] == ["send", "-t"] for args in local.read()["log"])
+    assert remote.snapshots("backup/data") == local.snapshots("tank/data")
+
+
+def test__replicate__batched_destroy(pools):
+    local, remote = pools
+    replicate(local, remote)
+
+    state = remote.read()
+    state["datasets"]["backup/data/c"]["snapshots"] = [[f"old{i}", str(i)] for i in range(100)]
+    remote.write(state)
+
+    assert replicate(local, remote, followdelete=True)[0]["msg"] == "Succeeded"
+
+    destroys = [args for args in remote.read()["log"] if args[0] == "destroy"]
+    assert destroys == [["destroy", "backup/data/c@" + ",".join(f"old{i}" for i in range(100))]]
+    assert remote.snapshots("backup/data")["/c"] == ["s1", "s2"]
+
+
+def test__replicate__receive_error(pools):
+    local, remote = pools
+    state = remote.read()
+    state["reject"] = "cannot receive new filesystem stream: destination has been modified"
+    remote.write(state)
+    # `zfs send` is still writing when the receiving side exits
+    state = local.read()
+    state["snapshot_size"] = 64 * 1024 * 1024
+    local.write(state)
+
+    result, mails, progress = replicate(local, remote)
+
+    # Error of the receiving side, not of `zfs send` killed once it exited
+    assert result["msg"] == (
+        "Failed: tank/data (s1): cannot receive new filesystem stream: destination has been modified"
+    )
+    assert "destination has been modified" in mails[0][1]
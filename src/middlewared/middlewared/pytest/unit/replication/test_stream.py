@@ -0,0 +1,73 @@
+import asyncio
+import concurrent.futures
+import gzip
+import lzma
+import os
+
+import pytest
+
+from middlewared.replication import stream
+from middlewared.replication.stream import BlockCompressor, TokenBucket, pump
+
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+
+    async def read(self, n):
+        block, self.data = self.data[:n], self.data[n:]
+        return block
+
+
+class Writer:
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+@pytest.mark.parametrize("method,decompress", [("PIGZ", gzip.decompress), ("XZ", lzma.decompress)])
+def test__pump__compressed_blocks_in_order(method, decompress):
+    data = b"".join(bytes([i]) * stream.BLOCK_SIZE for i in range(7)) + os.urandom(1000)
+    writer = Writer()
+    progress = []
+
+    with concurrent.futures.ThreadPoolExecutor(3) as executor:
+        read, written = asyncio.get_event_loop().run_until_complete(pump(
+            Reader(data), writer, BlockCompressor(method, executor, 3),
+            progress=lambda read, written: progress.append((read, written)),
+        ))
+
+    assert decompress(writer.data) == data
+    assert (read, written) == (len(data), len(writer.data))
+    assert sum(r for r, w in progress) == len(data)
+    assert written < read
+
+
+def test__token_bucket__rate_and_schedule(monkeypatch):
+    now = [0]
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(asyncio, "sleep", sleep)
+    rates = iter([1000, None])
+    bucket = TokenBucket(schedule=lambda: next(rates), clock=lambda: now[0])
+
+    async def consume():
+        for i in range(5):
+            await bucket.consume(500)
+        # Rate is evaluated again once SCHEDULE_INTERVAL passed
+        now[0] += stream.SCHEDULE_INTERVAL
+        await bucket.consume(10 ** 9)
+
+    asyncio.get_event_loop().run_until_complete(consume())
+
+    # 2500 bytes at 1000 bytes/s, then unlimited
+    assert sum(sleeps) == pytest.approx(2.5)
@@ -0,0 +1,67 @@
+import asyncio
+import os
+import textwrap
+
+import pytest
+
+from middlewared.replication import transport
+from middlewared.replication.transport import SSHTransport, keyscan
+
+# Logs its arguments, acts as a master when asked to and runs remote commands locally
+FAKE_SSH = textwrap.dedent("""\
+    #!/bin/sh
+    dir=$(dirname "$0")
+    echo "$@" >> "$dir/log"
+    case "$*" in
+        *"-O check"*) test -f "$dir/master" ;;
+        *"-O exit"*) rm -f "$dir/master" ;;
+        *ControlMaster=yes*) touch "$dir/master" ;;
+        *"-T 2"*) echo "$5 ssh-ed25519 AAAAC3NzaC1lZDI1NTE5" ;;
+        *) for last; do true; done; exec /bin/sh -c "$last" ;;
+    esac
+""")
+
+
+@pytest.fixture
+def ssh(tmpdir, monkeypatch):
+    path = str(tmpdir.join("ssh"))
+    with open(path, "w") as f:
+        f.write(FAKE_SSH)
+    os.chmod(path, 0o755)
+    monkeypatch.setattr(transport, "SSH", path)
+    monkeypatch.setattr(transport, "SSH_KEYSCAN", path)
+
+    def log():
+        with open(str(tmpdir.join("log"))) as f:
+            return f.read().splitlines()
+
+    return log
+
+
+def test__ssh_transport__persistent_connection(tmpdir, ssh):
+    t = SSHTransport("backup.local", 2222, "repl", control_dir=str(tmpdir.join("control")))
+
+    async def run():
+        return await asyncio.gather(*[t.run(["echo", f"hello {i}"]) for i in range(5)])
+
+    results = asyncio.get_event_loop().run_until_complete(run())
+
+    assert [stdout for returncode, stdout, stderr in results] == [f"hello {i}\n" for i in range(5)]
+    log = ssh()
+    # Single connection, checked once
+    assert len([line for line in log if "ControlMaster=yes" in line]) == 1
+    assert len([line for line in log if "-O check" in line]) == 1
+    assert all(f"ControlPath={tmpdir.join('control')}/standard-%C" in line for line in log)
+    commands = [line for line in log if "ControlMaster=no" in line]
+    assert len(commands) == 5
+    assert all("-l repl -p 2222 backup.local echo 'hello" in line for line in commands)
+
+
+def test__keyscan__shared(ssh):
+    async def scan():
+        return await asyncio.gather(*[keyscan("nas.local", 22) for i in range(3)])
+
+    results = asyncio.get_event_loop().run_until_complete(scan())
+
+    assert set(results) == {(0, "nas.local ssh-ed25519 AAAAC3NzaC1lZDI1NTE5\n", "")}
+    assert len(ssh()) == 1
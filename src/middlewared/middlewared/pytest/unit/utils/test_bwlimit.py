@@ -0,0 +1,28 @@
+from datetime import datetime
+
+import pytest
+
+from middlewared.utils.bwlimit import parse_timetable, rate_at
+
+
+def test__parse_timetable():
+    assert parse_timetable("1M") == [(0, 1024 ** 2)]
+    assert parse_timetable("Mon-08:00,512 Sat-00:00,off") == [(8 * 60, 512 * 1024), (5 * 24 * 60, None)]
+    assert len(parse_timetable("08:00,512 18:00,10M")) == 14
+
+
+@pytest.mark.parametrize("timetable", ["08:00", "25:00,1M", "Mon-08:00,1X", "Foo-08:00,1M"])
+def test__parse_timetable__invalid(timetable):
+    with pytest.raises(ValueError):
+        parse_timetable(timetable)
+
+
+@pytest.mark.parametrize("dt,rate", [
+    (datetime(2018, 6, 18, 7, 59), None),  # Monday, from Friday 18:00
+    (datetime(2018, 6, 18, 8, 0), 512 * 1024),
+    (datetime(2018, 6, 22, 17, 0), 512 * 1024),
+    (datetime(2018, 6, 23, 12, 0), None),  # Saturday
+])
+def test__rate_at(dt, rate):
+    timetable = parse_timetable("Mon-08:00,512 Fri-18:00,off")
+    assert rate_at(timetable, dt) == rate
@@ -0,0 +1,41 @@
+import os
+
+from middlewared.utils.geom_topology import GeomTopology
+
+with open(os.path.join(os.path.dirname(__file__), "fixtures", "geom_confxml.xml")) as f:
+    CONFXML = f.read()
+
+
+def test__geom_topology__disks():
+    topology = GeomTopology(CONFXML)
+
+    assert sorted(topology.disks) == ["da0", "da1"]
+    assert topology.disks["da0"].mediasize == 4000787030016
+    assert topology.disk_by_serial("ZC10ABCD", "5000c500a1b2c3d4") == "da0"
+    assert topology.disk_by_serial("ZC10ABCD") == "da0"
+    assert topology.disk_by_serial("ZC10EFGH  ") == "da1"
+    assert topology.disk_by_serial("ZC10ABCD", "0") is None
+
+
+def test__geom_topology__partitions_and_labels():
+    topology = GeomTopology(CONFXML)
+
+    assert topology.partitions["da0p1"].config["type"] == "freebsd-swap"
+    assert topology.disks_by_partition_uuid["6d5b1f2a-6e7e-11e8-a4e4-0cc47a3a1b2c"] == "da0"
+    assert topology.label_to_dev("gptid/6d5b1f2a-6e7e-11e8-a4e4-0cc47a3a1b2c.eli") == "da0p2"
+    assert topology.labels_by_dev["da0p2"] == "gptid/6d5b1f2a-6e7e-11e8-a4e4-0cc47a3a1b2c"
+
+    assert topology.dev_to_disk("gptid/6d5b1f2a-6e7e-11e8-a4e4-0cc47a3a1b2c") == "da0"
+    assert topology.dev_to_disk("da0p1") == "da0"
+    assert topology.dev_to_disk("da5") is None
+
+
+def test__geom_topology__consumers():
+    topology = GeomTopology(CONFXML)
+
+    part = topology.geom_by_name("PART", "da0")
+    assert part.consumer.provider is topology.disks["da0"]
+    assert [p.name for p in part.providers] == ["da0p1", "da0p2"]
+    assert topology.disks["da0"].consumers[0].geom is part
+    assert topology.class_geoms("MULTIPATH") == []
+    assert topology.class_by_name("MIRROR") is None
@@ -0,0 +1,61 @@
+from mock import patch
+
+from middlewared.utils.lru import LRUCache
+
+
+def test__lru_cache__evicts_least_recently_used():
+    cache = LRUCache(max_items=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.stats()["evictions"] == 1
+
+
+def test__lru_cache__max_size():
+    cache = LRUCache(max_size=1024)
+    cache.put("a", "x" * 600)
+    cache.put("b", "x" * 600)
+
+    assert "a" not in cache
+    assert "b" in cache
+
+
+def test__lru_cache__ttl():
+    with patch("middlewared.utils.lru.time.monotonic", lambda: 100):
+        cache = LRUCache()
+        cache.put("a", 1, 10)
+        cache.put("b", 2)
+
+    with patch("middlewared.utils.lru.time.monotonic", lambda: 105):
+        assert cache.get("a") == 1
+
+    with patch("middlewared.utils.lru.time.monotonic", lambda: 110):
+        assert cache.expire() == 1
+        assert "a" not in cache
+        assert cache.get("b") == 2
+
+
+def test__lru_cache__expire_ignores_overwritten_key():
+    with patch("middlewared.utils.lru.time.monotonic", lambda: 100):
+        cache = LRUCache()
+        cache.put("a", 1, 10)
+        cache.put("a", 2, 100)
+
+    with patch("middlewared.utils.lru.time.monotonic", lambda: 150):
+        assert cache.expire() == 0
+        assert cache.get("a") == 2
+
+
+def test__lru_cache__pop_prefix():
+    cache = LRUCache()
+    cache.put("method:pool.query:[]", 1)
+    cache.put("method:pool.query:[[], {}]", 2)
+    cache.put("method:device.get_info:[\"DISK\"]", 3)
+
+    assert cache.pop_prefix("method:pool.query:") == 2
+    assert len(cache) == 1
@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+
+from middlewared.utils.periodic_snapshot import SnapshotInventory, plan_snapshots
+
+SNAPTIME = datetime(2018, 6, 1, 12, 0)  # Friday
+
+
+def task(filesystem, recursive=False, interval=60, ret_count=2, ret_unit="WEEK", begin="00:00:00",
+         end="23:59:00", dow=(1, 2, 3, 4, 5, 6, 7)):
+    return {"filesystem": filesystem, "recursive": recursive, "interval": interval, "ret_count": ret_count,
+            "ret_unit": ret_unit, "begin": begin, "end": end, "dow": list(dow)}
+
+
+def stamp(dt):
+    return dt.strftime("%Y%m%d.%H%M")
+
+
+def test__inventory():
+    inventory = SnapshotInventory.load([
+        "tank/a@auto-20180601.1100-2w",
+        "tank/a@auto-20180601.1000-2w",
+        "tank/a@manual",
+        "tank/a-x@auto-20180601.1000-2w",
+        "tank/a/b@auto-20180601.1000-1d",
+    ])
+
+    assert len(inventory) == 4
+    assert inventory.latest("tank/a", "2w") == "20180601.1100"
+    assert inventory.descendants("tank/a") == ["tank/a", "tank/a/b"]
+
+    inventory.add("tank/a@auto-20180601.1200-2w")
+    inventory.remove("tank/a/b@auto-20180601.1000-1d")
+    assert inventory.latest("tank/a", "2w") == "20180601.1200"
+    assert inventory.descendants("tank/a") == ["tank/a"]
+
+
+def test__plan_snapshots__tasks():
+    inventory = SnapshotInventory.load([
+        "tank/recent@auto-20180601.1130-2w",
+        "tank/old@auto-20180601.1000-2w",
+        "tank/old@auto-20180501.1000-2w",
+        "tank/old/child@auto-20180501.1000-2w",
+        "tank/other@auto-20180501.1000-2w",
+    ])
+
+    create, destroy = plan_snapshots([
+        # Interval not elapsed
+        task("tank/recent"),
+        task("tank/old", recursive=True),
+        # Taken by the recursive task above
+        task("tank/old/child"),
+        task("tank/old/child", ret_count=1, ret_unit="DAY"),
+        task("data/vm"),
+        task("data/db"),
+        # Not running now
+        task("tank/other", begin="13:00:00", end="14:00:00"),
+        task("tank/weekend", dow=[6, 7]),
+    ], inventory, SNAPTIME)
+
+    assert create == [
+        (False, ["data/db@auto-20180601.1200-2w", "data/vm@auto-20180601.1200-2w"]),
+        (False, ["tank/old/child@auto-20180601.1200-1d"]),
+        (True, ["tank/old@auto-20180601.1200-2w"]),
+    ]
+    # Child snapshot is destroyed recursively with its parent, tank/other is not covered by a running task
+    assert destroy == [("tank/old", ["auto-20180501.1000-2w"])]
+
+
+def test__plan_snapshots__million_snapshots():
+    # 1000 datasets with a snapshot every 15 minutes for 10 days and a few more that expired
+    names = [f"auto-{stamp(SNAPTIME - timedelta(minutes=15 * j))}-10d" for j in range(1, 1001)]
+    snapshots = []
+    for i in range(1000):
+        dataset = "tank/vm" if i == 0 else f"tank/vm/{i:03d}"
+        snapshots.extend(f"{dataset}@{name}" for name in names)
+    # A dataset that has its own snapshots that expired
+    snapshots.append("tank/vm/001@auto-20180101.0000-10d")
+
+    inventory = SnapshotInventory.load(snapshots)
+    assert len(inventory) == 1000001
+
+    tasks = [task("tank/vm", recursive=True, interval=15, ret_count=10, ret_unit="DAY")]
+    create, destroy = plan_snapshots(tasks, inventory, SNAPTIME)
+
+    assert create == [(True, [f"tank/vm@auto-{stamp(SNAPTIME)}-10d"])]
+    # Expired snapshots are 10 days old or more, destroyed recursively from the parent
+    assert destroy == [
+        ("tank/vm", sorted(names[959:])),
+        ("tank/vm/001", ["auto-20180101.0000-10d"]),
+    ]
+
+    # Inventory updated with the result is up to date
+    for recursive, group in create:
+        for snapshot in group:
+            dataset, name = snapshot.split("@")
+            for child in inventory.descendants(dataset):
+                inventory.add(f"{child}@{name}")
+    for dataset, batch in destroy:
+        for child in inventory.descendants(dataset):
+            for name in batch:
+                inventory.remove(f"{child}@{name}")
+
+    assert len(inventory) == 1000 * 960
+    assert plan_snapshots(tasks, inventory, SNAPTIME) == ([], [])
@@ -0,0 +1,135 @@
+import math
+import struct
+
+import pytest
+
+from middlewared.utils.lru import LRUCache
+from middlewared.utils.rrd import (
+    CDP_PREP_SIZE, DS_DEF, FLOAT_COOKIE, LIVE_HEAD, PDP_PREP_SIZE, RRA_DEF, STAT_HEAD, RRDFile, fetch,
+    resolve_times, xport,
+)
+
+LAST_UP = 1500000005
+
+
+def write_rrd(path, step, ds, rras, value, last_up=LAST_UP):
+    """
+    Write an RRD file with `ds` names and `rras` (cf, row_cnt, pdp_cnt, cur_row) where each row holds
+    `value(cf, timestamp, ds_index)` for the interval ending at timestamp.
+    """
+    header = STAT_HEAD.pack(b"RRD\0", b"0003\0", FLOAT_COOKIE, len(ds), len(rras), step)
+    for name in ds:
+        header += DS_DEF.pack(name.encode(), b"GAUGE")
+    for cf, row_cnt, pdp_cnt, cur_row in rras:
+        header += RRA_DEF.pack(cf.encode(), row_cnt, pdp_cnt)
+    header += LIVE_HEAD.pack(last_up, 0)
+    header += b"\0" * (PDP_PREP_SIZE * len(ds) + CDP_PREP_SIZE * len(ds) * len(rras))
+    for cf, row_cnt, pdp_cnt, cur_row in rras:
+        header += struct.pack("<Q", cur_row)
+
+    data = b""
+    for cf, row_cnt, pdp_cnt, cur_row in rras:
+        rra_step = step * pdp_cnt
+        rra_end = last_up - last_up % rra_step
+        for pos in range(row_cnt):
+            timestamp = rra_end - ((cur_row - pos) % row_cnt) * rra_step
+            data += struct.pack(f"<{len(ds)}d", *[value(cf, timestamp, i) for i in range(len(ds))])
+
+    with open(path, "wb") as f:
+        f.write(header + data)
+
+
+def value(cf, timestamp, i):
+    if timestamp % 100 == 0:
+        return math.nan
+    return timestamp % 1000 + i * 1000
+
+
+@pytest.fixture
+def rrd_path(tmpdir):
+    path = str(tmpdir.join("load.rrd"))
+    write_rrd(path, 10, ["shortterm", "midterm"], [
+        ("AVERAGE", 360, 1, 17),
+        ("AVERAGE", 240, 6, 5),
+        ("MAX", 360, 1, 359),
+    ], value)
+    return path
+
+
+def test__rrd_file__header(rrd_path):
+    with RRDFile(rrd_path) as rrd:
+        assert rrd.ds_names == ["shortterm", "midterm"]
+        assert rrd.pdp_step == 10
+        assert rrd.last_up == LAST_UP
+        assert [(rra.cf, rra.row_cnt, rra.pdp_cnt) for rra in rrd.rras] == [
+            ("AVERAGE", 360, 1),
+            ("AVERAGE", 240, 6),
+            ("MAX", 360, 1),
+        ]
+
+
+def test__fetch__ring_buffer(rrd_path):
+    with RRDFile(rrd_path) as rrd:
+        start, end, step, rows = fetch(rrd, "AVERAGE", LAST_UP - 300, LAST_UP, 10)
+
+    assert (start, end, step) == (LAST_UP - 305, LAST_UP + 5, 10)
+    timestamps = range(start + step, end + 1, step)
+    assert len(rows) == len(timestamps)
+    for timestamp, row in zip(timestamps, rows):
+        if timestamp > LAST_UP:
+            # Not updated yet
+            assert math.isnan(row[0])
+        elif timestamp % 100 == 0:
+            assert math.isnan(row[0]) and math.isnan(row[1])
+        else:
+            assert row == (timestamp % 1000, timestamp % 1000 + 1000)
+
+
+def test__fetch__chooses_rra_covering_period(rrd_path):
+    with RRDFile(rrd_path) as rrd:
+        start, end, step, rows = fetch(rrd, "AVERAGE", LAST_UP - 7200, LAST_UP, 10)
+
+    # The 10s RRA only holds an hour
+    assert step == 60
+    assert len(rows) == (end - start) // step
+    # rows[-1] ends at `end`, not updated yet
+    timestamp = end - 2 * step
+    assert rows[-3] == (timestamp % 1000, timestamp % 1000 + 1000)
+
+
+def test__xport__reduce(rrd_path):
+    result = xport([(rrd_path, "midterm", "AVERAGE", "load/load")], LAST_UP - 3000, LAST_UP, 30)
+
+    assert result["meta"] == {
+        "start": LAST_UP - 3005 + 30 - (LAST_UP - 3005) % 30,
+        "step": 30,
+        "end": LAST_UP - LAST_UP % 30 + 30,
+        "legend": ["load/load"],
+    }
+    for i, row in enumerate(result["data"]):
+        timestamp = result["meta"]["start"] + i * 30
+        if timestamp > LAST_UP:
+            assert row == [None]
+            continue
+        values = [value("AVERAGE", t, 1) for t in (timestamp - 20, timestamp - 10, timestamp)]
+        values = [v for v in values if not math.isnan(v)]
+        assert row == [sum(values) / len(values)]
+
+
+def test__xport__cache(rrd_path):
+    cache = LRUCache()
+    defs = [(rrd_path, "shortterm", "MAX", "load/load")]
+
+    result = xport(defs, LAST_UP - 600, LAST_UP, 10, cache=cache)
+    assert xport(defs, LAST_UP - 600, LAST_UP, 10, cache=cache) is result
+
+    # File updated, result must be computed again
+    write_rrd(rrd_path, 10, ["shortterm", "midterm"], [("MAX", 360, 1, 0)], value, LAST_UP + 10)
+    assert xport(defs, LAST_UP - 600, LAST_UP, 10, cache=cache) is not result
+
+
+def test__resolve_times():
+    now = 1500000000
+    assert resolve_times("now-1h", "now", now) == (now - 3600, now)
+    assert resolve_times("end-30min", "1400000000", now) == (1400000000 - 1800, 1400000000)
+    assert resolve_times("1400000000", "start+2h", now) == (1400000000, 1400000000 + 7200)
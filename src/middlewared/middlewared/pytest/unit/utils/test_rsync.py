@@ -0,0 +1,112 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from middlewared.utils import rsync
+from middlewared.utils.rsync import (
+    ShardProgress, parse_progress2, partition_directories, partition_files, shard_command, source_base, tree_files
+)
+
+
+def make_tree(root, files):
+    for path, size in files.items():
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+
+
+def test__source_base():
+    assert source_base("/mnt/tank/data") == ("/mnt/tank", "data")
+    assert source_base("/mnt/tank/data/") == ("/mnt/tank/data/", "")
+
+
+def test__partition_directories(tmpdir):
+    make_tree(str(tmpdir), {"src/a/1": 10, "src/a/b/2": 10, "src/c/3": 30, "src/4": 1, "src/5": 1})
+    os.makedirs(str(tmpdir.join("src/empty")))
+
+    shards = partition_directories(str(tmpdir.join("src")))
+
+    assert [(shard.paths, shard.size, shard.recursive) for shard in shards] == [
+        (["src/c"], 30, True),
+        (["src/a"], 20, True),
+        (["src/4", "src/5"], 2, False),
+        (["src/empty"], 0, True),
+    ]
+
+
+def test__partition_files(tmpdir, monkeypatch):
+    monkeypatch.setattr(rsync, "SHARD_FILES", 3)
+    make_tree(str(tmpdir), {"src/a/1": 10, "src/a/2": 10, "src/b/3": 10, "src/4": 10})
+
+    shards = partition_files(str(tmpdir.join("src")) + "/")
+
+    assert sorted(path for shard in shards for path in shard.paths) == ["4", "a", "a/1", "a/2", "b", "b/3"]
+    assert all(len(shard.paths) <= 3 and not shard.recursive for shard in shards)
+    assert sum(shard.size for shard in shards) == 40
+    assert shards[0].files_from() == b"".join(os.fsencode(path) + b"\0" for path in shards[0].paths)
+
+
+def test__partition_files__empty(tmpdir):
+    os.makedirs(str(tmpdir.join("src")))
+
+    assert [shard.paths for shard in partition_files(str(tmpdir.join("src")))] == [["src"]]
+
+
+def test__parse_progress2():
+    assert parse_progress2("     32.77K  45%   31.25MB/s    0:00:00 (xfr#1, to-chk=0/1)") == 45
+    assert parse_progress2("sending incremental file list") is None
+
+
+def test__shard_progress():
+    shards = [rsync.Shard(["a"], 300, True), rsync.Shard(["b"], 100, True)]
+    progress = ShardProgress(shards)
+
+    progress.start(0, shards[0])
+    progress.start(1, shards[1])
+    progress.update(0, 50)
+    assert progress.percent == 37
+
+    progress.finish(1, False)
+    progress.start(1, shards[1])
+    progress.finish(1, True)
+    assert progress.percent == 62
+    assert progress.description == "Copied 1 of 2 shards with 1 rsync workers, 1 failed attempts"
+
+
+def test__shard_command():
+    # -a does not imply -r with --files-from
+    assert shard_command("rsync -a", rsync.Shard(["src/a"], 0, True), "/tmp/shard0", "/mnt/tank", '"/mnt/dst"') == (
+        'rsync -a -r --from0 --files-from="/tmp/shard0" "/mnt/tank/" "/mnt/dst"'
+    )
+    assert shard_command("rsync -a", rsync.Shard(["src/4"], 0, False), "/tmp/shard1", "/mnt/tank/", '"/mnt/dst"') == (
+        'rsync -a --no-recursive --from0 --files-from="/tmp/shard1" "/mnt/tank/" "/mnt/dst"'
+    )
+
+
+def test__tree_files(tmpdir):
+    make_tree(str(tmpdir), {"a/1": 10, "2": 20})
+
+    assert tree_files(str(tmpdir)) == {"a": None, "a/1": 10, "2": 20}
+
+
+@pytest.mark.skipif(shutil.which("rsync") is None, reason="rsync is not installed")
+@pytest.mark.parametrize("partition", [partition_directories, partition_files])
+def test__sharded_copy(tmpdir, partition):
+    make_tree(str(tmpdir), {"src/a/1": 10, "src/a/b/2": 10, "src/c/3": 30, "src/4": 1})
+    os.makedirs(str(tmpdir.join("src/empty")))
+    os.makedirs(str(tmpdir.join("dst")))
+
+    source = str(tmpdir.join("src"))
+    for i, shard in enumerate(partition(source)):
+        files_from = str(tmpdir.join(f"shard{i}"))
+        with open(files_from, "wb") as f:
+            f.write(shard.files_from())
+        subprocess.run(
+            shard_command("rsync -a", shard, files_from, source_base(source)[0], f'"{tmpdir.join("dst")}"'),
+            shell=True, check=True,
+        )
+
+    assert tree_files(str(tmpdir.join("dst", "src"))) == tree_files(source)
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+
+from middlewared.utils.scheduler import (
+    Admission, ScheduledTask, WaitStats, path_pool, task_due, upcoming
+)
+
+
+def task(kind, id, pools, weight=1, schedule=None, background=False):
+    return ScheduledTask(kind, id, f"{kind} {id}", schedule, pools, weight, background)
+
+
+def test__path_pool():
+    assert path_pool("/mnt/tank/data") == "tank"
+    assert path_pool("/mnt/tank") == "tank"
+    assert path_pool("/var/db") is None
+    assert path_pool("") is None
+
+
+def test__task_due():
+    midnight = task("CLOUD_SYNC", 1, [], schedule={"minute": "0", "hour": "0"})
+
+    assert task_due(midnight, datetime(2018, 6, 1, 0, 0))
+    assert not task_due(midnight, datetime(2018, 6, 1, 0, 1))
+    assert not task_due(task("REPLICATION", 1, []), datetime(2018, 6, 1, 0, 0))
+
+
+def test__upcoming():
+    start = datetime(2018, 6, 1, 12, 0)
+    tasks = [
+        task("CLOUD_SYNC", 1, [], schedule={"minute": "0", "hour": "0"}),
+        task("RSYNC", 1, [], schedule={"minute": "*/30"}),
+        task("REPLICATION", 1, []),
+    ]
+
+    runs = upcoming(tasks, start, start + timedelta(hours=24))
+
+    assert [run[1].key for run in runs].count("RSYNC:1") == 48
+    assert [run[1].key for run in runs].count("CLOUD_SYNC:1") == 1
+    assert [run[0] for run in runs] == sorted(run[0] for run in runs)
+    # Jitter is stable and spreads tasks scheduled at the same minute
+    midnight = [at for at, t in runs if t.key == "CLOUD_SYNC:1"][0]
+    assert midnight == datetime(2018, 6, 2) + timedelta(seconds=tasks[0].jitter)
+    assert tasks[0].jitter != tasks[1].jitter
+
+
+def test__admission():
+    admission = Admission(concurrency=3, pool_budget=2)
+    heavy = task("SCRUB", 1, ["tank"], weight=2)
+    sync = task("CLOUD_SYNC", 1, ["tank"])
+    rsync = task("RSYNC", 1, ["tank"])
+    other = task("RSYNC", 2, ["data"])
+    unpooled = task("CLOUD_SYNC", 2, [])
+
+    # A task as heavy as the pool budget has the pool for itself, tasks of other pools are not held back
+    assert admission.select([heavy, sync, other]) == [heavy, other]
+    assert admission.select([sync, rsync, unpooled]) == [unpooled]
+    assert admission.select([sync]) == []
+
+    admission.finish(heavy)
+    admission.finish(other)
+    assert admission.select([sync, rsync, other]) == [sync, rsync]
+    assert admission.usage == {"tank": 2}
+    # Global concurrency
+    assert not admission.admits(other)
+
+
+def test__admission__background():
+    admission = Admission(concurrency=2, pool_budget=2)
+    scrubs = [task("SCRUB", i, [f"pool{i}"], background=True) for i in range(4)]
+    syncs = [task("CLOUD_SYNC", i, [f"pool{i}"]) for i in range(4)]
+
+    # Scrubs lasting for days on every pool do not take the slots of the other tasks
+    assert admission.select(scrubs) == scrubs
+    assert admission.running == set()
+    assert admission.select(syncs) == syncs[:2]
+    assert admission.usage == {"pool0": 2, "pool1": 2, "pool2": 1, "pool3": 1}
+
+    # They still use the budget of their pool
+    assert not admission.admits(task("RSYNC", 1, ["pool0"]))
+
+    admission.finish(scrubs[0])
+    assert admission.usage["pool0"] == 1
+
+
+def test__wait_stats():
+    stats = WaitStats()
+    stats.record("SCRUB", 10)
+    stats.record("SCRUB", 30)
+
+    assert stats.report() == {"SCRUB": {"count": 2, "total": 40, "max": 30, "last": 30, "average": 20}}
@@ -0,0 +1,53 @@
+import array
+import base64
+import math
+
+import pytest
+
+from middlewared.utils.timeseries import aggregate, bucket, encode, lttb
+
+NAN = float("nan")
+
+
+@pytest.mark.parametrize("method,expected", [
+    ("SUM", [4, 2, None]),
+    ("AVERAGE", [2, 2, None]),
+    ("MIN", [1, 2, None]),
+    ("MAX", [3, 2, None]),
+    ("PERCENTILE", [2.9, 2, None]),
+])
+def test__aggregate(method, expected):
+    result = aggregate([[1, NAN, NAN], [3, 2, NAN]], method, 95)
+    assert [None if math.isnan(v) else pytest.approx(v) for v in result] == expected
+
+
+def test__bucket():
+    size, buckets = bucket([1, 2, 3, NAN, NAN, 8, 9], 3)
+
+    assert size == 3
+    assert buckets[0] == (2, 1, 3)
+    assert buckets[1] == (8, 8, 8)
+    assert buckets[2] == (9, 9, 9)
+
+
+def test__lttb__keeps_peaks():
+    timestamps = list(range(1000))
+    values = [0.0] * 1000
+    values[500] = 100.0
+    values[700] = -50.0
+
+    ts, result = lttb(timestamps, values, 20)
+
+    assert len(ts) == len(result) == 20
+    assert ts[0] == 0 and ts[-1] == 999
+    assert 100.0 in result and -50.0 in result
+
+
+def test__lttb__skips_unknown():
+    assert lttb([1, 2, 3], [1, NAN, 3], 10) == ([1, 3], [1, 3])
+
+
+def test__encode():
+    values = array.array("f", base64.b64decode(encode([1.5, NAN])))
+    assert values[0] == 1.5
+    assert math.isnan(values[1])
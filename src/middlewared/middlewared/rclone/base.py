@@ -11,6 +11,13 @@ class BaseRcloneRemote:
 
     task_schema = []
 
+    # What rclone uses for tasks that do not set them: parallel file transfers and checkers, multipart upload chunk
+    # size in MiB (None if the remote does not upload in chunks). And the chunk size range the remote accepts
+    transfers = 4
+    checkers = 8
+    chunk_size = None
+    chunk_size_range = None
+
     def __init__(self, middleware):
         self.middleware = middleware
 
@@ -0,0 +1,122 @@
+"""
+Incremental parser of rclone `--use-json-log` output.
+
+Every line rclone writes is a JSON object {"level", "msg", "time", ...}; lines logged by `--stats` also carry a
+"stats" object with the transfer counters. Lines that are not JSON (e.g. written by an older rclone or before
+logging is set up) are passed through as they are.
+"""
+import json
+import re
+
+__all__ = ["RcloneLog", "format_size", "supports_json_log"]
+
+# First rclone release with `--use-json-log`
+JSON_LOG_VERSION = (1, 48)
+RE_TRANSF = re.compile(r"Transferred:\s*?(.+)$", re.S)
+RE_VERSION = re.compile(r"^rclone v(\d+)\.(\d+)", re.M)
+
+
+def format_size(size):
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if abs(size) < 1024 or unit == "TiB":
+            break
+        size /= 1024
+    return f"{size:.0f} {unit}" if unit == "B" else f"{size:.2f} {unit}"
+
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60}s"
+    return f"{seconds}s"
+
+
+def supports_json_log(version):
+    """
+    Whether the rclone that printed `version` (output of `rclone version`) supports `--use-json-log`.
+    """
+    m = RE_VERSION.search(version)
+    return m is not None and (int(m.group(1)), int(m.group(2))) >= JSON_LOG_VERSION
+
+
+class RcloneLog:
+    """
+    Feed it rclone output chunks with `feed`, it returns the text to write to the job logs and keeps the last
+    reported stats in `progress` ((percent, description, extra) for `job.set_progress`) and error messages in
+    `errors`.
+    """
+
+    MAX_ERRORS = 10
+
+    def __init__(self):
+        self.pending = b""
+        self.progress = None
+        self.errors = []
+
+    def feed(self, data):
+        lines = (self.pending + data).split(b"\n")
+        self.pending = lines.pop()
+        return "".join(self._line(line.decode("utf-8", "ignore")) for line in lines)
+
+    def flush(self):
+        pending, self.pending = self.pending, b""
+        return self._line(pending.decode("utf-8", "ignore")) if pending else ""
+
+    def _line(self, line):
+        try:
+            entry = json.loads(line)
+            if not isinstance(entry, dict):
+                raise ValueError(line)
+        except ValueError:
+            # Text stats of an rclone without JSON logging
+            reg = RE_TRANSF.search(line)
+            if reg:
+                transferred = reg.group(1).strip()
+                if not transferred.isdigit():
+                    self.progress = None, transferred, None
+            return line + "\n"
+
+        msg = str(entry.get("msg", "")).rstrip("\n")
+        level = str(entry.get("level", "")).upper()
+
+        if "stats" in entry:
+            self._stats(entry["stats"])
+        elif level in ("ERROR", "CRITICAL"):
+            self.errors.append(msg)
+            del self.errors[:-self.MAX_ERRORS]
+
+        return f"{entry.get('time', '')} {level:<7}: {msg}\n"
+
+    def _stats(self, stats):
+        bytes_ = stats.get("bytes") or 0
+        total_bytes = stats.get("totalBytes") or 0
+        speed = stats.get("speed") or 0
+        eta = stats.get("eta")
+
+        extra = {
+            "bytes": bytes_,
+            "total_bytes": total_bytes,
+            "files": stats.get("transfers") or 0,
+            "total_files": stats.get("totalTransfers") or 0,
+            "checks": stats.get("checks") or 0,
+            "speed": int(speed),
+            "eta": eta,
+            "errors": stats.get("errors") or 0,
+            "last_error": stats.get("lastError") or None,
+            "elapsed": stats.get("elapsedTime") or 0,
+        }
+
+        percent = None
+        description = f"Transferred {format_size(bytes_)}"
+        if total_bytes:
+            percent = min(bytes_ * 100 / total_bytes, 100)
+            description += f" of {format_size(total_bytes)}"
+        description += f" at {format_size(speed)}/s"
+        if eta is not None:
+            description += f", ETA {format_eta(eta)}"
+        if extra["errors"]:
+            description += f", {extra['errors']} errors"
+
+        self.progress = percent, description, extra
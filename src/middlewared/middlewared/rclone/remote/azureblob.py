@@ -10,6 +10,9 @@ class AzureBlobRcloneRemote(BaseRcloneRemote):
 
     rclone_type = "azureblob"
 
+    chunk_size = 4
+    chunk_size_range = (1, 100)
+
     credentials_schema = [
         Str("account", verbose="Account Name", required=True),
         Str("key", verbose="Account Key", required=True),
@@ -10,6 +10,10 @@ class B2RcloneRemote(BaseRcloneRemote):
 
     rclone_type = "b2"
 
+    # Large files are uploaded in parts of at least 5 MB
+    chunk_size = 96
+    chunk_size_range = (5, 5 * 1024)
+
     credentials_schema = [
         Str("account", verbose="Account ID or Application Key ID", required=True),
         Str("key", verbose="Application Key", required=True),
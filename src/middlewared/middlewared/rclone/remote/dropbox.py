@@ -8,6 +8,9 @@ class DropboxRcloneRemote(BaseRcloneRemote):
 
     rclone_type = "dropbox"
 
+    chunk_size = 48
+    chunk_size_range = (1, 149)
+
     credentials_schema = [
         Str("token", verbose="Access Token", required=True),
     ]
@@ -11,6 +11,10 @@ class S3RcloneRemote(BaseRcloneRemote):
     buckets = True
     rclone_type = "s3"
 
+    # Parts are at least 5 MiB, objects have at most 10000 parts
+    chunk_size = 5
+    chunk_size_range = (5, 5 * 1024)
+
     credentials_schema = [
         Str("access_key_id", verbose="Access Key ID", required=True),
         Str("secret_access_key", verbose="Secret Access Key", required=True),
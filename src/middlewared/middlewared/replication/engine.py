@@ -0,0 +1,453 @@
+"""
+Replicates a dataset (and its children) to a remote, sending independent datasets concurrently.
+
+A child is only received once its parent is up to date so it gets mounted over it and not hidden by it.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+import shlex
+import subprocess
+from datetime import datetime
+
+from middlewared.utils.bwlimit import parse_timetable, rate_at
+
+from .plan import nearest_ancestor, parse_snapshot_list, plan_replication, remote_name, remote_parents
+from .stream import BLOCK_SIZE, COMPRESSORS, BlockCompressor, TokenBucket, pump
+from .transport import CommandError
+
+__all__ = ["ReplicationEngine", "ReplicationError"]
+
+logger = logging.getLogger(__name__)
+
+ZFS = ["/sbin/zfs"]
+
+# compression: (compress argv, decompress command on the remote side)
+# Methods in `stream.COMPRESSORS` are compressed in-process instead of with the compress command.
+COMPRESSION = {
+    "PIGZ": (["/usr/local/bin/pigz"], "/usr/bin/env pigz -d"),
+    "PLZIP": (["/usr/local/bin/plzip"], "/usr/bin/env plzip -d"),
+    "LZ4": (["/usr/local/bin/lz4c"], "/usr/bin/env lz4c -d"),
+    "XZ": (["/usr/bin/xz"], "/usr/bin/env xzdec"),
+}
+# Threads compressing blocks of a replication task
+COMPRESSION_THREADS = min(4, os.cpu_count() or 1)
+# Bytes buffered for the receiving side before `zfs send` is not read anymore
+WRITE_BUFFER = 4 * BLOCK_SIZE
+# Longest `zfs destroy ds@a,b,c` argument before it is split in another command
+DESTROY_BATCH_LENGTH = 16384
+
+
+class ReplicationError(Exception):
+    """
+    `mail` is a (subject, text) to notify the administrator with.
+    """
+
+    def __init__(self, msg, mail=None):
+        self.msg = msg
+        self.mail = mail
+        super().__init__(msg)
+
+
+class ReplicationEngine:
+    """
+    `progress(transferred, total)` is called every time a block of a stream is sent; `total` is an estimate
+    and is None when it could not be computed. `sent` holds the bytes actually sent (after compression).
+
+    `limit` is in KiB/s for all the streams of the replication, `limit_schedule` is a timetable (see
+    `middlewared.utils.bwlimit`) that overrides it.
+    """
+
+    def __init__(self, localfs, remotefs, transport, *, recursive=False, followdelete=False, compression=None,
+                 limit=0, limit_schedule=None, concurrency=4, check_readonly=False, zfs=None, remote_zfs="zfs",
+                 progress=None):
+        self.localfs = localfs
+        self.remotefs = remotefs
+        self.remotefs_final = remote_name(localfs, localfs, remotefs)
+        self.transport = transport
+        self.recursive = recursive
+        self.followdelete = followdelete
+        self.compression = compression
+        self.limit = limit
+        self.limit_schedule = parse_timetable(limit_schedule) if limit_schedule else None
+        self.concurrency = concurrency
+        self.check_readonly = check_readonly
+        self.zfs = zfs or ZFS
+        self.remote_zfs = remote_zfs
+        self.progress = progress
+
+        self.transferred = 0
+        self.sent = 0
+        self.total = None
+
+        if self.limit_schedule:
+            self.bucket = TokenBucket(schedule=lambda: rate_at(self.limit_schedule, datetime.now()))
+        else:
+            self.bucket = TokenBucket(limit * 1024 if limit else None)
+        self.compressor = None
+
+    async def run(self):
+        """
+        Returns replication result {"msg": ..., "last_snapshot": ...} and a list of (subject, text) of failures
+        that should be reported.
+        """
+        map_source = parse_snapshot_list(await self._local(
+            ["list", "-H", "-t", "snapshot", "-p", "-o", "name,creation", "-r"] +
+            ([] if self.recursive else ["-d", "1"]) +
+            [self.localfs]
+        ))
+
+        remote_datasets = await self._remote_datasets()
+
+        missing = [ds for ds in remote_parents(self.localfs, self.remotefs) if ds not in remote_datasets]
+        if missing:
+            # If it fails, we don't care at this point
+            await self.transport.run(" ; ".join(
+                self._zfs_command("create", "-o", "readonly=on", ds) for ds in missing
+            ), check=False)
+            for ds in missing:
+                remote_datasets.setdefault(ds, {"readonly": True, "token": None})
+
+        if self.check_readonly:
+            # Bi-directional replication: the remote side indicates that they are willing to receive
+            # snapshots by setting readonly to "on" on the target and its children.
+            writable = [ds for ds, info in remote_datasets.items()
+                        if self._is_target(ds) and not info["readonly"]]
+            if writable:
+                raise ReplicationError("Remote destination must be set readonly", (
+                    f"Replication denied! ({self.transport})",
+                    f"The remote system have denied our replication from local ZFS {self.localfs} to remote ZFS "
+                    f"{self.remotefs_final}. Please change the 'readonly' property of:\n"
+                    f"    {self.remotefs_final}\n"
+                    f"as well as its children to 'on' to allow receiving replication.",
+                ))
+
+        # zfs receive would try to remove the system dataset and fail because it is in use
+        if "/" not in self.remotefs_final and f"{self.remotefs_final}/.system" in remote_datasets:
+            raise ReplicationError("Please move system dataset of remote side to another pool")
+
+        map_target = await self._remote_snapshots(remote_datasets)
+
+        # Interrupted streams are resumed before anything else, the target then has new snapshots
+        resumed = False
+        for dataset in map_source:
+            token = remote_datasets.get(self._remote(dataset), {}).get("token")
+            if token:
+                await self._resume(dataset, token)
+                resumed = True
+        if resumed:
+            map_target = await self._remote_snapshots(remote_datasets)
+
+        tasks = plan_replication(map_source, map_target, self.followdelete)
+        if not tasks:
+            return {"msg": "Up to date"}, []
+
+        await self._destroy_datasets([dataset for dataset, task in tasks.items() if task["action"] == "DESTROY"])
+
+        sends = {dataset: task for dataset, task in tasks.items() if task["action"] == "SEND"}
+        self.total = await self._estimate(sends)
+        if self.compression in COMPRESSORS:
+            with concurrent.futures.ThreadPoolExecutor(COMPRESSION_THREADS) as executor:
+                self.compressor = BlockCompressor(self.compression, executor, COMPRESSION_THREADS)
+                try:
+                    failures = await self._send_all(sends)
+                finally:
+                    self.compressor = None
+        else:
+            failures = await self._send_all(sends)
+
+        if failures:
+            dataset, message, mail = failures[0]
+            return {"msg": f"Failed: {message}"}, [mail for dataset, message, mail in failures if mail]
+
+        result = {"msg": "Succeeded"}
+        if self.localfs in map_source:
+            result["last_snapshot"] = map_source[self.localfs][-1][0]
+        return result, []
+
+    def _is_target(self, ds):
+        return ds == self.remotefs_final or ds.startswith(self.remotefs_final + "/")
+
+    def _zfs_command(self, *args):
+        """
+        Shell command running zfs with `args` on the remote side.
+        """
+        return " ".join([self.remote_zfs] + [shlex.quote(arg) for arg in args])
+
+    def _remote(self, dataset):
+        return remote_name(dataset, self.localfs, self.remotefs)
+
+    async def _local(self, args):
+        proc = await asyncio.create_subprocess_exec(
+            *(self.zfs + args), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        stdout, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            raise ReplicationError(f"Failed: {stderr.decode('utf8', 'ignore').strip()}")
+        return stdout.decode("utf8", "ignore")
+
+    async def _remote_datasets(self):
+        try:
+            returncode, output, error = await self.transport.run(self._zfs_command(
+                "list", "-H", "-p", "-o", "name,readonly,receive_resume_token",
+                "-t", "filesystem,volume", "-r", self.remotefs_final.split("/")[0],
+            ))
+        except CommandError as e:
+            raise ReplicationError(f"Failed: {e.output}", (
+                f"Replication failed! ({self.transport})",
+                f"Replication of local ZFS {self.localfs} to remote ZFS {self.remotefs_final} failed. "
+                f"The remote system is not responding.",
+            ))
+
+        result = {}
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            name, readonly, token = line.split("\t")
+            result[name] = {"readonly": readonly == "on", "token": None if token in ("-", "") else token}
+        return result
+
+    async def _remote_snapshots(self, remote_datasets):
+        if self.remotefs_final not in remote_datasets:
+            return {}
+
+        try:
+            returncode, output, error = await self.transport.run(self._zfs_command(
+                "list", "-H", "-t", "snapshot", "-p", "-o", "name,creation", "-r",
+                *([] if self.recursive else ["-d", "1"]),
+                self.remotefs_final,
+            ))
+        except CommandError as e:
+            raise ReplicationError(f"Failed: {e.output}")
+
+        return parse_snapshot_list(output, (self.remotefs_final, self.localfs))
+
+    async def _resume(self, dataset, token):
+        logger.debug("Resuming interrupted replication of %s", dataset)
+        try:
+            await self._stream(["-t", token])
+        except ReplicationError as e:
+            logger.warning("Unable to resume replication of %s, starting over: %s", dataset, e)
+            await self.transport.run(self._zfs_command("receive", "-A", self._remote(dataset)), check=False)
+
+    async def _destroy_datasets(self, datasets):
+        datasets = [dataset for dataset in datasets if nearest_ancestor(dataset, datasets) is None]
+        if not datasets:
+            return
+
+        returncode, output, error = await self.transport.run(" ; ".join(
+            self._zfs_command("destroy", "-r", self._remote(dataset)) for dataset in datasets
+        ), check=False)
+        if returncode != 0:
+            logger.warning("Unable to destroy datasets on remote system: %s", error.strip())
+
+    async def _destroy_snapshots(self, dataset, snapshots, defer=False):
+        """
+        Destroys `snapshots` of remote `dataset` in as few `zfs destroy ds@a,b,c` as possible, all in a single
+        remote command.
+        """
+        name = self._remote(dataset)
+        commands = []
+        batch = []
+        for snapshot in snapshots:
+            if batch and len(name) + sum(len(s) + 1 for s in batch) + len(snapshot) > DESTROY_BATCH_LENGTH:
+                commands.append(batch)
+                batch = []
+            batch.append(snapshot)
+        commands.append(batch)
+
+        await self.transport.run(" && ".join(
+            self._zfs_command("destroy", *(["-d"] if defer else []), name + "@" + ",".join(batch))
+            for batch in commands
+        ))
+
+    async def _estimate(self, sends):
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def estimate(args):
+            async with sem:
+                output = await self._local(["send", "-nP"] + args)
+            for line in output.splitlines():
+                if line.startswith("size\t"):
+                    return int(line.split("\t")[1])
+            return 0
+
+        streams = []
+        for dataset, task in sends.items():
+            streams.extend(self._send_args(dataset, task["base"], task["snapshots"]))
+
+        try:
+            return sum(await asyncio.gather(*[estimate(args) for args in streams]))
+        except (ReplicationError, ValueError) as e:
+            logger.debug("Unable to estimate replication size: %s", e)
+            return None
+
+    def _send_args(self, dataset, base, snapshots):
+        """
+        `zfs send` arguments to send `snapshots` of `dataset`: a full stream of the first one when there is no
+        `base`, then a single stream with all the intermediary snapshots.
+        """
+        flags = ["-p"] if self.followdelete else []
+        result = []
+        if base is None and snapshots:
+            base = snapshots[0]
+            result.append(flags + [f"{dataset}@{base}"])
+            snapshots = snapshots[1:]
+        if snapshots:
+            result.append(flags + ["-I", f"{dataset}@{base}", f"{dataset}@{snapshots[-1]}"])
+        return result
+
+    async def _send_all(self, sends):
+        sem = asyncio.Semaphore(self.concurrency)
+        done = {dataset: asyncio.Event() for dataset in sends}
+        failed = set()
+        failures = []
+
+        async def send(dataset, task):
+            parent = nearest_ancestor(dataset, sends)
+            if parent is not None:
+                await done[parent].wait()
+            try:
+                if parent in failed:
+                    failed.add(dataset)
+                    return
+
+                async with sem:
+                    try:
+                        await self._send_dataset(dataset, task)
+                    except ReplicationError as e:
+                        failed.add(dataset)
+                        failures.append((dataset, e.msg, e.mail))
+            finally:
+                done[dataset].set()
+
+        await asyncio.gather(*[send(dataset, task) for dataset, task in sends.items()])
+
+        return sorted(failures, key=lambda failure: failure[0])
+
+    async def _send_dataset(self, dataset, task):
+        if task["destroy"]:
+            logger.debug("Deleting %d snapshot(s) of %s on pull side because not a single matching snapshot "
+                         "was found", len(task["destroy"]), dataset)
+            try:
+                await self._destroy_snapshots(dataset, task["destroy"])
+            except CommandError as e:
+                raise ReplicationError(f"{dataset} (unable to destroy remote snapshots)", (
+                    f"Replication failed! ({self.transport})",
+                    f"The replication failed for the local ZFS {dataset} because the remote system has diverged "
+                    f"snapshots with us and we were unable to remove them:\n{e.output}",
+                ))
+
+        base = task["base"]
+        for args in self._send_args(dataset, base, task["snapshots"]):
+            snapshot = args[-1].split("@", 1)[1]
+            description = f"{dataset} ({base}->{snapshot})" if base else f"{dataset} ({snapshot})"
+            try:
+                await self._stream(args)
+            except ReplicationError as e:
+                raise ReplicationError(f"{description}: {e}", (
+                    f"Replication failed when sending {dataset}@{snapshot}",
+                    f"The replication failed for the local ZFS {dataset} while attempting to send "
+                    f"{description} to {self.transport}:\n{e}",
+                ))
+            base = snapshot
+
+        if task["delete"]:
+            logger.debug("Deleting %d stale snapshot(s) of %s on pull side", len(task["delete"]), dataset)
+            try:
+                await self._destroy_snapshots(dataset, task["delete"], defer=True)
+            except CommandError as e:
+                logger.warning("Unable to delete stale snapshots of %s: %s", dataset, e.output)
+
+    async def _stream(self, send_args):
+        """
+        Runs `zfs send` | [compress] | `zfs receive` on the remote. The stream is copied by this process, which
+        counts transferred bytes, limits the rate and compresses it when it can.
+        """
+        stages = []
+        receive = self._zfs_command("receive", "-s", "-F", "-d", self.remotefs)
+        if self.compression in COMPRESSION:
+            compress, decompress = COMPRESSION[self.compression]
+            if self.compression not in COMPRESSORS:
+                stages.append(compress)
+            receive = f"{decompress} | {receive}"
+        stages.append(receive)
+
+        logger.debug("Sending zfs stream: %s", " ".join(self.zfs + ["send"] + send_args))
+
+        procs = []
+        try:
+            send = await asyncio.create_subprocess_exec(
+                *(self.zfs + ["send"] + send_args), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                limit=BLOCK_SIZE,
+            )
+            procs.append(send)
+
+            stdin = subprocess.PIPE
+            for i, argv in enumerate(stages):
+                last = i == len(stages) - 1
+                if last:
+                    stdout, stderr, next_stdin = subprocess.PIPE, subprocess.STDOUT, None
+                else:
+                    next_stdin, stdout = os.pipe()
+                    stderr = subprocess.PIPE
+                try:
+                    if last:
+                        procs.append(await self.transport.stream(argv, stdin=stdin, stdout=stdout, stderr=stderr))
+                    else:
+                        procs.append(await asyncio.create_subprocess_exec(
+                            *argv, stdin=stdin, stdout=stdout, stderr=stderr,
+                        ))
+                finally:
+                    if stdin != subprocess.PIPE:
+                        os.close(stdin)
+                    if not last:
+                        os.close(stdout)
+                stdin = next_stdin
+
+            procs[1].stdin.transport.set_write_buffer_limits(WRITE_BUFFER)
+
+            results = await asyncio.gather(
+                self._pump(send, procs[1]),
+                *[self._communicate(proc) for proc in procs],
+            )
+        finally:
+            for proc in procs:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+
+        # The receiving side is checked first: once it exits the stages before it fail writing to it (or `zfs send`
+        # is killed by `_pump`), their errors would hide why it exited
+        for proc, output in reversed(list(zip(procs, results[1:]))):
+            if proc.returncode == 0:
+                continue
+            # When replicating to a target "container" dataset that doesn't exist on the sending side the target
+            # dataset will have to be readonly, however that will preclude creating mountpoints for the datasets
+            # that are sent.
+            if proc is procs[-1] and "failed to create mountpoint" in output:
+                continue
+            raise ReplicationError(output.replace("WARNING: ENABLED NONE CIPHER", "").strip() or
+                                   f"Exited with code {proc.returncode}")
+
+    async def _pump(self, send, receive):
+        def progress(read, written):
+            self.transferred += read
+            self.sent += written
+            if self.progress:
+                self.progress(self.transferred, self.total)
+
+        try:
+            await pump(send.stdout, receive.stdin, self.compressor, self.bucket, progress)
+        except (BrokenPipeError, ConnectionResetError):
+            # Receiving side exited, its output tells why. Make sure `zfs send` does not block on a full pipe.
+            send.kill()
+        finally:
+            receive.stdin.close()
+
+    async def _communicate(self, proc):
+        # `zfs send` stdout is read by the pump, the receiving side has its stderr redirected to stdout
+        output = await (proc.stderr or proc.stdout).read()
+        await proc.wait()
+        return output.decode("utf8", "ignore")
@@ -0,0 +1,135 @@
+"""
+What has to be done to bring a replication target up to date, computed from the snapshot lists of both sides.
+"""
+import re
+
+__all__ = [
+    "RE_SYSTEM_DATASET", "parse_snapshot_list", "plan_replication", "nearest_ancestor", "remote_name", "remote_parents",
+]
+
+RE_SYSTEM_DATASET = re.compile(r"^[^/]+/\.system")
+
+
+def parse_snapshot_list(output, rename=None):
+    """
+    Parse `zfs list -H -t snapshot -p -o name,creation` output (sorted by creation) into
+    {dataset: [(snapshot, creation), ...]}.
+
+    `rename` is a (from, to) prefix pair used to map target datasets to their source names.
+    System dataset snapshots are skipped.
+    """
+    result = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        name, creation = line.split("\t")
+        if RE_SYSTEM_DATASET.match(name):
+            continue
+        if rename is not None:
+            if not name.startswith(rename[0]):
+                continue
+            name = rename[1] + name[len(rename[0]):]
+        dataset, snapshot = name.split("@", 1)
+        result.setdefault(dataset, []).append((snapshot, creation))
+    return result
+
+
+def remote_name(dataset, localfs, remotefs):
+    """
+    Name of the target of `dataset` (`localfs` or one of its children) replicated to `remotefs`.
+    """
+    localfs_final = remotefs + localfs.partition("/")[1] + localfs.partition("/")[2]
+    return localfs_final + dataset[len(localfs):]
+
+
+def _common_snapshot(list_source, list_target):
+    """
+    Indexes of the most recent snapshot (name and creation time) both lists share, (None, None) if none.
+
+    Both lists are ordered by creation time, scan them backwards from the end.
+    """
+    i = len(list_source) - 1
+    j = len(list_target) - 1
+    while i >= 0 and j >= 0:
+        source_snap, source_time = list_source[i]
+        target_snap, target_time = list_target[j]
+        if source_snap == target_snap and source_time == target_time:
+            return i, j
+        if source_time > target_time:
+            i -= 1
+        else:
+            j -= 1
+    return None, None
+
+
+def plan_replication(map_source, map_target, followdelete=False):
+    """
+    Returns tasks {dataset: task} to bring `map_target` up to date with `map_source`.
+
+    Each task is a dict:
+      - `action`: SEND or DESTROY (dataset no longer exists on source)
+      - `base`: snapshot the target already has to send incrementally from, None for a full send
+      - `snapshots`: snapshots to send, in order
+      - `destroy`: target snapshots to destroy before sending because the target diverged
+      - `delete`: target snapshots to destroy once sent because they no longer exist on source (`followdelete`)
+    """
+    tasks = {}
+    for dataset, list_source in map_source.items():
+        list_target = map_target.get(dataset)
+        task = {"action": "SEND", "base": None, "snapshots": [], "destroy": [], "delete": []}
+        if list_target:
+            i, j = _common_snapshot(list_source, list_target)
+            if i is not None:
+                task["base"] = list_source[i][0]
+                task["snapshots"] = [snap for snap, creation in list_source[i + 1:]]
+                if followdelete:
+                    source_names = {snap for snap, creation in list_source}
+                    task["delete"] = [snap for snap, creation in list_target if snap not in source_names]
+            else:
+                # No common snapshot, start over
+                task["snapshots"] = [snap for snap, creation in list_source]
+                task["destroy"] = [snap for snap, creation in list_target]
+        else:
+            task["snapshots"] = [snap for snap, creation in list_source]
+
+        if task["snapshots"] or task["delete"]:
+            tasks[dataset] = task
+
+    for dataset in map_target:
+        if dataset not in map_source:
+            tasks[dataset] = {"action": "DESTROY", "base": None, "snapshots": [], "destroy": [], "delete": []}
+
+    return tasks
+
+
+def nearest_ancestor(dataset, datasets):
+    """
+    Closest parent of `dataset` found in `datasets`, None if there is none.
+    """
+    while "/" in dataset:
+        dataset = dataset.rsplit("/", 1)[0]
+        if dataset in datasets:
+            return dataset
+    return None
+
+
+def remote_parents(localfs, remotefs):
+    """
+    Datasets that have to exist on the remote side before `localfs` can be received into `remotefs`,
+    parents first (e.g. tank -> tank replication needs none).
+    """
+    if "/" not in remotefs and "/" not in localfs:
+        return []
+
+    if "/" not in localfs:
+        localfs = f"{localfs}/{localfs}"
+
+    pool = remotefs.split("/")[0]
+    result = []
+    ds = ""
+    for direc in (remotefs.partition("/")[2] + "/" + localfs.partition("/")[2]).split("/"):
+        if not direc:
+            continue
+        ds = f"{ds}/{direc}" if ds else direc
+        result.append(f"{pool}/{ds}")
+    return result
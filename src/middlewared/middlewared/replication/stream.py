@@ -0,0 +1,132 @@
+"""
+In-process stages of a replication stream: block compression and rate limiting.
+"""
+import asyncio
+import collections
+import lzma
+import time
+import zlib
+
+__all__ = ["BLOCK_SIZE", "COMPRESSORS", "BlockCompressor", "TokenBucket", "pump"]
+
+# Size of the blocks read from `zfs send` and compressed independently
+BLOCK_SIZE = 1024 * 1024
+# Seconds between two evaluations of a rate limit schedule
+SCHEDULE_INTERVAL = 60
+
+
+def _gzip(block):
+    # Each block is a complete gzip member, `gzip -d` / `pigz -d` decompress their concatenation
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+
+def _xz(block):
+    # Concatenated .xz streams are decompressed by `xzdec`
+    return lzma.compress(block, format=lzma.FORMAT_XZ, preset=6)
+
+
+# Compression methods that can be done in-process (both zlib and lzma release the GIL)
+COMPRESSORS = {
+    "PIGZ": _gzip,
+    "XZ": _xz,
+}
+
+
+class BlockCompressor:
+    """
+    Compresses blocks with `method` in `executor` threads, up to `threads` blocks at the same time.
+    """
+
+    def __init__(self, method, executor, threads):
+        self.compress = COMPRESSORS[method]
+        self.executor = executor
+        self.threads = threads
+
+
+class TokenBucket:
+    """
+    Limits the rate of the streams consuming it to `rate` bytes per second (unlimited if None or 0).
+
+    `schedule`, if set, is called every `SCHEDULE_INTERVAL` seconds to get the current rate, e.g. to allow more
+    bandwidth outside business hours.
+    """
+
+    def __init__(self, rate=None, schedule=None, clock=time.monotonic):
+        self.rate = rate
+        self.schedule = schedule
+        self.clock = clock
+
+        self.tokens = 0
+        self.updated_at = clock()
+        self.scheduled_at = None
+
+    def set_rate(self, rate):
+        self._refill(self.clock())
+        self.rate = rate
+
+    async def consume(self, n):
+        now = self.clock()
+        if self.schedule is not None and (self.scheduled_at is None or now - self.scheduled_at >= SCHEDULE_INTERVAL):
+            self.scheduled_at = now
+            self.set_rate(self.schedule())
+
+        if not self.rate:
+            return
+
+        self._refill(now)
+        # Streams go into debt and wait for it to be paid, concurrent streams wait for each other's debt
+        self.tokens -= n
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+    def _refill(self, now):
+        if self.rate:
+            # Allow bursts of up to a second
+            self.tokens = min(self.tokens + (now - self.updated_at) * self.rate, self.rate)
+        else:
+            self.tokens = 0
+        self.updated_at = now
+
+
+async def pump(reader, writer, compressor=None, bucket=None, progress=None):
+    """
+    Copies `reader` to `writer` by blocks, compressing them with `compressor` and limiting the rate with `bucket`.
+
+    `progress(read, written)` is called with byte counts of every block. Returns (read, written) totals.
+    """
+    loop = asyncio.get_event_loop()
+    pending = collections.deque()
+    read = written = 0
+
+    async def write(block, size):
+        nonlocal written
+        if bucket is not None:
+            await bucket.consume(len(block))
+        writer.write(block)
+        await writer.drain()
+        written += len(block)
+        if progress is not None:
+            progress(size, len(block))
+
+    while True:
+        block = await reader.read(BLOCK_SIZE)
+        if not block:
+            break
+        read += len(block)
+
+        if compressor is None:
+            await write(block, len(block))
+            continue
+
+        # Keep reading while previous blocks are being compressed, write them in order
+        pending.append((loop.run_in_executor(compressor.executor, compressor.compress, block), len(block)))
+        if len(pending) >= compressor.threads:
+            fut, size = pending.popleft()
+            await write(await fut, size)
+
+    while pending:
+        fut, size = pending.popleft()
+        await write(await fut, size)
+
+    return read, written
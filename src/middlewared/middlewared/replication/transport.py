@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import os
+import shlex
+import subprocess
+import time
+
+__all__ = ["CommandError", "LocalTransport", "SSHTransport", "ssh_transport", "close_ssh_transports", "keyscan"]
+
+logger = logging.getLogger(__name__)
+
+SSH = "/usr/local/bin/ssh"
+SSH_KEYSCAN = "/usr/bin/ssh-keyscan"
+REPLICATION_PRIVATE_KEY = "/data/ssh/replication"
+
+# Control sockets of the persistent connections to replication remotes
+CONTROL_DIR = "/tmp/middlewared/ssh"
+# Seconds an idle persistent connection is kept open
+CONTROL_PERSIST = 600
+# Seconds a persistent connection is assumed to be alive before checking it again
+CONTROL_CHECK_INTERVAL = 60
+# Seconds host keys found by `keyscan` are kept
+KEYSCAN_TTL = 60
+
+SSH_CIPHER_OPTIONS = {
+    "FAST": ["-c", "arcfour256,arcfour128,blowfish-cbc,aes128-ctr,aes192-ctr,aes256-ctr"],
+    "DISABLED": ["-ononeenabled=yes", "-ononeswitch=yes"],
+    "STANDARD": [],
+}
+
+
+class CommandError(Exception):
+    def __init__(self, returncode, output):
+        self.returncode = returncode
+        self.output = output
+        super().__init__(output)
+
+
+class LocalTransport:
+    """
+    Runs "remote" commands on this machine, through the shell.
+    """
+
+    def __str__(self):
+        return "localhost"
+
+    def command(self, cmd):
+        if isinstance(cmd, list):
+            cmd = " ".join(shlex.quote(arg) for arg in cmd)
+        return ["/bin/sh", "-c", cmd]
+
+    async def stream(self, cmd, **kwargs):
+        """
+        Starts `cmd`, `kwargs` are passed to `asyncio.create_subprocess_exec` (e.g. `stdin`).
+        """
+        return await asyncio.create_subprocess_exec(*self.command(cmd), **kwargs)
+
+    async def run(self, cmd, check=True):
+        returncode, stdout, stderr = await _run(self.command(cmd))
+        if check and returncode != 0:
+            raise CommandError(returncode, stderr.strip() or stdout.strip())
+        return returncode, stdout, stderr
+
+
+class SSHTransport(LocalTransport):
+    """
+    Runs commands on a replication remote (storage.replremote) using the replication key.
+
+    All commands (and `zfs receive` streams) are sessions multiplexed over a single persistent connection
+    (ssh ControlMaster) so they do not pay for a TCP and SSH handshake each. If that connection can not be
+    established, ssh connects directly.
+    """
+
+    def __init__(self, hostname, port=22, user=None, cipher="STANDARD", connect_timeout=7, control_dir=CONTROL_DIR):
+        self.hostname = hostname
+        self.port = port
+        self.user = user
+        self.cipher = cipher
+        self.connect_timeout = connect_timeout
+        self.control_dir = control_dir
+        # %C is a hash of local host, remote host, port and user. Different ciphers need different connections.
+        self.control_path = os.path.join(control_dir, f"{cipher.lower()}-%C")
+
+        self.lock = asyncio.Lock()
+        self.checked_at = None
+
+    @classmethod
+    def from_replication(cls, replication):
+        return ssh_transport(
+            replication["remote_hostname"],
+            replication["remote_port"],
+            replication["remote_dedicateduser"] if replication["remote_dedicateduser_enabled"] else None,
+            replication["remote_cipher"],
+        )
+
+    def __str__(self):
+        return self.hostname
+
+    def ssh_args(self, *options):
+        args = [SSH] + SSH_CIPHER_OPTIONS.get(self.cipher, []) + [
+            "-i", REPLICATION_PRIVATE_KEY,
+            "-o", "BatchMode=yes",
+            "-o", "StrictHostKeyChecking=yes",
+            # It will prevent hanging in the status of "Sending"
+            "-o", f"ConnectTimeout={self.connect_timeout}",
+            "-o", f"ControlPath={self.control_path}",
+        ] + list(options)
+        if self.user:
+            args += ["-l", self.user]
+        args += ["-p", str(self.port), self.hostname]
+        return args
+
+    def command(self, cmd):
+        if isinstance(cmd, list):
+            cmd = " ".join(shlex.quote(arg) for arg in cmd)
+        return self.ssh_args("-o", "ControlMaster=no") + [cmd]
+
+    async def run(self, cmd, check=True):
+        await self.connect()
+        return await super().run(cmd, check)
+
+    async def connect(self):
+        """
+        Make sure the persistent connection is up.
+        """
+        async with self.lock:
+            if self.checked_at is not None and time.monotonic() - self.checked_at < CONTROL_CHECK_INTERVAL:
+                return
+
+            if (await _run(self.ssh_args("-O", "check")))[0] != 0:
+                os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+                returncode, stdout, stderr = await _run(self.ssh_args(
+                    "-o", "ControlMaster=yes", "-o", f"ControlPersist={CONTROL_PERSIST}", "-f", "-N",
+                ))
+                if returncode != 0:
+                    logger.debug("Unable to open persistent connection to %s: %s", self.hostname, stderr.strip())
+                    # Commands will connect directly, try again next time
+                    self.checked_at = None
+                    return
+
+            self.checked_at = time.monotonic()
+
+    async def close(self):
+        async with self.lock:
+            await _run(self.ssh_args("-O", "exit"))
+            self.checked_at = None
+
+    async def stream(self, cmd, **kwargs):
+        """
+        Starts `cmd` on a dedicated session of the persistent connection, e.g. to feed it a `zfs send` stream.
+        """
+        await self.connect()
+        return await super().stream(cmd, **kwargs)
+
+
+_transports = {}
+
+
+def ssh_transport(hostname, port=22, user=None, cipher="STANDARD"):
+    """
+    Shared transport to a remote so its commands all go through the same persistent connection.
+    """
+    key = (hostname, port, user, cipher)
+    if key not in _transports:
+        _transports[key] = SSHTransport(hostname, port, user, cipher)
+    return _transports[key]
+
+
+async def close_ssh_transports(hostname):
+    """
+    Close persistent connections to `hostname`, e.g. because its port or host key changed.
+    """
+    for key in [key for key in _transports if key[0] == hostname]:
+        await _transports.pop(key).close()
+
+
+_keyscans = {}
+
+
+async def keyscan(host, port):
+    """
+    Host keys of `host`:`port`. Scans requested at the same time (or shortly after) share the same
+    `ssh-keyscan` run.
+
+    Returns (returncode, keys, error).
+    """
+    key = (host, port)
+    if key in _keyscans:
+        started_at, fut = _keyscans[key]
+        if not fut.done() or time.monotonic() - started_at < KEYSCAN_TTL:
+            return await asyncio.shield(fut)
+
+    fut = asyncio.ensure_future(_run([SSH_KEYSCAN, "-p", str(port), "-T", "2", str(host)]))
+    _keyscans[key] = (time.monotonic(), fut)
+    result = await asyncio.shield(fut)
+    if result[0] != 0 or not result[1]:
+        # Do not remember failures
+        _keyscans.pop(key, None)
+    return result
+
+
+async def _run(argv):
+    proc = await asyncio.create_subprocess_exec(*argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = await proc.communicate()
+    return proc.returncode, stdout.decode("utf8", "ignore"), _strip_warnings(stderr.decode("utf8", "ignore"))
+
+
+def _strip_warnings(stderr):
+    return stderr.replace("WARNING: ENABLED NONE CIPHER", "")
@@ -5,13 +5,24 @@ import asyncio
 import base64
 import binascii
 import copy
+import gzip
+import hashlib
+import os
 import types
+import urllib.parse
 
 from .client import ejson as json
 from .job import Job
 from .schema import Error as SchemaError
 from .service import CallError, ValidationError, ValidationErrors
 
+# Arrays with more items than this are streamed using chunked encoding
+STREAM_THRESHOLD = 1000
+# Number of array items serialized per chunk when streaming
+STREAM_CHUNK_SIZE = 256
+# Methods, services and OpenAPI spec generated on a previous start
+RESTFUL_CACHE_PATH = '/var/db/middlewared/restful.json.gz'
+
 
 async def authenticate(middleware, req):
 
@@ -42,16 +53,73 @@ class RESTfulAPI(object):
         self._methods = {}
         self._methods_by_service = defaultdict(dict)
 
+        # Number of changes made through the API per service, part of the ETag
+        self._changes = defaultdict(int)
+
         self._openapi = OpenAPIResource(self)
 
     def get_app(self):
         return self.app
 
+    def _plugins_hash(self):
+        """
+        Hash of every middlewared module (and overlay) path, mtime and size.
+        Methods and their schemas can only change if one of these does.
+        """
+        digest = hashlib.sha256()
+        dirs = [os.path.dirname(os.path.realpath(__file__))] + list(self.middleware.overlay_dirs)
+        for base in dirs:
+            for root, subdirs, files in os.walk(base):
+                subdirs.sort()
+                for f in sorted(files):
+                    if not f.endswith('.py'):
+                        continue
+                    path = os.path.join(root, f)
+                    st = os.stat(path)
+                    digest.update(f'{path}:{st.st_mtime_ns}:{st.st_size}\n'.encode())
+        return digest.hexdigest()
+
+    def _load_cache(self, plugins_hash):
+        try:
+            with gzip.open(RESTFUL_CACHE_PATH, 'rt') as f:
+                cache = json.loads(f.read())
+        except Exception:
+            return None
+        if cache.get('hash') != plugins_hash:
+            return None
+        return cache
+
+    def _save_cache(self, plugins_hash, methods, services):
+        data = json.dumps({
+            'hash': plugins_hash,
+            'methods': methods,
+            'services': services,
+            'openapi': self._openapi.dump(),
+        })
+        try:
+            os.makedirs(os.path.dirname(RESTFUL_CACHE_PATH), exist_ok=True)
+            tmp = f'{RESTFUL_CACHE_PATH}.tmp'
+            with gzip.open(tmp, 'wt') as f:
+                f.write(data)
+            os.rename(tmp, RESTFUL_CACHE_PATH)
+        except OSError:
+            self.middleware.logger.warning('Failed to write RESTful API cache', exc_info=True)
+
     async def register_resources(self):
-        for methodname, method in list((await self.middleware.call('core.get_methods')).items()):
+        plugins_hash = await self.middleware.run_in_thread(self._plugins_hash)
+        cache = await self.middleware.run_in_thread(self._load_cache, plugins_hash)
+        if cache:
+            methods = cache['methods']
+            services = cache['services']
+            self._openapi.load(cache['openapi'])
+        else:
+            methods = await self.middleware.call('core.get_methods')
+            services = await self.middleware.call('core.get_services')
+
+        for methodname, method in list(methods.items()):
             self._methods[methodname] = method
             self._methods_by_service[methodname.rsplit('.', 1)[0]][methodname] = method
-        for name, service in list((await self.middleware.call('core.get_services')).items()):
+        for name, service in list(services.items()):
 
             kwargs = {}
             blacklist_methods = []
@@ -121,6 +189,9 @@ class RESTfulAPI(object):
                 Resource(self, self.middleware, short_methodname, parent=parent, **res_kwargs)
             await asyncio.sleep(0)  # Force context switch
 
+        if not cache:
+            await self.middleware.run_in_thread(self._save_cache, plugins_hash, methods, services)
+
 
 class OpenAPIResource(object):
 
@@ -150,9 +221,27 @@ class OpenAPIResource(object):
                 'scheme': 'basic'
             },
         }
+        # Paths and components loaded from cache do not need to be generated again
+        self._loaded = False
+        # Serialized and gzip compressed spec per server url
+        self._serialized = {}
+
+    def dump(self):
+        return {
+            'paths': self._paths,
+            'components': self._components,
+        }
+
+    def load(self, data):
+        self._paths = defaultdict(dict, data['paths'])
+        self._components = defaultdict(dict, data['components'])
+        self._schemas = self._components['schemas']
+        self._loaded = True
 
     def add_path(self, path, operation, methodname, params=None):
         assert operation in ('get', 'post', 'put', 'delete')
+        if self._loaded:
+            return
         opobject = {
             'tags': [methodname.rsplit('.', 1)[0]],
             'responses': {
@@ -194,6 +283,13 @@ class OpenAPIResource(object):
                         'required': False,
                         'schema': {'type': 'string'},
                     },
+                    {
+                        'name': 'cursor',
+                        'in': 'query',
+                        'required': False,
+                        'description': 'Opaque cursor from the `X-Next-Cursor` header of the previous page',
+                        'schema': {'type': 'string'},
+                    },
                 ]
             elif accepts:
                 opobject['requestBody'] = self._accepts_to_request(methodname, method, accepts)
@@ -274,14 +370,10 @@ class OpenAPIResource(object):
             }
         }
 
-    def get(self, req, **kwargs):
-
+    def _serialize(self, url):
         servers = []
-        host = req.headers.get('Host')
-        if host:
-            servers.append({
-                'url': f'{req.scheme}://{host}/api/v2.0',
-            })
+        if url:
+            servers.append({'url': url})
 
         result = {
             'openapi': '3.0.0',
@@ -295,8 +387,29 @@ class OpenAPIResource(object):
             'security': [{'basic': []}],
         }
 
-        resp = web.Response()
-        resp.text = json.dumps(result, indent=True)
+        body = json.dumps(result, indent=True).encode()
+        return body, gzip.compress(body)
+
+    def get(self, req, **kwargs):
+
+        url = None
+        host = req.headers.get('Host')
+        if host:
+            url = f'{req.scheme}://{host}/api/v2.0'
+
+        if url not in self._serialized:
+            # Host header comes from the client, do not let it grow unbounded
+            if len(self._serialized) >= 16:
+                self._serialized.pop(next(iter(self._serialized)))
+            self._serialized[url] = self._serialize(url)
+        body, compressed = self._serialized[url]
+
+        resp = web.Response(content_type='text/plain', charset='utf-8', headers={'Vary': 'Accept-Encoding'})
+        if 'gzip' in req.headers.get('Accept-Encoding', ''):
+            resp.headers['Content-Encoding'] = 'gzip'
+            resp.body = compressed
+        else:
+            resp.body = body
         return resp
 
 
@@ -415,7 +528,10 @@ class Resource(object):
                 options[key] = convert(val)
                 continue
             elif key == 'sort':
-                options[key] = [convert(v) for v in val.split(',')]
+                options['order_by'] = [convert(v) for v in val.split(',')]
+                continue
+            elif key == 'cursor':
+                options['offset'] = self._decode_cursor(val)
                 continue
 
             op_map = {
@@ -442,6 +558,77 @@ class Resource(object):
 
         return [filters, options]
 
+    def _encode_cursor(self, offset):
+        return base64.urlsafe_b64encode(json.dumps({'offset': offset}).encode()).decode()
+
+    def _decode_cursor(self, cursor):
+        try:
+            offset = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())['offset']
+        except Exception:
+            raise web.HTTPBadRequest(text='Invalid cursor')
+        if not isinstance(offset, int) or offset < 0:
+            raise web.HTTPBadRequest(text='Invalid cursor')
+        return offset
+
+    def _paginate(self, req, resp, result, options):
+        """
+        We ask for one item more than `limit` to know whether there is a next page.
+        """
+        limit = options['limit']
+        if len(result) <= limit:
+            return result
+
+        offset = options.get('offset') or 0
+        cursor = self._encode_cursor(offset + limit)
+        query = [(k, v) for k, v in req.query.items() if k not in ('cursor', 'offset')]
+        query.append(('cursor', cursor))
+        resp.headers['X-Next-Cursor'] = cursor
+        resp.headers['Link'] = f'<{req.path}?{urllib.parse.urlencode(query)}>; rel="next"'
+        return result[:limit]
+
+    def _etag(self, chunks):
+        """
+        Weak ETag of the response body prefixed with the service change counter.
+        """
+        digest = hashlib.sha1()
+        for chunk in chunks:
+            digest.update(chunk.encode())
+        service = self.get.rsplit('.', 1)[0]
+        return f'W/"{self.rest._changes[service]}-{digest.hexdigest()[:20]}"'
+
+    def _not_modified(self, req, etag):
+        if_none_match = req.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        return etag in [i.strip() for i in if_none_match.split(',')] or if_none_match.strip() == '*'
+
+    async def _stream(self, req, resp, result):
+        """
+        Stream a large array as chunked compact JSON instead of building the
+        whole indented body in memory.
+        """
+        chunks = []
+        for i in range(0, len(result), STREAM_CHUNK_SIZE):
+            chunks.append(','.join(json.dumps(item) for item in result[i:i + STREAM_CHUNK_SIZE]))
+            # Serializing thousands of items may take a while, let other tasks run
+            await asyncio.sleep(0)
+
+        etag = self._etag(chunks)
+        if self._not_modified(req, etag):
+            return web.Response(status=304, headers={'ETag': etag})
+
+        stream = web.StreamResponse(status=resp.status, headers=resp.headers)
+        stream.content_type = 'application/json'
+        stream.headers['ETag'] = etag
+        stream.enable_chunked_encoding()
+        await stream.prepare(req)
+        await stream.write(b'[')
+        for i, chunk in enumerate(chunks):
+            await stream.write((',' if i else '').encode() + chunk.encode())
+        await stream.write(b']')
+        await stream.write_eof()
+        return stream
+
     async def do(self, http_method, req, resp, **kwargs):
         assert http_method in ('delete', 'get', 'post', 'put')
 
@@ -505,6 +692,8 @@ class Resource(object):
                     method_args = [[('id', '=', filterid)], {'get': True}]
                 else:
                     method_args = self._filterable_args(req)
+                    if isinstance(method_args[1].get('limit'), int) and method_args[1]['limit'] > 0:
+                        method_args[1]['limit'] += 1
             else:
                 method_args = []
 
@@ -517,6 +706,8 @@ class Resource(object):
 
         try:
             result = await self.middleware.call(methodname, *method_args)
+            if http_method != 'get':
+                self.rest._changes[methodname.rsplit('.', 1)[0]] += 1
         except CallError as e:
             resp = web.Response(status=400)
             result = {
@@ -540,5 +731,24 @@ class Resource(object):
             result = [i async for i in result]
         elif isinstance(result, Job):
             result = result.id
+
+        if http_method == 'get' and resp.status == 200:
+            if method['filterable'] and isinstance(result, list) and len(method_args) > 1:
+                options = method_args[1]
+                if isinstance(options.get('limit'), int) and options['limit'] > 0:
+                    options['limit'] -= 1
+                    result = self._paginate(req, resp, result, options)
+
+            if isinstance(result, list) and len(result) > STREAM_THRESHOLD:
+                return await self._stream(req, resp, result)
+
+            body = json.dumps(result, indent=True)
+            etag = self._etag([body])
+            if self._not_modified(req, etag):
+                return web.Response(status=304, headers={'ETag': etag})
+            resp.headers['ETag'] = etag
+            resp.text = body
+            return resp
+
         resp.text = json.dumps(result, indent=True)
         return resp
@@ -45,6 +45,23 @@ def job(lock=None, lock_queue_size=None, logs=False, process=False, pipes=None,
     return check_job
 
 
+def cached(ttl, key=None):
+    """
+    Flag method result to be cached by the `cache` service for `ttl` seconds.
+
+    Results are cached per arguments; `key` can be a callable receiving the
+    method arguments and returning a string to build the cache key from.
+    Use `cache.invalidate` with the method name to drop cached results.
+    """
+    def wrapper(fn):
+        fn._cached = {
+            'ttl': ttl,
+            'key': key,
+        }
+        return fn
+    return wrapper
+
+
 def threaded(pool):
     def m(fn):
         fn._thread_pool = pool
@@ -262,6 +279,8 @@ class CRUDService(ServiceChangeMixin, Service):
             datastore_options = options.copy()
             datastore_options.pop('count', None)
             datastore_options.pop('get', None)
+            datastore_options.pop('offset', None)
+            datastore_options.pop('limit', None)
             result = await self.middleware.call(
                 'datastore.query', self._config.datastore, [], datastore_options
             )
@@ -488,7 +507,7 @@ class CoreService(Service):
 
         Returns the job id and the URL for download.
         """
-        job = await self.middleware.call(method, *args, pipes=Pipes(output=self.middleware.pipe()))
+        job = await self.middleware.call(method, *args, pipes=Pipes(output=self.middleware.pipe(sendfile=True)))
         token = await self.middleware.call('auth.generate_token', 300, {'filename': filename, 'job': job.id})
         self.middleware.fileapp.register_job(job.id)
         return job.id, f'/_download/{job.id}?auth_token={token}'
@@ -502,15 +521,21 @@ class CoreService(Service):
         """
         handler = logging._handlers.get('file')
         if handler:
-            stream = handler.stream
-            handler.stream = handler._open()
-            if sys.stdout is stream:
-                sys.stdout = handler.stream
-                sys.stderr = handler.stream
+            # Records are written by the logging queue thread, hold the handler
+            # lock so it does not write to the stream being replaced
+            handler.acquire()
             try:
-                stream.close()
-            except Exception:
-                pass
+                stream = handler.stream
+                handler.stream = handler._open()
+                if sys.stdout is stream:
+                    sys.stdout = handler.stream
+                    sys.stderr = handler.stream
+                try:
+                    stream.close()
+                except Exception:
+                    pass
+            finally:
+                handler.release()
 
     @private
     @accepts(Dict(
@@ -178,6 +178,12 @@ def filter_list(_list, filters=None, options=None):
                 reverse = False
             rv = sorted(rv, key=lambda x: x[o], reverse=reverse)
 
+    if options.get('offset'):
+        rv = rv[options['offset']:]
+
+    if options.get('limit'):
+        rv = rv[:options['limit']]
+
     if options.get('get') is True:
         return rv[0]
 
@@ -0,0 +1,83 @@
+"""
+Bandwidth limit timetables, in the format used by rclone `--bwlimit`:
+
+    "08:00,512 12:00,10M 13:00,512 18:00,30M 23:00,off"
+    "Mon-00:00,512 Fri-23:59,10M Sat-10:00,1M Sun-20:00,off"
+    "1M"
+
+Each entry sets the limit from its time until the next entry. Entries without a day apply to every day.
+Rates are in KiB/s unless suffixed with B, K, M or G; "off" means unlimited.
+"""
+import re
+
+__all__ = ["parse_rate", "parse_timetable", "rate_at"]
+
+DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+UNITS = {"B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+RE_ENTRY = re.compile(r"^(?:(?P<day>[A-Z][a-z]{2})-)?(?P<hour>[0-9]{2}):(?P<minute>[0-9]{2}),(?P<rate>\S+)$")
+RE_RATE = re.compile(r"^(?P<value>[0-9]+(?:\.[0-9]+)?)(?P<unit>[BKMG])?$", re.IGNORECASE)
+
+
+def parse_rate(rate):
+    """
+    Bytes per second for `rate`, None if unlimited.
+    """
+    if rate.lower() == "off":
+        return None
+
+    m = RE_RATE.match(rate)
+    if not m:
+        raise ValueError(f"Invalid rate {rate!r}")
+    value = int(float(m.group("value")) * UNITS[(m.group("unit") or "K").upper()])
+    return value or None
+
+
+def parse_timetable(timetable):
+    """
+    List of (minute of the week, bytes per second or None) sorted by time.
+    """
+    entries = timetable.split()
+    if len(entries) == 1 and "," not in entries[0]:
+        return [(0, parse_rate(entries[0]))]
+
+    result = {}
+    for entry in entries:
+        m = RE_ENTRY.match(entry)
+        if not m:
+            raise ValueError(f"Invalid timetable entry {entry!r}, expected [Day-]HH:MM,RATE")
+
+        hour, minute = int(m.group("hour")), int(m.group("minute"))
+        if hour > 23 or minute > 59:
+            raise ValueError(f"Invalid time in timetable entry {entry!r}")
+
+        rate = parse_rate(m.group("rate"))
+
+        if m.group("day") is None:
+            days = range(7)
+        elif m.group("day") in DAYS:
+            days = [DAYS.index(m.group("day"))]
+        else:
+            raise ValueError(f"Invalid day in timetable entry {entry!r}, expected one of {', '.join(DAYS)}")
+
+        for day in days:
+            result[day * 24 * 60 + hour * 60 + minute] = rate
+
+    return sorted(result.items())
+
+
+def rate_at(timetable, dt):
+    """
+    Bytes per second (None if unlimited) `timetable` (as returned by `parse_timetable`) sets at datetime `dt`.
+    """
+    if not timetable:
+        return None
+
+    minute = dt.weekday() * 24 * 60 + dt.hour * 60 + dt.minute
+    # Before the first entry of the week the last one of the previous week applies
+    rate = timetable[-1][1]
+    for start, entry_rate in timetable:
+        if start > minute:
+            break
+        rate = entry_rate
+    return rate
@@ -0,0 +1,220 @@
+from xml.etree import ElementTree
+
+__all__ = ["GeomTopology"]
+
+# Partition types we look for
+PART_TYPE_SWAP = "516e7cb5-6ecf-11d6-8ff8-00022d09712b"
+PART_TYPE_ZFS = "516e7cba-6ecf-11d6-8ff8-00022d09712b"
+
+
+def _int(text):
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def _config(xml):
+    config = xml.find("config")
+    if config is None:
+        return {}
+    return {child.tag: child.text for child in config}
+
+
+class GeomClass(object):
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.geoms = []
+        self.geoms_by_name = {}
+
+    def __repr__(self):
+        return f"<GeomClass name={self.name!r}>"
+
+    def geom_by_name(self, name):
+        return self.geoms_by_name.get(name)
+
+
+class Geom(object):
+    def __init__(self, id, name, clazz, config):
+        self.id = id
+        self.name = name
+        self.clazz = clazz
+        self.config = config
+        self.providers = []
+        self.consumers = []
+
+    def __repr__(self):
+        return f"<Geom class={self.clazz.name!r} name={self.name!r}>"
+
+    @property
+    def provider(self):
+        return self.providers[0] if self.providers else None
+
+    @property
+    def consumer(self):
+        return self.consumers[0] if self.consumers else None
+
+
+class GeomProvider(object):
+    def __init__(self, id, geom, name, mediasize, sectorsize, stripesize, config):
+        self.id = id
+        self.geom = geom
+        self.name = name
+        self.mediasize = mediasize
+        self.sectorsize = sectorsize
+        self.stripesize = stripesize
+        self.config = config
+        self.consumers = []
+
+    def __repr__(self):
+        return f"<GeomProvider name={self.name!r}>"
+
+
+class GeomConsumer(object):
+    def __init__(self, id, geom, provider):
+        self.id = id
+        self.geom = geom
+        self.provider = provider
+
+    def __repr__(self):
+        return f"<GeomConsumer geom={self.geom.name!r} provider={self.provider.name if self.provider else None!r}>"
+
+
+class GeomTopology(object):
+    """
+    Read-only model of `kern.geom.confxml` with the indexes disk handling needs.
+
+    It exposes the same attributes as `bsd.geom` objects (`class_by_name`, `geom_by_name`, `geoms`,
+    `providers`, `consumers`, `config`, ...) so it can be used in its place. A topology is never
+    modified once built, a new one is built on refresh, so it can be shared by concurrent readers.
+    """
+
+    def __init__(self, xml):
+        self.xml = xml
+        self.classes = {}
+        self.providers = {}
+
+        # disk name -> DISK provider
+        self.disks = {}
+        # serial -> disk name, serial_lunid ("{serial}_{lunid}") -> disk name
+        self.disks_by_serial = {}
+        self.disks_by_serial_lunid = {}
+        # label provider name (e.g. gptid/...) -> LABEL provider, name of the labeled provider and the reverse
+        self.label_providers = {}
+        self.labels = {}
+        self.labels_by_dev = {}
+        # partition name -> PART provider, partition rawuuid -> name of the disk holding the partition
+        self.partitions = {}
+        self.disks_by_partition_uuid = {}
+
+        self.__parse(ElementTree.fromstring(xml))
+
+    def __parse(self, root):
+        consumers = []
+        for class_xml in root.findall("class"):
+            clazz = GeomClass(class_xml.get("id"), class_xml.findtext("name"))
+            self.classes[clazz.name] = clazz
+
+            for geom_xml in class_xml.findall("geom"):
+                g = Geom(geom_xml.get("id"), geom_xml.findtext("name"), clazz, _config(geom_xml))
+                clazz.geoms.append(g)
+                clazz.geoms_by_name.setdefault(g.name, g)
+
+                for provider_xml in geom_xml.findall("provider"):
+                    p = GeomProvider(
+                        provider_xml.get("id"), g, provider_xml.findtext("name"),
+                        _int(provider_xml.findtext("mediasize")), _int(provider_xml.findtext("sectorsize")),
+                        _int(provider_xml.findtext("stripesize")), _config(provider_xml),
+                    )
+                    g.providers.append(p)
+                    self.providers[p.id] = p
+
+                for consumer_xml in geom_xml.findall("consumer"):
+                    provider_ref = consumer_xml.find("provider")
+                    consumers.append((consumer_xml.get("id"), g,
+                                      provider_ref.get("ref") if provider_ref is not None else None))
+
+        # Providers may be defined after the consumers referencing them
+        for id, g, provider_ref in consumers:
+            c = GeomConsumer(id, g, self.providers.get(provider_ref))
+            g.consumers.append(c)
+            if c.provider is not None:
+                c.provider.consumers.append(c)
+
+        self.__index()
+
+    def __index(self):
+        for g in self.class_geoms("DISK"):
+            p = g.provider
+            if p is None:
+                continue
+            self.disks[g.name] = p
+            ident = p.config.get("ident")
+            if ident:
+                self.disks_by_serial.setdefault(ident, g.name)
+                self.disks_by_serial_lunid.setdefault(f"{ident}_{p.config.get('lunid') or ''}", g.name)
+
+        for g in self.class_geoms("LABEL"):
+            for p in g.providers:
+                self.label_providers.setdefault(p.name, p)
+                self.labels.setdefault(p.name, g.name)
+                self.labels_by_dev.setdefault(g.name, p.name)
+
+        for g in self.class_geoms("PART"):
+            for p in g.providers:
+                self.partitions[p.name] = p
+                rawuuid = p.config.get("rawuuid")
+                if rawuuid and not p.name.startswith("label"):
+                    self.disks_by_partition_uuid.setdefault(rawuuid, g.name)
+
+    def class_by_name(self, name):
+        return self.classes.get(name)
+
+    def class_geoms(self, name):
+        clazz = self.classes.get(name)
+        return clazz.geoms if clazz else []
+
+    def geom_by_name(self, class_name, name):
+        clazz = self.classes.get(class_name)
+        if clazz:
+            return clazz.geom_by_name(name)
+
+    def provider_by_id(self, id):
+        return self.providers.get(id)
+
+    def disk_by_serial(self, serial, lunid=None):
+        """
+        Name of the disk with `serial` (and `lunid`, if given).
+        """
+        if lunid:
+            return self.disks_by_serial_lunid.get(f"{serial}_{lunid}")
+        return self.disks_by_serial.get(serial)
+
+    def label_to_dev(self, label):
+        """
+        Name of the provider labeled `label`, e.g. gptid/... -> da0p2.
+        """
+        if label.endswith(".nop") or label.endswith(".eli"):
+            label = label[:-4]
+        return self.labels.get(label)
+
+    def dev_to_disk(self, dev):
+        """
+        Name of the disk under provider `dev` (label or device), e.g. gptid/... -> da0.
+        """
+        if dev.endswith(".nop") or dev.endswith(".eli"):
+            dev = dev[:-4]
+
+        p = self.label_providers.get(dev)
+        if p is not None:
+            c = p.geom.consumer
+        else:
+            g = self.geom_by_name("DEV", dev)
+            c = g.consumer if g else None
+
+        if c is None or c.provider is None:
+            return None
+        name = c.provider.geom.name
+        if name in self.disks:
+            return name
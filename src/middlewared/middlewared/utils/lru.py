@@ -0,0 +1,162 @@
+from collections import OrderedDict, namedtuple
+
+import heapq
+import sys
+import threading
+import time
+
+CacheEntry = namedtuple('CacheEntry', ['value', 'expires', 'size'])
+
+
+def approximate_size(value, _depth=0):
+    """
+    Rough estimate in bytes of memory used by `value`, walking containers
+    a few levels deep. Good enough to bound the cache, not an exact account.
+    """
+    size = sys.getsizeof(value, 0)
+    if _depth > 4:
+        return size
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += approximate_size(k, _depth + 1) + approximate_size(v, _depth + 1)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            size += approximate_size(v, _depth + 1)
+    return size
+
+
+class LRUCache(object):
+    """
+    Thread safe LRU cache with per-key TTL and memory bounds.
+
+    Entries are evicted in least recently used order once either `max_items`
+    or `max_size` (approximate bytes) is exceeded. Expired entries are
+    removed lazily on access and in bulk by `expire()`.
+    """
+
+    def __init__(self, max_items=10000, max_size=64 * 1024 * 1024):
+        self.max_items = max_items
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        self.__data = OrderedDict()
+        # (expires, key) min-heap, entries are validated against __data when popped
+        self.__expiry = []
+        self.__size = 0
+        self.__stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.__data.get(key)
+            if entry is None:
+                return False
+            if self.__expired(entry, time.monotonic()):
+                self.__remove(key)
+                self.__stats['expirations'] += 1
+                return False
+            return True
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __expired(self, entry, now):
+        return entry.expires is not None and now >= entry.expires
+
+    def __remove(self, key):
+        entry = self.__data.pop(key)
+        self.__size -= entry.size
+        return entry
+
+    def get(self, key):
+        """
+        Raises:
+            KeyError: not found in the cache or expired
+        """
+        with self.lock:
+            entry = self.__data.get(key)
+            if entry is None:
+                self.__stats['misses'] += 1
+                raise KeyError(key)
+            if self.__expired(entry, time.monotonic()):
+                self.__remove(key)
+                self.__stats['expirations'] += 1
+                self.__stats['misses'] += 1
+                raise KeyError(f'{key} has expired')
+            self.__data.move_to_end(key)
+            self.__stats['hits'] += 1
+            return entry.value
+
+    def put(self, key, value, ttl=0):
+        expires = time.monotonic() + ttl if ttl else None
+        size = approximate_size(value)
+        with self.lock:
+            if key in self.__data:
+                self.__remove(key)
+            self.__data[key] = CacheEntry(value, expires, size)
+            self.__size += size
+            if expires is not None:
+                heapq.heappush(self.__expiry, (expires, key))
+            self.__evict()
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.__data:
+                return default
+            return self.__remove(key).value
+
+    def pop_prefix(self, prefix):
+        """
+        Remove every key starting with `prefix`, returns number of keys removed.
+        """
+        with self.lock:
+            keys = [k for k in self.__data if k.startswith(prefix)]
+            for key in keys:
+                self.__remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.__data.clear()
+            self.__expiry = []
+            self.__size = 0
+
+    def expire(self):
+        """
+        Remove all expired entries, returns number of entries removed.
+        """
+        removed = 0
+        now = time.monotonic()
+        with self.lock:
+            while self.__expiry and self.__expiry[0][0] <= now:
+                expires, key = heapq.heappop(self.__expiry)
+                entry = self.__data.get(key)
+                # Key may have been removed or replaced with a new TTL since
+                if entry is not None and entry.expires == expires:
+                    self.__remove(key)
+                    removed += 1
+            self.__stats['expirations'] += removed
+            # Do not let stale heap entries of overwritten keys accumulate
+            if len(self.__expiry) > 2 * len(self.__data) + 1024:
+                self.__expiry = [(e.expires, k) for k, e in self.__data.items() if e.expires is not None]
+                heapq.heapify(self.__expiry)
+        return removed
+
+    def __evict(self):
+        while self.__data and (len(self.__data) > self.max_items or self.__size > self.max_size):
+            key = next(iter(self.__data))
+            self.__remove(key)
+            self.__stats['evictions'] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                self.__stats,
+                items=len(self.__data),
+                size=self.__size,
+                max_items=self.max_items,
+                max_size=self.max_size,
+            )
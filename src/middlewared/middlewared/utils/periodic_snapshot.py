@@ -0,0 +1,267 @@
+"""
+Planning of periodic snapshot tasks.
+
+Periodic snapshots are named `auto-%Y%m%d.%H%M-<retention>`, e.g. `tank/data@auto-20180101.0900-2w`, the retention
+being a count followed by a unit: h(our), d(ay), w(eek), m(onth) or y(ear). The timestamp part of these names sorts
+chronologically so the inventory keeps and compares them as strings.
+"""
+import bisect
+import re
+from datetime import time, timedelta
+
+__all__ = ["RE_AUTOSNAP", "SnapshotInventory", "plan_snapshots", "retention_timedelta", "task_matches",
+           "task_retention"]
+
+RE_AUTOSNAP = re.compile(r"^auto-(?P<stamp>[0-9]{8}\.[0-9]{4})-(?P<retention>[0-9]+[hdwmy])$")
+STAMP_FORMAT = "%Y%m%d.%H%M"
+# Longest `zfs destroy ds@a,b,c` argument before it is split in another command
+DESTROY_BATCH_LENGTH = 16384
+
+
+def retention_timedelta(retention):
+    count, unit = int(retention[:-1]), retention[-1]
+    if unit == "h":
+        return timedelta(hours=count)
+    if unit == "d":
+        return timedelta(days=count)
+    if unit == "w":
+        return timedelta(days=7 * count)
+    if unit == "m":
+        return timedelta(days=int(30.436875 * count))
+    if unit == "y":
+        return timedelta(days=int(365.2425 * count))
+    raise ValueError(f"Invalid retention {retention!r}")
+
+
+def task_retention(task):
+    return f"{task['ret_count']}{task['ret_unit'][0].lower()}"
+
+
+def task_matches(task, snaptime):
+    """
+    Whether the begin/end window and the days of the week of periodic snapshot `task` include `snaptime`.
+    """
+    now = time(snaptime.hour, snaptime.minute)
+    begin = time(*[int(v) for v in task["begin"].split(":")])
+    end = time(*[int(v) for v in task["end"].split(":")])
+    if begin <= end:
+        if not (begin <= now <= end):
+            return False
+    elif not (now >= begin or now <= end):
+        return False
+
+    if task.get("repeat_unit", "weekly") == "daily":
+        return True
+
+    return snaptime.isoweekday() in task["dow"]
+
+
+class SnapshotInventory:
+    """
+    Periodic snapshots of every dataset, indexed by dataset and retention.
+
+    Non-periodic snapshot names are ignored by `add` and `remove`, so the output of `zfs list -t snapshot -o name`
+    can be fed to it as is.
+    """
+
+    def __init__(self):
+        # {dataset: {retention: sorted timestamps}}
+        self.datasets = {}
+        self._sorted_datasets = None
+
+    @classmethod
+    def load(cls, snapshots):
+        inventory = cls()
+        for snapshot in snapshots:
+            parsed = cls._parse(snapshot)
+            if parsed is not None:
+                dataset, stamp, retention = parsed
+                inventory.datasets.setdefault(dataset, {}).setdefault(retention, []).append(stamp)
+
+        for retentions in inventory.datasets.values():
+            for stamps in retentions.values():
+                stamps.sort()
+
+        return inventory
+
+    def __len__(self):
+        return sum(len(stamps) for retentions in self.datasets.values() for stamps in retentions.values())
+
+    def add(self, snapshot):
+        parsed = self._parse(snapshot)
+        if parsed is None:
+            return
+
+        dataset, stamp, retention = parsed
+        if dataset not in self.datasets:
+            self._sorted_datasets = None
+        stamps = self.datasets.setdefault(dataset, {}).setdefault(retention, [])
+        i = bisect.bisect_left(stamps, stamp)
+        if i == len(stamps) or stamps[i] != stamp:
+            stamps.insert(i, stamp)
+
+    def remove(self, snapshot):
+        parsed = self._parse(snapshot)
+        if parsed is None:
+            return
+
+        dataset, stamp, retention = parsed
+        stamps = self.datasets.get(dataset, {}).get(retention)
+        if not stamps:
+            return
+
+        i = bisect.bisect_left(stamps, stamp)
+        if i < len(stamps) and stamps[i] == stamp:
+            del stamps[i]
+        if not stamps:
+            del self.datasets[dataset][retention]
+            if not self.datasets[dataset]:
+                del self.datasets[dataset]
+                self._sorted_datasets = None
+
+    def latest(self, dataset, retention):
+        """
+        Timestamp of the latest snapshot of `dataset` with `retention`, None if there is none.
+        """
+        stamps = self.datasets.get(dataset, {}).get(retention)
+        return stamps[-1] if stamps else None
+
+    def expired(self, dataset, cutoffs):
+        """
+        Names of the snapshots of `dataset` taken at or before `cutoffs[retention]`, i.e. whose retention is over.
+        """
+        result = []
+        for retention, stamps in self.datasets.get(dataset, {}).items():
+            cutoff = cutoffs[retention]
+            result.extend(f"auto-{stamp}-{retention}" for stamp in stamps[:bisect.bisect_right(stamps, cutoff)])
+        return result
+
+    def descendants(self, dataset):
+        """
+        `dataset` and its children that have periodic snapshots, in sorted order.
+        """
+        if self._sorted_datasets is None:
+            self._sorted_datasets = sorted(self.datasets)
+
+        result = [dataset] if dataset in self.datasets else []
+        prefix = dataset + "/"
+        for name in self._sorted_datasets[bisect.bisect_left(self._sorted_datasets, prefix):]:
+            if not name.startswith(prefix):
+                break
+            result.append(name)
+        return result
+
+    @staticmethod
+    def _parse(snapshot):
+        dataset, _, name = snapshot.partition("@")
+        m = RE_AUTOSNAP.match(name)
+        if m is None:
+            return None
+        return dataset, m.group("stamp"), m.group("retention")
+
+
+class _Cutoffs(dict):
+    # Latest expired timestamp for every retention, relative to `snaptime`
+    def __init__(self, snaptime):
+        super().__init__()
+        self.snaptime = snaptime
+
+    def __missing__(self, retention):
+        self[retention] = (self.snaptime - retention_timedelta(retention)).strftime(STAMP_FORMAT)
+        return self[retention]
+
+
+def _covered(dataset, retention, recursive_keys):
+    # Whether `dataset` or one of its parents is snapshotted recursively with `retention`
+    while True:
+        if (dataset, retention) in recursive_keys:
+            return True
+        if "/" not in dataset:
+            return False
+        dataset = dataset.rsplit("/", 1)[0]
+
+
+def plan_snapshots(tasks, inventory, snaptime):
+    """
+    Snapshots to take and to destroy at `snaptime` for periodic snapshot `tasks`.
+
+    Returns (create, destroy):
+    `create` is a list of (recursive, [snapshot, ...]), each one a single atomic `zfs snapshot` on one pool.
+    `destroy` is a list of (dataset, [snapshot name, ...]) for `zfs destroy -r -d dataset@a,b,...`, expired snapshots
+    of datasets covered by tasks that run at `snaptime`.
+    """
+    snapstamp = snaptime.strftime(STAMP_FORMAT)
+    cutoffs = _Cutoffs(snaptime)
+
+    # Tasks that run at `snaptime`, only the shortest interval matters for tasks creating the same snapshots
+    intervals = {}
+    for task in tasks:
+        if not task_matches(task, snaptime):
+            continue
+
+        key = (task["filesystem"], task_retention(task), task["recursive"])
+        intervals[key] = min(intervals.get(key, task["interval"]), task["interval"])
+
+    if not intervals:
+        return [], []
+
+    due = set()
+    for (filesystem, retention, recursive), interval in intervals.items():
+        latest = inventory.latest(filesystem, retention)
+        if (
+            latest is not None and latest > cutoffs[retention] and
+            latest > (snaptime - timedelta(minutes=interval)).strftime(STAMP_FORMAT)
+        ):
+            continue
+        due.add((filesystem, retention, recursive))
+
+    # Snapshots taken by a recursive task on the same dataset or one of its parents would make the whole
+    # `zfs snapshot` fail with "dataset already exists"
+    recursive_keys = {(filesystem, retention) for filesystem, retention, recursive in due if recursive}
+    groups = {}
+    for filesystem, retention, recursive in sorted(due):
+        parent = filesystem.rsplit("/", 1)[0] if "/" in filesystem else None
+        if (
+            (not recursive and _covered(filesystem, retention, recursive_keys)) or
+            (recursive and parent is not None and _covered(parent, retention, recursive_keys))
+        ):
+            continue
+
+        groups.setdefault((filesystem.split("/")[0], recursive), []).append(
+            f"{filesystem}@auto-{snapstamp}-{retention}"
+        )
+    create = [(recursive, snapshots) for (pool, recursive), snapshots in sorted(groups.items())]
+
+    # Expired snapshots of datasets covered by the tasks, recursive destroy of a parent snapshot covers the
+    # children snapshots with the same name
+    datasets = set()
+    for filesystem, retention, recursive in intervals:
+        datasets.update(inventory.descendants(filesystem) if recursive else [filesystem])
+
+    pending = set()
+    destroy = []
+    for dataset in sorted(datasets):
+        names = []
+        for name in inventory.expired(dataset, cutoffs):
+            pending.add((dataset, name))
+            parent = dataset
+            while "/" in parent:
+                parent = parent.rsplit("/", 1)[0]
+                if (parent, name) in pending:
+                    break
+            else:
+                names.append(name)
+
+        batch = []
+        length = len(dataset)
+        for name in sorted(names):
+            if batch and length + len(name) + 1 > DESTROY_BATCH_LENGTH:
+                destroy.append((dataset, batch))
+                batch = []
+                length = len(dataset)
+            batch.append(name)
+            length += len(name) + 1
+        if batch:
+            destroy.append((dataset, batch))
+
+    return create, destroy
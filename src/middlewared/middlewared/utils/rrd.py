@@ -0,0 +1,439 @@
+"""
+In-process reader for RRD files, replacing `rrdtool info`/`rrdtool xport` for the stats plugin.
+
+Files are memory mapped and their RRA ring buffers decoded directly. RRA selection, alignment and
+consolidation follow rrdtool (rrd_fetch_fn, reduce_data and rrd_xport_fn) so `xport` returns the same
+data as `rrdtool xport --json`. Layouts this module does not know about raise `RRDUnsupported` so
+callers can fall back to rrdtool.
+"""
+import math
+import mmap
+import re
+import struct
+import time
+
+__all__ = ["RRDError", "RRDUnsupported", "RRDFile", "choose_rra", "fetch", "reduce_data", "xport", "resolve_times"]
+
+# Written in the header to detect files created on a different architecture
+FLOAT_COOKIE = 8.642135E130
+
+# Layout of rrd_format.h structures on 64 bit little endian platforms
+STAT_HEAD = struct.Struct("<4s5s7xdQQQ80x")
+DS_DEF = struct.Struct("<20s20s80x")
+RRA_DEF = struct.Struct("<20s4xQQ80x")
+LIVE_HEAD = struct.Struct("<qq")
+LIVE_HEAD_V1 = struct.Struct("<q")
+PDP_PREP_SIZE = 112
+CDP_PREP_SIZE = 80
+RRA_PTR = struct.Struct("<Q")
+VALUE_SIZE = 8
+
+VERSIONS = ("0001", "0002", "0003", "0004")
+CFS = ("AVERAGE", "MIN", "MAX", "LAST")
+
+# Default of `rrdtool xport --maxrows`
+XPORT_MAXROWS = 400
+
+NAN = float("nan")
+
+
+class RRDError(Exception):
+    pass
+
+
+class RRDUnsupported(RRDError):
+    pass
+
+
+def _cstr(value):
+    return value.split(b"\0", 1)[0].decode("ascii", "ignore")
+
+
+class RRA(object):
+    def __init__(self, cf, row_cnt, pdp_cnt):
+        self.cf = cf
+        self.row_cnt = row_cnt
+        self.pdp_cnt = pdp_cnt
+        self.cur_row = 0
+        self.offset = 0
+
+    def __repr__(self):
+        return f"<RRA cf={self.cf!r} row_cnt={self.row_cnt!r} pdp_cnt={self.pdp_cnt!r}>"
+
+
+class RRDFile(object):
+    """
+    Memory mapped RRD file.
+
+    Use as a context manager or call `close()` once done.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise RRDError(f"{path}: not an RRD file")
+        try:
+            self.__parse_header()
+        except Exception:
+            self.mmap.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.mmap.close()
+
+    def __parse_header(self):
+        m = self.mmap
+        if len(m) < STAT_HEAD.size:
+            raise RRDError(f"{self.path}: not an RRD file")
+
+        cookie, version, float_cookie, ds_cnt, rra_cnt, pdp_step = STAT_HEAD.unpack_from(m, 0)
+        if cookie != b"RRD\0":
+            raise RRDError(f"{self.path}: not an RRD file")
+        self.version = _cstr(version)
+        if self.version not in VERSIONS:
+            raise RRDUnsupported(f"{self.path}: unsupported RRD version {self.version}")
+        if float_cookie != FLOAT_COOKIE:
+            raise RRDUnsupported(f"{self.path}: RRD was created on another architecture")
+
+        self.pdp_step = pdp_step
+        offset = STAT_HEAD.size
+
+        self.ds = []
+        for i in range(ds_cnt):
+            name, dst = DS_DEF.unpack_from(m, offset)
+            self.ds.append((_cstr(name), _cstr(dst)))
+            offset += DS_DEF.size
+
+        self.rras = []
+        for i in range(rra_cnt):
+            cf, row_cnt, pdp_cnt = RRA_DEF.unpack_from(m, offset)
+            self.rras.append(RRA(_cstr(cf), row_cnt, pdp_cnt))
+            offset += RRA_DEF.size
+
+        if self.version >= "0003":
+            self.last_up = LIVE_HEAD.unpack_from(m, offset)[0]
+            offset += LIVE_HEAD.size
+        else:
+            self.last_up = LIVE_HEAD_V1.unpack_from(m, offset)[0]
+            offset += LIVE_HEAD_V1.size
+
+        offset += PDP_PREP_SIZE * ds_cnt + CDP_PREP_SIZE * ds_cnt * rra_cnt
+
+        for rra in self.rras:
+            rra.cur_row = RRA_PTR.unpack_from(m, offset)[0]
+            offset += RRA_PTR.size
+
+        self.header_len = offset
+        for rra in self.rras:
+            rra.offset = offset
+            offset += rra.row_cnt * ds_cnt * VALUE_SIZE
+
+        if offset > len(m):
+            raise RRDError(f"{self.path}: RRD file is truncated")
+
+    @property
+    def ds_names(self):
+        return [name for name, dst in self.ds]
+
+    def ds_index(self, name):
+        for i, (ds_name, dst) in enumerate(self.ds):
+            if ds_name == name:
+                return i
+        raise RRDError(f"No DS called '{name}' in '{self.path}'")
+
+    def rra_rows(self, rra):
+        """
+        Rows of `rra` as tuples of values, in the order they are stored.
+        """
+        ds_cnt = len(self.ds)
+        values = struct.unpack_from(f"<{rra.row_cnt * ds_cnt}d", self.mmap, rra.offset)
+        return [values[i:i + ds_cnt] for i in range(0, len(values), ds_cnt)]
+
+    def info(self):
+        return {
+            "step": self.pdp_step,
+            "last_update": self.last_up,
+            "ds": {name: {"type": dst} for name, dst in self.ds},
+        }
+
+
+def choose_rra(rrd, cf, start, end, step):
+    """
+    RRA of consolidation function `cf` best matching `step` for `start` to `end`, as rrdtool picks it:
+    among RRAs covering the whole period the one with the closest step, otherwise the one covering most.
+
+    Returns (rra, step, start, end) with the period aligned to the RRA step.
+    """
+    if cf not in CFS:
+        raise RRDError(f"unknown consolidation function '{cf}'")
+
+    best_full = best_part = None
+    best_full_step_diff = best_part_step_diff = best_match = 0
+    for rra in rrd.rras:
+        if rra.cf != cf:
+            continue
+
+        cal_end = rrd.last_up - rrd.last_up % (rra.pdp_cnt * rrd.pdp_step)
+        cal_start = cal_end - rra.pdp_cnt * rra.row_cnt * rrd.pdp_step
+        step_diff = abs(step - rrd.pdp_step * rra.pdp_cnt)
+        if cal_start <= start:
+            if best_full is None or step_diff < best_full_step_diff:
+                best_full = rra
+                best_full_step_diff = step_diff
+        else:
+            match = end - start - (cal_start - start)
+            if (best_part is None or best_match < match or
+                    (best_match == match and step_diff < best_part_step_diff)):
+                best_part = rra
+                best_match = match
+                best_part_step_diff = step_diff
+
+    chosen = best_full if best_full is not None else best_part
+    if chosen is None:
+        raise RRDError("the RRD does not contain an RRA matching the chosen CF")
+
+    step = rrd.pdp_step * chosen.pdp_cnt
+    start -= start % step
+    end += step - end % step
+    return chosen, step, start, end
+
+
+def fetch(rrd, cf, start, end, step):
+    """
+    Values of `rrd` between `start` and `end` from the RRA of consolidation function `cf` best matching
+    the requested `step`.
+
+    Returns (start, end, step, rows) adjusted to the chosen RRA; `rows[i]` holds the values of every DS
+    for the interval ending at `start + (i + 1) * step`.
+    """
+    chosen, step, start, end = choose_rra(rrd, cf, start, end, step)
+
+    rra_end = rrd.last_up - rrd.last_up % step
+    rra_start = rra_end - step * (chosen.row_cnt - 1)
+    start_offset = (start + step - rra_start) // step
+    end_offset = (rra_end - end) // step
+
+    ring = rrd.rra_rows(chosen)
+    unknown = (NAN,) * len(rrd.ds)
+    rows = []
+    for i in range(start_offset, chosen.row_cnt - end_offset):
+        if 0 <= i < chosen.row_cnt:
+            rows.append(ring[(chosen.cur_row + 1 + i) % chosen.row_cnt])
+        else:
+            rows.append(unknown)
+
+    return start, end, step, rows
+
+
+def _consolidate(cf, values):
+    values = [v for v in values if not math.isnan(v)]
+    if not values:
+        return NAN
+    if cf == "AVERAGE":
+        return sum(values) / len(values)
+    if cf == "MIN":
+        return min(values)
+    if cf == "MAX":
+        return max(values)
+    return values[-1]
+
+
+def reduce_data(cf, cur_step, start, end, step, rows):
+    """
+    Consolidate `rows` fetched every `cur_step` seconds into rows of (at least) `step` seconds.
+
+    Destination rows not entirely covered by source rows are unknown.
+    Returns (start, end, step, rows) like `fetch`.
+    """
+    factor = int(math.ceil(step / cur_step))
+    step = cur_step * factor
+
+    new_start = start - start % step
+    new_end = end if end % step == 0 else end - end % step + step
+
+    ds_cnt = len(rows[0]) if rows else 0
+    unknown = (NAN,) * ds_cnt
+    reduced = []
+    for row_start in range(new_start, new_end, step):
+        first = (row_start - start) // cur_step
+        if first < 0 or first + factor > len(rows):
+            reduced.append(unknown)
+            continue
+        chunk = rows[first:first + factor]
+        reduced.append(tuple(_consolidate(cf, [row[i] for row in chunk]) for i in range(ds_cnt)))
+
+    return new_start, new_end, step, reduced
+
+
+def xport(defs, start, end, step=0, maxrows=XPORT_MAXROWS, cache=None, ttl=0):
+    """
+    Same as `rrdtool xport --json` with a `DEF:` and `XPORT:` for each of `defs`.
+
+    `defs` is a list of (rrd path, ds name, cf, legend); `start` and `end` are timestamps.
+
+    If `cache` (e.g. a `LRUCache`) is given results are stored in it for `ttl` seconds, keyed by the
+    files, CFs, steps and aligned window they were computed from along with the last update of each
+    file, so a cached result is only reused while it is identical to what would be computed.
+    """
+    if start < 3600 * 24 * 365 * 10:
+        raise RRDError("the first entry to fetch should be after 1980")
+    if end < start:
+        raise RRDError(f"start ({start}) should be less than end ({end})")
+
+    im_step = max(step or 0, (end - start) // maxrows)
+
+    files = {}
+    try:
+        plan = {}
+        columns = []
+        for path, ds, cf, legend in defs:
+            if path not in files:
+                files[path] = RRDFile(path)
+            rrd = files[path]
+            ds_index = rrd.ds_index(ds)
+
+            # DEFs of the same file and CF share one fetch, like rrd_graph does
+            if (path, cf) not in plan:
+                rra, ft_step, g_start, g_end = choose_rra(rrd, cf, start, end, im_step)
+                g_step = ft_step * int(math.ceil(im_step / ft_step)) if ft_step < im_step else ft_step
+                plan[(path, cf)] = (rrd.rras.index(rra), rrd.last_up, g_start, g_end, g_step)
+            columns.append(((path, cf), ds_index))
+
+        # A step all columns can be sampled at
+        x_step = 0
+        for g in plan.values():
+            x_step = math.gcd(x_step, g[4])
+        x_start = start - start % x_step
+        x_end = end - end % x_step + x_step
+
+        key = None
+        if cache is not None:
+            key = repr((tuple(defs), im_step, x_start, x_end, sorted(plan.items())))
+            try:
+                return cache.get(key)
+            except KeyError:
+                pass
+
+        fetched = {}
+        for (path, cf) in plan:
+            g_start, g_end, ft_step, rows = fetch(files[path], cf, start, end, im_step)
+            g_step = im_step
+            if ft_step < g_step:
+                g_start, g_end, g_step, rows = reduce_data(cf, ft_step, g_start, g_end, g_step, rows)
+            else:
+                g_step = ft_step
+            fetched[(path, cf)] = (g_start, g_step, rows)
+    finally:
+        for rrd in files.values():
+            rrd.close()
+
+    data = []
+    for now in range(x_start, x_end - x_step + 1, x_step):
+        row = []
+        for key_, ds_index in columns:
+            g_start, g_step, rows = fetched[key_]
+            i = (now - g_start) // g_step
+            value = rows[i][ds_index] if 0 <= i < len(rows) else NAN
+            # rrdtool prints values with "%0.10e"
+            row.append(None if math.isnan(value) else float("%0.10e" % value))
+        data.append(row)
+
+    result = {
+        "about": "RRDtool graph JSON output",
+        "meta": {
+            "start": x_start + x_step,
+            "step": x_step,
+            "end": x_end,
+            "legend": [legend for path, ds, cf, legend in defs],
+        },
+        "data": data,
+    }
+    if cache is not None:
+        cache.put(key, result, ttl)
+    return result
+
+
+RE_TIME_SPEC = re.compile(r"^(?P<base>now|start|end|[se])?(?P<offsets>([+-]\d+[a-z]*)*)$")
+RE_TIME_OFFSET = re.compile(r"([+-])(\d+)([a-z]*)")
+TIME_UNITS = {
+    "": ("seconds", 1),
+    "s": ("seconds", 1), "sec": ("seconds", 1), "second": ("seconds", 1), "seconds": ("seconds", 1),
+    "min": ("seconds", 60), "minute": ("seconds", 60), "minutes": ("seconds", 60),
+    "h": ("seconds", 3600), "hour": ("seconds", 3600), "hours": ("seconds", 3600),
+    "d": ("days", 1), "day": ("days", 1), "days": ("days", 1),
+    "w": ("days", 7), "week": ("days", 7), "weeks": ("days", 7),
+    "mon": ("months", 1), "month": ("months", 1), "months": ("months", 1),
+    "y": ("years", 1), "year": ("years", 1), "years": ("years", 1),
+}
+
+
+def _parse_time(spec):
+    spec = spec.strip().lower().replace(" ", "")
+    if spec.isdigit():
+        if len(spec) < 9:
+            # rrdtool reads short numbers as times of day
+            raise RRDUnsupported(f"unsupported time specification {spec!r}")
+        return None, {"seconds": int(spec)}
+
+    m = RE_TIME_SPEC.match(spec)
+    if m is None or not spec:
+        raise RRDUnsupported(f"unsupported time specification {spec!r}")
+
+    base = {None: "now", "s": "start", "e": "end"}.get(m.group("base"), m.group("base"))
+    offsets = {"seconds": 0, "days": 0, "months": 0, "years": 0}
+    for sign, number, unit in RE_TIME_OFFSET.findall(m.group("offsets")):
+        # "m" is either minutes or months depending on context, leave it to rrdtool
+        if unit not in TIME_UNITS:
+            raise RRDUnsupported(f"unsupported time specification {spec!r}")
+        field, multiplier = TIME_UNITS[unit]
+        offsets[field] += int(number) * multiplier * (-1 if sign == "-" else 1)
+    return base, offsets
+
+
+def _apply(base_ts, offsets):
+    if offsets.get("days") or offsets.get("months") or offsets.get("years"):
+        # Calendar offsets are applied in local time, as rrdtool does with mktime
+        tm = time.localtime(base_ts)
+        base_ts = int(time.mktime((
+            tm.tm_year + offsets["years"], tm.tm_mon + offsets["months"], tm.tm_mday + offsets["days"],
+            tm.tm_hour, tm.tm_min, tm.tm_sec, 0, 0, -1,
+        )))
+    return base_ts + offsets["seconds"]
+
+
+def resolve_times(start_spec, end_spec, now=None):
+    """
+    Timestamps of rrdtool `--start` and `--end` time specifications.
+
+    Supports absolute timestamps and offsets from now, start or end (e.g. "now-1h", "end-2d").
+    """
+    now = int(time.time()) if now is None else now
+    start_base, start_offsets = _parse_time(start_spec)
+    end_base, end_offsets = _parse_time(end_spec)
+
+    if start_base == "start":
+        raise RRDError("the start time cannot be specified relative to itself")
+    if end_base == "end":
+        raise RRDError("the end time cannot be specified relative to itself")
+    if start_base == "end" and end_base == "start":
+        raise RRDError("the start and end times cannot be specified relative to each other")
+
+    if start_base == "end":
+        end = _apply(now if end_base else 0, end_offsets)
+        start = _apply(end, start_offsets)
+    elif end_base == "start":
+        start = _apply(now if start_base else 0, start_offsets)
+        end = _apply(start, end_offsets)
+    else:
+        start = _apply(now if start_base else 0, start_offsets)
+        end = _apply(now if end_base else 0, end_offsets)
+    return start, end
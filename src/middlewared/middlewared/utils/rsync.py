@@ -0,0 +1,232 @@
+"""
+Splitting of an rsync copy in shards copied by parallel rsync processes.
+
+A shard is a list of paths relative to the base directory of the source, copied with
+`rsync --files-from=<list> <base>/ <destination>`. Shard paths keep the source directory name when the source is
+given without a trailing slash so the result is the same as copying the source with a single rsync.
+"""
+import os
+import re
+import threading
+
+__all__ = ["Shard", "ShardProgress", "parse_progress2", "partition_directories", "partition_files", "shard_command",
+           "source_base", "tree_files"]
+
+RE_PROGRESS2 = re.compile(r"\s([0-9]+)%\s")
+# Shards of loose files are cut at whichever limit is hit first
+SHARD_FILES = 10000
+SHARD_BYTES = 1024 * 1024 * 1024
+
+
+class Shard:
+    def __init__(self, paths, size, recursive):
+        self.paths = paths
+        self.size = size
+        # Whether directories in `paths` are copied with their contents or only created
+        self.recursive = recursive
+        self.attempts = 0
+
+    def __repr__(self):
+        return f"<Shard {len(self.paths)} paths, {self.size} bytes>"
+
+    def files_from(self):
+        return b"".join(os.fsencode(path) + b"\0" for path in self.paths)
+
+
+def shard_command(line, shard, files_from, base, destination):
+    """
+    rsync command `line` copying `shard` listed in `files_from` from `base` to `destination` (quoted for the shell).
+    """
+    # With --files-from, -a no longer implies -r: recursive shards would only create their directories
+    return (
+        f'{line} {"-r" if shard.recursive else "--no-recursive"} --from0 --files-from="{files_from}" '
+        f'"{base.rstrip("/")}/" {destination}'
+    )
+
+
+def source_base(path):
+    """
+    Returns (base, prefix) of rsync source `path`: `rsync dir dst` copies `dir` into `dst/dir`, `rsync dir/ dst`
+    copies the contents of `dir`.
+    """
+    if path.endswith("/"):
+        return path, ""
+
+    path = os.path.normpath(path)
+    return os.path.dirname(path) or ".", os.path.basename(path)
+
+
+def tree_size(path):
+    """
+    Apparent size of the files under `path`, symlinks are not followed and unreadable directories are skipped
+    (rsync reports them).
+    """
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+    return total
+
+
+def tree_files(path):
+    """
+    {relative path: size} of the files under `path`, None as size for directories, to check a copy against its
+    source.
+    """
+    result = {}
+    for root, dirs, files in os.walk(path):
+        for name in dirs:
+            result[os.path.relpath(os.path.join(root, name), path)] = None
+        for name in files:
+            result[os.path.relpath(os.path.join(root, name), path)] = os.lstat(os.path.join(root, name)).st_size
+    return result
+
+
+class _Shards:
+    # Accumulates loose entries in non-recursive shards
+    def __init__(self):
+        self.shards = []
+        self.paths = []
+        self.size = 0
+
+    def add(self, path, size):
+        if self.paths and (len(self.paths) >= SHARD_FILES or self.size + size > SHARD_BYTES):
+            self.cut()
+        self.paths.append(path)
+        self.size += size
+
+    def cut(self):
+        if self.paths:
+            self.shards.append(Shard(self.paths, self.size, False))
+            self.paths = []
+            self.size = 0
+
+
+def _sorted(shards, prefix):
+    if not shards:
+        # Empty source directory is still created
+        shards = [Shard([prefix or "."], 0, False)]
+    # Largest shards first so that the last ones to run are the small ones
+    return sorted(shards, key=lambda shard: shard.size, reverse=True)
+
+
+def partition_directories(path):
+    """
+    One recursive shard for each top level directory of `path`, top level files are grouped in shards.
+    """
+    base, prefix = source_base(path)
+    root = os.path.join(base, prefix)
+
+    loose = _Shards()
+    shards = []
+    with os.scandir(root) as it:
+        for entry in sorted(it, key=lambda entry: entry.name):
+            relpath = os.path.join(prefix, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                shards.append(Shard([relpath], tree_size(entry.path), True))
+            else:
+                loose.add(relpath, entry.stat(follow_symlinks=False).st_size)
+    loose.cut()
+
+    return _sorted(shards + loose.shards, prefix)
+
+
+def partition_files(path):
+    """
+    Every file and directory under `path` in shards of up to `SHARD_FILES` entries or `SHARD_BYTES` bytes, in
+    tree order so that a shard mostly covers a few neighbouring directories.
+    """
+    base, prefix = source_base(path)
+
+    loose = _Shards()
+    stack = [prefix]
+    while stack:
+        relpath = stack.pop()
+        try:
+            with os.scandir(os.path.join(base, relpath)) as it:
+                entries = sorted(it, key=lambda entry: entry.name, reverse=True)
+        except OSError:
+            continue
+
+        for entry in entries:
+            child = os.path.join(relpath, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                # Listed too so that empty directories are created
+                loose.add(child, 0)
+                stack.append(child)
+            else:
+                loose.add(child, entry.stat(follow_symlinks=False).st_size)
+    loose.cut()
+
+    return _sorted(loose.shards, prefix)
+
+
+def parse_progress2(line):
+    """
+    Percentage of an `rsync --info=progress2` line, None if there is none.
+    """
+    m = RE_PROGRESS2.search(f" {line} ")
+    return int(m.group(1)) if m else None
+
+
+class ShardProgress:
+    """
+    Overall progress of `shards` copied by parallel workers, weighted by shard size. Thread-safe.
+    """
+
+    def __init__(self, shards):
+        self.lock = threading.Lock()
+        self.count = len(shards)
+        self.total = sum(shard.size for shard in shards)
+        self.done = 0
+        self.done_size = 0
+        self.failed = 0
+        # {worker: (shard, percent)}
+        self.running = {}
+
+    def start(self, worker, shard):
+        with self.lock:
+            self.running[worker] = shard, 0
+
+    def update(self, worker, percent):
+        with self.lock:
+            shard, _ = self.running[worker]
+            self.running[worker] = shard, min(percent, 100)
+
+    def finish(self, worker, success):
+        with self.lock:
+            shard, _ = self.running.pop(worker)
+            if success:
+                self.done += 1
+                self.done_size += shard.size
+            else:
+                self.failed += 1
+
+    @property
+    def percent(self):
+        with self.lock:
+            if self.total:
+                size = self.done_size + sum(shard.size * percent / 100 for shard, percent in self.running.values())
+                return min(int(size * 100 / self.total), 100)
+
+            if self.count:
+                return int((self.done + sum(percent / 100 for _, percent in self.running.values())) * 100 /
+                           self.count)
+
+            return 100
+
+    @property
+    def description(self):
+        with self.lock:
+            description = f"Copied {self.done} of {self.count} shards with {len(self.running)} rsync workers"
+            if self.failed:
+                description += f", {self.failed} failed attempts"
+            return description
@@ -0,0 +1,161 @@
+"""
+Planning and admission of data protection tasks: cloud sync, rsync, replication, scrub and SMART tests.
+
+Tasks scheduled for the same minute do not all start at that minute. Each task is delayed by a jitter derived from
+the task itself, so the plan stays the same from one run to the next. It is then admitted when the global concurrency
+and the I/O budgets of the pools it uses allow it.
+"""
+from datetime import datetime, timedelta
+import zlib
+
+from croniter import croniter
+
+__all__ = ["Admission", "ScheduledTask", "WaitStats", "cron_expression", "path_pool", "task_due", "upcoming"]
+
+# Start of a task is spread over this many seconds after its scheduled minute
+JITTER = 300
+# Runs of a single task listed by `upcoming`, a task scheduled every minute would otherwise flood the plan
+MAX_RUNS = 1440
+
+
+class ScheduledTask:
+    def __init__(self, kind, id, description, schedule, pools, weight, background=False):
+        self.kind = kind
+        self.id = id
+        self.description = description
+        # Cron schedule, None for tasks only started by `submit` (e.g. replication after periodic snapshots)
+        self.schedule = schedule
+        self.pools = set(pools)
+        self.weight = weight
+        # Runs in background once started (e.g. a scrub), it only uses the budget of its pools and not a slot of the
+        # global concurrency as it can take days
+        self.background = background
+
+    def __repr__(self):
+        return f"<ScheduledTask {self.key}>"
+
+    @property
+    def key(self):
+        return f"{self.kind}:{self.id}"
+
+    @property
+    def jitter(self):
+        return zlib.crc32(self.key.encode("utf-8")) % JITTER
+
+
+def cron_expression(schedule):
+    return " ".join(schedule.get(field) or "*" for field in ("minute", "hour", "dom", "month", "dow"))
+
+
+def path_pool(path):
+    """
+    Pool of a `/mnt/<pool>/...` path, None for other paths.
+    """
+    parts = (path or "").split("/")
+    if len(parts) >= 3 and parts[0] == "" and parts[1] == "mnt" and parts[2]:
+        return parts[2]
+    return None
+
+
+def task_due(task, minute):
+    """
+    Whether `task` is scheduled at `minute` (a datetime with no seconds).
+    """
+    if task.schedule is None:
+        return False
+
+    return croniter(cron_expression(task.schedule), minute - timedelta(seconds=1)).get_next(datetime) == minute
+
+
+def upcoming(tasks, start, end):
+    """
+    (time, task) of every run of `tasks` after `start` up to `end`, jitter included, in time order.
+    """
+    runs = []
+    for task in tasks:
+        if task.schedule is None:
+            continue
+
+        jitter = timedelta(seconds=task.jitter)
+        it = croniter(cron_expression(task.schedule), start - jitter)
+        for _ in range(MAX_RUNS):
+            at = it.get_next(datetime) + jitter
+            if at > end:
+                break
+            runs.append((at, task))
+
+    return sorted(runs, key=lambda run: (run[0], run[1].key))
+
+
+class Admission:
+    """
+    Global concurrency and per-pool I/O budgets. A task uses `weight` of the budget of each of its pools, a task
+    heavier than a pool budget runs alone on that pool. Background tasks only use the budget of their pools.
+    """
+
+    def __init__(self, concurrency, pool_budget, budgets=None):
+        self.concurrency = concurrency
+        self.pool_budget = pool_budget
+        self.budgets = budgets or {}
+        self.running = set()
+        # {pool: used budget}
+        self.usage = {}
+
+    def budget(self, pool):
+        return self.budgets.get(pool, self.pool_budget)
+
+    def admits(self, task):
+        if not task.background and len(self.running) >= self.concurrency:
+            return False
+
+        return all(
+            self.usage.get(pool, 0) + min(task.weight, self.budget(pool)) <= self.budget(pool)
+            for pool in task.pools
+        )
+
+    def start(self, task):
+        if not task.background:
+            self.running.add(task.key)
+        for pool in task.pools:
+            self.usage[pool] = self.usage.get(pool, 0) + min(task.weight, self.budget(pool))
+
+    def finish(self, task):
+        self.running.discard(task.key)
+        for pool in task.pools:
+            self.usage[pool] -= min(task.weight, self.budget(pool))
+            if self.usage[pool] <= 0:
+                del self.usage[pool]
+
+    def select(self, queue):
+        """
+        Admit tasks of `queue` in order, tasks blocked by a busy pool do not hold back tasks of other pools.
+        Returns the admitted tasks.
+        """
+        admitted = []
+        for task in queue:
+            if self.admits(task):
+                self.start(task)
+                admitted.append(task)
+        return admitted
+
+
+class WaitStats:
+    """
+    Time tasks spent queued before they were admitted, by kind.
+    """
+
+    def __init__(self):
+        self.kinds = {}
+
+    def record(self, kind, seconds):
+        stats = self.kinds.setdefault(kind, {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0})
+        stats["count"] += 1
+        stats["total"] += seconds
+        stats["max"] = max(stats["max"], seconds)
+        stats["last"] = seconds
+
+    def report(self):
+        return {
+            kind: dict(stats, average=stats["total"] / stats["count"])
+            for kind, stats in self.kinds.items()
+        }
@@ -0,0 +1,117 @@
+"""
+Downsampling and aggregation of time series for reporting.
+
+Series are lists of floats where unknown values are NaN, sampled at the same timestamps.
+"""
+import array
+import base64
+import math
+import sys
+
+__all__ = ["aggregate", "bucket", "lttb", "encode"]
+
+NAN = float("nan")
+
+
+def _known(values):
+    return [v for v in values if not math.isnan(v)]
+
+
+def percentile(values, p):
+    """
+    `p`th percentile of sorted `values`, interpolated linearly between closest ranks.
+    """
+    k = (len(values) - 1) * p / 100
+    f = math.floor(k)
+    c = math.ceil(k)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def aggregate(columns, method, p=95):
+    """
+    Combine `columns` into a single series with `method` (SUM, AVERAGE, MIN, MAX or PERCENTILE)
+    applied at each timestamp. Unknown values are ignored, timestamps without any known value stay unknown.
+    """
+    result = []
+    for values in zip(*columns):
+        values = _known(values)
+        if not values:
+            result.append(NAN)
+        elif method == "SUM":
+            result.append(sum(values))
+        elif method == "AVERAGE":
+            result.append(sum(values) / len(values))
+        elif method == "MIN":
+            result.append(min(values))
+        elif method == "MAX":
+            result.append(max(values))
+        elif method == "PERCENTILE":
+            result.append(percentile(sorted(values), p))
+        else:
+            raise ValueError(f"Invalid aggregation method {method!r}")
+    return result
+
+
+def bucket(values, points):
+    """
+    Split `values` in at most `points` consecutive buckets of equal size.
+
+    Returns (size, [(average, min, max), ...]), unknown if a bucket has no known value.
+    """
+    size = max(1, int(math.ceil(len(values) / points)))
+    result = []
+    for i in range(0, len(values), size):
+        known = _known(values[i:i + size])
+        if known:
+            result.append((sum(known) / len(known), min(known), max(known)))
+        else:
+            result.append((NAN, NAN, NAN))
+    return size, result
+
+
+def lttb(timestamps, values, points):
+    """
+    Largest-Triangle-Three-Buckets downsampling of `values` to `points` points, keeping the shape of the
+    series (peaks and valleys) better than averaging. Unknown values are skipped.
+
+    Returns (timestamps, values).
+    """
+    data = [(t, v) for t, v in zip(timestamps, values) if not math.isnan(v)]
+    if points >= len(data) or points < 3:
+        return [t for t, v in data], [v for t, v in data]
+
+    sampled = [data[0]]
+    every = (len(data) - 2) / (points - 2)
+    a = 0
+    for i in range(points - 2):
+        # Average point of the next bucket
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, len(data))
+        avg = data[avg_start:avg_end]
+        avg_t = sum(t for t, v in avg) / len(avg)
+        avg_v = sum(v for t, v in avg) / len(avg)
+
+        # Point of this bucket forming the largest triangle with the previous point and the next average
+        t_a, v_a = data[a]
+        max_area = -1
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            t, v = data[j]
+            area = abs((t_a - avg_t) * (v - v_a) - (t_a - t) * (avg_v - v_a))
+            if area > max_area:
+                max_area = area
+                next_a = j
+        sampled.append(data[next_a])
+        a = next_a
+    sampled.append(data[-1])
+
+    return [t for t, v in sampled], [v for t, v in sampled]
+
+
+def encode(values, typecode="f"):
+    """
+    Base64 of `values` packed as little endian `typecode` (float32 by default), NaN for unknown values.
+    """
+    packed = array.array(typecode, values)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return base64.b64encode(packed.tobytes()).decode("ascii")